@@ -0,0 +1,222 @@
+""" Signals used by the culler to decide whether a user's server is really idle.
+
+    The hub's last_activity only reflects browser traffic: a user running a long job with the browser closed looks
+    idle, and a user who left a tab open on an idle kernel looks active. The ActivityCollector gathers two other
+    signals for every tracked worker: kernel execution state and last activity from the worker agents, and host CPU
+    utilization from CloudWatch (one GetMetricData call covers up to 500 instances). Both are fetched concurrently
+    and cached, so a cull pass over hundreds of servers only fetches what has expired. IdlePolicy turns the signals
+    into a decision. """
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import boto3
+from botocore.exceptions import ClientError
+from dateutil.parser import parse as parse_date
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from models import Server
+from ttl_cache import TTLCache
+from worker_agent import WorkerAgentError
+
+logger = logging.getLogger(__name__)
+
+DESCRIBE_FILTER_LIMIT = 200  # values per DescribeInstances filter
+METRIC_QUERY_LIMIT = 500  # queries per GetMetricData call
+
+
+def naive_utc(timestamp):
+    """ Parses an ISO 8601 timestamp (or passes through a datetime) and drops its timezone. """
+    if timestamp is None:
+        return None
+    if not isinstance(timestamp, datetime):
+        timestamp = parse_date(timestamp)
+    return timestamp.replace(tzinfo=None)
+
+
+class ActivityCollector(object):
+    """ Collects kernel activity and CPU utilization for users' running workers. """
+
+    def __init__(self, region, agent_clients=None, notebook_port=4444, cpu_window=3600, cpu_recent=900,
+                 cpu_period=300, cache_ttl=120, max_workers=10):
+        self.region = region
+        self.agent_clients = agent_clients
+        self.notebook_port = notebook_port
+        self.cpu_window = cpu_window
+        self.cpu_recent = cpu_recent
+        self.cpu_period = cpu_period
+        self.agent_cache = TTLCache(cache_ttl)
+        self.cpu_cache = TTLCache(cache_ttl)
+        self.executor = ThreadPoolExecutor(max_workers)
+
+    @gen.coroutine
+    def collect(self, user_names):
+        """ Returns {user name: {"instance_id", "instance_type", "kernels", "resources", "cpu", "cpu_peak"}} for users
+            with a running worker. "kernels" and "resources" are the agent's activity and resource reports. "cpu" is
+            the CPU utilization (percent) sustained over the last cpu_recent seconds, the lowest of its cpu_period
+            averages, and "cpu_peak" the highest average over the last cpu_window seconds. Each is None when it could
+            not be determined. """
+        workers = yield self.get_workers(user_names)
+        reports, cpu = yield [self.get_agent_reports(workers), self.get_cpu_utilization(workers)]
+        return {user_name: {"instance_id": worker["instance_id"],
+                            "instance_type": worker["instance_type"],
+                            "kernels": reports.get(user_name, {}).get("kernels"),
+                            "resources": reports.get(user_name, {}).get("resources"),
+                            "cpu": cpu.get(worker["instance_id"], (None, None))[0],
+                            "cpu_peak": cpu.get(worker["instance_id"], (None, None))[1]}
+                for user_name, worker in workers.items()}
+
+    @gen.coroutine
+    def get_workers(self, user_names):
+        """ Returns {user name: {"instance_id", "ip_address", "instance_type"}} for the users' running workers,
+            describing them in as few calls as possible instead of loading one instance per user. """
+        servers = {server.server_id: server.user_id
+                   for server in Server.select().where(Server.user_id.in_(list(user_names)))}
+        instance_ids = list(servers)
+        ec2 = boto3.client("ec2", region_name=self.region)
+        chunks = [instance_ids[i:i + DESCRIBE_FILTER_LIMIT] for i in range(0, len(instance_ids), DESCRIBE_FILTER_LIMIT)]
+        # run_in_executor, as gen.multi would run the callbacks of executor.submit() futures on the executor's threads
+        io_loop = IOLoop.current()
+        responses = yield [io_loop.run_in_executor(self.executor, self._describe_running, ec2, chunk)
+                           for chunk in chunks]
+        workers = {}
+        for instances in responses:
+            for instance in instances:
+                workers[servers[instance["InstanceId"]]] = {"instance_id": instance["InstanceId"],
+                                                            "ip_address": instance["PrivateIpAddress"],
+                                                            "instance_type": instance["InstanceType"]}
+        return workers
+
+    def _describe_running(self, ec2, instance_ids):
+        try:
+            response = ec2.describe_instances(Filters=[
+                {"Name": "instance-id", "Values": instance_ids},
+                {"Name": "instance-state-name", "Values": ["running"]},
+            ])
+        except ClientError as e:
+            logger.warning("could not describe workers: %s", e)
+            return []
+        return [instance for reservation in response["Reservations"] for instance in reservation["Instances"]]
+
+    @gen.coroutine
+    def get_agent_reports(self, workers):
+        """ Asks the worker agents for their kernels' activity and their resource usage, concurrently, for workers
+            not in the cache. Returns {user name: {"kernels", "resources"}}. """
+        if self.agent_clients is None:
+            return {}
+        reports = {}
+        requests = {}
+        for user_name, worker in workers.items():
+            cached = self.agent_cache.get((user_name, worker["instance_id"]))
+            if cached is not None:
+                reports[user_name] = cached
+            else:
+                agent = self.agent_clients.get(user_name, worker["ip_address"])
+                requests[user_name] = [
+                    agent.call("activity", port=self.notebook_port, ip=worker["ip_address"], timeout=10),
+                    agent.call("resources", timeout=10),
+                ]
+        for user_name, request in requests.items():
+            try:
+                kernels, resources = yield request
+            except WorkerAgentError as e:
+                logger.warning("could not get activity for %s from its worker agent: %s", user_name, e)
+                continue
+            reports[user_name] = {"kernels": kernels, "resources": resources}
+            self.agent_cache.set((user_name, workers[user_name]["instance_id"]), reports[user_name])
+        return reports
+
+    @gen.coroutine
+    def get_cpu_utilization(self, workers):
+        """ Returns {instance id: (sustained, peak CPU utilization)} from CloudWatch, with one GetMetricData call per
+            500 instances not in the cache. Instances without datapoints (e.g. just started) are left out, and the
+            sustained utilization is None for instances without datapoints in the last cpu_recent seconds. """
+        utilization = {}
+        missing = []
+        for instance_id in [worker["instance_id"] for worker in workers.values()]:
+            cached = self.cpu_cache.get(instance_id)
+            if cached is not None:
+                utilization[instance_id] = cached
+            else:
+                missing.append(instance_id)
+        chunks = [missing[i:i + METRIC_QUERY_LIMIT] for i in range(0, len(missing), METRIC_QUERY_LIMIT)]
+        io_loop = IOLoop.current()
+        results = yield [io_loop.run_in_executor(self.executor, self._get_metric_data, chunk) for chunk in chunks]
+        for result in results:
+            for instance_id, value in result.items():
+                self.cpu_cache.set(instance_id, value)
+                utilization[instance_id] = value
+        return utilization
+
+    def _get_metric_data(self, instance_ids):
+        cloudwatch = boto3.client("cloudwatch", region_name=self.region)
+        queries = [{
+            "Id": "cpu%d" % index,
+            "MetricStat": {
+                "Metric": {"Namespace": "AWS/EC2", "MetricName": "CPUUtilization",
+                           "Dimensions": [{"Name": "InstanceId", "Value": instance_id}]},
+                "Period": self.cpu_period,
+                "Stat": "Average",
+            },
+            "ReturnData": True,
+        } for index, instance_id in enumerate(instance_ids)]
+        end_time = datetime.utcnow()
+        kwargs = {"MetricDataQueries": queries, "StartTime": end_time - timedelta(seconds=self.cpu_window),
+                  "EndTime": end_time}
+        values = {}
+        try:
+            while True:
+                response = cloudwatch.get_metric_data(**kwargs)
+                for result in response["MetricDataResults"]:
+                    values.setdefault(result["Id"], []).extend(zip(result["Timestamps"], result["Values"]))
+                if not response.get("NextToken"):
+                    break
+                kwargs["NextToken"] = response["NextToken"]
+        except ClientError as e:
+            logger.warning("could not get CPU utilization from CloudWatch: %s", e)
+        recent = end_time - timedelta(seconds=self.cpu_recent)
+        utilization = {}
+        for query_id, datapoints in values.items():
+            if datapoints:
+                # a period counts as recent if it ends within the recent window
+                sustained = [value for timestamp, value in datapoints
+                             if naive_utc(timestamp) + timedelta(seconds=self.cpu_period) > recent]
+                utilization[instance_ids[int(query_id[3:])]] = (min(sustained) if sustained else None,
+                                                                max(value for _, value in datapoints))
+        return utilization
+
+
+class IdlePolicy(object):
+    """ Decides whether a server is idle from the hub's last activity and the collected signals:
+        - a busy kernel, or CPU utilization sustained at or above cpu_threshold percent, always keeps a server;
+        - otherwise, recent kernel activity keeps it, e.g. a job running with the browser closed;
+        - and so does the hub's last activity, as it always has: a user who edits, saves or browses without running
+          anything is not idle. A server is only culled once both are older than the timeout. """
+
+    def __init__(self, timeout, cpu_threshold=5.0):
+        self.timeout = timeout
+        self.cpu_threshold = cpu_threshold
+
+    def should_cull(self, hub_last_activity, activity=None, now=None):
+        """ Returns (should_cull, reason). """
+        cull_limit = (now or datetime.utcnow()) - timedelta(seconds=self.timeout)
+        hub_last_activity = naive_utc(hub_last_activity)
+        activity = activity or {}
+        kernels = (activity.get("kernels") or {}).get("kernels")
+        cpu = activity.get("cpu")
+        if kernels and any(kernel["execution_state"] == "busy" for kernel in kernels):
+            return False, "a kernel is busy"
+        if cpu is not None and cpu >= self.cpu_threshold:
+            return False, "CPU utilization is %.1f%%" % cpu
+        kernel_last_activity = None
+        if kernels:
+            kernel_last_activity = naive_utc(activity["kernels"]["last_activity"])
+            if kernel_last_activity is not None and kernel_last_activity >= cull_limit:
+                return False, "kernels active since %s" % kernel_last_activity
+        if hub_last_activity is not None and hub_last_activity >= cull_limit:
+            return False, "active since %s" % hub_last_activity
+        if kernels:
+            return True, "inactive since %s, kernels idle since %s" % (hub_last_activity, kernel_last_activity)
+        return True, "inactive since %s" % hub_last_activity
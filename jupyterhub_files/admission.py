@@ -0,0 +1,116 @@
+""" Admission control for spawns.
+
+    A class-wide login used to start hundreds of spawns at once, all competing for the spawner's threads and for the
+    EC2 API rate limits, and many of them timed out together. The AdmissionController splits a spawn into phases
+    (launching or starting the instance, waiting for it to boot, starting the notebook) and lets only a bounded number
+    of spawns into each phase at a time. Spawns waiting for a phase are queued first come, first served, and their
+    position in the queue can be shown to the user. """
+
+import time
+from collections import deque
+
+from tornado import gen
+from tornado.concurrent import Future
+
+LAUNCH = "launch"
+BOOT = "boot"
+NOTEBOOK = "notebook"
+
+
+class AdmissionCancelled(Exception):
+    pass
+
+
+class Admission(object):
+    """ A spawn's place in a phase, released when used as a context manager exits. """
+
+    def __init__(self, phase, user_name):
+        self.phase = phase
+        self.user_name = user_name
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.phase.release(self.user_name)
+
+
+class Phase(object):
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.active = set()  # user names
+        self.waiting = deque()  # (user name, Future, time queued)
+        self.admitted = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @gen.coroutine
+    def enter(self, user_name):
+        """ Waits for a free slot, in FIFO order. Use as `with (yield phase.enter(user_name)):`. """
+        if len(self.active) < self.limit and not self.waiting:
+            self._admit(user_name, 0.0)
+        else:
+            entry = (user_name, Future(), time.time())
+            self.waiting.append(entry)
+            yield entry[1]
+        return Admission(self, user_name)
+
+    def release(self, user_name):
+        self.active.discard(user_name)
+        while self.waiting and len(self.active) < self.limit:
+            user, future, queued = self.waiting.popleft()
+            if not future.done():
+                self._admit(user, time.time() - queued)
+                future.set_result(None)
+
+    def cancel(self, user_name):
+        """ Removes user_name from the queue; their waiting spawn raises AdmissionCancelled. """
+        for entry in [entry for entry in self.waiting if entry[0] == user_name]:
+            self.waiting.remove(entry)
+            if not entry[1].done():
+                entry[1].set_exception(AdmissionCancelled("spawn of %s was cancelled" % user_name))
+
+    def position(self, user_name):
+        """ user_name's 1-based position in the queue, 0 if admitted, or None. """
+        if user_name in self.active:
+            return 0
+        for index, entry in enumerate(self.waiting):
+            if entry[0] == user_name:
+                return index + 1
+        return None
+
+    def _admit(self, user_name, waited):
+        self.active.add(user_name)
+        self.admitted += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+
+class AdmissionController(object):
+
+    def __init__(self, limits):
+        """ limits maps each phase (LAUNCH, BOOT, NOTEBOOK) to the number of spawns allowed in it at once. """
+        self.phases = {name: Phase(name, limit) for name, limit in limits.items()}
+
+    def enter(self, phase, user_name):
+        return self.phases[phase].enter(user_name)
+
+    def cancel(self, user_name):
+        for phase in self.phases.values():
+            phase.cancel(user_name)
+
+    def status(self, user_name):
+        """ Returns (phase, position) for a spawn that is queued for or admitted to a phase, or (None, None). """
+        for name, phase in self.phases.items():
+            position = phase.position(user_name)
+            if position is not None:
+                return name, position
+        return None, None
+
+    def metrics(self):
+        return {name: {"limit": phase.limit, "active": len(phase.active), "waiting": len(phase.waiting),
+                       "admitted": phase.admitted, "max_wait": round(phase.max_wait, 1),
+                       "average_wait": round(phase.total_wait / phase.admitted, 1) if phase.admitted else 0.0}
+                for name, phase in sorted(self.phases.items())}
@@ -0,0 +1,46 @@
+""" configurable-http-proxy with batched route changes, the hub's proxy_class (see jupyterhub_config.py).
+
+    Route additions and deletions go through a RouteBatcher (see route_batcher.py), and concurrent reads of the
+    routing table share a single request. `python3 proxy_benchmark.py` measures what this saves, and how the proxy
+    behaves with thousands of routes and websocket sessions. """
+
+from tornado import gen
+from traitlets import Float, Integer
+
+from jupyterhub.proxy import ConfigurableHTTPProxy
+
+import cluster_metrics
+from route_batcher import RouteBatcher, ADD
+
+
+class BatchedConfigurableHTTPProxy(ConfigurableHTTPProxy):
+
+    batch_window = Float(0.05, config=True, help="Seconds to collect route changes for before applying them")
+    batch_concurrency = Integer(10, config=True, help="Route changes sent to the proxy's API at a time")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batcher = RouteBatcher(self._apply_change, window=self.batch_window,
+                                    concurrency=self.batch_concurrency)
+        self._routes_request = None
+        cluster_metrics.register("proxy_routes", self.batcher.metrics)
+
+    @gen.coroutine
+    def _apply_change(self, operation, routespec, target, data):
+        if operation == ADD:
+            yield super().add_route(routespec, target, data)
+        else:
+            yield super().delete_route(routespec)
+
+    def add_route(self, routespec, target, data):
+        return self.batcher.add(routespec, target, data)
+
+    def delete_route(self, routespec):
+        return self.batcher.delete(routespec)
+
+    async def get_all_routes(self, client=None):
+        """ Callers that ask while a read of the table is in flight get its result. """
+        if self._routes_request is None:
+            self._routes_request = gen.convert_yielded(super().get_all_routes(client))
+            self._routes_request.add_done_callback(lambda _: setattr(self, "_routes_request", None))
+        return await self._routes_request
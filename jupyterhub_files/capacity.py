@@ -0,0 +1,318 @@
+""" Quota- and capacity-aware admission of worker launches.
+
+    create_new_instance() used to call RunInstances blindly: once the account's vCPU quota or the worker subnets' free
+    IP addresses ran out, every spawn still went through its retries and a full start_timeout before failing, so a
+    class-wide login turned into hundreds of slow failures. The CapacityPlanner keeps an estimate of the headroom left.
+    It periodically reads the EC2 vCPU quotas (Service Quotas), the account's vCPU usage (the AWS/Usage CloudWatch
+    metrics, which also count instances that are not this cluster's), the cluster's own workers (the tracking database
+    and the instance state cache) and the subnets' free addresses, and adds the launches and starts in flight since.
+    A spawn that does not fit waits a short while for capacity to free up and is then rejected right away, instead of
+    failing at EC2.
+
+    The limits are only as fresh as the last refresh, so EC2 remains the final judge; the planner only keeps spawns
+    from trying when it already knows they cannot succeed. A quota that cannot be read (e.g. the manager's role lacks
+    servicequotas:GetServiceQuota) is treated as unlimited. """
+
+import logging
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+from tornado import gen
+from tornado.ioloop import PeriodicCallback
+from tornado.locks import Condition
+
+from models import Server, SharedWorker
+
+logger = logging.getLogger(__name__)
+
+# EC2 vCPU quotas are per instance family class and market; the families not listed here are "Standard"
+FAMILY_CLASSES = {"g": "G", "vt": "G", "p": "P", "x": "X", "f": "F", "inf": "Inf"}
+QUOTA_CODES = {
+    ("Standard", "on-demand"): "L-1216C47A", ("G", "on-demand"): "L-DB2E81BA", ("P", "on-demand"): "L-417A185B",
+    ("X", "on-demand"): "L-7295265B", ("F", "on-demand"): "L-74FC7D96", ("Inf", "on-demand"): "L-1945791B",
+    ("Standard", "spot"): "L-34B43A08", ("G", "spot"): "L-3819A6DF", ("P", "spot"): "L-7212CCBC",
+    ("X", "spot"): "L-E3A00192", ("F", "spot"): "L-88CF9481", ("Inf", "spot"): "L-B5D1601B",
+}
+USAGE_MARKETS = {"on-demand": "OnDemand", "spot": "Spot"}  # as in the Class dimension of the AWS/Usage metrics
+USAGE_WINDOW = 900  # seconds of AWS/Usage data points to look at, the metric is published every few minutes
+DESCRIBE_FILTER_LIMIT = 200  # instance types per DescribeInstanceTypes call
+
+
+class CapacityExhausted(Exception):
+    pass
+
+
+def quota_class(instance_type):
+    """ The vCPU quota class of an instance type, e.g. "Standard" for m5.large and "G" for g4dn.xlarge. """
+    family = re.match(r"[a-z]+", instance_type).group(0)
+    return FAMILY_CLASSES.get(family, "Standard")
+
+
+def quota_limit(quotas, key):
+    """ The vCPU limit of a (quota class, market), or None if it is unknown. """
+    code = QUOTA_CODES.get(key)
+    if code is None:
+        return None
+    try:
+        return quotas.get_service_quota(ServiceCode="ec2", QuotaCode=code)["Quota"]["Value"]
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "NoSuchResourceException":
+            raise
+        # quotas that were never changed are only listed with their defaults
+        return quotas.get_aws_default_service_quota(ServiceCode="ec2", QuotaCode=code)["Quota"]["Value"]
+
+
+def account_usage(cloudwatch, keys):
+    """ Returns {(quota class, market): vCPUs the account ran at the latest AWS/Usage data point} for keys. """
+    queries = [{"Id": "usage%d" % index, "ReturnData": True,
+                "MetricStat": {"Period": 60, "Stat": "Maximum", "Metric": {
+                    "Namespace": "AWS/Usage", "MetricName": "ResourceCount",
+                    "Dimensions": [{"Name": "Service", "Value": "EC2"}, {"Name": "Type", "Value": "Resource"},
+                                   {"Name": "Resource", "Value": "vCPU"},
+                                   {"Name": "Class", "Value": "%s/%s" % (key[0], USAGE_MARKETS[key[1]])}]}}}
+               for index, key in enumerate(keys)]
+    now = datetime.utcnow()
+    results = cloudwatch.get_metric_data(MetricDataQueries=queries, StartTime=now - timedelta(seconds=USAGE_WINDOW),
+                                         EndTime=now, ScanBy="TimestampDescending")["MetricDataResults"]
+    usage = {}
+    for result in results:
+        if result["Values"]:
+            usage[keys[int(result["Id"][len("usage"):])]] = result["Values"][0]
+    return usage
+
+
+class Reservation(object):
+    """ The vCPUs (and the address) of a launch or start in flight, counted against the headroom until a refresh
+        sees the instance. Used as a context manager, it is released when the launch call is done. """
+
+    def __init__(self, planner, user_name, key, vcpus, addresses, markets):
+        self.planner = planner
+        self.user_name = user_name
+        self.key = key  # (quota class, market)
+        self.vcpus = vcpus
+        self.addresses = addresses
+        self.markets = markets  # the markets the spawn may launch in, those without headroom left out
+        self.released_at = None
+
+    @property
+    def market(self):
+        return self.key[1]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.released_at = time.time()
+
+
+class CapacityPlanner(object):
+
+    def __init__(self, region, subnet_ids, instance_states, interval=60, queue_timeout=60, vcpu_margin=0,
+                 address_margin=0, settle=30, max_workers=2):
+        """ Launches wait at most queue_timeout seconds for headroom. vcpu_margin vCPUs and address_margin addresses
+            are kept free, e.g. for other users of the account. A released reservation is still counted until a
+            refresh that started settle seconds after it, so that DescribeInstances knows about its instance. """
+        self.region = region
+        self.subnet_ids = subnet_ids
+        self.instance_states = instance_states
+        self.interval = interval
+        self.queue_timeout = queue_timeout
+        self.vcpu_margin = vcpu_margin
+        self.address_margin = address_margin
+        self.settle = settle
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.keys = {("Standard", "on-demand")}  # the (quota class, market) pairs spawns have asked for
+        self.vcpus = {}  # instance type: vCPUs
+        self.limits = {}  # (quota class, market): vCPUs, absent when unknown
+        self.account_usage = {}  # (quota class, market): vCPUs
+        self.cluster_usage = {}  # (quota class, market): vCPUs
+        self.free_addresses = {}  # subnet id: free IP addresses
+        self.reservations = []
+        self.refreshed_at = None
+        self.refresh_errors = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.waiting = deque()  # user names, first come first served
+        self._refreshed = Condition()
+        self._refreshing = None
+        self._periodic_callback = None
+
+    def start(self):
+        """ Starts the periodic refreshes on the current IOLoop; calling it again is a no-op. """
+        if self._periodic_callback is None:
+            self._periodic_callback = PeriodicCallback(self.refresh, 1e3 * self.interval)
+            self._periodic_callback.start()
+
+    def stop(self):
+        if self._periodic_callback is not None:
+            self._periodic_callback.stop()
+            self._periodic_callback = None
+
+    def refresh(self):
+        """ Reads the quotas, usage and free addresses again. Concurrent calls share one refresh. """
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = self._refresh()
+        return self._refreshing
+
+    @gen.coroutine
+    def _refresh(self):
+        started = time.time()
+        try:
+            instance_ids = [server.server_id for server in Server.select()]
+            instance_ids += [worker.instance_id for worker in SharedWorker.select() if worker.instance_id]
+            descriptions = yield self.instance_states.get(instance_ids)
+            running = [description for description in descriptions.values()
+                       if description["State"]["Name"] in ("pending", "running")]
+            keys = sorted(self.keys)
+            limits, usage, free_addresses = yield self.executor.submit(
+                self._read, keys, [description["InstanceType"] for description in running])
+        except (ClientError, BotoCoreError) as e:
+            self.refresh_errors += 1
+            logger.warning("Could not refresh the worker capacity: %s", e)
+            return
+        cluster_usage = {}
+        for description in running:
+            key = (quota_class(description["InstanceType"]),
+                   "spot" if description.get("InstanceLifecycle") == "spot" else "on-demand")
+            cluster_usage[key] = cluster_usage.get(key, 0) + self.vcpus.get(description["InstanceType"], 0)
+        self.limits, self.account_usage, self.cluster_usage = limits, usage, cluster_usage
+        self.free_addresses = free_addresses
+        self.reservations = [reservation for reservation in self.reservations
+                             if reservation.released_at is None or reservation.released_at > started - self.settle]
+        self.refreshed_at = time.time()
+        self._refreshed.notify_all()
+
+    def _read(self, keys, instance_types):
+        """ Runs in the executor: returns (limits, account usage, free addresses) and learns the vCPUs of
+            instance_types. """
+        ec2 = boto3.client("ec2", region_name=self.region)
+        self._learn_vcpus(ec2, instance_types)
+        limits = {}
+        quotas = boto3.client("service-quotas", region_name=self.region)
+        for key in keys:
+            try:
+                limit = quota_limit(quotas, key)
+            except ClientError as e:
+                logger.info("Could not read the %s %s vCPU quota, treating it as unlimited: %s", key[1], key[0], e)
+                continue
+            if limit is not None:
+                limits[key] = limit
+        try:
+            usage = account_usage(boto3.client("cloudwatch", region_name=self.region), keys)
+        except ClientError as e:
+            logger.info("Could not read the account's vCPU usage, counting the cluster's workers only: %s", e)
+            usage = {}
+        subnets = ec2.describe_subnets(SubnetIds=self.subnet_ids)["Subnets"]
+        free_addresses = {subnet["SubnetId"]: subnet["AvailableIpAddressCount"] for subnet in subnets}
+        return limits, usage, free_addresses
+
+    def _learn_vcpus(self, ec2, instance_types):
+        unknown = sorted(set(instance_types) - set(self.vcpus))
+        for start in range(0, len(unknown), DESCRIBE_FILTER_LIMIT):
+            described = ec2.describe_instance_types(InstanceTypes=unknown[start:start + DESCRIBE_FILTER_LIMIT])
+            for description in described["InstanceTypes"]:
+                self.vcpus[description["InstanceType"]] = description["VCpuInfo"]["DefaultVCpus"]
+
+    def headroom(self, key):
+        """ vCPUs of (quota class, market) that can still be launched, or None if the quota is unknown. """
+        if key not in self.limits:
+            return None
+        used = max(self.account_usage.get(key, 0), self.cluster_usage.get(key, 0))
+        in_flight = sum(reservation.vcpus for reservation in self.reservations if reservation.key == key)
+        return self.limits[key] - used - in_flight - self.vcpu_margin
+
+    def address_headroom(self):
+        """ IP addresses left in the worker subnets for new instances, or None before the first refresh. """
+        if not self.free_addresses:
+            return None
+        in_flight = sum(reservation.addresses for reservation in self.reservations)
+        return sum(self.free_addresses.values()) - in_flight - self.address_margin
+
+    def has_addresses(self, subnet_id):
+        """ False if subnet_id had no free address at the last refresh. """
+        return self.free_addresses.get(subnet_id) != 0
+
+    @gen.coroutine
+    def reserve(self, user_name, instance_types, markets=("on-demand",), new_instance=True):
+        """ Reserves the vCPUs of the largest of instance_types, in the first of markets with headroom for them, and
+            an IP address if new_instance. Waits up to queue_timeout for headroom, then raises CapacityExhausted.
+            Use as `with (yield planner.reserve(...)) as reservation:`. """
+        self.start()
+        unknown = [instance_type for instance_type in instance_types if instance_type not in self.vcpus]
+        if unknown:
+            yield self.executor.submit(self._learn_vcpus, boto3.client("ec2", region_name=self.region), unknown)
+        vcpus = max(self.vcpus[instance_type] for instance_type in instance_types)
+        family = quota_class(instance_types[0])
+        keys = [(family, market) for market in markets]
+        if not self.keys.issuperset(keys) or self.refreshed_at is None:
+            self.keys.update(keys)
+            yield self.refresh()
+        deadline = time.time() + self.queue_timeout
+        if self.waiting:
+            self.queued += 1
+            reservation = None  # others were first
+        else:
+            reservation = self._try_reserve(user_name, keys, vcpus, new_instance)
+            if reservation is None:
+                self.queued += 1
+        if reservation is None:
+            self.waiting.append(user_name)
+            try:
+                while reservation is None:
+                    if time.time() >= deadline:
+                        self.rejected += 1
+                        raise CapacityExhausted(self._explain(keys, vcpus, new_instance))
+                    if self.refreshed_at is None or self.refreshed_at < time.time() - self.interval / 4:
+                        self.refresh()  # capacity may have been freed since, do not wait for the periodic refresh
+                    yield self._refreshed.wait(timeout=timedelta(seconds=deadline - time.time()))
+                    if self.waiting[0] == user_name:
+                        reservation = self._try_reserve(user_name, keys, vcpus, new_instance)
+            finally:
+                self.waiting.remove(user_name)
+                self._refreshed.notify_all()  # the next in line may fit
+        self.admitted += 1
+        return reservation
+
+    def _try_reserve(self, user_name, keys, vcpus, new_instance):
+        address_headroom = self.address_headroom()
+        if new_instance and address_headroom is not None and address_headroom < 1:
+            return None
+        for index, key in enumerate(keys):
+            headroom = self.headroom(key)
+            if headroom is None or headroom >= vcpus:
+                reservation = Reservation(self, user_name, key, vcpus, 1 if new_instance else 0,
+                                          [market for _, market in keys[index:]])
+                self.reservations.append(reservation)
+                return reservation
+        return None
+
+    def _explain(self, keys, vcpus, new_instance):
+        address_headroom = self.address_headroom()
+        if new_instance and address_headroom is not None and address_headroom < 1:
+            return "the worker subnets have no free IP addresses left"
+        return "the %s vCPU quota has %s vCPUs left, %d are needed" % (
+            " and ".join("%s %s" % (market, family) for family, market in keys),
+            " and ".join(str(self.headroom(key)) for key in keys), vcpus)
+
+    def metrics(self):
+        return {
+            "vcpus": {"%s/%s" % key: {"limit": self.limits.get(key), "account_usage": self.account_usage.get(key, 0),
+                                      "cluster_usage": self.cluster_usage.get(key, 0), "headroom": self.headroom(key),
+                                      "in_flight": sum(reservation.vcpus for reservation in self.reservations
+                                                       if reservation.key == key)}
+                      for key in sorted(self.keys)},
+            "free_addresses": dict(self.free_addresses),
+            "address_headroom": self.address_headroom(),
+            "waiting": len(self.waiting),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "refresh_errors": self.refresh_errors,
+            "refreshed_seconds_ago": round(time.time() - self.refreshed_at, 1) if self.refreshed_at else None,
+        }
@@ -0,0 +1,24 @@
+""" Metrics about the cluster's own machinery (e.g. worker placement), served to admins as JSON by the hub at
+    /hub/api/cluster/metrics. Modules register a function returning a JSON-serializable dict under a name. """
+
+import json
+
+from jupyterhub.apihandlers.base import APIHandler
+from jupyterhub.utils import admin_only
+
+providers = {}
+
+
+def register(name, provider):
+    providers[name] = provider
+
+
+def collect():
+    return {name: provider() for name, provider in sorted(providers.items())}
+
+
+class ClusterMetricsHandler(APIHandler):
+
+    @admin_only
+    def get(self):
+        self.write(json.dumps(collect()))
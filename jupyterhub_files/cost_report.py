@@ -0,0 +1,138 @@
+#!/usr/bin/python3 python3
+""" Instance-hours and estimated cost of the workers, from the event log written by the spawner and the culler.
+
+    `aggregate` (run hourly from cron) reads the events recorded since its last run and adds the instance-hours of
+    every worker, split by day, to the UsageRollup table. A worker that is still running is counted up to now and
+    carried over to the next run, so each run only reads new events. Hours are priced with instance_prices.json, or
+    with the Spot price recorded at launch for Spot workers. EBS storage and the manager are not included, see
+    Documentation/cost_analysis for those.
+
+    `export` prints the rollups for dashboards, one row per day, user, group, instance type and market, as CSV or JSON
+    lines; `summary` prints totals by user, group or day.
+
+    Usage: python3 cost_report.py aggregate
+           python3 cost_report.py export [--days 30] [--format csv|json]
+           python3 cost_report.py summary [--days 30] [--by user|group|day] """
+
+import argparse
+import csv
+import json
+import sys
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+sys.path.insert(1, '/etc/jupyterhub')
+from models import DB, InstanceEvent, UsageRollup, JobState, SpotUsage, Lease
+from instance_profiles import read_userlist
+from event_log import SPAWN, START
+from leader import LeaderElection
+
+with open("/etc/jupyterhub/instance_prices.json", "r") as f:
+    ON_DEMAND_PRICES = json.load(f)
+
+JOB_NAME = "cost_aggregation"
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def split_by_day(start, end):
+    """ Yields (day, hours) for the interval [start, end). """
+    while start < end:
+        next_day = datetime.combine(start.date() + timedelta(days=1), datetime.min.time())
+        until = min(end, next_day)
+        yield start.date(), (until - start).total_seconds() / 3600
+        start = until
+
+
+def hourly_price(instance_id, instance_type, market):
+    if market == "spot":
+        usage = SpotUsage.get_or_none(SpotUsage.instance_id == instance_id)
+        if usage is not None and usage.spot_price is not None:
+            return usage.spot_price
+    return ON_DEMAND_PRICES.get(instance_type) or 0.0
+
+
+def add_hours(totals, interval, end):
+    """ Adds the hours of an open interval up to end to totals, keyed by (day, user, instance type, market). """
+    start = datetime.strptime(interval["since"], TIME_FORMAT)
+    for day, hours in split_by_day(start, end):
+        key = (day, interval["user_id"], interval["instance_type"] or "unknown", interval["market"] or "on-demand")
+        totals[key][0] += hours
+        totals[key][1] += hours * interval["price"]
+
+
+def aggregate(now=None):
+    """ Processes the events recorded since the last run. Returns the number of events processed. """
+    now = now or datetime.now()
+    state = JobState.load(JOB_NAME, {"last_event_id": 0, "open": {}})
+    intervals = state["open"]  # instance id: {"user_id", "instance_type", "market", "price", "since"}
+    totals = defaultdict(lambda: [0.0, 0.0])
+    events = list(InstanceEvent.select().where(InstanceEvent.id > state["last_event_id"]).order_by(InstanceEvent.id))
+    for event in events:
+        interval = intervals.get(event.instance_id)
+        if event.event in [SPAWN, START]:
+            if interval is None:
+                intervals[event.instance_id] = {
+                    "user_id": event.user_id, "instance_type": event.instance_type, "market": event.market,
+                    "price": hourly_price(event.instance_id, event.instance_type, event.market),
+                    "since": event.occurred_at.strftime(TIME_FORMAT),
+                }
+        elif interval is not None:
+            # stop, cull and terminate all end the interval; the first one counts
+            add_hours(totals, interval, event.occurred_at)
+            del intervals[event.instance_id]
+    for interval in intervals.values():
+        add_hours(totals, interval, now)
+        interval["since"] = now.strftime(TIME_FORMAT)
+    with DB.atomic():
+        for (day, user_id, instance_type, market), (hours, cost) in totals.items():
+            UsageRollup.add(day, user_id, instance_type, market, hours, cost)
+        if events:
+            state["last_event_id"] = events[-1].id
+        JobState.save_state(JOB_NAME, state)
+    return len(events)
+
+
+def export_rows(days):
+    groups = {user: settings.get("group", "") for user, settings in read_userlist().items()}
+    since = (datetime.now() - timedelta(days=days)).date()
+    for rollup in UsageRollup.select().where(UsageRollup.day >= since).order_by(UsageRollup.day, UsageRollup.user_id):
+        yield {"day": rollup.day.isoformat(), "user": rollup.user_id, "group": groups.get(rollup.user_id, ""),
+               "instance_type": rollup.instance_type, "market": rollup.market,
+               "hours": round(rollup.hours, 3), "cost": round(rollup.cost, 4)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Computes and reports worker instance-hours and cost")
+    parser.add_argument("command", choices=["aggregate", "export", "summary"])
+    parser.add_argument("--days", type=int, default=30, help="how many days back to report")
+    parser.add_argument("--format", choices=["csv", "json"], default="csv", help="export format")
+    parser.add_argument("--by", choices=["user", "group", "day"], default="user", help="summary grouping")
+    args = parser.parse_args()
+
+    if args.command == "aggregate":
+        # managers sharing the tracking database all run this from cron, only one of them may aggregate at a time
+        election = LeaderElection(JOB_NAME, ttl=3000)
+        if not election.renew():
+            print("Another process is aggregating (%s)" % Lease.holder_of(JOB_NAME))
+            sys.exit(0)
+        try:
+            print("Processed %d events" % aggregate())
+        finally:
+            election.stop()
+    elif args.command == "export":
+        fields = ["day", "user", "group", "instance_type", "market", "hours", "cost"]
+        if args.format == "csv":
+            writer = csv.DictWriter(sys.stdout, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(export_rows(args.days))
+        else:
+            for row in export_rows(args.days):
+                print(json.dumps(row))
+    else:
+        totals = defaultdict(lambda: [0.0, 0.0])
+        for row in export_rows(args.days):
+            totals[row[args.by] or "-"][0] += row["hours"]
+            totals[row[args.by] or "-"][1] += row["cost"]
+        print("%-24s %10s %10s" % (args.by, "hours", "cost ($)"))
+        for key, (hours, cost) in sorted(totals.items()):
+            print("%-24s %10.1f %10.2f" % (key, hours, cost))
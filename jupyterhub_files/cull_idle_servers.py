@@ -14,11 +14,20 @@ import boto3
 import logging
 
 sys.path.insert(1, '/etc/jupyterhub')
-from models import Server
+from models import DB, Server, UtilizationSample, SpotUsage, SpawnClaim
+from worker_agent import AgentClientPool, DEFAULT_AGENT_PORT
+from activity import ActivityCollector, IdlePolicy
+from home_volumes import HomeVolumes, HomeVolumeError
+from instance_states import InstanceStateCache
+from stop_pipeline import StopPipeline, StopFailed
+from event_log import EventLog, CULL
+from structured_log import install as install_logging, summarize
+from leader import LeaderElection
+from tracing import tracer_from_config, no_key
 
 from dateutil.parser import parse as parse_date
 
-from botocore.exceptions import ClientError, WaiterError
+from botocore.exceptions import BotoCoreError, ClientError, WaiterError
 from concurrent.futures import ThreadPoolExecutor
 from tornado.gen import coroutine, sleep
 from tornado.log import app_log
@@ -35,6 +44,26 @@ logging.getLogger('botocore').setLevel(logging.ERROR)
 
 thread_pool = ThreadPoolExecutor(10)
 
+NOTEBOOK_SERVER_PORT = 4444
+PREWARM_TAG = "Prewarmed Until"  # set by fleet_admin.py prewarm
+# The worker agents report kernel activity, which the hub's last_activity does not see.
+agent_clients = None
+if SERVER_PARAMS.get("WORKER_AGENT_SECRET"):
+    agent_clients = AgentClientPool(SERVER_PARAMS["WORKER_AGENT_SECRET"],
+                                    SERVER_PARAMS.get("WORKER_AGENT_PORT", DEFAULT_AGENT_PORT))
+
+# Servers the culler stops itself are stopped in batches, see stop_pipeline.py.
+instance_states = InstanceStateCache(SERVER_PARAMS["REGION"])
+stop_pipeline = StopPipeline(SERVER_PARAMS["REGION"], instance_states)
+
+# cull events, for cost accounting (see cost_report.py)
+event_log = EventLog()
+
+# Home volumes are detached from the workers the culler stops, see home_volumes.py.
+home_volumes = None
+if SERVER_PARAMS["USER_HOME_EBS_SIZE"] > 0:
+    home_volumes = HomeVolumes(SERVER_PARAMS["REGION"], SERVER_PARAMS["USER_HOME_EBS_SIZE"])
+
 @coroutine
 def retry(function, *args, **kwargs):
     """ Retries a function up to max_retries, waiting `timeout` seconds between tries.
@@ -48,10 +77,10 @@ def retry(function, *args, **kwargs):
             ret = yield thread_pool.submit(function, *args, **kwargs)
             return ret
         except (ClientError, WaiterError) as e:
-            app_log.warn("encountered %s, waiting for %s seconds before retrying..." % (type(e), timeout) )
+            app_log.warning("encountered %s, waiting for %s seconds before retrying...", type(e), timeout)
             yield sleep(timeout)
     else:
-         print("Failure in %s with args %s and kwargs %s" % (function.__name__, args, kwargs))
+         app_log.error("Failure in %s with args %s and kwargs %s", function.__name__, summarize(args), summarize(kwargs))
          #raise e
 
 @coroutine
@@ -59,28 +88,75 @@ def manually_kill_server(user_name):
     # Get our AWS server db's instance for the user
     try:
         server = Server.get_server(user_name)
-        app_log.debug("Checking server for %s manually..." % user_name)
+        app_log.debug("Checking server for %s manually...", user_name)
     except Server.DoesNotExist:
         # it is not necessarily the case that a server will exist, we return early if that is the case.
-        app_log.warn("There is no matching, allocated server for user %s" % user_name)
+        app_log.warning("There is no matching, allocated server for user %s", user_name)
         return
-    # get server instance information
-    resource = yield retry(boto3.resource, "ec2", region_name=SERVER_PARAMS["REGION"])
-    instance = yield retry(resource.Instance, server.server_id)
-    # instance object is lazy, run this to get full info...
-    yield retry(instance.load)
-    
+    if SpawnClaim.is_claimed(user_name, expiry=SERVER_PARAMS.get("SPAWN_CLAIM_EXPIRY", 900)):
+        # the hub is starting this server right now, e.g. the user just logged in again
+        app_log.info("Server for user %s is being started, not killing it", user_name)
+        return
+    # get server instance information, shared with the lookups of the other servers being checked
+    try:
+        description = (yield instance_states.get([server.server_id]))[server.server_id]
+    except (ClientError, BotoCoreError) as e:
+        app_log.error("Could not check server for user %s: %s", user_name, e)
+        return
+    state = description["State"]["Name"]
+    tags = {tag["Key"]: tag["Value"] for tag in description.get("Tags", [])}
+    if tags.get(PREWARM_TAG, "") > datetime.datetime.utcnow().isoformat():
+        # started ahead of time by fleet_admin.py prewarm
+        app_log.debug("server for user %s is prewarmed until %s, no action taken", user_name, tags[PREWARM_TAG])
+        return
+
     #stop server if state is running (possible states are stopped, stopping, pending, shutting-down, terminated, and running)
-    if instance.state["Name"] == "running":
-        retry(instance.stop)
-        app_log.info("manually killed server for user %s" % user_name)
+    if state == "running":
+        if server.market == "spot":
+            # Spot workers are terminated, their home volume is attached to a new instance on next login.
+            SpotUsage.end(server.server_id)
+        stopped = stop_pipeline.stop(user_name, server.server_id, terminate=server.market == "spot")
+        event_log.record(CULL, user_name, server.server_id)
+        IOLoop.current().spawn_callback(finish_stop, user_name, server.server_id, stopped)
+        app_log.info("manually killing server for user %s", user_name)
     else:
-        app_log.debug("server state for user %s is %s, no action taken" % (user_name, instance.state["Name"]))
+        app_log.debug("server state for user %s is %s, no action taken", user_name, state)
 
 @coroutine
-def cull_idle(url, api_token, timeout):
-    #last valid activity timestame
-    cull_limit = datetime.datetime.utcnow() - datetime.timedelta(seconds=timeout)
+def finish_stop(user_name, instance_id, stopped):
+    """ Waits for a stop to complete, then detaches the user's home volume. Errors are logged by the stop pipeline
+        and home_volumes. """
+    try:
+        yield stopped
+    except StopFailed:
+        return
+    app_log.info("manually killed server for user %s", user_name)
+    if home_volumes is not None:
+        try:
+            yield home_volumes.release(user_name, instance_id)
+        except (HomeVolumeError, ClientError, WaiterError):
+            pass
+
+def record_utilization(activity):
+    """ Keeps the collected utilization as history for right-sizing recommendations (see rightsizing_report.py). """
+    rows = []
+    for user_name, worker in activity.items():
+        resources = worker["resources"] or {}
+        memory_total, memory_available = resources.get("memory_total"), resources.get("memory_available")
+        if worker["cpu_peak"] is None and memory_total is None:
+            continue
+        rows.append({
+            "user_id": user_name,
+            "instance_type": worker["instance_type"],
+            "cpu_percent": worker["cpu_peak"],
+            "memory_used": memory_total - memory_available if None not in (memory_total, memory_available) else None,
+            "memory_total": memory_total,
+        })
+    UtilizationSample.record_many(rows)
+
+@coroutine
+def cull_idle(url, api_token, timeout, collector=None, cpu_threshold=5.0):
+    policy = IdlePolicy(timeout, cpu_threshold)
     
     #get user list
     hub_api_authorization_header = { 'Authorization': 'token %s' % api_token}
@@ -89,6 +165,12 @@ def cull_idle(url, api_token, timeout):
     #run request tornado-asynchronously, extract user list (contains more information)
     resp = yield AsyncHTTPClient().fetch(users_request)
     all_users = json.loads(resp.body.decode('utf8', 'replace'))
+
+    # the hub only sees browser traffic; kernel state and CPU utilization of every worker tell whether it is really idle.
+    activity = {}
+    if collector is not None:
+        activity = yield collector.collect([user['name'] for user in all_users])
+        record_utilization(activity)
     
     #build a bunch of (asynchronous) HTTP request futures...
     stop_notebook_futures = []
@@ -98,16 +180,17 @@ def cull_idle(url, api_token, timeout):
 
         #extract last activity time, determine cullability of the server.
         last_activity = parse_date(user['last_activity'])
-        should_cull = last_activity.replace(tzinfo=None)  < cull_limit.replace(tzinfo=None)
         user_name = user['name']
-        app_log.debug("checking %s, last activity: %s, server: %s" % (user_name, last_activity, user['server']) )
+        should_cull, reason = policy.should_cull(last_activity, activity.get(user_name))
+        app_log.debug("checking %s, last activity: %s, server: %s, activity: %s", user_name, last_activity,
+                      user['server'], activity.get(user_name))
         
         if not should_cull:
             dont_cull_these.add(user_name)
         
         #server should be culled:
         if user['server'] and should_cull:
-            app_log.info("Culling %s (inactive since %s)", user_name, last_activity)
+            app_log.info("Culling %s (%s)", user_name, reason)
             stop_user_request = HTTPRequest(url=url + '/users/%s/server' % user_name,
                                             method='DELETE',
                                             headers=hub_api_authorization_header )
@@ -119,7 +202,7 @@ def cull_idle(url, api_token, timeout):
 
         #server should not be culled, just a log statement
         if user['server'] and not should_cull:
-            app_log.info("Not culling %s (active since %s)", user['name'], last_activity)
+            app_log.info("Not culling %s (%s)", user['name'], reason)
             
     # Cull notebooks using normal API.
     for (user_name, cull_request) in stop_notebook_futures:
@@ -132,17 +215,32 @@ def cull_idle(url, api_token, timeout):
             continue
         app_log.info("Finished culling %s", user_name)
         
-    for user_name in servers_to_check:
-        if user_name not in dont_cull_these:
-            yield manually_kill_server(user_name)
+    # checked concurrently, so that their lookups and stops are batched
+    yield [manually_kill_server(user_name) for user_name in servers_to_check if user_name not in dont_cull_these]
 
 
 if __name__ == '__main__':
     define('url', default=os.environ.get('JUPYTERHUB_API_URL'), help="The JupyterHub API URL")
     define('timeout', default=SERVER_PARAMS["JUPYTER_NOTEBOOK_TIMEOUT"], help="The idle timeout (in seconds)")
     define('cull_every', default=300, help="The interval (in seconds) for checking for idle servers to cull")
+    define('cpu_threshold', default=5.0, help="CPU utilization (percent) at or above which a server is never culled")
+    define('cpu_sustained', default=900, help="How long (in seconds) CPU utilization must have stayed at or above "
+                                              "--cpu_threshold, in 5 minute averages")
+    define('activity_cache_ttl', default=120, help="How long (in seconds) kernel and CPU activity is cached")
+    define('lease', default="culler", help="Only the culler holding this lease in the tracking database culls; "
+                                           "cullers of hubs that serve different users need different leases")
     
     parse_command_line()
+    install_logging(logging.getLogger(), SERVER_PARAMS.get("LOG_FORMAT", "json"))
+    # With TRACE_DIR set, each cull and its calls to AWS, the hub, the workers and the tracking database are written
+    # to a trace that tracing.py replays offline.
+    tracer = tracer_from_config(SERVER_PARAMS, "culler")
+    if tracer is not None:
+        tracer.install_aws()
+        tracer.install_db(DB)
+        tracer.install_agent()
+        tracer.install_http()
+        tracer.patch(sys.modules[__name__], "cull_idle", "cull", no_key)
     if not options.cull_every:
         options.cull_every = options.timeout // 2
 
@@ -153,7 +251,20 @@ if __name__ == '__main__':
         api_token = f.read().strip()
     
     loop = IOLoop.current()
-    cull = lambda: cull_idle(options.url, api_token, options.timeout)
+    collector = ActivityCollector(SERVER_PARAMS["REGION"], agent_clients=agent_clients,
+                                  notebook_port=NOTEBOOK_SERVER_PORT, cpu_window=options.timeout,
+                                  cpu_recent=options.cpu_sustained,
+                                  cache_ttl=options.activity_cache_ttl)
+    # with several managers sharing the tracking database, one culler culls and the others stand by
+    election = LeaderElection(options.lease)
+    election.start()
+
+    def cull():
+        if not election.is_leader:
+            app_log.debug("not the leader for %s, not culling", options.lease)
+            return None
+        return cull_idle(options.url, api_token, options.timeout, collector, options.cpu_threshold)
+
     # run once before scheduling periodic call
     loop.run_sync(cull)
     # schedule periodic cull
@@ -162,4 +273,4 @@ if __name__ == '__main__':
     try:
         loop.start()
     except KeyboardInterrupt:
-        pass
+        election.stop()
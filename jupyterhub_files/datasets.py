@@ -0,0 +1,114 @@
+""" Shared, read-only course datasets on every worker.
+
+    Without them, every user downloads the same datasets into their own home volume, which multiplies the transfer,
+    the storage and the time it takes before their notebook can use them. Instead an admin publishes the datasets once
+    as a snapshot of an XFS volume labelled "datasets" (`shared_datasets.py publish`), which is recorded as the next
+    DatasetVersion. Every worker launched afterwards gets a volume restored from the current version's snapshot, deleted
+    with the instance, which user_data_worker.sh mounts read-only at /datasets. A stopped worker whose volume holds an
+    older version, or that has none, gets a volume of the current version before it is started, so users see a new
+    version on their next start while running workers keep theirs. The DatasetVolume table records which version each
+    worker has.
+
+    A volume restored from a snapshot loads its blocks on first read, unless fast snapshot restore is enabled for the
+    snapshot (`shared_datasets.py publish --fast-restore`). """
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.exceptions import ClientError
+from tornado import gen
+
+from instance_profiles import DEFAULT_VOLUME, ebs_parameters
+from models import DatasetVersion, DatasetVolume
+
+logger = logging.getLogger(__name__)
+
+DATASET_DEVICE = "/dev/sdg"  # the home volume is /dev/sdf
+DATASET_LABEL = "datasets"  # user_data_worker.sh mounts the file system with this label
+VERSION_TAG = "Dataset Version"
+
+
+class DatasetVolumes(object):
+
+    def __init__(self, region, volume=None, tags=None, max_workers=10):
+        self.region = region
+        self.volume = volume or DEFAULT_VOLUME  # EBS settings of the volumes
+        self.tags = tags or []
+        self.executor = ThreadPoolExecutor(max_workers)
+
+    def _client(self):
+        return boto3.client("ec2", region_name=self.region)
+
+    def launch_mapping(self):
+        """ The block device mapping that gives an instance launched now a volume of the current version, and that
+            version; (None, None) while no datasets were published. """
+        current = DatasetVersion.current()
+        if current is None:
+            return None, None
+        mapping = {"DeviceName": DATASET_DEVICE,
+                   "Ebs": dict(ebs_parameters(self.volume), SnapshotId=current.snapshot_id, DeleteOnTermination=True)}
+        return mapping, current.version
+
+    @gen.coroutine
+    def launched(self, instance_id, version):
+        """ Records the dataset volume of an instance launched with launch_mapping(), once it is running. """
+        yield self.executor.submit(self._launched, instance_id, version)
+
+    @gen.coroutine
+    def update(self, instance_id):
+        """ Gives the stopped (or stopping) instance_id a volume of the current version, if it has an older one or
+            none, replacing its old volume. Returns the instance's version. """
+        version = yield self.executor.submit(self._update, instance_id)
+        return version
+
+    def _launched(self, instance_id, version):
+        ec2 = self._client()
+        instance = ec2.describe_instances(InstanceIds=[instance_id])["Reservations"][0]["Instances"][0]
+        volume_id = self._attached_volume(instance)
+        if volume_id is not None:
+            ec2.create_tags(Resources=[volume_id], Tags=self.tags + [{"Key": VERSION_TAG, "Value": str(version)}])
+            DatasetVolume.set_volume(instance_id, volume_id, version)
+
+    def _attached_volume(self, instance):
+        for mapping in instance.get("BlockDeviceMappings", []):
+            if mapping["DeviceName"] == DATASET_DEVICE and "Ebs" in mapping:
+                return mapping["Ebs"]["VolumeId"]
+        return None
+
+    def _update(self, instance_id):
+        current = DatasetVersion.current()
+        record = DatasetVolume.get_volume(instance_id)
+        if current is None or (record is not None and record.version >= current.version):
+            return record.version if record is not None else None
+        ec2 = self._client()
+        ec2.get_waiter("instance_stopped").wait(InstanceIds=[instance_id])
+        instance = ec2.describe_instances(InstanceIds=[instance_id])["Reservations"][0]["Instances"][0]
+        availability_zone = instance["Placement"]["AvailabilityZone"]
+        volume_id = ec2.create_volume(
+            AvailabilityZone=availability_zone, SnapshotId=current.snapshot_id,
+            TagSpecifications=[{"ResourceType": "volume", "Tags": self.tags + [
+                {"Key": VERSION_TAG, "Value": str(current.version)}]}],
+            **ebs_parameters(self.volume))["VolumeId"]
+        old_volume_id = self._attached_volume(instance)
+        try:
+            ec2.get_waiter("volume_available").wait(VolumeIds=[volume_id])
+            if old_volume_id is not None:
+                ec2.detach_volume(VolumeId=old_volume_id, InstanceId=instance_id)
+                ec2.get_waiter("volume_available").wait(VolumeIds=[old_volume_id])
+                # from here on, a failure leaves the instance without datasets until its next start
+                DatasetVolume.remove(instance_id)
+                ec2.delete_volume(VolumeId=old_volume_id)
+            ec2.attach_volume(VolumeId=volume_id, InstanceId=instance_id, Device=DATASET_DEVICE)
+            ec2.get_waiter("volume_in_use").wait(VolumeIds=[volume_id])
+        except Exception:
+            try:
+                ec2.delete_volume(VolumeId=volume_id)
+            except ClientError:
+                pass  # attached after all
+            raise
+        ec2.modify_instance_attribute(InstanceId=instance_id, BlockDeviceMappings=[
+            {"DeviceName": DATASET_DEVICE, "Ebs": {"DeleteOnTermination": True}}])
+        DatasetVolume.set_volume(instance_id, volume_id, current.version)
+        logger.info("gave %s datasets version %s (volume %s)" % (instance_id, current.version, volume_id))
+        return current.version
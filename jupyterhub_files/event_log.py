@@ -0,0 +1,60 @@
+""" Buffered writing of worker events (see models.InstanceEvent).
+
+    Recording an event only appends it to an in-memory buffer, so that the spawner's start and stop paths never wait
+    for the database. The buffer is written with one batched insert every flush_interval seconds, or as soon as it
+    holds batch_size events, on a thread of its own; whatever is left is written when the process exits. """
+
+import atexit
+import datetime
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from models import InstanceEvent
+
+logger = logging.getLogger(__name__)
+
+SPAWN = "spawn"
+START = "start"
+STOP = "stop"
+CULL = "cull"
+TERMINATE = "terminate"
+
+
+class EventLog(object):
+
+    def __init__(self, flush_interval=10, batch_size=500):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.buffer = []
+        self.executor = ThreadPoolExecutor(1)  # a single writer keeps the batches in order
+        self._periodic_callback = None
+        atexit.register(self.flush_now)
+
+    def record(self, event, user_name, instance_id, instance_type=None, market=None):
+        self.buffer.append({"user_id": user_name, "instance_id": instance_id, "event": event,
+                            "instance_type": instance_type, "market": market,
+                            "occurred_at": datetime.datetime.now()})
+        if self._periodic_callback is None:
+            self._periodic_callback = PeriodicCallback(self.flush, 1e3 * self.flush_interval)
+            self._periodic_callback.start()
+        if len(self.buffer) >= self.batch_size:
+            IOLoop.current().add_callback(self.flush)
+
+    def flush(self):
+        """ Hands the buffered events to the writer thread. """
+        if self.buffer:
+            rows, self.buffer = self.buffer, []
+            self.executor.submit(self._write, rows)
+
+    def flush_now(self):
+        """ Writes the buffered events and waits for every pending batch, e.g. at exit. """
+        self.flush()
+        self.executor.shutdown(wait=True)
+
+    def _write(self, rows):
+        try:
+            InstanceEvent.record_many(rows)
+        except Exception as e:
+            logger.error("could not write %s worker events: %s" % (len(rows), e))
@@ -0,0 +1,358 @@
+#!/usr/bin/python3 python3
+""" Bulk administration of the cluster's workers.
+
+    Workers are found with a few paginated DescribeInstances calls on the cluster's tag rather than one lookup per
+    user, and every action is sent in chunks of up to --chunk-size instances, several chunks at a time, with the EC2
+    calls rate limited to --rate per second. Progress is printed to stderr as chunks complete. --dry-run sends the
+    EC2 calls with DryRun=True, which checks permissions and parameters without changing anything.
+
+    Workers can be selected with --all, --user, --group (from the userlist), --state, --tag KEY=VALUE, --idle-hours
+    (from the hub's last activity) and --untracked (instances tagged for the cluster but unknown to the tracking DB).
+
+    Usage: python3 fleet_admin.py list [filters] [--format text|json]
+           python3 fleet_admin.py stop|start|terminate|snapshot|prewarm (--all | filters) [--dry-run]
+
+    stop terminates Spot workers, which cannot be stopped, as the spawner does, and detaches users' home volumes
+    once their workers have stopped. start attaches users' home volumes before starting their instances. prewarm
+    starts stopped workers ahead of a class and tags them so that the culler leaves them running for --hold-minutes.
+    snapshot snapshots users' home volumes, or the root volumes of workers without one. terminate also removes the
+    terminated workers from the tracking DB, as the spawner does when it replaces a terminated instance, and
+    requires --yes. stop, start, prewarm and terminate record their stops, starts and terminations in the event log. """
+
+import argparse
+import json
+import socket
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+import boto3
+from botocore.exceptions import ClientError, WaiterError
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+sys.path.insert(1, '/etc/jupyterhub')
+from models import Server, HomeVolume, SpotUsage
+from instance_profiles import read_userlist
+from activity import naive_utc
+from event_log import EventLog, START, STOP, TERMINATE
+
+with open("/etc/jupyterhub/server_config.json", "r") as f:
+    SERVER_PARAMS = json.load(f) # load local server parameters
+
+PREWARM_TAG = "Prewarmed Until"  # the culler does not stop a worker before this time (ISO 8601, UTC)
+DESCRIBE_PAGE_SIZE = 1000
+
+event_log = EventLog()  # written out when the script exits
+
+
+class RateLimiter(object):
+    """ Allows `rate` calls per second across threads, in bursts of up to `rate`. """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def progress(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def get_local_ip_address():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.connect(("8.8.8.8", 80))
+    ip_address = s.getsockname()[0]
+    s.close()
+    return ip_address
+
+
+def get_last_activity(hub_url):
+    """ Returns {user name: last activity (naive UTC datetime)} from the hub API. """
+    with open("/etc/jupyterhub/api_token.txt", "r") as f:
+        api_token = f.read().strip()
+    request = urllib.request.Request(hub_url + "/users", headers={"Authorization": "token %s" % api_token})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        users = json.loads(response.read().decode())
+    return {user["name"]: naive_utc(user["last_activity"]) for user in users}
+
+
+def get_workers(ec2, states=None, tags=None):
+    """ Returns every instance tagged for this cluster as a dict with the fields the filters and actions use. """
+    filters = [{"Name": "tag:Jupyter Cluster", "Values": [SERVER_PARAMS["JUPYTER_CLUSTER"]]}]
+    filters.append({"Name": "instance-state-name",
+                    "Values": states or ["pending", "running", "stopping", "stopped", "shutting-down"]})
+    for key, value in (tags or {}).items():
+        filters.append({"Name": "tag:%s" % key, "Values": [value]})
+    tracked = {server.server_id: server.user_id for server in Server.select()}
+    workers = []
+    for page in ec2.get_paginator("describe_instances").paginate(Filters=filters, MaxResults=DESCRIBE_PAGE_SIZE):
+        for reservation in page["Reservations"]:
+            for instance in reservation["Instances"]:
+                tags = {tag["Key"]: tag["Value"] for tag in instance.get("Tags", [])}
+                if tags.get("Name") != SERVER_PARAMS["WORKER_SERVER_NAME"]:
+                    continue  # e.g. the manager
+                workers.append({
+                    "instance_id": instance["InstanceId"],
+                    "user": tracked.get(instance["InstanceId"], tags.get("User")),
+                    "tracked": instance["InstanceId"] in tracked,
+                    "instance_type": instance["InstanceType"],
+                    "state": instance["State"]["Name"],
+                    "availability_zone": instance["Placement"]["AvailabilityZone"],
+                    "market": "spot" if instance.get("InstanceLifecycle") == "spot" else "on-demand",
+                    "launch_time": naive_utc(instance["LaunchTime"]).isoformat(),
+                    "root_volume_id": next((mapping["Ebs"]["VolumeId"]
+                                            for mapping in instance.get("BlockDeviceMappings", [])
+                                            if mapping["DeviceName"] == instance.get("RootDeviceName")), None),
+                })
+    return workers
+
+
+def select_workers(workers, args):
+    """ Applies the user, group, untracked and idle filters (states and tags are filtered by EC2). """
+    if args.user:
+        workers = [worker for worker in workers if worker["user"] in args.user]
+    if args.group:
+        userlist = read_userlist()
+        workers = [worker for worker in workers if userlist.get(worker["user"], {}).get("group") in args.group]
+    if args.untracked:
+        workers = [worker for worker in workers if not worker["tracked"]]
+    if args.idle_hours is not None:
+        last_activity = get_last_activity(args.hub_url)
+        limit = datetime.utcnow() - timedelta(hours=args.idle_hours)
+        workers = [worker for worker in workers
+                   if last_activity.get(worker["user"]) is None or last_activity[worker["user"]] < limit]
+        for worker in workers:
+            activity = last_activity.get(worker["user"])
+            worker["last_activity"] = activity.isoformat() if activity else None
+    return workers
+
+
+def run_chunks(name, items, action, args, chunk_size=None):
+    """ Runs action(chunk) for chunks of items, args.concurrency chunks at a time, and reports progress. Each chunk
+        is one rate-limited EC2 call. Returns the items whose chunk succeeded. """
+    chunk_size = chunk_size or args.chunk_size
+    chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+    limiter = RateLimiter(args.rate)
+    started = time.time()
+    succeeded = []
+    failed = 0
+
+    def run(chunk):
+        limiter.acquire()
+        try:
+            action(chunk)
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "DryRunOperation":
+                raise
+
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        futures = {executor.submit(run, chunk): chunk for chunk in chunks}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                succeeded.extend(futures[future])
+            except (ClientError, WaiterError) as e:
+                failed += len(futures[future])
+                progress("%s failed for %s: %s" % (name, ", ".join(str(item) for item in futures[future]), e))
+            progress("%s: %d/%d done, %d failed (%.1fs)" % (name, len(succeeded), len(items), failed,
+                                                           time.time() - started))
+    return succeeded
+
+
+def instance_ids(workers):
+    return [worker["instance_id"] for worker in workers]
+
+
+def stop(ec2, workers, args):
+    spot = [worker for worker in workers if worker["market"] == "spot"]
+    on_demand = [worker for worker in workers if worker["market"] != "spot"]
+    stopped = run_chunks("stop", instance_ids(on_demand),
+                         lambda ids: ec2.stop_instances(InstanceIds=ids, DryRun=args.dry_run), args)
+    # one-time Spot instances cannot be stopped; their home volumes are kept
+    terminated = run_chunks("terminate (spot)", instance_ids(spot),
+                            lambda ids: ec2.terminate_instances(InstanceIds=ids, DryRun=args.dry_run), args)
+    if args.dry_run:
+        return
+    for instance_id in terminated:
+        SpotUsage.end(instance_id)
+    record_events(STOP, workers, stopped)
+    record_events(TERMINATE, workers, terminated)
+    halted = set(stopped + terminated)
+    release_home_volumes([worker for worker in workers if worker["instance_id"] in halted], args)
+
+
+def record_events(event, workers, ids):
+    """ Records event in the event log for the workers whose instance id is in ids. """
+    ids = set(ids)
+    for worker in workers:
+        if worker["instance_id"] in ids:
+            event_log.record(event, worker["user"] or "", worker["instance_id"], worker["instance_type"],
+                             worker["market"])
+
+
+def attach_home_volumes(workers, args):
+    """ Attaches the home volumes of the users of stopped workers, which are detached while the workers are stopped.
+        Workers whose volume could not be attached are left out. """
+    if SERVER_PARAMS["USER_HOME_EBS_SIZE"] <= 0 or args.dry_run:
+        return workers
+    from home_volumes import HomeVolumes, HomeVolumeError
+    home_volumes = HomeVolumes(SERVER_PARAMS["REGION"], SERVER_PARAMS["USER_HOME_EBS_SIZE"],
+                               max_workers=args.concurrency)
+    volumes = {volume.user_id: volume for volume in HomeVolume.select()}
+    to_claim = [worker for worker in workers if worker["user"] in volumes
+                and volumes[worker["user"]].instance_id != worker["instance_id"]]
+
+    @gen.coroutine
+    def claim(worker):
+        try:
+            yield home_volumes.claim(worker["user"], worker["instance_id"])
+            return True
+        except (HomeVolumeError, ClientError) as e:
+            progress("could not attach the home volume of %s: %s" % (worker["user"], e))
+            return False
+
+    progress("attaching %d home volumes" % len(to_claim))
+    results = IOLoop.current().run_sync(lambda: gen.multi([claim(worker) for worker in to_claim]))
+    failed = {worker["instance_id"] for worker, ok in zip(to_claim, results) if not ok}
+    return [worker for worker in workers if worker["instance_id"] not in failed]
+
+
+def release_home_volumes(workers, args):
+    """ Detaches the home volumes of the users of stopping workers once they have stopped, as the spawner does, so that
+        the volumes are no longer recorded on those workers. """
+    if SERVER_PARAMS["USER_HOME_EBS_SIZE"] <= 0 or args.dry_run:
+        return
+    from home_volumes import HomeVolumes, HomeVolumeError
+    home_volumes = HomeVolumes(SERVER_PARAMS["REGION"], SERVER_PARAMS["USER_HOME_EBS_SIZE"],
+                               max_workers=args.concurrency)
+    volumes = {volume.user_id: volume for volume in HomeVolume.select()}
+    to_release = [worker for worker in workers if worker["user"] in volumes
+                  and volumes[worker["user"]].instance_id == worker["instance_id"]]
+
+    @gen.coroutine
+    def release(worker):
+        try:
+            yield home_volumes.release(worker["user"], worker["instance_id"])
+        except (HomeVolumeError, ClientError, WaiterError) as e:
+            progress("could not detach the home volume of %s: %s" % (worker["user"], e))
+
+    progress("detaching %d home volumes" % len(to_release))
+    IOLoop.current().run_sync(lambda: gen.multi([release(worker) for worker in to_release]))
+
+
+def start(ec2, workers, args):
+    workers = attach_home_volumes([worker for worker in workers if worker["state"] == "stopped"], args)
+    started = run_chunks("start", instance_ids(workers),
+                         lambda ids: ec2.start_instances(InstanceIds=ids, DryRun=args.dry_run), args)
+    if not args.dry_run:
+        record_events(START, workers, started)
+    return workers
+
+
+def prewarm(ec2, workers, args):
+    until = (datetime.utcnow() + timedelta(minutes=args.hold_minutes)).isoformat()
+    run_chunks("tag", instance_ids(workers), lambda ids: ec2.create_tags(
+        Resources=ids, Tags=[{"Key": PREWARM_TAG, "Value": until}], DryRun=args.dry_run), args)
+    started = start(ec2, workers, args)
+    if started and not args.dry_run:
+        progress("waiting for %d workers to run" % len(started))
+        run_chunks("running", instance_ids(started), lambda ids: ec2.get_waiter("instance_running").wait(
+            InstanceIds=ids), args)
+
+
+def terminate(ec2, workers, args):
+    terminated = run_chunks("terminate", instance_ids(workers),
+                            lambda ids: ec2.terminate_instances(InstanceIds=ids, DryRun=args.dry_run), args)
+    if not args.dry_run:
+        record_events(TERMINATE, workers, terminated)
+        for instance_id in terminated:
+            Server.remove_terminated(instance_id)
+
+
+def snapshot(ec2, workers, args):
+    volumes = {volume.user_id: volume.volume_id for volume in HomeVolume.select()}
+    description = "%s home of %%s, %s" % (SERVER_PARAMS["JUPYTER_CLUSTER"], datetime.utcnow().strftime("%Y-%m-%d"))
+    targets = [(worker["user"], volumes.get(worker["user"]) or worker["root_volume_id"]) for worker in workers]
+
+    def create(chunk):
+        # CreateSnapshot takes a single volume, so chunks are single volumes
+        for user, volume_id in chunk:
+            ec2.create_snapshot(VolumeId=volume_id, Description=description % user, DryRun=args.dry_run,
+                                TagSpecifications=[{"ResourceType": "snapshot", "Tags": [
+                                    {"Key": "Jupyter Cluster", "Value": SERVER_PARAMS["JUPYTER_CLUSTER"]},
+                                    {"Key": "User", "Value": user or ""}]}])
+
+    run_chunks("snapshot", [target for target in targets if target[1]], create, args, chunk_size=1)
+
+
+def print_workers(workers, output_format):
+    if output_format == "json":
+        for worker in workers:
+            print(json.dumps(worker))
+        return
+    print("%-20s %-20s %-12s %-14s %-11s %-10s %-20s" % ("user", "instance", "type", "state", "zone", "market",
+                                                          "launched"))
+    for worker in workers:
+        print("%-20s %-20s %-12s %-14s %-11s %-10s %-20s" % (
+            worker["user"] or "?", worker["instance_id"], worker["instance_type"], worker["state"],
+            worker["availability_zone"], worker["market"], worker["launch_time"][:19]))
+    print("%d workers" % len(workers), file=sys.stderr)
+
+
+ACTIONS = {"stop": stop, "start": start, "terminate": terminate, "snapshot": snapshot, "prewarm": prewarm}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lists and acts on the cluster's workers in bulk")
+    parser.add_argument("command", choices=["list"] + sorted(ACTIONS))
+    parser.add_argument("--all", action="store_true", help="act on every worker (required without other filters)")
+    parser.add_argument("--user", action="append", help="select this user's worker (repeatable)")
+    parser.add_argument("--group", action="append", help="select workers of users in this userlist group (repeatable)")
+    parser.add_argument("--state", action="append", help="select workers in this state (repeatable)")
+    parser.add_argument("--tag", action="append", default=[], help="select workers with this tag, as KEY=VALUE")
+    parser.add_argument("--idle-hours", type=float, help="select workers whose user has been idle this long")
+    parser.add_argument("--untracked", action="store_true", help="select workers unknown to the tracking DB")
+    parser.add_argument("--hub-url", default="http://%s:8081/hub/api" % get_local_ip_address(),
+                        help="the JupyterHub API URL, for --idle-hours")
+    parser.add_argument("--chunk-size", type=int, default=100, help="instances per EC2 call")
+    parser.add_argument("--concurrency", type=int, default=8, help="EC2 calls in flight at once")
+    parser.add_argument("--rate", type=float, default=10, help="EC2 calls per second")
+    parser.add_argument("--hold-minutes", type=int, default=60, help="prewarm: how long the culler leaves workers up")
+    parser.add_argument("--dry-run", action="store_true", help="check the EC2 calls without changing anything")
+    parser.add_argument("--yes", action="store_true", help="confirm terminate")
+    parser.add_argument("--format", choices=["text", "json"], default="text")
+    args = parser.parse_args()
+
+    has_filters = args.user or args.group or args.state or args.tag or args.idle_hours is not None or args.untracked
+    if args.command != "list" and not (args.all or has_filters):
+        parser.error("%s needs --all or at least one filter" % args.command)
+    if args.command == "terminate" and not (args.yes or args.dry_run):
+        parser.error("terminate needs --yes (or --dry-run)")
+
+    ec2 = boto3.client("ec2", region_name=SERVER_PARAMS["REGION"])
+    started = time.time()
+    workers = get_workers(ec2, args.state, dict(tag.split("=", 1) for tag in args.tag))
+    workers = select_workers(workers, args)
+    progress("selected %d workers in %.1fs" % (len(workers), time.time() - started))
+    if args.command == "list":
+        print_workers(workers, args.format)
+    else:
+        ACTIONS[args.command](ec2, workers, args)
+        progress("%s finished in %.1fs%s" % (args.command, time.time() - started, " (dry run)" if args.dry_run else ""))
@@ -0,0 +1,230 @@
+#!/usr/bin/python3 python3
+""" Builds and inspects the golden home snapshot that new users' home volumes are created from.
+
+    Without a golden snapshot, a new user's first boot formats their blank home volume and copies the home directory
+    skeleton onto it while the spawner waits. `rebuild` formats a volume once on a scratch worker, copies the skeleton
+    (and, with --materials-url, the course materials from a .tar.gz) to it and snapshots it, tagged with the cluster
+    name; the spawner creates new home volumes from the latest such snapshot, and user_data_worker.sh only moves the
+    skeleton into place and sets its ownership. --fast-restore enables fast snapshot restore in the workers'
+    availability zones, so that volumes created from the snapshot do not load their blocks lazily on first read (this
+    is charged per zone and hour). The two previous snapshots are kept, older ones are deleted.
+
+    `compare` sets up one home volume each way on a scratch worker and prints how long each step took. `show` lists the
+    golden snapshots.
+
+    Usage: python3 golden_home.py rebuild [--materials-url URL] [--size GB] [--fast-restore]
+           python3 golden_home.py compare
+           python3 golden_home.py show """
+
+import argparse
+import json
+import re
+import sys
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+
+sys.path.insert(1, '/etc/jupyterhub')
+from home_volumes import GOLDEN_TAG, GOLDEN_LOOKUP_INTERVAL, golden_snapshots
+from instance_profiles import DEFAULT_VOLUME, ebs_parameters
+from placement import describe_subnets
+
+with open("/etc/jupyterhub/server_config.json", "r") as f:
+    SERVER_PARAMS = json.load(f) # load local server parameters
+
+with open("/etc/jupyterhub/golden_home_builder.sh", "r") as f:
+    BUILDER_USER_DATA = f.read()
+
+CLUSTER = SERVER_PARAMS["JUPYTER_CLUSTER"]
+KEEP_SNAPSHOTS = 3
+BUILDER_TIMEOUT = 1800  # seconds for the scratch worker to finish
+REPORT = re.compile(r"GOLDEN_HOME (.*)")
+
+
+def progress(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def wait(ec2, waiter, timeout=BUILDER_TIMEOUT, **kwargs):
+    ec2.get_waiter(waiter).wait(WaiterConfig={"Delay": 15, "MaxAttempts": max(1, timeout // 15)}, **kwargs)
+
+
+def launch_builder(ec2, mode, materials_url=""):
+    """ Starts a scratch worker that runs golden_home_builder.sh and stops itself when done. """
+    user_data = BUILDER_USER_DATA.format(mode=mode, materials_url=materials_url)
+    reservation = ec2.run_instances(
+        ImageId=SERVER_PARAMS["WORKER_AMI"], InstanceType=SERVER_PARAMS["INSTANCE_TYPE"],
+        SubnetId=SERVER_PARAMS["SUBNET_ID"], SecurityGroupIds=SERVER_PARAMS["WORKER_SECURITY_GROUPS"],
+        KeyName=SERVER_PARAMS["KEY_NAME"], MinCount=1, MaxCount=1, UserData=user_data,
+        InstanceInitiatedShutdownBehavior="stop",
+        TagSpecifications=[{"ResourceType": "instance", "Tags": [
+            {"Key": "Name", "Value": "golden-home-%s-%s" % (mode, CLUSTER)},
+            {"Key": "Owner", "Value": SERVER_PARAMS["WORKER_SERVER_OWNER"]},
+            {"Key": GOLDEN_TAG + " Builder", "Value": CLUSTER}]}])
+    instance_id = reservation["Instances"][0]["InstanceId"]
+    progress("launched scratch worker %s" % instance_id)
+    wait(ec2, "instance_running", InstanceIds=[instance_id])
+    instance = ec2.describe_instances(InstanceIds=[instance_id])["Reservations"][0]["Instances"][0]
+    return instance_id, instance["Placement"]["AvailabilityZone"]
+
+
+def create_volume(ec2, availability_zone, size, snapshot_id=None):
+    """ Returns the new volume's id and the seconds it took to become available. """
+    started = time.time()
+    snapshot_args = {"SnapshotId": snapshot_id} if snapshot_id else {}
+    # the home volumes' settings, so that `compare` times what users get
+    volume_args = ebs_parameters(SERVER_PARAMS.get("HOME_VOLUME") or DEFAULT_VOLUME)
+    volume_id = ec2.create_volume(AvailabilityZone=availability_zone, Size=size, TagSpecifications=[
+        {"ResourceType": "volume", "Tags": [{"Key": "Name", "Value": "golden-home-scratch-%s" % CLUSTER}]}],
+        **dict(volume_args, **snapshot_args))["VolumeId"]
+    wait(ec2, "volume_available", VolumeIds=[volume_id])
+    return volume_id, time.time() - started
+
+
+def attach(ec2, volume_id, instance_id, device):
+    ec2.attach_volume(VolumeId=volume_id, InstanceId=instance_id, Device=device)
+    wait(ec2, "volume_in_use", VolumeIds=[volume_id])
+
+
+def builder_reports(ec2, instance_id):
+    """ Waits for the scratch worker to stop, then returns the GOLDEN_HOME lines of its console output. """
+    wait(ec2, "instance_stopped", InstanceIds=[instance_id])
+    for _ in range(20):
+        try:
+            output = ec2.get_console_output(InstanceId=instance_id, Latest=True).get("Output", "")
+        except ClientError:
+            output = ec2.get_console_output(InstanceId=instance_id).get("Output", "")
+        reports = REPORT.findall(output)
+        if reports:
+            return reports
+        time.sleep(15)  # the console output of a stopped instance can take a few minutes to come through
+    raise RuntimeError("scratch worker %s did not report, see /var/log/golden_home.log on it" % instance_id)
+
+
+def cleanup(ec2, instance_id, volume_ids):
+    ec2.terminate_instances(InstanceIds=[instance_id])
+    for volume_id in volume_ids:
+        try:
+            wait(ec2, "volume_available", timeout=300, VolumeIds=[volume_id])
+            ec2.delete_volume(VolumeId=volume_id)
+        except Exception as e:
+            progress("could not delete scratch volume %s, please delete it: %s" % (volume_id, e))
+
+
+def worker_zones():
+    subnet_ids = SERVER_PARAMS.get("WORKER_SUBNET_IDS") or [SERVER_PARAMS["SUBNET_ID"]]
+    return sorted({subnet["AVAILABILITY_ZONE"] for subnet in describe_subnets(SERVER_PARAMS["REGION"], subnet_ids)})
+
+
+def rebuild(ec2, size, materials_url, fast_restore):
+    started = time.time()
+    instance_id, availability_zone = launch_builder(ec2, "build", materials_url)
+    volume_id, _ = create_volume(ec2, availability_zone, size)
+    try:
+        attach(ec2, volume_id, instance_id, "/dev/sdf")
+        reports = builder_reports(ec2, instance_id)
+        if reports[-1] != "built":
+            raise RuntimeError("building the golden home volume failed: %s" % reports[-1])
+        ec2.detach_volume(VolumeId=volume_id)
+        wait(ec2, "volume_available", VolumeIds=[volume_id])
+        snapshot_id = ec2.create_snapshot(
+            VolumeId=volume_id, Description="Golden home volume of %s" % CLUSTER,
+            TagSpecifications=[{"ResourceType": "snapshot", "Tags": [
+                {"Key": GOLDEN_TAG, "Value": CLUSTER}, {"Key": "Name", "Value": "golden-home-%s" % CLUSTER}]}]
+        )["SnapshotId"]
+        progress("snapshotting %s" % snapshot_id)
+        wait(ec2, "snapshot_completed", SnapshotIds=[snapshot_id])
+    finally:
+        cleanup(ec2, instance_id, [volume_id])
+    if fast_restore:
+        zones = worker_zones()
+        ec2.enable_fast_snapshot_restores(AvailabilityZones=zones, SourceSnapshotIds=[snapshot_id])
+        progress("enabled fast snapshot restore of %s in %s" % (snapshot_id, ", ".join(zones)))
+    for snapshot in golden_snapshots(ec2, CLUSTER)[1:]:
+        # volumes are only created from the latest one
+        disable_fast_restore(ec2, snapshot["SnapshotId"])
+    for snapshot in golden_snapshots(ec2, CLUSTER)[KEEP_SNAPSHOTS:]:
+        ec2.delete_snapshot(SnapshotId=snapshot["SnapshotId"])
+        progress("deleted old golden snapshot %s" % snapshot["SnapshotId"])
+    print("golden snapshot %s built in %d seconds; new home volumes are created from it within %d minutes" % (
+        snapshot_id, time.time() - started, GOLDEN_LOOKUP_INTERVAL // 60))
+
+
+def fast_restore_zones(ec2, snapshot_id):
+    restores = ec2.describe_fast_snapshot_restores(Filters=[{"Name": "snapshot-id", "Values": [snapshot_id]}])
+    return {restore["AvailabilityZone"]: restore["State"] for restore in restores["FastSnapshotRestores"]}
+
+
+def disable_fast_restore(ec2, snapshot_id):
+    zones = [zone for zone, state in fast_restore_zones(ec2, snapshot_id).items() if state != "disabled"]
+    if zones:
+        ec2.disable_fast_snapshot_restores(AvailabilityZones=zones, SourceSnapshotIds=[snapshot_id])
+
+
+def compare(ec2):
+    snapshots = golden_snapshots(ec2, CLUSTER)
+    if not snapshots:
+        sys.exit("There is no golden snapshot yet, see rebuild")
+    snapshot = snapshots[0]
+    size = max(SERVER_PARAMS["USER_HOME_EBS_SIZE"], snapshot["VolumeSize"])
+    instance_id, availability_zone = launch_builder(ec2, "compare")
+    volume_ids = []
+    try:
+        blank_id, blank_seconds = create_volume(ec2, availability_zone, size)
+        volume_ids.append(blank_id)
+        golden_id, golden_seconds = create_volume(ec2, availability_zone, size, snapshot["SnapshotId"])
+        volume_ids.append(golden_id)
+        attach(ec2, blank_id, instance_id, "/dev/sdf")
+        attach(ec2, golden_id, instance_id, "/dev/sdg")
+        reports = builder_reports(ec2, instance_id)
+    finally:
+        cleanup(ec2, instance_id, volume_ids)
+    if reports[-1] != "done":
+        sys.exit("the comparison failed: %s" % reports[-1])
+    timings = {}
+    for report in reports:
+        fields = report.split()
+        if fields[0] == "timing":
+            timings[fields[1]] = int(fields[2]) / 1000
+    fast_restore = fast_restore_zones(ec2, snapshot["SnapshotId"]).get(availability_zone, "disabled")
+    print("%s (fast snapshot restore in %s: %s)" % (snapshot["SnapshotId"], availability_zone, fast_restore))
+    print("%-40s %12s %12s" % ("seconds", "current", "golden"))
+    print("%-40s %12.1f %12.1f" % ("volume created and available", blank_seconds, golden_seconds))
+    # current: mkfs, cp -R and chown -R; golden: xfs_growfs, mv and chown -R
+    print("%-40s %12.1f %12.1f" % ("home directory set up on first boot", timings["current_setup"],
+                                   timings["golden_setup"]))
+    print("%-40s %12.1f %12.1f" % ("first read of every file", timings["current_first_read"],
+                                   timings["golden_first_read"]))
+    print("The golden volume holds the skeleton and any course materials, the current path only the skeleton.")
+
+
+def show(ec2):
+    for snapshot in golden_snapshots(ec2, CLUSTER):
+        zones = fast_restore_zones(ec2, snapshot["SnapshotId"])
+        print("%s  %s  %s GB  fast restore: %s" % (
+            snapshot["SnapshotId"], snapshot["StartTime"].strftime("%Y-%m-%d %H:%M"), snapshot["VolumeSize"],
+            ", ".join("%s %s" % (zone, state) for zone, state in sorted(zones.items())) or "-"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds and inspects the golden home snapshot")
+    parser.add_argument("command", choices=["rebuild", "compare", "show"])
+    parser.add_argument("--materials-url", default="", help="a .tar.gz of course materials to add to the skeleton")
+    parser.add_argument("--size", type=int, default=SERVER_PARAMS["USER_HOME_EBS_SIZE"],
+                        help="size (GB) of the golden volume, at most USER_HOME_EBS_SIZE")
+    parser.add_argument("--fast-restore", action="store_true",
+                        help="enable fast snapshot restore in the workers' availability zones")
+    args = parser.parse_args()
+
+    if SERVER_PARAMS["USER_HOME_EBS_SIZE"] <= 0:
+        sys.exit("This cluster has no home volumes (USER_HOME_EBS_SIZE)")
+    ec2 = boto3.client("ec2", region_name=SERVER_PARAMS["REGION"])
+    if args.command == "rebuild":
+        if not 0 < args.size <= SERVER_PARAMS["USER_HOME_EBS_SIZE"]:
+            sys.exit("--size must be between 1 and USER_HOME_EBS_SIZE (%s)" % SERVER_PARAMS["USER_HOME_EBS_SIZE"])
+        rebuild(ec2, args.size, args.materials_url, args.fast_restore)
+    elif args.command == "compare":
+        compare(ec2)
+    else:
+        show(ec2)
@@ -0,0 +1,99 @@
+#!/bin/bash -x
+# User data of the scratch instance golden_home.py runs, either to build the golden home snapshot (mode "build") or
+# to time the setup of a new user's home volume with and without it (mode "compare"). shared_datasets.py runs it to
+# build a version of the shared datasets (mode "dataset"). The instance reports on its console, where the scripts read
+# the results.
+exec > >(tee /var/log/golden_home.log) 2>&1
+
+# The instance is shut down (and stopped) whatever happens.
+trap "shutdown -h now" EXIT
+
+# Function bodies are subshells rather than braces, as golden_home.py fills this file in with str.format().
+report() (
+    echo "GOLDEN_HOME $*" > /dev/console
+)
+
+wait_for_device() (
+    for i in $(seq 1 300); do
+        [ -b /dev/$1 ] && exit 0
+        sleep 1
+    done
+    report failed "device /dev/$1 never appeared"
+    exit 1
+)
+
+milliseconds() (
+    echo $(( $(date +%s%N) / 1000000 ))
+)
+
+if [ "{mode}" = "build" ]; then
+    # xvdf: the volume to snapshot. The skeleton is what user_data_worker.sh would otherwise copy for every user.
+    wait_for_device xvdf || exit 1
+    mkfs.xfs /dev/xvdf
+    mkdir -p /mnt/golden
+    mount /dev/xvdf /mnt/golden
+    cp -R /home/ubuntu /mnt/golden/.skel
+    if [ -n "{materials_url}" ]; then
+        # course materials, a .tar.gz
+        if ! curl -fsSL "{materials_url}" | tar -xz -C /mnt/golden/.skel; then
+            report failed "could not fetch the course materials from {materials_url}"
+            exit 1
+        fi
+    fi
+    umount /mnt/golden
+    report built
+    exit 0
+fi
+
+if [ "{mode}" = "dataset" ]; then
+    # xvdf: the volume to snapshot, labelled so that workers mount it at /datasets whatever its device is named
+    wait_for_device xvdf || exit 1
+    mkfs.xfs -L datasets /dev/xvdf
+    mkdir -p /mnt/datasets
+    mount /dev/xvdf /mnt/datasets
+    if ! curl -fsSL "{materials_url}" | tar -xz -C /mnt/datasets; then
+        report failed "could not fetch the dataset bundle from {materials_url}"
+        exit 1
+    fi
+    # workers mount it read-only, every user must be able to read every file
+    chown -R root.root /mnt/datasets
+    chmod -R a+rX,go-w /mnt/datasets
+    report used_mb $(du -sm /mnt/datasets | cut -f1)
+    umount /mnt/datasets
+    report built
+    exit 0
+fi
+
+# compare: xvdf is a blank volume, set up as user_data_worker.sh does without a golden snapshot; xvdg was created
+# from the golden snapshot.
+wait_for_device xvdf || exit 1
+wait_for_device xvdg || exit 1
+useradd -d /home/compare compare -s /bin/bash
+mkdir -p /mnt/blank /mnt/golden
+
+start=$(milliseconds)
+mkfs.xfs /dev/xvdf
+mount /dev/xvdf /mnt/blank
+cp -R /home/ubuntu /mnt/blank/compare
+chown -R compare.compare /mnt/blank/compare
+report timing current_setup $(( $(milliseconds) - start ))
+
+start=$(milliseconds)
+mount /dev/xvdg /mnt/golden
+xfs_growfs /mnt/golden
+mv /mnt/golden/.skel /mnt/golden/compare
+chown -R compare.compare /mnt/golden/compare
+report timing golden_setup $(( $(milliseconds) - start ))
+
+# Reading every file shows the cost of the blocks a volume created from a snapshot loads on first access, unless
+# fast snapshot restore is enabled for the snapshot.
+start=$(milliseconds)
+tar -cf - /mnt/golden/compare | wc -c > /dev/null
+report timing golden_first_read $(( $(milliseconds) - start ))
+start=$(milliseconds)
+tar -cf - /mnt/blank/compare | wc -c > /dev/null
+report timing current_first_read $(( $(milliseconds) - start ))
+report files $(find /mnt/golden/compare | wc -l) $(find /mnt/blank/compare | wc -l)
+
+umount /mnt/blank /mnt/golden
+report done
@@ -0,0 +1,574 @@
+#!/usr/bin/python3 python3
+""" Autogrades an assignment's submissions in parallel on grader instances.
+
+    `nbgrader autograde` grades one submission after the other, so a 400 student course waits for hours on one
+    machine. `grade` splits the assignment into one job per submission and runs the jobs concurrently on a pool of
+    grader instances, several per instance. Each job is a copy of the course's nbgrader_config.py, gradebook.db and
+    the student's submission; the grader autogrades it in a directory of its own with `grading.py run-job` and sends
+    back the scores and the autograded notebooks, which are merged into the course's gradebook and autograded/
+    directory as each job finishes. A job that fails or takes longer than --timeout is run again, on another grader
+    where there is one, up to --attempts times; the submissions that never succeed are listed at the end.
+
+    Graders are instances of the worker AMI (which has nbgrader) tagged with the cluster name, reached over SSH like
+    the spawner reaches workers. Stopped graders are started, missing ones are launched, and they are stopped again
+    when grading is done, so that the next run starts warm ones. Users' workers are never used: their users have
+    sudo on them, and would see the other students' submissions.
+
+    `benchmark` runs the scheduler against a local process pool with synthetic jobs that burn CPU, fail or hang, and
+    compares the wall time with grading them one after the other.
+
+    Usage: python3 grading.py grade COURSE_DIR ASSIGNMENT [--graders N] [--student S]... [--timeout SECONDS]
+           python3 grading.py benchmark [--submissions N] [--processes N] [--seconds S]
+           python3 grading.py run-job JOB_DIR ASSIGNMENT STUDENT [--timeout SECONDS] (on a grader) """
+
+import json
+import os
+import random
+import shlex
+import shutil
+import signal
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+DEFAULT_TIMEOUT = 600  # seconds per attempt of a job
+DEFAULT_ATTEMPTS = 3
+REMOTE_DIR = "/tmp/grading"
+GRADER_TAG = "Jupyter Grader"
+LOG_TAIL = 2000  # characters of a failed job's output that are kept
+
+
+def progress(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, len(sorted_values) * p // 100)]
+
+
+######################################################################################################################
+###################################################### JOBS ##########################################################
+######################################################################################################################
+
+class Job(object):
+
+    def __init__(self, assignment, student, archive=None):
+        self.assignment = assignment
+        self.student = student
+        self.archive = archive  # the job's files, a .tar.gz
+        self.attempts = 0
+        self.avoid = set()  # graders this job failed on
+        self.result = None
+        self.seconds = []  # of each attempt
+
+    @property
+    def name(self):
+        return "%s-%s" % (self.assignment, self.student)
+
+
+def pack_job(course_dir, assignment, student, archive_dir):
+    """ Writes the files `nbgrader autograde` needs for student's submission to a .tar.gz in archive_dir. """
+    archive = os.path.join(archive_dir, "%s-%s.tar.gz" % (assignment, student))
+    with tarfile.open(archive, "w:gz") as tar:
+        for name in ("nbgrader_config.py", "gradebook.db"):
+            if os.path.exists(os.path.join(course_dir, name)):
+                tar.add(os.path.join(course_dir, name), arcname=name)
+        source = os.path.join("source", assignment)
+        if os.path.isdir(os.path.join(course_dir, source)):
+            tar.add(os.path.join(course_dir, source), arcname=source)
+        submission = os.path.join("submitted", student, assignment)
+        tar.add(os.path.join(course_dir, submission), arcname=submission)
+    return archive
+
+
+def submissions(course_dir, assignment, students=None):
+    """ The students with a submission of assignment, in course_dir/submitted/STUDENT/ASSIGNMENT. """
+    submitted = os.path.join(course_dir, "submitted")
+    found = sorted(student for student in os.listdir(submitted)
+                   if os.path.isdir(os.path.join(submitted, student, assignment)))
+    if students:
+        missing = set(students) - set(found)
+        if missing:
+            raise ValueError("no submission of %s from %s" % (assignment, ", ".join(sorted(missing))))
+        found = [student for student in found if student in students]
+    return found
+
+
+def read_scores(job_dir, assignment, student):
+    """ The autograded scores of student's submission in job_dir's gradebook. """
+    from nbgrader.api import Gradebook
+    gradebook = Gradebook("sqlite:///%s" % os.path.join(job_dir, "gradebook.db"))
+    try:
+        submission = gradebook.find_submission(assignment, student)
+        return [{"notebook": notebook.name, "cell": grade.name, "auto_score": grade.auto_score,
+                 "max_score": grade.max_score}
+                for notebook in submission.notebooks for grade in notebook.grades]
+    finally:
+        gradebook.close()
+
+
+def run_job(job_dir, assignment, student, timeout, command=None, scorer=read_scores):
+    """ Autogrades the job extracted in job_dir, killing it after timeout seconds. Returns {"status": "graded",
+        "scores": [...]}, or a "failed" or "timeout" status with the end of the output in "log". """
+    job_dir = os.path.abspath(job_dir)
+    # the job directory is the course directory, whatever nbgrader_config.py says
+    command = command or ["nbgrader", "autograde", assignment, "--student", student, "--force",
+                          "--CourseDirectory.root=%s" % job_dir]
+    started = time.time()
+    # a session of its own, so that a timeout also kills the kernels nbgrader started
+    process = subprocess.Popen(command, cwd=job_dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               start_new_session=True)
+    try:
+        output, _ = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        output, _ = process.communicate()
+        return {"status": "timeout", "seconds": time.time() - started,
+                "log": output.decode(errors="replace")[-LOG_TAIL:]}
+    result = {"seconds": time.time() - started, "log": output.decode(errors="replace")[-LOG_TAIL:]}
+    if process.returncode != 0:
+        result["status"] = "failed"
+        return result
+    try:
+        result["scores"] = scorer(job_dir, assignment, student)
+    except Exception as e:
+        result["status"], result["log"] = "failed", "%s\n%s" % (result["log"], e)
+        return result
+    result["status"] = "graded"
+    return result
+
+
+def run_archived_job(archive, assignment, student, timeout, command=None, scorer=read_scores):
+    """ Extracts archive into a directory next to it and runs the job there (in the local process pool). """
+    job_dir = archive[:-len(".tar.gz")]
+    if os.path.exists(job_dir):
+        shutil.rmtree(job_dir)  # an earlier attempt's
+    os.makedirs(job_dir)
+    with tarfile.open(archive) as tar:
+        tar.extractall(job_dir)
+    result = run_job(job_dir, assignment, student, timeout, command, scorer)
+    result["job_dir"] = job_dir
+    return result
+
+
+######################################################################################################################
+##################################################### BACKENDS #######################################################
+######################################################################################################################
+
+class ProcessPoolBackend(object):
+    """ Runs jobs in local processes: the stand-in for graders, e.g. on the manager of a small course. """
+
+    def __init__(self, processes, command=None, scorer=read_scores):
+        self.processes = processes
+        self.command = command
+        self.scorer = scorer
+        self.pool = ProcessPoolExecutor(processes)
+
+    def slots(self):
+        return [("local", i) for i in range(self.processes)]
+
+    def run(self, slot, job, timeout):
+        command = self.command(job) if self.command else None
+        return self.pool.submit(run_archived_job, job.archive, job.assignment, job.student, timeout, command,
+                                self.scorer).result()
+
+    def close(self):
+        self.pool.shutdown()
+
+
+class SSHBackend(object):
+    """ Runs jobs on grader instances over SSH, `slots_per_grader` at a time on each. Uses paramiko directly rather
+        than fabric: fabric's settings are process-wide, and the jobs run from many threads at once. """
+
+    def __init__(self, addresses, username, key_filename, slots_per_grader):
+        import paramiko
+        self.addresses = addresses  # {instance id: private ip address}
+        self.slots_per_grader = slots_per_grader
+        self.clients = {}
+        for instance_id, address in addresses.items():
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            for attempt in range(30):  # a grader that was just started takes a while to accept connections
+                try:
+                    client.connect(address, username=username, key_filename=key_filename, timeout=10)
+                    break
+                except (paramiko.SSHException, OSError):
+                    if attempt == 29:
+                        raise
+                    time.sleep(10)
+            self.clients[instance_id] = client
+            self._execute(instance_id, "rm -rf {0} && mkdir -p {0}".format(REMOTE_DIR), 60)
+            sftp = client.open_sftp()
+            try:
+                sftp.put(os.path.abspath(__file__), REMOTE_DIR + "/grading.py")
+            finally:
+                sftp.close()
+
+    def slots(self):
+        return [(instance_id, i) for instance_id in sorted(self.clients) for i in range(self.slots_per_grader)]
+
+    def _execute(self, instance_id, command, timeout):
+        _, stdout, _ = self.clients[instance_id].exec_command(command, timeout=timeout)
+        output = stdout.read().decode(errors="replace")
+        if stdout.channel.recv_exit_status() != 0:
+            raise RuntimeError("`%s` failed on %s: %s" % (command, instance_id, output[-LOG_TAIL:]))
+        return output
+
+    def run(self, slot, job, timeout):
+        instance_id = slot[0]
+        remote = "%s/%s" % (REMOTE_DIR, job.name)
+        job_dir = job.archive[:-len(".tar.gz")]
+        sftp = self.clients[instance_id].open_sftp()
+        try:
+            sftp.put(job.archive, remote + ".tar.gz")
+            # the grader kills the job itself after timeout, the margin covers the transfers
+            output = self._execute(instance_id, (
+                "cd {dir} && rm -rf {name} && mkdir {name} && tar -xzf {name}.tar.gz -C {name} && "
+                "python3 grading.py run-job {name} {assignment} {student} --timeout {timeout} "
+                "--output {name}.out.tar.gz").format(dir=REMOTE_DIR, name=shlex.quote(job.name),
+                                                     assignment=shlex.quote(job.assignment),
+                                                     student=shlex.quote(job.student), timeout=int(timeout)),
+                timeout + 120)
+            result = json.loads(output.strip().splitlines()[-1])
+            if result["status"] == "graded":
+                if os.path.exists(job_dir):
+                    shutil.rmtree(job_dir)
+                os.makedirs(job_dir)
+                sftp.get(remote + ".out.tar.gz", job_dir + ".out.tar.gz")
+                with tarfile.open(job_dir + ".out.tar.gz") as tar:
+                    tar.extractall(job_dir)
+                result["job_dir"] = job_dir
+        finally:
+            sftp.close()
+            try:
+                self._execute(instance_id, "rm -rf {0} {0}.tar.gz {0}.out.tar.gz".format(shlex.quote(remote)), 60)
+            except Exception:
+                pass  # the next run starts from an empty REMOTE_DIR
+        return result
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
+
+
+######################################################################################################################
+#################################################### SCHEDULER #######################################################
+######################################################################################################################
+
+class GradingScheduler(object):
+    """ Runs jobs on the backend's slots, one at a time per slot. A job that fails or times out is queued again, for
+        a slot on another grader where there is one, until it ran `attempts` times. on_result(job, result) is called
+        in run()'s thread as each job is graded, so it may write to the gradebook. """
+
+    def __init__(self, backend, timeout=DEFAULT_TIMEOUT, attempts=DEFAULT_ATTEMPTS, on_result=None, report=None):
+        self.backend = backend
+        self.timeout = timeout
+        self.attempts = attempts
+        self.on_result = on_result
+        self.report = report or progress
+
+    def _take(self, queue, slot):
+        """ The first queued job that did not fail on slot's grader, else the first job. """
+        for job in queue:
+            if slot[0] not in job.avoid:
+                queue.remove(job)
+                return job
+        return queue.popleft()
+
+    def _attempt(self, slot, job):
+        started = time.time()
+        try:
+            result = self.backend.run(slot, job, self.timeout)
+        except Exception as e:
+            result = {"status": "error", "log": str(e)}
+        result["wall_seconds"] = time.time() - started
+        return result
+
+    def run(self, jobs):
+        """ Runs jobs to completion. Returns a summary: graded and failed jobs, retries and job times. """
+        queue = deque(jobs)
+        free = deque(self.backend.slots())
+        running = {}
+        graded, failed, retries = [], [], 0
+        started = time.time()
+        with ThreadPoolExecutor(len(free)) as pool:
+            while queue or running:
+                while queue and free:
+                    slot = free.popleft()
+                    job = self._take(queue, slot)
+                    running[pool.submit(self._attempt, slot, job)] = (slot, job)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    slot, job = running.pop(future)
+                    free.append(slot)
+                    result = future.result()
+                    job.attempts += 1
+                    job.seconds.append(result["wall_seconds"])
+                    job.result = result
+                    if result["status"] == "graded":
+                        graded.append(job)
+                        if self.on_result is not None:
+                            try:
+                                self.on_result(job, result)
+                            except Exception as e:
+                                result["status"], result["log"] = "error", "merging failed: %s" % e
+                                graded.pop()
+                                failed.append(job)
+                                self.report("%s could not be merged: %s" % (job.student, e))
+                                continue
+                        self.report("%d/%d graded %s (%.1f s)" % (len(graded), len(jobs), job.student,
+                                                                   result["wall_seconds"]))
+                    elif job.attempts < self.attempts:
+                        retries += 1
+                        job.avoid.add(slot[0])
+                        queue.append(job)
+                        self.report("%s %s on %s, retrying" % (job.student, result["status"], slot[0]))
+                    else:
+                        failed.append(job)
+                        self.report("%s %s %d times: %s" % (job.student, result["status"], job.attempts,
+                                                            result.get("log", "").strip()[-200:]))
+        wall = time.time() - started
+        seconds = sorted(s for job in jobs for s in job.seconds)
+        return {
+            "jobs": len(jobs),
+            "graded": len(graded),
+            "failed": sorted(job.student for job in failed),
+            "retries": retries,
+            "slots": len(self.backend.slots()),
+            "wall_seconds": round(wall, 1),
+            "job_seconds": round(sum(seconds), 1),
+            "submissions_per_minute": round(60 * len(graded) / wall, 1) if wall else None,
+            "attempt_seconds": {"p%d" % p: round(percentile(seconds, p), 2) for p in (50, 90, 99)} if seconds else {},
+        }
+
+
+######################################################################################################################
+##################################################### GRADEBOOK ######################################################
+######################################################################################################################
+
+def merge(course_dir, job, result):
+    """ Records job's scores in the course's gradebook and copies its autograded notebooks into the course. """
+    from nbgrader.api import Gradebook, MissingEntry
+    autograded = os.path.join("autograded", job.student, job.assignment)
+    target = os.path.join(course_dir, autograded)
+    if os.path.exists(target):
+        shutil.rmtree(target)
+    shutil.copytree(os.path.join(result["job_dir"], autograded), target)
+    gradebook = Gradebook("sqlite:///%s" % os.path.join(course_dir, "gradebook.db"))
+    try:
+        try:
+            gradebook.find_student(job.student)
+        except MissingEntry:
+            gradebook.add_student(job.student)
+        try:
+            gradebook.find_submission(job.assignment, job.student)
+        except MissingEntry:
+            gradebook.add_submission(job.assignment, job.student)
+        for score in result["scores"]:
+            grade = gradebook.find_grade(score["cell"], score["notebook"], job.assignment, job.student)
+            grade.auto_score = score["auto_score"]
+        gradebook.db.commit()
+    finally:
+        gradebook.close()
+
+
+######################################################################################################################
+###################################################### GRADERS #######################################################
+######################################################################################################################
+
+class GraderPool(object):
+    """ The cluster's grader instances: started (or launched) for a run and stopped after it. """
+
+    def __init__(self, server_params):
+        import boto3
+        self.params = server_params
+        self.cluster = server_params["JUPYTER_CLUSTER"]
+        self.ec2 = boto3.client("ec2", region_name=server_params["REGION"])
+
+    def graders(self):
+        """ {instance id: state} of the cluster's graders. """
+        reservations = self.ec2.describe_instances(Filters=[
+            {"Name": "tag:" + GRADER_TAG, "Values": [self.cluster]},
+            {"Name": "instance-state-name", "Values": ["pending", "running", "stopping", "stopped"]}])["Reservations"]
+        return {instance["InstanceId"]: instance["State"]["Name"]
+                for reservation in reservations for instance in reservation["Instances"]}
+
+    def start(self, count, instance_type):
+        """ Starts `count` graders, launching the missing ones. Returns {instance id: private ip address}. """
+        graders = sorted(self.graders().items(), key=lambda item: item[1] != "running")[:count]
+        stopped = [instance_id for instance_id, state in graders if state in ("stopping", "stopped")]
+        if stopped:
+            self.ec2.get_waiter("instance_stopped").wait(InstanceIds=stopped)
+            self.ec2.start_instances(InstanceIds=stopped)
+            progress("starting graders %s" % ", ".join(stopped))
+        instance_ids = [instance_id for instance_id, _ in graders]
+        if len(instance_ids) < count:
+            reservation = self.ec2.run_instances(
+                ImageId=self.params["WORKER_AMI"], InstanceType=instance_type,
+                SubnetId=self.params["SUBNET_ID"], SecurityGroupIds=self.params["WORKER_SECURITY_GROUPS"],
+                KeyName=self.params["KEY_NAME"], MinCount=count - len(instance_ids), MaxCount=count - len(instance_ids),
+                TagSpecifications=[{"ResourceType": "instance", "Tags": [
+                    {"Key": "Name", "Value": "grader-%s" % self.cluster},
+                    {"Key": "Owner", "Value": self.params["WORKER_SERVER_OWNER"]},
+                    {"Key": GRADER_TAG, "Value": self.cluster}]}])
+            launched = [instance["InstanceId"] for instance in reservation["Instances"]]
+            progress("launched graders %s" % ", ".join(launched))
+            instance_ids += launched
+        self.ec2.get_waiter("instance_running").wait(InstanceIds=instance_ids)
+        reservations = self.ec2.describe_instances(InstanceIds=instance_ids)["Reservations"]
+        return {instance["InstanceId"]: instance["PrivateIpAddress"]
+                for reservation in reservations for instance in reservation["Instances"]}
+
+    def vcpus(self, instance_type):
+        description = self.ec2.describe_instance_types(InstanceTypes=[instance_type])["InstanceTypes"][0]
+        return description["VCpuInfo"]["DefaultVCpus"]
+
+    def stop(self, instance_ids, terminate=False):
+        if terminate:
+            self.ec2.terminate_instances(InstanceIds=list(instance_ids))
+        else:
+            self.ec2.stop_instances(InstanceIds=list(instance_ids))
+
+
+def grade(course_dir, assignment, students, graders, instance_type, slots_per_grader, timeout, attempts, local,
+          terminate):
+    course_dir = os.path.abspath(course_dir)
+    students = submissions(course_dir, assignment, students)
+    if not students:
+        raise SystemExit("no submissions of %s in %s" % (assignment, course_dir))
+    work_dir = tempfile.mkdtemp(prefix="grading-")
+    pool = backend = addresses = None
+    try:
+        jobs = [Job(assignment, student, pack_job(course_dir, assignment, student, work_dir)) for student in students]
+        progress("%d submissions of %s" % (len(jobs), assignment))
+        if local:
+            backend = ProcessPoolBackend(local)
+        else:
+            with open("/etc/jupyterhub/server_config.json") as f:
+                server_params = json.load(f)
+            instance_type = instance_type or server_params.get("GRADER_INSTANCE_TYPE") or \
+                server_params["INSTANCE_TYPE"]
+            pool = GraderPool(server_params)
+            graders = min(graders, len(jobs))
+            addresses = pool.start(graders, instance_type)
+            backend = SSHBackend(
+                addresses, server_params["WORKER_USERNAME"],
+                "/home/%s/.ssh/%s" % (server_params["SERVER_USERNAME"], server_params["KEY_NAME"]),
+                slots_per_grader or pool.vcpus(instance_type))
+        scheduler = GradingScheduler(backend, timeout, attempts,
+                                     on_result=lambda job, result: merge(course_dir, job, result))
+        summary = scheduler.run(jobs)
+    finally:
+        if backend is not None:
+            backend.close()
+        if pool is not None:
+            pool.stop(addresses or pool.graders(), terminate)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print(json.dumps(summary, indent=2))
+    return summary
+
+
+######################################################################################################################
+##################################################### BENCHMARK ######################################################
+######################################################################################################################
+
+BURN = "import sys, time\nend = time.time() + %f\nwhile time.time() < end: pass\nsys.exit(%d)"
+
+
+def synthetic_scores(job_dir, assignment, student):
+    return [{"notebook": "problem", "cell": "test", "auto_score": 1.0, "max_score": 1.0}]
+
+
+class SyntheticJobs(object):
+    """ Commands that burn CPU for about `seconds`, fail at failure_rate or hang (past the timeout) at hang_rate. """
+
+    def __init__(self, seconds, failure_rate, hang_rate, timeout):
+        self.seconds = seconds
+        self.failure_rate = failure_rate
+        self.hang_rate = hang_rate
+        self.timeout = timeout
+
+    def __call__(self, job):
+        draw = random.random()
+        if draw < self.hang_rate:
+            return [sys.executable, "-c", BURN % (self.timeout * 10, 0)]
+        seconds = self.seconds * random.uniform(0.5, 1.5)
+        return [sys.executable, "-c", BURN % (seconds, 1 if draw < self.hang_rate + self.failure_rate else 0)]
+
+
+def benchmark(submissions=400, processes=None, seconds=0.5, failure_rate=0.05, hang_rate=0.01, timeout=None):
+    processes = processes or os.cpu_count()
+    timeout = timeout or 10 * seconds
+    work_dir = tempfile.mkdtemp(prefix="grading-benchmark-")
+    backend = ProcessPoolBackend(processes, SyntheticJobs(seconds, failure_rate, hang_rate, timeout),
+                                 synthetic_scores)
+    try:
+        jobs = []
+        for i in range(submissions):
+            student = "student%03d" % i
+            os.makedirs(os.path.join(work_dir, "course", "submitted", student, "ps1"))
+            jobs.append(Job("ps1", student, pack_job(os.path.join(work_dir, "course"), "ps1", student, work_dir)))
+        merged = []
+        scheduler = GradingScheduler(backend, timeout, on_result=lambda job, result: merged.append(job.student),
+                                     report=lambda message: None)
+        summary = scheduler.run(jobs)
+    finally:
+        backend.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    summary["merged"] = len(merged)
+    summary["failed"] = len(summary["failed"])
+    print(json.dumps(summary, indent=2))
+    print("%d submissions on %d processes: %.1f s, against %.1f s for the attempts one after the other (%.1fx)" % (
+        submissions, processes, summary["wall_seconds"], summary["job_seconds"],
+        summary["job_seconds"] / summary["wall_seconds"]))
+    return summary
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Autogrades submissions in parallel")
+    commands = parser.add_subparsers(dest="command")
+    grade_parser = commands.add_parser("grade", help="autograde an assignment's submissions")
+    grade_parser.add_argument("course_dir", help="the nbgrader course directory, with gradebook.db and submitted/")
+    grade_parser.add_argument("assignment")
+    grade_parser.add_argument("--student", action="append", default=[], help="only this student (repeatable)")
+    grade_parser.add_argument("--graders", type=int, default=4, help="grader instances to use")
+    grade_parser.add_argument("--instance-type", help="of graders that are launched (default: GRADER_INSTANCE_TYPE)")
+    grade_parser.add_argument("--slots-per-grader", type=int, help="jobs at a time on a grader (default: its vCPUs)")
+    grade_parser.add_argument("--timeout", type=int, default=DEFAULT_TIMEOUT, help="seconds per attempt of a job")
+    grade_parser.add_argument("--attempts", type=int, default=DEFAULT_ATTEMPTS)
+    grade_parser.add_argument("--local", type=int, metavar="PROCESSES",
+                              help="grade in this many local processes instead of on graders")
+    grade_parser.add_argument("--terminate", action="store_true", help="terminate the graders instead of stopping")
+    benchmark_parser = commands.add_parser("benchmark", help="run synthetic jobs in a local process pool")
+    benchmark_parser.add_argument("--submissions", type=int, default=400)
+    benchmark_parser.add_argument("--processes", type=int, help="default: the number of CPUs")
+    benchmark_parser.add_argument("--seconds", type=float, default=0.5, help="CPU seconds of a job")
+    benchmark_parser.add_argument("--failure-rate", type=float, default=0.05)
+    benchmark_parser.add_argument("--hang-rate", type=float, default=0.01)
+    benchmark_parser.add_argument("--timeout", type=float, help="seconds per attempt (default: 10 * --seconds)")
+    job_parser = commands.add_parser("run-job", help="autograde one extracted job (on a grader)")
+    job_parser.add_argument("job_dir")
+    job_parser.add_argument("assignment")
+    job_parser.add_argument("student")
+    job_parser.add_argument("--timeout", type=int, default=DEFAULT_TIMEOUT)
+    job_parser.add_argument("--output", help="write the autograded notebooks to this .tar.gz")
+    args = parser.parse_args()
+    if args.command == "grade":
+        summary = grade(args.course_dir, args.assignment, args.student, args.graders, args.instance_type,
+                        args.slots_per_grader, args.timeout, args.attempts, args.local, args.terminate)
+        sys.exit(1 if summary["failed"] else 0)
+    elif args.command == "benchmark":
+        benchmark(args.submissions, args.processes, args.seconds, args.failure_rate, args.hang_rate, args.timeout)
+    elif args.command == "run-job":
+        result = run_job(args.job_dir, args.assignment, args.student, args.timeout)
+        if result["status"] == "graded" and args.output:
+            with tarfile.open(args.output, "w:gz") as tar:
+                tar.add(os.path.join(args.job_dir, "autograded"), arcname="autograded")
+        print(json.dumps(result))
+    else:
+        parser.print_help()
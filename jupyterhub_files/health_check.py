@@ -0,0 +1,144 @@
+""" Background health checking of worker instances.
+
+    Detecting a hung worker used to happen inside the spawner's poll(), which SSHed into the worker with several
+    retries and could hold a poll (and its pool threads) for many seconds. The HealthMonitor below probes every
+    registered worker on its own schedule instead, with a hard timeout per probe, and only changes its verdict once
+    several consecutive probes agree. poll() just reads the latest verdict. """
+
+import logging
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from tornado import gen
+from tornado.ioloop import PeriodicCallback
+from tornado.locks import Semaphore
+
+logger = logging.getLogger(__name__)
+
+HEALTHY = "HEALTHY"
+UNHEALTHY = "UNHEALTHY"
+UNKNOWN = "UNKNOWN"
+
+
+def uptime_seconds(launch_time, now=None):
+    """ Seconds since launch_time. Uses total_seconds(), as timedelta.seconds wraps around every 24 hours. """
+    now = now or datetime.utcnow()
+    return (now - launch_time.replace(tzinfo=None)).total_seconds()
+
+
+def probe_ssh(ip_address, port=22, timeout=5):
+    """ Returns True if an SSH server at ip_address answers with its banner within timeout seconds. This is a plain
+        socket read rather than a full Fabric session, so it cannot block longer than its timeouts. """
+    try:
+        with socket.create_connection((ip_address, port), timeout=timeout) as connection:
+            connection.settimeout(timeout)
+            return connection.recv(4).startswith(b"SSH-")
+    except (socket.timeout, OSError):
+        return False
+
+
+class HealthTarget(object):
+    """ Health state of a single worker instance. """
+
+    def __init__(self, instance_id, ip_address, launch_time):
+        self.instance_id = instance_id
+        self.ip_address = ip_address
+        self.launch_time = launch_time
+        self.verdict = UNKNOWN
+        self.consecutive_failures = 0
+        self.consecutive_successes = 0
+        self.last_checked = None
+
+    def record(self, ok, failure_threshold, recovery_threshold):
+        """ Records a probe result. The verdict only flips to UNHEALTHY after failure_threshold consecutive failures,
+            and only back to HEALTHY after recovery_threshold consecutive successes. """
+        self.last_checked = datetime.utcnow()
+        if ok:
+            self.consecutive_successes += 1
+            self.consecutive_failures = 0
+            if self.verdict == UNKNOWN or self.consecutive_successes >= recovery_threshold:
+                self.verdict = HEALTHY
+        else:
+            self.consecutive_failures += 1
+            self.consecutive_successes = 0
+            if self.consecutive_failures >= failure_threshold:
+                self.verdict = UNHEALTHY
+
+
+class HealthMonitor(object):
+    """ Periodically probes registered workers and keeps a verdict per key (the user name, in the spawner).
+        Workers are not probed until they have been up for grace_period seconds, which leaves the user data script
+        time to finish (it deliberately stops sshd while it sets up the user's home). """
+
+    def __init__(self, interval=30, probe_timeout=5, failure_threshold=3, recovery_threshold=2, grace_period=180,
+                 max_concurrent_probes=20):
+        self.interval = interval
+        self.probe_timeout = probe_timeout
+        self.failure_threshold = failure_threshold
+        self.recovery_threshold = recovery_threshold
+        self.grace_period = grace_period
+        self.targets = {}
+        self._semaphore = Semaphore(max_concurrent_probes)
+        self._probe_pool = ThreadPoolExecutor(max_concurrent_probes)
+        self._periodic_callback = None
+        self._checking = False
+
+    def start(self):
+        """ Starts the periodic checks on the current IOLoop; calling it again is a no-op. """
+        if self._periodic_callback is None:
+            self._periodic_callback = PeriodicCallback(self.check_all, 1e3 * self.interval)
+            self._periodic_callback.start()
+
+    def stop(self):
+        if self._periodic_callback is not None:
+            self._periodic_callback.stop()
+            self._periodic_callback = None
+
+    def register(self, key, instance_id, ip_address, launch_time):
+        """ Starts (or keeps) monitoring an instance. A different instance or a new launch time (i.e. the instance
+            was stopped and started again) resets the target's health history. """
+        target = self.targets.get(key)
+        if target is None or target.instance_id != instance_id or target.launch_time != launch_time:
+            self.targets[key] = HealthTarget(instance_id, ip_address, launch_time)
+        else:
+            target.ip_address = ip_address
+        self.start()
+
+    def unregister(self, key):
+        self.targets.pop(key, None)
+
+    def verdict(self, key):
+        """ Returns the latest verdict for key without doing any I/O. """
+        target = self.targets.get(key)
+        return target.verdict if target is not None else UNKNOWN
+
+    @gen.coroutine
+    def check_all(self):
+        """ Probes every registered target concurrently. A pass that is still running when the next one is due
+            causes the next one to be skipped rather than overlapping. """
+        if self._checking:
+            return
+        self._checking = True
+        try:
+            yield [self.check(target) for target in list(self.targets.values())]
+        finally:
+            self._checking = False
+
+    @gen.coroutine
+    def check(self, target):
+        if uptime_seconds(target.launch_time) <= self.grace_period:
+            return
+        # the timeout starts once a probe slot is free, so a long queue of probes cannot cause false failures.
+        with (yield self._semaphore.acquire()):
+            try:
+                ok = yield gen.with_timeout(timedelta(seconds=self.probe_timeout),
+                                            self._probe_pool.submit(probe_ssh, target.ip_address,
+                                                                    timeout=self.probe_timeout))
+            except gen.TimeoutError:
+                ok = False
+        previous_verdict = target.verdict
+        target.record(ok, self.failure_threshold, self.recovery_threshold)
+        if target.verdict != previous_verdict:
+            logger.info("health of instance %s changed from %s to %s", target.instance_id, previous_verdict,
+                        target.verdict)
@@ -0,0 +1,226 @@
+""" Users' home volumes, decoupled from their worker instances.
+
+    A user's home volume used to be created by run_instances together with their worker, which tied the user to that
+    instance for good. HomeVolumes instead creates the volume once, in the availability zone of the user's first
+    worker, attaches it to whichever instance the user is given when they start their server and detaches it once that
+    instance is stopped again. Stopping, terminating or replacing a worker therefore never touches the user's files, and
+    a terminated or broken worker is replaced by attaching the volume to a new one. The HomeVolume table records where
+    each volume is.
+
+    New volumes are created from the cluster's golden snapshot when there is one (see golden_home.py): a formatted
+    volume that already holds the home directory skeleton and course materials, so that a new user's first boot only
+    has to move it into place instead of formatting the volume and copying files.
+
+    Volumes get the EBS settings (type, IOPS, throughput) of the user's instance profile, see instance_profiles.py. An
+    existing volume whose settings differ is modified while it is attached; EC2 allows one modification per volume
+    every six hours, so a failed modification only leaves the volume as it was. """
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.exceptions import ClientError, WaiterError
+from tornado import gen
+
+from instance_profiles import DEFAULT_VOLUME, ebs_parameters
+from models import HomeVolume
+
+logger = logging.getLogger(__name__)
+
+HOME_DEVICE = "/dev/sdf"  # seen as xvdf by the worker's user data script
+GOLDEN_TAG = "Golden Home"  # tags the golden snapshots, with the cluster name as value
+GOLDEN_LOOKUP_INTERVAL = 300  # seconds between lookups of the latest golden snapshot
+
+
+class HomeVolumeError(Exception):
+    pass
+
+
+def instance_state(ec2, instance_id):
+    """ Returns the state of instance_id; instances EC2 no longer knows about are reported as terminated. """
+    try:
+        reservations = ec2.describe_instances(InstanceIds=[instance_id])["Reservations"]
+    except ClientError as e:
+        if "InvalidInstanceID.NotFound" not in str(e):
+            raise
+        reservations = []
+    return reservations[0]["Instances"][0]["State"]["Name"] if reservations else "terminated"
+
+
+def golden_snapshots(ec2, cluster):
+    """ The completed golden snapshots of the cluster, newest first. """
+    snapshots = ec2.describe_snapshots(OwnerIds=["self"], Filters=[
+        {"Name": "tag:%s" % GOLDEN_TAG, "Values": [cluster]}, {"Name": "status", "Values": ["completed"]}])["Snapshots"]
+    return sorted(snapshots, key=lambda snapshot: snapshot["StartTime"], reverse=True)
+
+
+class HomeVolumes(object):
+
+    def __init__(self, region, size, volume=None, tags=None, halt_timeout=600, max_workers=10,
+                 golden_cluster=None):
+        self.region = region
+        self.size = size
+        self.volume = volume or DEFAULT_VOLUME  # the default EBS settings
+        self.tags = tags or []
+        self.halt_timeout = halt_timeout
+        self.golden_cluster = golden_cluster  # look for golden snapshots tagged with this cluster name
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.releases = {}  # user name: Future of a pending release
+        self._golden = (None, 0)  # (snapshot id, time of the lookup)
+
+    @gen.coroutine
+    def ensure(self, user_name, availability_zone, volume=None):
+        """ Returns the user's HomeVolume, creating the volume in availability_zone, with the EBS settings volume, if
+            they have none yet. """
+        record = HomeVolume.get_volume(user_name)
+        if record is None:
+            record = yield self.executor.submit(self._create, user_name, availability_zone, volume)
+        return record
+
+    @gen.coroutine
+    def claim(self, user_name, instance_id, volume=None):
+        """ Attaches the user's home volume to instance_id (running or stopped), creating the volume first if the user
+            has none, and modifies it to the EBS settings volume if given. Waits for a release of the volume still in
+            progress, so that it cannot detach the volume from an instance that is being started again. Returns the
+            HomeVolume. """
+        pending = self.releases.get(user_name)
+        if pending is not None:
+            try:
+                yield pending
+            except (HomeVolumeError, ClientError, WaiterError):
+                pass  # already logged by release(), _claim() handles whatever state the volume is in
+        record = yield self.executor.submit(self._claim, user_name, instance_id, volume)
+        return record
+
+    @gen.coroutine
+    def release(self, user_name, instance_id):
+        """ Detaches the user's home volume from instance_id once the instance has stopped. A terminated instance
+            releases its volume by itself. """
+        future = self.executor.submit(self._release, user_name, instance_id)
+        self.releases[user_name] = future
+        try:
+            yield future
+        except (HomeVolumeError, ClientError, WaiterError) as e:
+            logger.error("could not release home volume of %s: %s", user_name, e)
+            raise
+        finally:
+            if self.releases.get(user_name) is future:
+                del self.releases[user_name]
+
+    def _client(self):
+        return boto3.client("ec2", region_name=self.region)
+
+    def golden_snapshot_id(self, ec2):
+        """ The latest golden snapshot, looked up at most every GOLDEN_LOOKUP_INTERVAL seconds, or None. """
+        if self.golden_cluster is None:
+            return None
+        snapshot_id, looked_up_at = self._golden
+        if time.time() - looked_up_at > GOLDEN_LOOKUP_INTERVAL:
+            try:
+                snapshots = golden_snapshots(ec2, self.golden_cluster)
+                snapshot_id = snapshots[0]["SnapshotId"] if snapshots else None
+            except ClientError as e:
+                logger.warning("could not look up the golden home snapshot: %s", e)
+            self._golden = (snapshot_id, time.time())
+        return snapshot_id
+
+    def _create(self, user_name, availability_zone, volume_settings=None):
+        ec2 = self._client()
+        tags = self.tags + [{"Key": "User", "Value": user_name}]
+        snapshot_args = {}
+        snapshot_id = self.golden_snapshot_id(ec2)
+        if snapshot_id is not None:
+            snapshot_args = {"SnapshotId": snapshot_id}
+            tags = tags + [{"Key": GOLDEN_TAG, "Value": snapshot_id}]
+        volume = ec2.create_volume(
+            AvailabilityZone=availability_zone,
+            Size=self.size,
+            TagSpecifications=[{"ResourceType": "volume", "Tags": tags}],
+            **dict(ebs_parameters(volume_settings or self.volume), **snapshot_args)
+        )
+        record = HomeVolume.new_volume(user_name, volume["VolumeId"], availability_zone)
+        logger.info("created home volume %s for %s in %s%s", volume["VolumeId"], user_name, availability_zone,
+                    " from %s" % snapshot_id if snapshot_id else "")
+        ec2.get_waiter("volume_available").wait(VolumeIds=[volume["VolumeId"]])
+        return record
+
+    def _claim(self, user_name, instance_id, volume_settings=None):
+        ec2 = self._client()
+        instance = ec2.describe_instances(InstanceIds=[instance_id])["Reservations"][0]["Instances"][0]
+        availability_zone = instance["Placement"]["AvailabilityZone"]
+        record = HomeVolume.get_volume(user_name)
+        if record is None:
+            mappings = {mapping["DeviceName"]: mapping["Ebs"]["VolumeId"]
+                        for mapping in instance.get("BlockDeviceMappings", []) if "Ebs" in mapping}
+            if HOME_DEVICE in mappings:
+                # a worker launched before home volumes were tracked, with the volume in its block device mappings
+                record = HomeVolume.new_volume(user_name, mappings[HOME_DEVICE], availability_zone, instance_id)
+            else:
+                record = self._create(user_name, availability_zone, volume_settings)
+        volume = ec2.describe_volumes(VolumeIds=[record.volume_id])["Volumes"][0]
+        if record.availability_zone != volume["AvailabilityZone"]:
+            record.availability_zone = volume["AvailabilityZone"]
+            record.save()
+        if volume["AvailabilityZone"] != availability_zone:
+            raise HomeVolumeError("home volume %s of %s is in %s, but instance %s is in %s" % (
+                record.volume_id, user_name, volume["AvailabilityZone"], instance_id, availability_zone))
+        if volume_settings is not None:
+            self._modify(ec2, volume, volume_settings)
+        for attachment in volume["Attachments"]:
+            if attachment["InstanceId"] == instance_id:
+                HomeVolume.set_instance(record.volume_id, instance_id)
+                return record
+            self._detach(ec2, record.volume_id, attachment["InstanceId"])
+        ec2.attach_volume(VolumeId=record.volume_id, InstanceId=instance_id, Device=HOME_DEVICE)
+        ec2.get_waiter("volume_in_use").wait(VolumeIds=[record.volume_id])
+        HomeVolume.set_instance(record.volume_id, instance_id)
+        logger.info("attached home volume %s of %s to %s", record.volume_id, user_name, instance_id)
+        return record
+
+    def _release(self, user_name, instance_id):
+        record = HomeVolume.get_volume(user_name)
+        if record is None:
+            return
+        ec2 = self._client()
+        state = self._wait_until_halted(ec2, instance_id)
+        if state == "stopped":
+            volume = ec2.describe_volumes(VolumeIds=[record.volume_id])["Volumes"][0]
+            if any(attachment["InstanceId"] == instance_id for attachment in volume["Attachments"]):
+                self._detach(ec2, record.volume_id, instance_id)
+                logger.info("detached home volume %s of %s from %s", record.volume_id, user_name, instance_id)
+        if record.instance_id == instance_id:
+            HomeVolume.set_instance(record.volume_id, None)
+
+    def _modify(self, ec2, volume, settings):
+        """ Modifies volume (as described by EC2) to settings if they differ. """
+        parameters = ebs_parameters(settings)
+        if all(volume.get(key) == value for key, value in parameters.items()):
+            return
+        try:
+            ec2.modify_volume(VolumeId=volume["VolumeId"], **parameters)
+            logger.info("modifying home volume %s to %s", volume["VolumeId"], parameters)
+        except ClientError as e:
+            logger.warning("could not modify home volume %s to %s: %s", volume["VolumeId"], parameters, e)
+
+    def _detach(self, ec2, volume_id, instance_id):
+        """ Detaches volume_id from instance_id, which must be stopped or terminated: detaching a mounted volume from a
+            running instance would hang or corrupt it. """
+        state = instance_state(ec2, instance_id)
+        if state not in ["stopped", "terminated"]:
+            raise HomeVolumeError("volume %s is attached to instance %s, which is %s" % (volume_id, instance_id, state))
+        if state == "stopped":
+            ec2.detach_volume(VolumeId=volume_id, InstanceId=instance_id)
+        ec2.get_waiter("volume_available").wait(VolumeIds=[volume_id])
+
+    def _wait_until_halted(self, ec2, instance_id, interval=5):
+        """ Waits until instance_id is stopped or terminated and returns its state. """
+        deadline = time.time() + self.halt_timeout
+        while True:
+            state = instance_state(ec2, instance_id)
+            if state in ["stopped", "terminated"]:
+                return state
+            if time.time() > deadline:
+                raise HomeVolumeError("instance %s is still %s after %s seconds"
+                                      % (instance_id, state, self.halt_timeout))
+            time.sleep(interval)
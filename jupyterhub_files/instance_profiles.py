@@ -0,0 +1,162 @@
+""" Instance profiles: the named worker sizes users can run on.
+
+    Profiles are defined in /etc/jupyterhub/instance_profiles.json, for example:
+
+        {
+            "default": "standard",
+            "profiles": {
+                "small":    {"description": "1 vCPU, 1 GB",  "instance_type": "t2.micro"},
+                "standard": {"description": "2 vCPU, 4 GB",  "instance_type": "t2.medium",
+                             "fallback_instance_types": ["t3.medium"]},
+                "large":    {"description": "4 vCPU, 16 GB", "instance_type": "t2.xlarge",
+                             "spot_instance_types": ["t3.xlarge", "t3a.xlarge", "m5.xlarge"]},
+                "data":     {"description": "4 vCPU, 32 GB, fast disks", "instance_type": "r5d.xlarge",
+                             "root_volume": {"type": "gp3", "iops": 6000, "throughput": 250},
+                             "home_volume": {"type": "io2", "iops": 8000}, "scratch": true}
+            },
+            "groups": {
+                "students":    ["standard", "small"],
+                "instructors": ["large", "standard", "small"]
+            }
+        }
+
+    Users are put in a group (or pinned to a profile) in the userlist, e.g. `jdoe admin group=instructors` or
+    `asmith profile=large`. A user may pick any profile of their group in the spawn form, the first one being their
+    default; users without a group get the "default" profile. Without an instance_profiles.json every user runs on
+    the cluster-wide INSTANCE_TYPE, as before.
+
+    "fallback_instance_types" are launched (or a stopped worker is resized to them) when no availability zone has
+    capacity for the profile's instance type. When Spot workers are enabled, "spot_instance_types" lists the
+    interchangeable types to try for a profile, in order of preference, defaulting to the profile's instance type.
+    Without profiles, the cluster-wide FALLBACK_INSTANCE_TYPES and SPOT_INSTANCE_TYPES are used.
+
+    "root_volume" and "home_volume" override the EBS settings of the cluster-wide ROOT_VOLUME and HOME_VOLUME: "type"
+    (gp3, gp2, io1, io2), "iops" and "throughput" (MiB/s, gp3 only); unset values get the type's baseline, which for
+    gp3 is 3000 IOPS and 125 MiB/s at any size. A user's home volume is modified to the settings of the profile they
+    start with. "scratch" (or the cluster-wide WORKER_SCRATCH) mounts the instance store of instance types that have
+    one, e.g. r5d or m5d, at /mnt; it is blank after every stop. """
+
+import json
+import os
+
+# gp2 volumes smaller than 1 TB run on burst credits and are throttled once those run out
+DEFAULT_VOLUME = {"type": "gp3"}
+# the instance store disks of instance types that have them; Nitro instance types attach theirs in any case
+SCRATCH_DEVICES = [{"DeviceName": "/dev/sd%s" % letter, "VirtualName": "ephemeral%d" % i}
+                   for i, letter in enumerate("bcde")]
+PROFILES_FILE = "/etc/jupyterhub/instance_profiles.json"
+USERLIST_FILE = "/etc/jupyterhub/userlist"
+
+
+def ebs_parameters(volume):
+    """ The VolumeType, Iops and Throughput for run_instances, create_volume and modify_volume of volume settings. """
+    volume_type = volume.get("type") or DEFAULT_VOLUME["type"]
+    parameters = {"VolumeType": volume_type}
+    if volume.get("iops") and volume_type in ("gp3", "io1", "io2"):
+        parameters["Iops"] = int(volume["iops"])
+    elif volume_type in ("io1", "io2"):
+        parameters["Iops"] = 3000  # provisioned IOPS volumes require a value
+    if volume.get("throughput") and volume_type == "gp3":
+        parameters["Throughput"] = int(volume["throughput"])
+    return parameters
+
+
+def read_userlist(path=USERLIST_FILE):
+    """ Parses the userlist. Each line is a user name, optionally followed by `admin` and by key=value settings.
+        Returns {name: {"admin": bool, **settings}}. """
+    users = {}
+    if not os.path.isfile(path):
+        return users
+    with open(path) as f:
+        for line in f:
+            if line.isspace():
+                continue
+            parts = line.split()
+            settings = {"admin": len(parts) > 1 and parts[1] == "admin"}
+            for part in parts[1:]:
+                if "=" in part:
+                    key, value = part.split("=", 1)
+                    settings[key] = value
+            users[parts[0]] = settings
+    return users
+
+
+class InstanceProfiles(object):
+
+    def __init__(self, default_instance_type, default_spot_instance_types=None, default_fallback_instance_types=None,
+                 profiles_file=PROFILES_FILE, userlist_file=USERLIST_FILE, default_volumes=None):
+        self.default_instance_type = default_instance_type
+        self.default_spot_instance_types = default_spot_instance_types
+        self.default_fallback_instance_types = default_fallback_instance_types
+        # {"root_volume": settings, "home_volume": settings, "scratch": bool}
+        self.default_volumes = default_volumes or {}
+        self.profiles_file = profiles_file
+        self.userlist_file = userlist_file
+        self.load()
+
+    def load(self):
+        """ (Re)reads the profile definitions and the userlist. """
+        config = {}
+        if os.path.isfile(self.profiles_file):
+            with open(self.profiles_file) as f:
+                config = json.load(f)
+        self.profiles = config.get("profiles") or {
+            "default": {"description": "Default", "instance_type": self.default_instance_type,
+                        "spot_instance_types": self.default_spot_instance_types,
+                        "fallback_instance_types": self.default_fallback_instance_types}
+        }
+        self.default_profile = config.get("default") or sorted(self.profiles)[0]
+        self.groups = config.get("groups", {})
+        self.users = read_userlist(self.userlist_file)
+
+    def set_users(self, users):
+        """ Takes the users' settings from a userlist read elsewhere, e.g. by the roster when the file changed. """
+        self.users = users
+
+    def allowed_profiles(self, user_name):
+        """ The profiles user_name may choose from, their default first. """
+        settings = self.users.get(user_name, {})
+        if "profile" in settings:
+            allowed = [settings["profile"]]
+        elif settings.get("group") in self.groups:
+            allowed = self.groups[settings["group"]]
+        else:
+            allowed = [self.default_profile]
+        return [profile for profile in allowed if profile in self.profiles] or [self.default_profile]
+
+    def resolve(self, user_name, requested=None, stored=None):
+        """ Picks the profile for a spawn: the one the user requested if they are allowed to use it, then the one
+            stored for them (their last choice, or one set by an admin), then their default. """
+        allowed = self.allowed_profiles(user_name)
+        if requested in allowed:
+            return requested
+        if stored in self.profiles:
+            return stored
+        return allowed[0]
+
+    def instance_type(self, profile):
+        return self.profiles.get(profile, {}).get("instance_type", self.default_instance_type)
+
+    def instance_types(self, profile):
+        """ The profile's instance type followed by its fallback types. """
+        fallbacks = self.profiles.get(profile, {}).get("fallback_instance_types") or []
+        return [self.instance_type(profile)] + [t for t in fallbacks if t != self.instance_type(profile)]
+
+    def spot_instance_types(self, profile):
+        return self.profiles.get(profile, {}).get("spot_instance_types") or [self.instance_type(profile)]
+
+    def volume(self, profile, name):
+        """ The settings of the profile's "root_volume" or "home_volume", over the cluster-wide ones. """
+        settings = dict(self.default_volumes.get(name) or DEFAULT_VOLUME)
+        settings.update(self.profiles.get(profile, {}).get(name) or {})
+        return settings
+
+    def scratch(self, profile):
+        """ Whether the profile's workers mount their instance store at /mnt. """
+        return bool(self.profiles.get(profile, {}).get("scratch", self.default_volumes.get("scratch", False)))
+
+    def profile_for_instance_type(self, instance_type):
+        for name, profile in sorted(self.profiles.items()):
+            if profile.get("instance_type") == instance_type:
+                return name
+        return None
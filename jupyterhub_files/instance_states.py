@@ -0,0 +1,100 @@
+""" A shared, batched cache of worker instance descriptions.
+
+    Looking up instances one at a time costs one DescribeInstances call each, which adds up when many users are
+    stopped or started together. InstanceStateCache collects the lookups made within a short window and answers them
+    with as few DescribeInstances calls as possible, then keeps the descriptions for a few seconds so that the spawner's
+    components can share them. """
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+DESCRIBE_FILTER_LIMIT = 200  # values per DescribeInstances filter
+
+
+class InstanceStateCache(object):
+
+    def __init__(self, region, ttl=5, window=0.2, max_workers=4):
+        self.region = region
+        self.window = window
+        self.cache = TTLCache(ttl)
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.describe_calls = 0
+        self._queued = {}  # instance id: [Future]
+
+    @gen.coroutine
+    def get(self, instance_ids):
+        """ Returns {instance id: description} as returned by DescribeInstances. Instances EC2 no longer knows about
+            are described as terminated. """
+        descriptions = {}
+        futures = {}
+        for instance_id in instance_ids:
+            cached = self.cache.get(instance_id)
+            if cached is not None:
+                descriptions[instance_id] = cached
+            else:
+                futures[instance_id] = self._queue(instance_id)
+        if futures:
+            fetched = yield list(futures.values())
+            descriptions.update(zip(futures, fetched))
+        return descriptions
+
+    @gen.coroutine
+    def state(self, instance_id):
+        """ Returns the state name of a single instance. """
+        descriptions = yield self.get([instance_id])
+        return descriptions[instance_id]["State"]["Name"]
+
+    def invalidate(self, instance_ids):
+        for instance_id in instance_ids:
+            self.cache.pop(instance_id)
+
+    def _queue(self, instance_id):
+        future = Future()
+        if not self._queued:
+            IOLoop.current().call_later(self.window, self._flush)
+        self._queued.setdefault(instance_id, []).append(future)
+        return future
+
+    @gen.coroutine
+    def _flush(self):
+        queued, self._queued = self._queued, {}
+        instance_ids = list(queued)
+        chunks = [instance_ids[i:i + DESCRIBE_FILTER_LIMIT] for i in range(0, len(instance_ids), DESCRIBE_FILTER_LIMIT)]
+        try:
+            # run_in_executor rather than a list of executor.submit() futures, whose callbacks gen.multi would run on
+            # the executor's threads, without waking the IOLoop
+            io_loop = IOLoop.current()
+            responses = yield [io_loop.run_in_executor(self.executor, self._describe, chunk) for chunk in chunks]
+        except Exception as e:
+            # not only ClientError: a BotoCoreError (e.g. EndpointConnectionError, ReadTimeout) must fail the waiting
+            # lookups as well, or they would wait forever
+            logger.warning("could not describe instances: %s" % e)
+            for futures in queued.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        found = {instance["InstanceId"]: instance for instances in responses for instance in instances}
+        for instance_id, futures in queued.items():
+            description = found.get(instance_id, {"InstanceId": instance_id, "State": {"Name": "terminated"}})
+            self.cache.set(instance_id, description)
+            for future in futures:
+                future.set_result(description)
+
+    def _describe(self, instance_ids):
+        # a filter, unlike InstanceIds, does not fail the whole call when one instance no longer exists
+        self.describe_calls += 1
+        ec2 = boto3.client("ec2", region_name=self.region)
+        paginator = ec2.get_paginator("describe_instances")
+        return [instance
+                for page in paginator.paginate(Filters=[{"Name": "instance-id", "Values": instance_ids}])
+                for reservation in page["Reservations"] for instance in reservation["Instances"]]
@@ -0,0 +1,217 @@
+#!/usr/bin/python3 python3
+""" A small, fio-like disk benchmark for workers, to compare volume settings and instance types.
+
+    For each path it writes and reads back a test file sequentially in large blocks, and then reads and writes 4 KiB
+    blocks at random offsets from several threads, as a notebook loading a dataset or a database would. It reports
+    the throughput (MiB/s), the IOPS and the latency of the random I/O. The file is opened with O_DIRECT where the file
+    system allows it, so that the page cache does not hide the disk; elsewhere the cache is dropped before reading.
+
+    The worker AMI has it next to the worker agent: `python3 /opt/jupyter_worker_agent/io_benchmark.py / /jupyteruser
+    /mnt` on a worker compares its root volume, home volume and instance store scratch disk. On the manager,
+    `python3 /etc/jupyterhub/io_benchmark.py --user alice --user bob` runs it through the worker agents of these
+    users' running workers and prints their instance types and profiles with the results, e.g. for one user per
+    instance profile. gp2 volumes run on burst credits, so a long enough run (--size) shows their baseline. """
+
+import json
+import mmap
+import os
+import random
+import threading
+import time
+
+BLOCK_SIZE = 1024 * 1024  # bytes per sequential read or write
+RANDOM_BLOCK_SIZE = 4096
+TEST_FILE = ".io_benchmark"
+
+
+def default_paths():
+    """ / and whichever of the home volume (/jupyteruser) and the scratch disk (/mnt) are mounted. """
+    return ["/"] + [path for path in ("/jupyteruser", "/mnt") if os.path.ismount(path)]
+
+
+def open_test_file(path, flags):
+    """ Opens path with O_DIRECT if its file system supports it. Returns (fd, direct). """
+    if hasattr(os, "O_DIRECT"):
+        try:
+            return os.open(path, flags | os.O_DIRECT, 0o600), True
+        except OSError:
+            pass  # e.g. tmpfs
+    return os.open(path, flags, 0o600), False
+
+
+def drop_cache(fd):
+    os.fsync(fd)
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, len(sorted_values) * p // 100)]
+
+
+def sequential(fd, size, write):
+    """ Reads or writes size bytes from the start of fd. Returns MiB/s. """
+    buffer = mmap.mmap(-1, BLOCK_SIZE)  # page aligned, as O_DIRECT requires
+    if write:
+        buffer.write(os.urandom(BLOCK_SIZE))
+    os.lseek(fd, 0, os.SEEK_SET)
+    started = time.perf_counter()
+    for _ in range(size // BLOCK_SIZE):
+        if write:
+            os.writev(fd, [buffer])
+        elif os.readv(fd, [buffer]) < BLOCK_SIZE:
+            break
+    if write:
+        os.fsync(fd)
+    return size / (1024.0 * 1024) / (time.perf_counter() - started)
+
+
+def random_io(path, size, write, seconds, jobs):
+    """ Reads or writes random 4 KiB blocks of the file at path from `jobs` threads for `seconds`. Returns (IOPS,
+        latencies in seconds). """
+    latencies = []
+    deadline = time.perf_counter() + seconds
+    blocks = size // RANDOM_BLOCK_SIZE
+
+    def job():
+        fd, _ = open_test_file(path, (os.O_RDWR | os.O_DSYNC) if write else os.O_RDONLY)
+        buffer = mmap.mmap(-1, RANDOM_BLOCK_SIZE)
+        if write:
+            buffer.write(os.urandom(RANDOM_BLOCK_SIZE))
+        done = []
+        try:
+            while True:
+                started = time.perf_counter()
+                if started >= deadline:
+                    break
+                os.lseek(fd, random.randrange(blocks) * RANDOM_BLOCK_SIZE, os.SEEK_SET)
+                if write:
+                    os.writev(fd, [buffer])
+                else:
+                    os.readv(fd, [buffer])
+                done.append(time.perf_counter() - started)
+        finally:
+            os.close(fd)
+        latencies.extend(done)  # list.extend is atomic
+
+    threads = [threading.Thread(target=job) for _ in range(jobs)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(latencies) / (time.perf_counter() - started), sorted(latencies)
+
+
+def run(path, size_mb=1024, seconds=10, jobs=8):
+    """ Benchmarks the file system path is on with a size_mb test file, which is removed afterwards. """
+    size = max(1, size_mb) * 1024 * 1024
+    file_path = os.path.join(path, TEST_FILE)
+    statvfs = os.statvfs(path)
+    if statvfs.f_bavail * statvfs.f_frsize < size * 1.1:
+        raise ValueError("not enough free space in %s for a %s MiB test file" % (path, size_mb))
+    result = {"path": path, "size_mb": size_mb, "jobs": jobs}
+    try:
+        fd, result["direct"] = open_test_file(file_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+        try:
+            result["write_mb_per_second"] = round(sequential(fd, size, write=True), 1)
+            drop_cache(fd)
+            result["read_mb_per_second"] = round(sequential(fd, size, write=False), 1)
+            drop_cache(fd)
+        finally:
+            os.close(fd)
+        for name, write in (("random_read", False), ("random_write", True)):
+            iops, latencies = random_io(file_path, size, write, seconds, jobs)
+            result[name + "_iops"] = round(iops)
+            if latencies:
+                result[name + "_latency_ms"] = {"p50": round(1000 * percentile(latencies, 50), 2),
+                                                "p99": round(1000 * percentile(latencies, 99), 2)}
+    finally:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+    return result
+
+
+def print_report(results):
+    print("%-24s %-12s %-12s %8s %10s %10s %10s %10s %12s" % (
+        "worker", "path", "direct", "MiB", "write MB/s", "read MB/s", "rand rd/s", "rand wr/s", "rd p99 ms"))
+    for result in results:
+        if "error" in result:
+            print("%-24s %-12s %s" % (result.get("worker", ""), result.get("path", ""), result["error"]))
+            continue
+        print("%-24s %-12s %-12s %8d %10.1f %10.1f %10d %10d %12.2f" % (
+            result.get("worker", "local"), result["path"], result["direct"], result["size_mb"],
+            result["write_mb_per_second"], result["read_mb_per_second"], result["random_read_iops"],
+            result["random_write_iops"], result.get("random_read_latency_ms", {}).get("p99", 0)))
+
+
+def run_on_workers(user_names, paths, size_mb, seconds, jobs):
+    """ Runs the benchmark through the worker agents of the users' running workers (on the manager). """
+    import boto3
+    from tornado.ioloop import IOLoop
+    from models import Server, UserProfile
+    from worker_agent import AgentClientPool, WorkerAgentError, DEFAULT_AGENT_PORT
+
+    with open("/etc/jupyterhub/server_config.json") as f:
+        server_params = json.load(f)
+    if not server_params.get("WORKER_AGENT_SECRET"):
+        raise SystemExit("the workers of this cluster have no worker agent, run the benchmark on them directly")
+    ec2 = boto3.client("ec2", region_name=server_params["REGION"])
+    agents = AgentClientPool(server_params["WORKER_AGENT_SECRET"],
+                             server_params.get("WORKER_AGENT_PORT", DEFAULT_AGENT_PORT))
+    results = []
+
+    def benchmark_user(user_name):
+        try:
+            instance_id = Server.get_server(user_name).server_id
+        except Server.DoesNotExist:
+            results.append({"worker": user_name, "error": "has no worker"})
+            return
+        instance = ec2.describe_instances(InstanceIds=[instance_id])["Reservations"][0]["Instances"][0]
+        if instance["State"]["Name"] != "running":
+            results.append({"worker": user_name, "error": "worker %s is %s" % (instance_id,
+                                                                               instance["State"]["Name"])})
+            return
+        worker = "%s (%s, %s)" % (user_name, instance["InstanceType"], UserProfile.get_profile(user_name) or "-")
+        agent = agents.get(user_name, instance["PrivateIpAddress"])
+        timeout = (len(paths) if paths else 3) * (2 * seconds + size_mb / 10 + 60)
+        try:
+            response = IOLoop.current().run_sync(lambda: agent.call(
+                "io_benchmark", timeout=timeout, paths=paths, size_mb=size_mb, seconds=seconds, jobs=jobs))
+        except WorkerAgentError as e:
+            results.append({"worker": worker, "error": str(e)})
+            return
+        for result in response["results"]:
+            result["worker"] = worker
+            results.append(result)
+
+    for user_name in user_names:
+        benchmark_user(user_name)
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Measures disk throughput, IOPS and latency")
+    parser.add_argument("paths", nargs="*", default=[], help="directories to test (default: / and, where they are "
+                        "mounted, /jupyteruser and /mnt)")
+    parser.add_argument("--user", action="append", default=[],
+                        help="on the manager, run on this user's running worker (repeatable)")
+    parser.add_argument("--size", type=int, default=1024, help="MiB of the test file")
+    parser.add_argument("--seconds", type=int, default=10, help="duration of each random I/O test")
+    parser.add_argument("--jobs", type=int, default=8, help="threads doing random I/O")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+    if args.user:
+        results = run_on_workers(args.user, args.paths or None, args.size, args.seconds, args.jobs)
+    else:
+        results = []
+        for path in args.paths or default_paths():
+            try:
+                results.append(run(path, args.size, args.seconds, args.jobs))
+            except (OSError, ValueError) as e:
+                results.append({"path": path, "error": str(e)})
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
@@ -0,0 +1,89 @@
+""" Leader election for the tasks that only one process of a cluster may run, through a Lease in the tracking database.
+
+    When several managers share the tracking database (TRACKING_DB_URL), each of them runs the culler and the cost
+    aggregation cron job, but only the holder of the task's lease acts; the others stand by and take over once the
+    lease expires, i.e. at most ttl seconds after its holder went down. The lease is renewed every ttl / 3 seconds. A
+    process that cannot reach the database steps down rather than risk running next to a new leader.
+
+    Other tasks are not elected. In particular the SharedWorkerPool of packed mode (packing.py) places users and
+    rebalances its workers in the hub's process without coordinating with other hubs, so packed mode needs a single
+    hub.
+
+    To try it locally, run `TRACKING_DB_URL=sqlite:////tmp/tracking.sqlite3 python3 leader.py demo` in two terminals
+    and stop the one that is the leader. """
+
+import logging
+import os
+import socket
+
+from tornado.ioloop import PeriodicCallback
+
+from models import Lease
+
+logger = logging.getLogger(__name__)
+
+
+def process_id():
+    return "%s:%s" % (socket.gethostname(), os.getpid())
+
+
+class LeaderElection(object):
+
+    def __init__(self, name, ttl=60, holder=None, on_elected=None, on_deposed=None):
+        self.name = name
+        self.ttl = ttl
+        self.holder = holder or process_id()
+        self.on_elected = on_elected
+        self.on_deposed = on_deposed
+        self.is_leader = False
+        self._periodic_callback = None
+
+    def start(self):
+        """ Campaigns right away, then renews the lease (or campaigns again) periodically on the IOLoop. """
+        self.renew()
+        self._periodic_callback = PeriodicCallback(self.renew, 1e3 * self.ttl / 3)
+        self._periodic_callback.start()
+
+    def renew(self):
+        try:
+            leader = Lease.acquire(self.name, self.holder, self.ttl)
+        except Exception as e:
+            logger.warning("could not renew the %s lease: %s", self.name, e)
+            leader = False
+        if leader and not self.is_leader:
+            logger.info("%s is now the leader for %s", self.holder, self.name)
+            self.is_leader = True
+            if self.on_elected is not None:
+                self.on_elected()
+        elif not leader and self.is_leader:
+            logger.warning("%s is no longer the leader for %s", self.holder, self.name)
+            self.is_leader = False
+            if self.on_deposed is not None:
+                self.on_deposed()
+        return self.is_leader
+
+    def stop(self):
+        """ Stops campaigning and hands the lease over right away. """
+        if self._periodic_callback is not None:
+            self._periodic_callback.stop()
+        if self.is_leader:
+            Lease.release(self.name, self.holder)
+            self.is_leader = False
+
+
+if __name__ == "__main__":
+    import argparse
+    from tornado.ioloop import IOLoop
+
+    parser = argparse.ArgumentParser(description="Campaigns for a lease and reports leadership changes")
+    parser.add_argument("name", help="the name of the lease, e.g. demo")
+    parser.add_argument("--ttl", type=int, default=15, help="seconds before an unrenewed lease expires")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    election = LeaderElection(args.name, ttl=args.ttl)
+    election.start()
+    try:
+        IOLoop.current().start()
+    except KeyboardInterrupt:
+        election.stop()
@@ -0,0 +1,27 @@
+#!/bin/bash -e
+# Formats the instance store of the worker and mounts it at /mnt, as scratch space for datasets and temporary files.
+# Instance store disks are blank again after every stop and start, so jupyter-scratch.service runs this at each boot.
+# Several disks (e.g. on larger d instance types) are striped together.
+
+if mountpoint -q /mnt; then
+    exit 0  # e.g. mounted by cloud-init from the ephemeral0 mapping of an older instance type
+fi
+devices=$(lsblk -dno NAME,MODEL | awk '/Instance Storage/ {print "/dev/" $1}')
+if [ -z "$devices" ] && [ -b /dev/xvdb ]; then
+    devices=/dev/xvdb
+fi
+if [ -z "$devices" ]; then
+    echo "no instance store, /mnt stays on the root volume"
+    exit 0
+fi
+count=$(echo $devices | wc -w)
+if [ "$count" -gt 1 ]; then
+    mdadm --create /dev/md/scratch --run --level=0 --raid-devices=$count $devices
+    device=/dev/md/scratch
+else
+    device=$devices
+fi
+mkfs.xfs -f $device
+mount -o noatime $device /mnt
+chmod 1777 /mnt
+echo "mounted the instance store ($devices) at /mnt"
@@ -0,0 +1,334 @@
+""" Packing the notebook servers of several users onto shared workers (SPAWNER_MODE "packed").
+
+    The InstanceSpawner gives every user an instance of their own, which for light workloads (e.g. an intro course)
+    leaves most of each instance idle and makes most logins wait for a boot. The PackedSpawner places users on larger
+    shared workers instead. Each user reserves memory and CPU, and is placed by best fit: on the active worker that
+    has the least memory left after taking them, so that the emptiest workers empty out and can be retired. Every
+    notebook gets its own port on the worker and runs as the user under the jupyter-singleuser@ unit, with cgroup
+    limits set to its reservation (see WorkerAgent.notebook_unit_start).
+
+    Workers scale out ahead of demand: once the reserved share of the pool's memory or CPU (its density) reaches
+    scale_out_at, another worker is launched in the background, so that most logins land on a running worker within
+    seconds. A worker is drained, i.e. takes no new users, when the other workers could hold all the reservations with
+    a density below scale_in_at, and is terminated once its last user has stopped; users are never moved. Homes are
+    on a file system shared by all workers (PACKED_HOME_NFS), so a user can land on any worker.
+
+    The pool's state is SharedWorker and PackedServer in the tracking database. Placement decisions make no yields,
+    so they never interleave within a process, but neither they nor the rebalancing are coordinated between processes
+    (they are not leader-elected, see leader.py): the hub running in packed mode must be the cluster's only one. """
+
+import logging
+import time
+import uuid
+from collections import Counter, deque
+from datetime import datetime, timedelta
+
+import boto3
+from tornado import gen
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from models import DB, SharedWorker, PackedServer, IntegrityError
+
+logger = logging.getLogger(__name__)
+
+LAUNCHING = "launching"
+ACTIVE = "active"
+DRAINING = "draining"
+# notebooks listen on ports from PORT_BASE up, clear of the worker agent's port (4445)
+PORT_BASE = 4450
+# a launch that has not finished by then was abandoned, e.g. by a hub that restarted
+LAUNCH_TIMEOUT = 900
+
+
+class PackingError(Exception): pass
+
+
+def instance_capacity(region, instance_type):
+    """ Returns (memory in MiB, vCPUs) of an instance type. """
+    ec2 = boto3.client("ec2", region_name=region)
+    description = ec2.describe_instance_types(InstanceTypes=[instance_type])["InstanceTypes"][0]
+    return description["MemoryInfo"]["SizeInMiB"], description["VCpuInfo"]["DefaultVCpus"]
+
+
+def free_port(used_ports, base=PORT_BASE):
+    """ The lowest port from base up that is not in used_ports. """
+    port = base
+    while port in used_ports:
+        port += 1
+    return port
+
+
+def reservations(servers):
+    """ Returns {worker name: [memory_mb, cpus, users]} for PackedServer rows. """
+    reserved = {}
+    for server in servers:
+        totals = reserved.setdefault(server.worker, [0, 0.0, 0])
+        totals[0] += server.memory_mb
+        totals[1] += server.cpus
+        totals[2] += 1
+    return reserved
+
+
+def density(workers, memory_mb, cpus):
+    """ The larger of the reserved shares of the workers' memory and CPU, for memory_mb and cpus reserved in all. """
+    capacity_memory = sum(worker.memory_mb for worker in workers)
+    capacity_cpus = sum(worker.cpus for worker in workers)
+    if not capacity_memory or not capacity_cpus:
+        return float("inf") if memory_mb or cpus else 0.0
+    return max(memory_mb / capacity_memory, cpus / capacity_cpus)
+
+
+def best_fit(workers, reserved, memory_mb, cpus, max_users=None):
+    """ The worker that has the least memory left after taking memory_mb and cpus, or None if none has room. Active
+        workers come before launching ones, which come before draining ones. """
+    rank = {ACTIVE: 0, LAUNCHING: 1, DRAINING: 2}
+    options = []
+    for worker in workers:
+        used_memory, used_cpus, users = reserved.get(worker.name, (0, 0.0, 0))
+        memory_left = worker.memory_mb - used_memory - memory_mb
+        if memory_left < 0 or worker.cpus - used_cpus - cpus < -1e-9:
+            continue
+        if max_users is not None and users >= max_users:
+            continue
+        options.append((rank[worker.state], memory_left, worker.created_at, worker))
+    if not options:
+        return None
+    return min(options, key=lambda option: option[:3])[3]
+
+
+class SharedWorkerPool(object):
+    """ Places users on shared workers, and launches, drains and retires the workers.
+
+        launch(name, instance_type) is a coroutine that launches a worker whose agent accepts the token derived from
+        name, waits until the agent is ready and returns (instance id, private ip address); it cleans up after
+        itself if it fails. retire(worker) is a coroutine that terminates an empty worker. """
+
+    def __init__(self, launch, retire, instance_type, memory_mb, cpus, instance_states=None, scale_out_at=0.8,
+                 scale_in_at=0.5, min_workers=1, max_workers=20, max_users=None, interval=60,
+                 recent_decisions=100):
+        self.launch = launch
+        self.retire = retire
+        self.instance_type = instance_type
+        self.memory_mb = memory_mb
+        self.cpus = cpus
+        self.instance_states = instance_states
+        self.scale_out_at = scale_out_at
+        self.scale_in_at = scale_in_at
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.max_users = max_users
+        self.interval = interval
+        self.counts = Counter()
+        self.decisions = deque(maxlen=recent_decisions)
+        self._launches = {}  # worker name: Future of its launch
+        self._periodic_callback = None
+        self._rebalancing = False
+
+    def start(self):
+        """ Starts the periodic rebalancing on the current IOLoop; calling it again is a no-op. """
+        if self._periodic_callback is None:
+            self._periodic_callback = PeriodicCallback(self.rebalance, 1e3 * self.interval)
+            self._periodic_callback.start()
+            IOLoop.current().spawn_callback(self.rebalance)
+
+    def snapshot(self):
+        """ Returns (workers, {worker name: [memory_mb, cpus, users]}). """
+        return list(SharedWorker.select().order_by(SharedWorker.created_at)), reservations(PackedServer.select())
+
+    @gen.coroutine
+    def place(self, user_name, memory_mb, cpus):
+        """ Reserves memory_mb and cpus and a port for user_name on a worker, unless the user has a place already.
+            Returns (SharedWorker, port) once the worker is up. """
+        self.start()
+        server = PackedServer.get_server(user_name)
+        if server is None:
+            started = time.time()
+            server = self._reserve(user_name, memory_mb, cpus)
+        else:
+            started = None
+        launch = self._launches.get(server.worker)
+        if launch is not None:
+            yield launch
+        worker = SharedWorker.get_or_none(SharedWorker.name == server.worker)
+        if worker is None or worker.state == LAUNCHING or not worker.ip_address:
+            PackedServer.remove_server(user_name)
+            raise PackingError("the shared worker %s of user %s is gone" % (server.worker, user_name))
+        if started is not None:
+            self.decisions.append({"time": started, "user": user_name, "worker": worker.name, "port": server.port,
+                                   "waited_for_launch": launch is not None,
+                                   "seconds": round(time.time() - started, 1)})
+        return worker, server.port
+
+    def release(self, user_name):
+        """ Gives up user_name's reservation, e.g. once their notebook has stopped. """
+        PackedServer.remove_server(user_name)
+
+    def _reserve(self, user_name, memory_mb, cpus):
+        workers, reserved = self.snapshot()
+        worker = best_fit(workers, reserved, memory_mb, cpus, self.max_users)
+        if worker is None:
+            if memory_mb > self.memory_mb or cpus > self.cpus:
+                raise PackingError("user %s asks for more than a whole shared worker" % user_name)
+            if len(workers) >= self.max_workers:
+                self.counts["full"] += 1
+                raise PackingError("all %s shared workers are full" % len(workers))
+            worker = self._add_worker("no room for %s" % user_name)
+        elif worker.state == DRAINING:
+            # taking a user back is cheaper than launching a worker
+            SharedWorker.set_state(worker.name, ACTIVE)
+            self.counts["undrained"] += 1
+            logger.info("shared worker %s takes users again", worker.name)
+        used_ports = {server.port for server in PackedServer.select().where(PackedServer.worker == worker.name)}
+        for _ in range(10):
+            port = free_port(used_ports)
+            try:
+                with DB.atomic():
+                    server = PackedServer.create(user_id=user_name, worker=worker.name, port=port,
+                                                 memory_mb=memory_mb, cpus=cpus)
+                break
+            except IntegrityError:
+                # another process took the user or the port meanwhile
+                existing = PackedServer.get_server(user_name)
+                if existing is not None:
+                    return existing
+                used_ports.add(port)
+        else:
+            raise PackingError("no free port on shared worker %s" % worker.name)
+        self.counts["placements"] += 1
+        logger.info("placed user %s on shared worker %s, port %s", user_name, worker.name, port)
+        self._check_density()
+        return server
+
+    def _add_worker(self, reason):
+        name = "shared-%s" % uuid.uuid4().hex[:10]
+        SharedWorker.create(name=name, instance_type=self.instance_type, memory_mb=self.memory_mb, cpus=self.cpus)
+        self.counts["launches"] += 1
+        logger.info("launching shared worker %s (%s): %s", name, self.instance_type, reason)
+        future = self._launches[name] = gen.convert_yielded(self._launch(name))
+
+        def done(future):
+            self._launches.pop(name, None)
+            future.exception()  # failures are logged by _launch, whether or not a user was waiting
+        future.add_done_callback(done)
+        return SharedWorker.get(SharedWorker.name == name)
+
+    @gen.coroutine
+    def _launch(self, name):
+        try:
+            instance_id, ip_address = yield self.launch(name, self.instance_type)
+        except Exception as e:
+            logger.error("could not launch shared worker %s: %s", name, e)
+            self.counts["launch_failures"] += 1
+            PackedServer.delete().where(PackedServer.worker == name).execute()
+            SharedWorker.delete().where(SharedWorker.name == name).execute()
+            raise PackingError("could not launch a shared worker: %s" % e)
+        SharedWorker.set_state(name, ACTIVE, instance_id=instance_id, ip_address=ip_address)
+        logger.info("shared worker %s is up as %s", name, instance_id)
+
+    def _check_density(self):
+        """ Launches (or takes back) a worker in the background once the pool is dense enough. """
+        if self._launches:
+            return
+        workers, reserved = self.snapshot()
+        serving = [worker for worker in workers if worker.state != DRAINING]
+        memory_mb = sum(totals[0] for totals in reserved.values())
+        cpus = sum(totals[1] for totals in reserved.values())
+        current = density(serving, memory_mb, cpus)
+        if len(serving) >= self.min_workers and (not serving or current < self.scale_out_at):
+            return
+        draining = [worker for worker in workers if worker.state == DRAINING]
+        if draining:
+            worker = max(draining, key=lambda w: reserved.get(w.name, (0, 0.0, 0))[0])
+            SharedWorker.set_state(worker.name, ACTIVE)
+            self.counts["undrained"] += 1
+            logger.info("shared worker %s takes users again", worker.name)
+        elif len(workers) < self.max_workers:
+            self._add_worker("density %.2f" % current if len(serving) >= self.min_workers else "warm pool")
+
+    @gen.coroutine
+    def rebalance(self):
+        """ Retires drained workers, forgets workers whose instance is gone, drains the emptiest worker when the
+            others can take its share, and scales out if needed. A pass still running when the next one is due
+            causes the next one to be skipped. """
+        if self._rebalancing:
+            return
+        self._rebalancing = True
+        try:
+            yield self._forget_lost_workers()
+            workers, reserved = self.snapshot()
+            for worker in workers:
+                if worker.state == DRAINING and worker.name not in reserved:
+                    SharedWorker.delete().where(SharedWorker.name == worker.name).execute()
+                    self.counts["retired"] += 1
+                    logger.info("retiring drained shared worker %s", worker.name)
+                    IOLoop.current().spawn_callback(self._retire, worker)
+            self._drain_emptiest()
+            self._check_density()
+        except Exception:
+            logger.exception("could not rebalance the shared workers")
+        finally:
+            self._rebalancing = False
+
+    @gen.coroutine
+    def _forget_lost_workers(self):
+        """ Removes workers whose instance was terminated (or whose launch was abandoned) and the places on them. """
+        workers = list(SharedWorker.select())
+        abandoned = datetime.now() - timedelta(seconds=LAUNCH_TIMEOUT)
+        lost = [worker for worker in workers
+                if worker.state == LAUNCHING and worker.name not in self._launches and worker.updated_at < abandoned]
+        if self.instance_states is not None:
+            instance_ids = [worker.instance_id for worker in workers if worker.instance_id]
+            descriptions = {}
+            if instance_ids:
+                descriptions = yield self.instance_states.get(instance_ids)
+            lost += [worker for worker in workers if worker.instance_id and
+                     descriptions[worker.instance_id]["State"]["Name"] in ["shutting-down", "terminated", "stopped"]]
+        for worker in lost:
+            logger.warning("shared worker %s (%s) is gone, forgetting it and its users",
+                           worker.name, worker.instance_id)
+            PackedServer.delete().where(PackedServer.worker == worker.name).execute()
+            SharedWorker.delete().where(SharedWorker.name == worker.name).execute()
+            self.counts["lost"] += 1
+            if worker.instance_id:
+                IOLoop.current().spawn_callback(self._retire, worker)
+
+    def _drain_emptiest(self):
+        workers, reserved = self.snapshot()
+        active = [worker for worker in workers if worker.state == ACTIVE]
+        if len(active) <= self.min_workers or self._launches:
+            return
+        emptiest = min(active, key=lambda w: (reserved.get(w.name, (0, 0.0, 0))[2], w.created_at))
+        rest = [worker for worker in active if worker is not emptiest]
+        memory_mb = sum(reserved.get(w.name, (0, 0.0, 0))[0] for w in active)
+        cpus = sum(reserved.get(w.name, (0, 0.0, 0))[1] for w in active)
+        if density(rest, memory_mb, cpus) < self.scale_in_at:
+            SharedWorker.set_state(emptiest.name, DRAINING)
+            self.counts["drained"] += 1
+            logger.info("draining shared worker %s (%s users)", emptiest.name,
+                        reserved.get(emptiest.name, (0, 0.0, 0))[2])
+
+    @gen.coroutine
+    def _retire(self, worker):
+        try:
+            yield self.retire(worker)
+        except Exception as e:
+            logger.error("could not terminate shared worker %s (%s): %s", worker.name, worker.instance_id, e)
+
+    def metrics(self):
+        """ Workers with their reservations and density, event counts, and the latest placements. """
+        workers, reserved = self.snapshot()
+        serving = [worker for worker in workers if worker.state != DRAINING]
+        memory_mb = sum(reserved.get(w.name, (0, 0.0, 0))[0] for w in serving)
+        cpus = sum(reserved.get(w.name, (0, 0.0, 0))[1] for w in serving)
+        return {
+            "density": round(density(serving, memory_mb, cpus), 3) if serving else None,
+            "scale_out_at": self.scale_out_at,
+            "scale_in_at": self.scale_in_at,
+            "workers": [{"name": worker.name, "instance_id": worker.instance_id, "state": worker.state,
+                         "users": reserved.get(worker.name, (0, 0.0, 0))[2],
+                         "memory_mb": [reserved.get(worker.name, (0, 0.0, 0))[0], worker.memory_mb],
+                         "cpus": [round(reserved.get(worker.name, (0, 0.0, 0))[1], 2), worker.cpus]}
+                        for worker in workers],
+            "counts": dict(self.counts),
+            "recent_placements": list(self.decisions),
+        }
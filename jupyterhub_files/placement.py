@@ -0,0 +1,89 @@
+""" Placement of new workers across subnets and instance types.
+
+    Workers used to be launched in a single subnet, hence a single availability zone, with a single instance type; when
+    that zone ran out of capacity for the type every launch failed. The PlacementScheduler is given the worker subnets
+    (one or more per zone) and, for each launch, the instance types the user may run on in order of preference. It
+    keeps a score of recent capacity errors per zone, instance type and market that decays with a half life, and
+    offers the options with the lowest scores first. A user with a home volume can only be placed in the volume's
+    zone. """
+
+import logging
+import time
+from collections import Counter, deque
+
+import boto3
+
+logger = logging.getLogger(__name__)
+
+# errors that mean a zone has no capacity for an instance type (or Spot market) right now
+CAPACITY_ERRORS = ["InsufficientInstanceCapacity", "InsufficientCapacity", "UnfulfillableCapacity",
+                   "SpotMaxPriceTooLow", "MaxSpotInstanceCountExceeded", "InsufficientFreeAddressesInSubnet"]
+
+
+def describe_subnets(region, subnet_ids):
+    """ Returns [{"SUBNET_ID", "AVAILABILITY_ZONE"}] for subnet_ids, in the same order. """
+    ec2 = boto3.client("ec2", region_name=region)
+    zones = {subnet["SubnetId"]: subnet["AvailabilityZone"]
+             for subnet in ec2.describe_subnets(SubnetIds=subnet_ids)["Subnets"]}
+    return [{"SUBNET_ID": subnet_id, "AVAILABILITY_ZONE": zones[subnet_id]} for subnet_id in subnet_ids]
+
+
+class PlacementScheduler(object):
+
+    def __init__(self, subnets, half_life=900, recent_decisions=100):
+        self.subnets = subnets
+        self.half_life = half_life
+        self.scores = {}  # (zone, instance type, market): (score, time of last update)
+        self.launches = Counter()
+        self.failures = Counter()
+        self.decisions = deque(maxlen=recent_decisions)
+
+    def score(self, availability_zone, instance_type, market, now=None):
+        """ The decayed number of recent capacity errors for an option. """
+        score, updated = self.scores.get((availability_zone, instance_type, market), (0.0, None))
+        if updated is None:
+            return 0.0
+        return score * 0.5 ** (((now or time.time()) - updated) / self.half_life)
+
+    def candidates(self, instance_types, market, availability_zone=None):
+        """ Returns the (subnet, instance type) options for a launch, healthiest first. Equally healthy options keep
+            the order of preference of instance_types, then of the subnets. """
+        now = time.time()
+        options = [(round(self.score(subnet["AVAILABILITY_ZONE"], instance_type, market, now), 1), type_index,
+                    subnet_index, subnet, instance_type)
+                   for type_index, instance_type in enumerate(instance_types)
+                   for subnet_index, subnet in enumerate(self.subnets)
+                   if availability_zone is None or subnet["AVAILABILITY_ZONE"] == availability_zone]
+        return [(subnet, instance_type) for _, _, _, subnet, instance_type in sorted(options, key=lambda o: o[:3])]
+
+    def record_failure(self, subnet, instance_type, market, error_code):
+        """ Records a failed launch. Only capacity errors count against the option. """
+        key = (subnet["AVAILABILITY_ZONE"], instance_type, market)
+        self.failures[key + (error_code,)] += 1
+        if error_code in CAPACITY_ERRORS:
+            now = time.time()
+            self.scores[key] = (self.score(*key, now=now) + 1, now)
+            logger.info("capacity error in %s for %s (%s): %s" % (key + (error_code,)))
+
+    def record_launch(self, user_name, subnet, instance_type, market, attempts):
+        key = (subnet["AVAILABILITY_ZONE"], instance_type, market)
+        self.launches[key] += 1
+        self.decisions.append({"time": time.time(), "user": user_name, "subnet_id": subnet["SUBNET_ID"],
+                               "availability_zone": key[0], "instance_type": instance_type, "market": market,
+                               "attempts": attempts})
+        logger.info("placed worker of %s in %s (%s, %s) after %s attempt(s)" % (
+            user_name, subnet["SUBNET_ID"], instance_type, market, attempts))
+
+    def metrics(self):
+        """ The scheduler's state: scores and launch and failure counts per option, and the latest decisions. """
+        now = time.time()
+        keys = set(self.scores) | set(self.launches) | {key[:3] for key in self.failures}
+        return {
+            "options": [{"availability_zone": zone, "instance_type": instance_type, "market": market,
+                         "score": round(self.score(zone, instance_type, market, now), 3),
+                         "launches": self.launches[(zone, instance_type, market)],
+                         "failures": {key[3]: count for key, count in self.failures.items()
+                                      if key[:3] == (zone, instance_type, market)}}
+                        for zone, instance_type, market in sorted(keys)],
+            "recent_decisions": list(self.decisions),
+        }
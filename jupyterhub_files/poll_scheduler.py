@@ -0,0 +1,199 @@
+""" Scheduled, phase-spread checks of users' servers, so that poll() never does I/O of its own.
+
+    JupyterHub polls every spawner every poll_interval seconds, and after a hub restart or a burst of logins those polls
+    line up: every user's server is looked up in the tracking database and EC2 and probed at the same moment, every
+    time. The PollScheduler runs each server's check on its own schedule instead, and poll() answers with the latest
+    result. Every server gets a random phase, and is checked at that phase of its interval (at phase * interval plus
+    a multiple of the interval), so that the checks of servers on the same interval are spread evenly across it
+    however many start together and whichever way their intervals change. Intervals adapt: a server that keeps
+    answering the same is checked less and less often, up to max_interval; a server that was just started, or whose
+    check failed or changed, is checked every min_interval. At most `concurrency` checks run at a time.
+
+    The scheduler keeps the checks per second and the lag of each check behind its due time, see metrics() (in
+    /hub/api/cluster/metrics). Run `python3 poll_scheduler.py` to see them for simulated servers. """
+
+import heapq
+import itertools
+import logging
+import math
+import random
+import time
+from collections import deque
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.locks import Semaphore
+
+logger = logging.getLogger(__name__)
+
+# returned by result() when a server has no recent scheduled result, the caller checks it itself
+NOT_CHECKED = object()
+
+
+class PollEntry(object):
+
+    def __init__(self, key, check, result, interval, generation):
+        self.key = key
+        self.check = check
+        self.result = result
+        self.checked_at = time.time()
+        self.interval = interval
+        self.generation = generation
+        self.phase = random.random()
+        self.checks = 0
+        self.failures = 0
+
+
+class PollScheduler(object):
+    """ check is a coroutine function returning what poll() should return: None while the server runs, a message
+        otherwise. """
+
+    def __init__(self, interval=10, min_interval=5, max_interval=60, backoff=1.5, concurrency=20, recent=2000):
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.entries = {}
+        self.lags = deque(maxlen=recent)  # seconds each check started after its due time
+        self.per_second = deque(maxlen=600)  # [second, checks started in it]
+        self.checks = 0
+        self.failures = 0
+        self._semaphore = Semaphore(concurrency)
+        self._heap = []  # (due, sequence, key, generation)
+        self._sequence = itertools.count()
+        self._generations = itertools.count()
+        self._timer = None
+        self._timer_due = None
+
+    def track(self, key, check, result=None, fresh=False):
+        """ Schedules key's checks, with result as its latest result. A fresh server (e.g. just started) is checked
+            every min_interval at first, any other every interval. """
+        interval = self.min_interval if fresh else self.interval
+        entry = self.entries[key] = PollEntry(key, check, result, interval, next(self._generations))
+        self._schedule(entry)
+
+    def untrack(self, key):
+        self.entries.pop(key, None)
+
+    def result(self, key):
+        """ key's latest result, or NOT_CHECKED if it is not tracked or its result is stale (e.g. its checks are stuck
+            behind slow ones). """
+        entry = self.entries.get(key)
+        if entry is None or time.time() - entry.checked_at > 3 * self.max_interval:
+            return NOT_CHECKED
+        return entry.result
+
+    def _schedule(self, entry):
+        """ Schedules entry's next check at its phase of its interval. """
+        now = IOLoop.current().time()
+        offset = entry.phase * entry.interval
+        due = (math.floor((now - offset) / entry.interval) + 1) * entry.interval + offset
+        heapq.heappush(self._heap, (due, next(self._sequence), entry.key, entry.generation))
+        if self._timer_due is None or due < self._timer_due:
+            loop = IOLoop.current()
+            if self._timer is not None:
+                loop.remove_timeout(self._timer)
+            self._timer_due = due
+            self._timer = loop.call_at(due, self._run_due)
+
+    def _run_due(self):
+        loop = IOLoop.current()
+        self._timer = self._timer_due = None
+        now = loop.time()
+        while self._heap and self._heap[0][0] <= now:
+            due, _, key, generation = heapq.heappop(self._heap)
+            entry = self.entries.get(key)
+            if entry is not None and entry.generation == generation:
+                loop.spawn_callback(self._check, entry, due)
+        if self._heap:
+            self._timer_due = self._heap[0][0]
+            self._timer = loop.call_at(self._timer_due, self._run_due)
+
+    @gen.coroutine
+    def _check(self, entry, due):
+        loop = IOLoop.current()
+        with (yield self._semaphore.acquire()):
+            if self.entries.get(entry.key) is not entry:
+                return  # untracked, or tracked again, while waiting
+            self.lags.append(loop.time() - due)
+            second = int(time.time())
+            if self.per_second and self.per_second[-1][0] == second:
+                self.per_second[-1][1] += 1
+            else:
+                self.per_second.append([second, 1])
+            self.checks += 1
+            entry.checks += 1
+            failed = False
+            try:
+                result = yield entry.check()
+            except Exception as e:
+                logger.warning("check of %s failed: %s" % (entry.key, e))
+                result, failed = entry.result, True
+                self.failures += 1
+                entry.failures += 1
+        if self.entries.get(entry.key) is not entry:
+            return
+        if failed or result is not None or result != entry.result:
+            entry.interval = self.min_interval
+        else:
+            entry.interval = min(self.max_interval, entry.interval * self.backoff)
+        entry.result, entry.checked_at = result, time.time()
+        self._schedule(entry)
+
+    def metrics(self, window=60):
+        since = int(time.time()) - window
+        recent = sum(count for second, count in self.per_second if second >= since)
+        lags = sorted(self.lags)
+        intervals = sorted(entry.interval for entry in self.entries.values())
+        return {
+            "tracked": len(self.entries),
+            "checks": self.checks,
+            "failures": self.failures,
+            "checks_per_second": round(recent / window, 2),
+            "lag_seconds": {"p%d" % p: round(lags[min(len(lags) - 1, len(lags) * p // 100)], 3)
+                            for p in (50, 90, 99)} if lags else {},
+            "max_lag_seconds": round(lags[-1], 3) if lags else None,
+            "interval_seconds": {"min": round(intervals[0], 1), "median": round(intervals[len(intervals) // 2], 1),
+                                 "max": round(intervals[-1], 1)} if intervals else {},
+        }
+
+
+def simulate(servers=2000, seconds=60, check_seconds=0.05, concurrency=20):
+    """ Tracks `servers` simulated servers at once, as after a hub restart, whose checks take check_seconds, and
+        prints the checks per second and the lag every 10 seconds. The hub's own polling would run all of them
+        every 10 seconds, in phase. """
+    scheduler = PollScheduler(concurrency=concurrency)
+
+    @gen.coroutine
+    def check():
+        yield gen.sleep(check_seconds)
+
+    @gen.coroutine
+    def main():
+        for i in range(servers):
+            scheduler.track("user%d" % i, check)
+        print("%8s %12s %10s %10s %10s %16s" % ("seconds", "checks/s", "lag p50", "lag p99", "lag max",
+                                                 "median interval"))
+        for elapsed in range(10, seconds + 1, 10):
+            yield gen.sleep(10)
+            metrics = scheduler.metrics(window=10)
+            print("%8d %12.1f %10.3f %10.3f %10.3f %16.1f" % (
+                elapsed, metrics["checks_per_second"], metrics["lag_seconds"].get("p50", 0),
+                metrics["lag_seconds"].get("p99", 0), metrics["max_lag_seconds"] or 0,
+                metrics["interval_seconds"]["median"]))
+            scheduler.lags.clear()
+        print("polling every 10 seconds in phase: %d checks at once, %.1f checks/s on average" % (servers,
+                                                                                                servers / 10.0))
+
+    IOLoop.current().run_sync(main)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Simulates the poll scheduler")
+    parser.add_argument("--servers", type=int, default=2000)
+    parser.add_argument("--seconds", type=int, default=60)
+    parser.add_argument("--check-seconds", type=float, default=0.05, help="how long one check takes")
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+    simulate(args.servers, args.seconds, args.check_seconds, args.concurrency)
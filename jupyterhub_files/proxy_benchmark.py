@@ -0,0 +1,397 @@
+#!/usr/bin/python3 python3
+""" Benchmarks the proxy all notebook traffic goes through, to size it (or compare a replacement) with data.
+
+    Fake single-user servers are started on local ports: they answer /user/<name>/api/status and echo every message
+    of /user/<name>/api/kernels/<kernel>/channels websockets, like a kernel that replies at once. The benchmark then
+    - adds `--routes` routes one at a time and reports the latency of a route update as the table grows, the time to
+      read the whole table, and the time to add the same routes through a RouteBatcher (see route_batcher.py);
+    - opens `--sessions` concurrent websocket sessions through the proxy, each sending `--messages` messages of
+      `--message-size` bytes and waiting for each echo, and reports the message throughput and round trip latencies.
+
+    Backends:
+    - "chp": configurable-http-proxy's REST API, at --api-url with --token, proxying at --proxy-url. With --start-chp a
+      local configurable-http-proxy is started (it must be on the PATH, `npm install -g configurable-http-proxy`).
+    - "tornado": an in-process reverse proxy with a path-prefix routing table, as a baseline for a replacement. It
+      shares the benchmark's process and CPU, so its throughput is a lower bound.
+    - "module:Class": any class with the same interface as ChpBackend (start, stop, add_route, delete_route,
+      get_routes and proxy_url), e.g. to try another proxy.
+
+    The fake servers and the clients share this process, run it on a different host than the proxy (with --bind set
+    to an address the proxy can reach) to measure a remote proxy.
+
+    Usage: python3 proxy_benchmark.py --backend chp --start-chp [--routes 2000] [--sessions 200] [--messages 50]
+           python3 proxy_benchmark.py --backend tornado --json """
+
+import argparse
+import importlib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import time
+from urllib.parse import urlparse
+
+from tornado import gen, web
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPClientError
+from tornado.ioloop import IOLoop
+from tornado.websocket import WebSocketHandler, WebSocketClosedError, websocket_connect
+
+from route_batcher import RouteBatcher, ADD
+
+
+def free_tcp_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """ {"p50": ..., ...} of values, in milliseconds for values in seconds. """
+    if not values:
+        return {}
+    ordered = sorted(values)
+    return {"p%d" % point: round(1e3 * ordered[min(len(ordered) - 1, int(len(ordered) * point / 100))], 3)
+            for point in points}
+
+#########################################################################################################
+### fake single-user servers ###
+
+
+class KernelChannelsHandler(WebSocketHandler):
+
+    def on_message(self, message):
+        try:
+            self.write_message(message, binary=isinstance(message, bytes))
+        except WebSocketClosedError:
+            pass
+
+
+class StatusHandler(web.RequestHandler):
+
+    def get(self, user):
+        self.finish({"user": user, "started": True})
+
+
+def start_fake_servers(count, bind="127.0.0.1"):
+    """ Starts count fake single-user servers, returns their "http://host:port" targets. """
+    app = web.Application([
+        (r"/user/([^/]+)/api/kernels/[^/]+/channels", KernelChannelsHandler),
+        (r"/user/([^/]+)/api/status", StatusHandler),
+    ])
+    targets = []
+    for _ in range(count):
+        port = free_tcp_port()
+        app.listen(port, bind)
+        targets.append("http://%s:%s" % (bind, port))
+    return targets
+
+#########################################################################################################
+### backends ###
+
+
+class ChpBackend(object):
+    """ configurable-http-proxy, through its REST API. """
+
+    def __init__(self, api_url=None, token=None, proxy_url=None, start_chp=False):
+        self.start_chp = start_chp
+        self.token = token or os.environ.get("CONFIGPROXY_AUTH_TOKEN") or os.urandom(16).hex()
+        self.process = None
+        if start_chp:
+            proxy_port, api_port = free_tcp_port(), free_tcp_port()
+            self.proxy_url = "http://127.0.0.1:%s" % proxy_port
+            self.api_url = "http://127.0.0.1:%s" % api_port
+        else:
+            self.api_url = api_url
+            self.proxy_url = proxy_url
+        self.client = AsyncHTTPClient(max_clients=100)
+
+    @gen.coroutine
+    def start(self):
+        if not self.start_chp:
+            return
+        command = shutil.which("configurable-http-proxy")
+        if command is None:
+            raise SystemExit("configurable-http-proxy not found, `npm install -g configurable-http-proxy`")
+        self.process = subprocess.Popen(
+            [command, "--ip", "127.0.0.1", "--port", str(urlparse(self.proxy_url).port), "--api-ip", "127.0.0.1",
+             "--api-port", str(urlparse(self.api_url).port), "--log-level", "warn"],
+            env=dict(os.environ, CONFIGPROXY_AUTH_TOKEN=self.token))
+        for _ in range(100):
+            try:
+                yield self.get_routes()
+                return
+            except (OSError, HTTPClientError):
+                yield gen.sleep(0.1)
+        raise SystemExit("configurable-http-proxy did not start")
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+
+    def request(self, path, method="GET", body=None):
+        return self.client.fetch(HTTPRequest(self.api_url + "/api/routes" + path, method=method, body=body,
+                                             headers={"Authorization": "token %s" % self.token},
+                                             request_timeout=30))
+
+    @gen.coroutine
+    def add_route(self, path, target):
+        yield self.request(path, "POST", json.dumps({"target": target}))
+
+    @gen.coroutine
+    def delete_route(self, path):
+        yield self.request(path, "DELETE")
+
+    @gen.coroutine
+    def get_routes(self):
+        response = yield self.request("")
+        return json.loads(response.body.decode("utf8"))
+
+
+class RouteTable(object):
+    """ Path prefix routing, longest prefix first, one dict lookup per path segment. """
+
+    def __init__(self):
+        self.routes = {}
+
+    def lookup(self, path):
+        segments = path.rstrip("/").split("/")
+        for end in range(len(segments), 0, -1):
+            target = self.routes.get("/".join(segments[:end]) or "/")
+            if target is not None:
+                return target
+        return None
+
+
+class ProxyHandler(WebSocketHandler):
+    """ Proxies websockets, and plain GET and POST requests, to the route's target. """
+
+    def initialize(self, table, client):
+        self.table = table
+        self.client = client
+        self.upstream = None
+
+    def target_url(self):
+        target = self.table.lookup(self.request.path)
+        if target is None:
+            raise web.HTTPError(404)
+        return target + self.request.uri
+
+    async def get(self, *args, **kwargs):
+        url = self.target_url()
+        if self.request.headers.get("Upgrade", "").lower() != "websocket":
+            return await self.forward(url)
+        self.upstream = await websocket_connect("ws" + url[4:], on_message_callback=self.from_upstream)
+        await super().get(*args, **kwargs)
+
+    async def post(self, *args, **kwargs):
+        await self.forward(self.target_url())
+
+    async def forward(self, url):
+        response = await self.client.fetch(HTTPRequest(url, method=self.request.method,
+                                                       body=self.request.body if self.request.method == "POST" else None,
+                                                       headers=self.request.headers), raise_error=False)
+        self.set_status(response.code)
+        self.finish(response.body or b"")
+
+    def on_message(self, message):
+        self.upstream.write_message(message, binary=isinstance(message, bytes))
+
+    def from_upstream(self, message):
+        if message is None:
+            self.close()
+            return
+        try:
+            self.write_message(message, binary=isinstance(message, bytes))
+        except WebSocketClosedError:
+            pass
+
+    def on_close(self):
+        if self.upstream is not None:
+            self.upstream.close()
+
+
+class TornadoBackend(object):
+    """ An in-process reverse proxy, the routing table being a plain dict. """
+
+    def __init__(self, **kwargs):
+        self.table = RouteTable()
+        self.proxy_url = None
+
+    @gen.coroutine
+    def start(self):
+        port = free_tcp_port()
+        web.Application([(r"/.*", ProxyHandler, {"table": self.table, "client": AsyncHTTPClient()})]).listen(
+            port, "127.0.0.1")
+        self.proxy_url = "http://127.0.0.1:%s" % port
+
+    def stop(self):
+        pass
+
+    @gen.coroutine
+    def add_route(self, path, target):
+        self.table.routes[path] = target
+
+    @gen.coroutine
+    def delete_route(self, path):
+        self.table.routes.pop(path, None)
+
+    @gen.coroutine
+    def get_routes(self):
+        return {path: {"target": target} for path, target in self.table.routes.items()}
+
+
+BACKENDS = {"chp": ChpBackend, "tornado": TornadoBackend}
+
+
+def load_backend(name):
+    if name in BACKENDS:
+        return BACKENDS[name]
+    module, _, cls = name.partition(":")
+    return getattr(importlib.import_module(module), cls)
+
+#########################################################################################################
+### benchmarks ###
+
+
+@gen.coroutine
+def benchmark_routes(backend, targets, count, batch_concurrency):
+    """ Route update latencies, one at a time and batched. """
+    paths = ["/user/bench-%05d" % i for i in range(count)]
+    latencies = []
+    by_size = {}
+    started = time.perf_counter()
+    for i, path in enumerate(paths):
+        before = time.perf_counter()
+        yield backend.add_route(path, targets[i % len(targets)])
+        latencies.append(time.perf_counter() - before)
+        if (i + 1) % max(1, count // 5) == 0:
+            by_size[i + 1] = percentiles(latencies[-max(1, count // 5):])["p50"]
+    sequential = time.perf_counter() - started
+
+    before = time.perf_counter()
+    routes = yield backend.get_routes()
+    read_seconds = time.perf_counter() - before
+
+    deletes = []
+    for path in paths:
+        before = time.perf_counter()
+        yield backend.delete_route(path)
+        deletes.append(time.perf_counter() - before)
+
+    @gen.coroutine
+    def apply(operation, routespec, target, data):
+        if operation == ADD:
+            yield backend.add_route(routespec, target)
+        else:
+            yield backend.delete_route(routespec)
+    batcher = RouteBatcher(apply, concurrency=batch_concurrency)
+    started = time.perf_counter()
+    yield [batcher.add(path, targets[i % len(targets)]) for i, path in enumerate(paths)]
+    batched = time.perf_counter() - started
+    return {
+        "routes": count,
+        "add_one_at_a_time": {"seconds": round(sequential, 3), "per_second": round(count / sequential, 1),
+                              "latency_ms": percentiles(latencies), "p50_ms_by_table_size": by_size},
+        "delete_latency_ms": percentiles(deletes),
+        "read_table": {"routes": len(routes), "ms": round(1e3 * read_seconds, 3)},
+        "add_batched": {"seconds": round(batched, 3), "per_second": round(count / batched, 1),
+                        "concurrency": batch_concurrency},
+    }
+
+
+@gen.coroutine
+def benchmark_sessions(backend, targets, sessions, messages, message_size):
+    """ Concurrent websocket sessions through the proxy, each a request and reply loop. """
+    for i in range(sessions):
+        yield backend.add_route("/user/ws-%05d" % i, targets[i % len(targets)])
+    payload = "x" * message_size
+    round_trips = []
+    failures = []
+    ws_url = "ws" + backend.proxy_url[4:]
+
+    @gen.coroutine
+    def session(i):
+        try:
+            connection = yield websocket_connect("%s/user/ws-%05d/api/kernels/k%d/channels" % (ws_url, i, i))
+        except Exception as e:
+            failures.append(str(e))
+            return
+        for _ in range(messages):
+            before = time.perf_counter()
+            connection.write_message(payload)
+            reply = yield connection.read_message()
+            if reply is None:
+                failures.append("closed")
+                return
+            round_trips.append(time.perf_counter() - before)
+        connection.close()
+
+    started = time.perf_counter()
+    yield [session(i) for i in range(sessions)]
+    elapsed = time.perf_counter() - started
+    for i in range(sessions):
+        yield backend.delete_route("/user/ws-%05d" % i)
+    return {
+        "sessions": sessions, "messages_per_session": messages, "message_bytes": message_size,
+        "seconds": round(elapsed, 3), "messages_per_second": round(len(round_trips) / elapsed, 1),
+        "megabytes_per_second": round(2 * len(round_trips) * message_size / elapsed / 1e6, 2),
+        "round_trip_ms": percentiles(round_trips), "failed_sessions": len(failures),
+    }
+
+
+def print_report(name, results):
+    routes, sessions = results["routes"], results["sessions"]
+    print("backend %s" % name)
+    print("  %d routes added one at a time: %.1f/s, latency ms %s" % (
+        routes["routes"], routes["add_one_at_a_time"]["per_second"], routes["add_one_at_a_time"]["latency_ms"]))
+    print("  median add latency (ms) by table size: %s" % routes["add_one_at_a_time"]["p50_ms_by_table_size"])
+    print("  delete latency ms %s; reading the table of %d routes: %.1f ms" % (
+        routes["delete_latency_ms"], routes["read_table"]["routes"], routes["read_table"]["ms"]))
+    print("  batched (%d at a time): %.1f routes/s" % (routes["add_batched"]["concurrency"],
+                                                       routes["add_batched"]["per_second"]))
+    print("  %d websocket sessions x %d messages of %d bytes: %.1f messages/s (%.2f MB/s), round trip ms %s, "
+          "%d failed" % (sessions["sessions"], sessions["messages_per_session"], sessions["message_bytes"],
+                         sessions["messages_per_second"], sessions["megabytes_per_second"],
+                         sessions["round_trip_ms"], sessions["failed_sessions"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks proxy route updates and websocket throughput")
+    parser.add_argument("--backend", default="chp", help="chp, tornado, or module:Class")
+    parser.add_argument("--api-url", help="the proxy's REST API, e.g. http://127.0.0.1:8001")
+    parser.add_argument("--proxy-url", help="the proxy's public side, e.g. http://127.0.0.1:8000")
+    parser.add_argument("--token", help="the proxy's API token (default $CONFIGPROXY_AUTH_TOKEN)")
+    parser.add_argument("--start-chp", action="store_true", help="start a local configurable-http-proxy")
+    parser.add_argument("--bind", default="127.0.0.1", help="address of the fake single-user servers")
+    parser.add_argument("--servers", type=int, default=8, help="fake single-user servers the routes point to")
+    parser.add_argument("--routes", type=int, default=2000)
+    parser.add_argument("--batch-concurrency", type=int, default=10)
+    parser.add_argument("--sessions", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--message-size", type=int, default=1024)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    backend = load_backend(args.backend)(api_url=args.api_url, token=args.token, proxy_url=args.proxy_url,
+                                         start_chp=args.start_chp)
+
+    @gen.coroutine
+    def main():
+        targets = start_fake_servers(args.servers, args.bind)
+        yield backend.start()
+        try:
+            results = {
+                "routes": (yield benchmark_routes(backend, targets, args.routes, args.batch_concurrency)),
+                "sessions": (yield benchmark_sessions(backend, targets, args.sessions, args.messages,
+                                                      args.message_size)),
+            }
+        finally:
+            backend.stop()
+        if args.json:
+            print(json.dumps(dict(results, backend=args.backend)))
+        else:
+            print_report(args.backend, results)
+
+    IOLoop.current().run_sync(main)
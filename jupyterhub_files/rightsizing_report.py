@@ -0,0 +1,106 @@
+#!/usr/bin/python3 python3
+""" Recommends an instance profile for every user from the utilization history recorded by the culler.
+
+    For each user, the 95th percentile of CPU utilization (converted to vCPUs of the instance type it was measured on)
+    and of memory used is compared with the capacity of the profiles the user may run on; the smallest profile that
+    keeps both under the target utilization is recommended. With --apply, recommendations are stored in the tracking
+    DB and used from the user's next start, which resizes their stopped instance.
+
+    Usage: python3 rightsizing_report.py [--days 14] [--apply] [--format text|json] """
+
+import argparse
+import json
+import sys
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import boto3
+
+sys.path.insert(1, '/etc/jupyterhub')
+from models import UserProfile, UtilizationSample
+from instance_profiles import InstanceProfiles
+
+with open("/etc/jupyterhub/server_config.json", "r") as f:
+    SERVER_PARAMS = json.load(f) # load local server parameters
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def get_instance_type_specs(instance_types):
+    """ Returns {instance type: (vcpus, memory in bytes)}. """
+    ec2 = boto3.client("ec2", region_name=SERVER_PARAMS["REGION"])
+    instance_types = sorted(set(instance_types))
+    specs = {}
+    for i in range(0, len(instance_types), 100):
+        response = ec2.describe_instance_types(InstanceTypes=instance_types[i:i + 100])
+        for info in response["InstanceTypes"]:
+            specs[info["InstanceType"]] = (info["VCpuInfo"]["DefaultVCpus"], info["MemoryInfo"]["SizeInMiB"] * 2 ** 20)
+    return specs
+
+
+def recommend(profiles, days=14, min_samples=12, cpu_target=0.7, memory_target=0.8):
+    """ Yields one recommendation dict per user with enough samples in the last `days` days. """
+    since = datetime.now() - timedelta(days=days)
+    samples = defaultdict(list)
+    for sample in UtilizationSample.select().where(UtilizationSample.sampled_at >= since):
+        samples[sample.user_id].append(sample)
+    instance_types = {sample.instance_type for user_samples in samples.values() for sample in user_samples}
+    instance_types.update(profile["instance_type"] for profile in profiles.profiles.values())
+    specs = get_instance_type_specs([instance_type for instance_type in instance_types if instance_type])
+
+    for user_name, user_samples in sorted(samples.items()):
+        if len(user_samples) < min_samples:
+            continue
+        cpu_vcpus = [sample.cpu_percent / 100.0 * specs[sample.instance_type][0] for sample in user_samples
+                     if sample.cpu_percent is not None and sample.instance_type in specs]
+        memory = [sample.memory_used for sample in user_samples if sample.memory_used is not None]
+        needed_vcpus = percentile(cpu_vcpus, 0.95) / cpu_target if cpu_vcpus else 0
+        needed_memory = percentile(memory, 0.95) / memory_target if memory else 0
+
+        current = profiles.resolve(user_name, stored=UserProfile.get_profile(user_name))
+        candidates = sorted(profiles.allowed_profiles(user_name),
+                            key=lambda profile: specs.get(profiles.instance_type(profile), (0, 0)))
+        recommended = candidates[-1]
+        for profile in candidates:
+            vcpus, memory_bytes = specs.get(profiles.instance_type(profile), (0, 0))
+            if vcpus >= needed_vcpus and memory_bytes >= needed_memory:
+                recommended = profile
+                break
+        yield {
+            "user": user_name,
+            "samples": len(user_samples),
+            "p95_vcpus": round(needed_vcpus * cpu_target, 2),
+            "p95_memory_gb": round(needed_memory * memory_target / 2 ** 30, 2),
+            "current": current,
+            "recommended": recommended,
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recommends instance profiles from utilization history")
+    parser.add_argument("--days", type=int, default=14, help="how many days of history to use")
+    parser.add_argument("--min-samples", type=int, default=12, help="skip users with fewer samples than this")
+    parser.add_argument("--cpu-target", type=float, default=0.7, help="target p95 CPU utilization (0-1)")
+    parser.add_argument("--memory-target", type=float, default=0.8, help="target p95 memory utilization (0-1)")
+    parser.add_argument("--apply", action="store_true", help="store the recommended profiles for the users' next start")
+    parser.add_argument("--format", choices=["text", "json"], default="text")
+    args = parser.parse_args()
+
+    profiles = InstanceProfiles(SERVER_PARAMS["INSTANCE_TYPE"])
+    recommendations = list(recommend(profiles, args.days, args.min_samples, args.cpu_target, args.memory_target))
+    if args.format == "json":
+        print(json.dumps(recommendations, indent=2))
+    else:
+        print("%-24s %8s %10s %12s %-12s %-12s" % ("user", "samples", "p95 vCPUs", "p95 mem (GB)", "current",
+                                                 "recommended"))
+        for r in recommendations:
+            print("%-24s %8d %10.2f %12.2f %-12s %-12s" % (r["user"], r["samples"], r["p95_vcpus"],
+                                                         r["p95_memory_gb"], r["current"], r["recommended"]))
+    if args.apply:
+        for r in recommendations:
+            if r["recommended"] != r["current"]:
+                UserProfile.set_profile(r["user"], r["recommended"])
+        print("Applied %s changes" % sum(r["recommended"] != r["current"] for r in recommendations))
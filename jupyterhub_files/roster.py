@@ -0,0 +1,460 @@
+""" The course roster (who may log in, and who is an admin), kept in sync without restarting the hub, and a cache of
+    authentication results.
+
+    jupyterhub_config.py used to read /etc/jupyterhub/userlist into the authenticator's whitelist and admin users once,
+    so adding a student meant restarting the hub. A Roster re-reads its source every ROSTER_SYNC_INTERVAL seconds
+    instead: the userlist file (only when it changed), or the members of LDAP groups (ROSTER_LDAP). Each sync applies
+    only the difference to the previous one, so users added through the admin page are kept, and a source that fails
+    or suddenly returns nobody is ignored, as an empty whitelist would let anyone in.
+
+    An authenticator like LDAPAuthenticator binds to the directory and looks up the user's groups on every login,
+    which at the start of a class means hundreds of round trips within a minute. cached_authenticator() wraps an
+    authenticator class so that its results are kept in an AuthCache: a successful login for AUTH_CACHE_TTL seconds
+    (default 300) and a failed one for a tenth of that, for at most AUTH_CACHE_SIZE (default 10000) username and
+    password pairs; concurrent logins with the same credentials share one lookup, and at most
+    AUTH_MAX_CONCURRENT_LOOKUPS (default 20) lookups run at a time. Passwords are only kept as an HMAC with a key
+    that lives as long as the hub process. A changed password is accepted alongside the old one until the old one's
+    entry expires. Logins without a password (e.g. OAuth) are not cached.
+
+    Run `python3 roster.py` to benchmark a login burst and a roster sync against a local LDAP stand-in. """
+
+import copy
+import hashlib
+import hmac
+import inspect
+import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado import gen
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.locks import Semaphore
+
+from instance_profiles import read_userlist
+from ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+MISSING = object()
+
+
+######################################################################################################################
+##################################################### SOURCES ########################################################
+######################################################################################################################
+
+class UserlistFile(object):
+    """ A roster source reading a userlist file, which returns None while the file is unchanged. The userlist also
+        holds users' settings, e.g. their instance profile group; on_change(users) is called with all of them, as
+        instance_profiles.read_userlist() returns them, whenever the file is read. """
+
+    def __init__(self, path, on_change=None):
+        self.path = path
+        self.on_change = on_change
+        self._stat = None
+
+    def __call__(self):
+        if not os.path.isfile(self.path):
+            return None
+        stat = os.stat(self.path)
+        stat = (stat.st_mtime_ns, stat.st_size)
+        if stat == self._stat:
+            return None
+        users = read_userlist(self.path)
+        if self.on_change is not None:
+            self.on_change(users)
+        self._stat = stat
+        return {name: settings["admin"] for name, settings in users.items()}
+
+
+def member_name(member, username_attribute):
+    """ The user name in a group member value, which is either a DN (member, uniqueMember) or a name (memberUid). """
+    if "=" not in member:
+        return member
+    attribute, _, value = member.split(",", 1)[0].partition("=")
+    return value.strip() if attribute.strip().lower() == username_attribute.lower() else None
+
+
+class LDAPGroups(object):
+    """ A roster source reading the members of LDAP groups: everyone in `groups` may log in, everyone in
+        `admin_groups` is an admin as well. Each group's members are kept for group_ttl seconds. """
+
+    def __init__(self, server_address, groups, admin_groups=(), bind_dn=None, password=None, use_ssl=True,
+                 member_attribute="member", username_attribute="uid", group_ttl=60, connect=None):
+        self.server_address = server_address
+        self.groups = list(groups)
+        self.admin_groups = list(admin_groups)
+        self.bind_dn = bind_dn
+        self.password = password
+        self.use_ssl = use_ssl
+        self.member_attribute = member_attribute
+        self.username_attribute = username_attribute
+        self.cache = TTLCache(group_ttl, max_size=1000)
+        self.lookups = 0
+        self._connect = connect or self._ldap3_connection
+
+    def _ldap3_connection(self):
+        import ldap3
+        server = ldap3.Server(self.server_address, use_ssl=self.use_ssl)
+        return ldap3.Connection(server, user=self.bind_dn, password=self.password, auto_bind=True, read_only=True)
+
+    def members(self, connection, group_dn):
+        """ The user names in group_dn, from the cache or the directory. The cache is only used from the sync's
+            thread. """
+        members = self.cache.get(group_dn)
+        if members is None:
+            self.lookups += 1
+            connection.search(group_dn, "(objectClass=*)", search_scope="BASE", attributes=[self.member_attribute])
+            values = connection.entries[0][self.member_attribute].values if connection.entries else []
+            members = {name for name in (member_name(str(value), self.username_attribute) for value in values)
+                       if name}
+            self.cache.set(group_dn, members)
+        return members
+
+    def __call__(self):
+        connection = self._connect()
+        try:
+            admins = set().union(*[self.members(connection, group) for group in self.admin_groups])
+            users = set().union(admins, *[self.members(connection, group) for group in self.groups])
+        finally:
+            connection.unbind()
+        return {name: name in admins for name in users}
+
+
+######################################################################################################################
+###################################################### ROSTER ########################################################
+######################################################################################################################
+
+class Roster(object):
+    """ Keeps an authenticator's whitelist and admin users in sync with source, a callable returning {user name: is
+        admin}, or None when nothing changed. """
+
+    def __init__(self, source, interval=60):
+        self.source = source
+        self.interval = interval
+        self.entries = {}
+        self.whitelist = set()
+        self.admin = set()
+        self.syncs = 0
+        self.changes = 0
+        self.failures = 0
+        self.last_sync = None
+        self.last_error = None
+        self._executor = ThreadPoolExecutor(1)
+        self._periodic_callback = None
+        self._set_admin = None
+
+    def load(self):
+        """ Reads the source once, e.g. at startup. """
+        entries = self.source()
+        if entries is not None:
+            self.apply(entries)
+        return self.entries
+
+    def attach(self, whitelist, admin, set_admin=None):
+        """ Syncs into these sets from now on (the authenticator's, which traitlets copies on assignment). The hub
+            only reads admin users into its database at startup, so set_admin({user name: is admin}) is called with
+            the users whose admin status a sync changed. """
+        whitelist.update(self.whitelist)
+        admin.update(self.admin)
+        self.whitelist, self.admin = whitelist, admin
+        self._set_admin = set_admin
+
+    def apply(self, entries):
+        """ Applies the changes from the previous entries to entries. Returns (added, removed, admin changed). """
+        if not entries and self.entries:
+            raise ValueError("the roster source returned nobody, keeping the %d users" % len(self.entries))
+        added = set(entries) - set(self.entries)
+        removed = set(self.entries) - set(entries)
+        changed = {name for name in set(entries) & set(self.entries) if entries[name] != self.entries[name]}
+        for name in added | changed:
+            self.whitelist.add(name)
+            if entries[name]:
+                self.admin.add(name)
+            else:
+                self.admin.discard(name)
+        for name in removed:
+            self.whitelist.discard(name)
+            self.admin.discard(name)
+        admin_changes = dict({name: False for name in removed if self.entries[name]},
+                             **{name: entries[name] for name in added | changed})
+        self.entries = dict(entries)
+        self.changes += len(added) + len(removed) + len(changed)
+        if self._set_admin is not None and admin_changes:
+            try:
+                self._set_admin(admin_changes)
+            except Exception as e:
+                logger.error("could not update the admin status of %s: %s", sorted(admin_changes), e)
+        return added, removed, changed
+
+    def start(self):
+        """ Starts the periodic syncs on the current IOLoop; calling it again is a no-op. """
+        if self._periodic_callback is None and self.interval:
+            self._periodic_callback = PeriodicCallback(self.sync, 1e3 * self.interval)
+            self._periodic_callback.start()
+
+    def stop(self):
+        if self._periodic_callback is not None:
+            self._periodic_callback.stop()
+            self._periodic_callback = None
+
+    @gen.coroutine
+    def sync(self):
+        """ Reads the source (in a thread, as it may block) and applies the changes. """
+        self.syncs += 1
+        try:
+            entries = yield self._executor.submit(self.source)
+            if entries is None:
+                return
+            added, removed, changed = self.apply(entries)
+        except Exception as e:
+            self.failures += 1
+            self.last_error = str(e)
+            logger.warning("roster sync failed: %s", e)
+            return
+        self.last_sync = time.time()
+        self.last_error = None
+        if added or removed or changed:
+            logger.info("roster: added %s, removed %s, admin changed for %s",
+                        sorted(added) or "nobody", sorted(removed) or "nobody", sorted(changed) or "nobody")
+
+    def metrics(self):
+        return {
+            "users": len(self.entries),
+            "admins": sum(1 for admin in self.entries.values() if admin),
+            "syncs": self.syncs,
+            "changes": self.changes,
+            "failures": self.failures,
+            "last_sync": self.last_sync,
+            "last_error": self.last_error,
+        }
+
+
+######################################################################################################################
+#################################################### AUTH CACHE ######################################################
+######################################################################################################################
+
+class AuthCache(object):
+    """ Caches the results of an authenticator's authenticate(handler, data) by username and password. """
+
+    def __init__(self, ttl=300, failure_ttl=None, max_size=10000, max_concurrent=20):
+        self.failure_ttl = ttl / 10.0 if failure_ttl is None else failure_ttl
+        self.cache = TTLCache(ttl, max_size)
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.uncached = 0
+        self._key = os.urandom(32)
+        self._pending = {}
+        self._semaphore = Semaphore(max_concurrent)
+
+    def _cache_key(self, username, password):
+        digest = hmac.new(self._key, password.encode("utf-8"), hashlib.sha256).hexdigest()
+        return username, digest
+
+    @gen.coroutine
+    def authenticate(self, authenticate, handler, data):
+        password = data.get("password")
+        if not password:
+            self.uncached += 1
+            result = yield self._call(authenticate, handler, data)
+            return result
+        key = self._cache_key(data.get("username", ""), password)
+        result = self.cache.get(key, MISSING)
+        if result is not MISSING:
+            self.hits += 1
+            return copy.deepcopy(result)  # the hub adds its own keys to a dict result
+        future = self._pending.get(key)
+        if future is None:
+            self.misses += 1
+            future = self._pending[key] = self._lookup(key, authenticate, handler, data)
+            future.add_done_callback(lambda _: self._pending.pop(key, None))
+        else:
+            self.shared += 1
+        result = yield future
+        return copy.deepcopy(result)
+
+    @gen.coroutine
+    def _call(self, authenticate, handler, data):
+        result = authenticate(handler, data)
+        if inspect.isawaitable(result):
+            result = yield result
+        return result
+
+    @gen.coroutine
+    def _lookup(self, key, authenticate, handler, data):
+        with (yield self._semaphore.acquire()):
+            result = yield self._call(authenticate, handler, data)
+        self.cache.set(key, result, ttl=None if result else self.failure_ttl)
+        return result
+
+    def metrics(self):
+        lookups = self.hits + self.misses + self.shared
+        return {
+            "entries": len(self.cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "shared": self.shared,
+            "uncached": self.uncached,
+            "hit_rate": round((self.hits + self.shared) / float(lookups), 3) if lookups else None,
+            "pending": len(self._pending),
+        }
+
+
+def cached_authenticator(base, cache, roster=None):
+    """ A subclass of the authenticator class base whose logins go through cache, and whose whitelist and admin
+        users roster keeps in sync. """
+
+    class CachedAuthenticator(base):
+
+        def __init__(self, **kwargs):
+            super().__init__(**kwargs)
+            if roster is not None:
+                roster.attach(self.whitelist, self.admin_users, self.set_admin)
+                IOLoop.current().add_callback(roster.start)
+
+        def set_admin(self, changes):
+            """ Updates the admin status of the hub's users in changes, {user name: is admin}; users who never
+                logged in get theirs from admin_users when they first do. """
+            from jupyterhub import orm
+            db = self.parent.db
+            for name, admin in changes.items():
+                user = orm.User.find(db, name)
+                if user is not None and user.admin != admin:
+                    user.admin = admin
+            db.commit()
+
+        @gen.coroutine
+        def authenticate(self, handler, data):
+            result = yield cache.authenticate(super().authenticate, handler, data)
+            return result
+
+    CachedAuthenticator.__name__ = "Cached" + base.__name__
+    return CachedAuthenticator
+
+
+######################################################################################################################
+##################################################### BENCHMARK ######################################################
+######################################################################################################################
+
+class FakeDirectory(object):
+    """ A local LDAP stand-in: binds and group searches take `latency` seconds, and at most `capacity` are served at
+        a time, as by a directory server with a small connection pool. """
+
+    def __init__(self, users, latency=0.05, capacity=10):
+        self.users = users  # {user name: password}
+        self.groups = {}
+        self.latency = latency
+        self.requests = 0
+        self.capacity = Semaphore(capacity)
+
+    @gen.coroutine
+    def request(self):
+        with (yield self.capacity.acquire()):
+            self.requests += 1
+            yield gen.sleep(self.latency)
+
+    @gen.coroutine
+    def authenticate(self, handler, data):
+        """ As LDAPAuthenticator does: bind as the user, then look up their groups. """
+        yield self.request()
+        if self.users.get(data["username"]) != data["password"]:
+            return None
+        yield self.request()
+        return {"name": data["username"], "auth_state": {"groups": ["course"]}}
+
+    def connect(self):
+        directory = self
+
+        class Connection(object):
+            entries = []
+
+            def search(self, group_dn, search_filter, search_scope, attributes):
+                directory.requests += 1
+                time.sleep(directory.latency)
+                self.entries = [{attributes[0]: FakeAttribute(directory.groups.get(group_dn, []))}]
+
+            def unbind(self):
+                pass
+
+        return Connection()
+
+
+class FakeAttribute(object):
+
+    def __init__(self, values):
+        self.values = values
+
+
+def login_burst(directory, cache, users, logins_per_user, window):
+    """ Each user logs in logins_per_user times (e.g. several tabs, or a retry) at random moments within window
+        seconds. Returns the sorted login latencies. """
+    latencies = []
+
+    @gen.coroutine
+    def login(name, delay):
+        yield gen.sleep(delay)
+        started = time.perf_counter()
+        data = {"username": name, "password": directory.users[name]}
+        if cache is None:
+            result = yield directory.authenticate(None, data)
+        else:
+            result = yield cache.authenticate(directory.authenticate, None, data)
+        assert result and result["name"] == name
+        latencies.append(time.perf_counter() - started)
+
+    @gen.coroutine
+    def main():
+        yield [login(name, random.uniform(0, window)) for name in users for _ in range(logins_per_user)]
+
+    IOLoop.current().run_sync(main)
+    return sorted(latencies)
+
+
+def benchmark(users=400, logins_per_user=3, window=10, latency=0.05, capacity=10, roster_users=5000,
+              roster_changes=20):
+    names = ["student%04d" % i for i in range(users)]
+    print("%d users logging in %d times each within %d s, directory round trips of %d ms, %d at a time" % (
+        users, logins_per_user, window, 1000 * latency, capacity))
+    print("%-10s %12s %10s %10s %10s" % ("", "directory", "p50 ms", "p99 ms", "max ms"))
+    for label, cache in (("uncached", None), ("cached", AuthCache())):
+        directory = FakeDirectory({name: "pw-" + name for name in names}, latency, capacity)
+        latencies = login_burst(directory, cache, names, logins_per_user, window)
+        print("%-10s %12d %10.1f %10.1f %10.1f" % (label, directory.requests, 1000 * latencies[len(latencies) // 2],
+                                                   1000 * latencies[len(latencies) * 99 // 100],
+                                                   1000 * latencies[-1]))
+        if cache is not None:
+            print("cache: %s" % cache.metrics())
+
+    directory = FakeDirectory({}, latency)
+    members = ["uid=student%05d,ou=people,dc=example,dc=edu" % i for i in range(roster_users)]
+    directory.groups = {"cn=course,ou=groups": members, "cn=staff,ou=groups": members[:5]}
+    source = LDAPGroups("ldap.example.edu", ["cn=course,ou=groups"], ["cn=staff,ou=groups"], group_ttl=0,
+                        connect=directory.connect)
+    roster = Roster(source)
+    whitelist, admin = set(), set()
+    roster.attach(whitelist, admin)
+    started = time.perf_counter()
+    roster.load()
+    loaded = time.perf_counter() - started
+    members[-roster_changes:] = ["uid=late%05d,ou=people,dc=example,dc=edu" % i for i in range(roster_changes)]
+    started = time.perf_counter()
+    added, removed, changed = roster.apply(source())
+    print("roster of %d users from a group search: loaded in %.1f ms; a sync with %d users replaced took %.1f ms "
+          "(%d added, %d removed) and %d directory requests in all" % (
+              len(whitelist), 1000 * loaded, roster_changes, 1000 * (time.perf_counter() - started), len(added),
+              len(removed), directory.requests))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmarks the authentication cache and the roster sync against a "
+                                                 "local LDAP stand-in")
+    parser.add_argument("--users", type=int, default=400)
+    parser.add_argument("--logins-per-user", type=int, default=3)
+    parser.add_argument("--window", type=float, default=10, help="seconds over which the logins are spread")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per directory request")
+    parser.add_argument("--capacity", type=int, default=10, help="directory requests served at a time")
+    args = parser.parse_args()
+    benchmark(args.users, args.logins_per_user, args.window, args.latency, args.capacity)
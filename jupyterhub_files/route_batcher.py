@@ -0,0 +1,95 @@
+""" Batched synchronization of proxy routes.
+
+    The hub adds a route to configurable-http-proxy when a user's server starts and deletes it when the server stops,
+    one REST call each, and at startup (and every few minutes in check_routes) it fetches the whole table and adds
+    every missing route at once. The RouteBatcher collects the changes requested within a short window, keeps only the
+    last change per route (an add followed by a delete of the same route sends only the delete), and applies them
+    with a bounded number of requests in flight, so that a login burst or a hub restart neither floods the proxy's API
+    nor waits on it one route at a time. Each caller still gets a future that resolves once its change is applied; the
+    future of a change that was undone by the opposite change (e.g. the add above) fails with RouteSuperseded. """
+
+import logging
+from collections import OrderedDict
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.locks import Semaphore
+
+logger = logging.getLogger(__name__)
+
+ADD = "add"
+DELETE = "delete"
+
+
+class RouteSuperseded(Exception):
+    pass
+
+
+class RouteBatcher(object):
+    """ apply(operation, routespec, target, data) is a coroutine that applies one change (ADD or DELETE) to the
+        proxy; target and data are None for a delete. """
+
+    def __init__(self, apply, window=0.05, concurrency=10):
+        self.apply = apply
+        self.window = window
+        self._semaphore = Semaphore(concurrency)
+        self._pending = OrderedDict()  # routespec: (operation, target, data, [Future])
+        self.requested = 0
+        self.coalesced = 0
+        self.applied = 0
+        self.failed = 0
+        self.flushes = 0
+
+    def add(self, routespec, target, data=None):
+        return self._queue(ADD, routespec, target, data)
+
+    def delete(self, routespec):
+        return self._queue(DELETE, routespec, None, None)
+
+    def _queue(self, operation, routespec, target, data):
+        future = Future()
+        self.requested += 1
+        if not self._pending:
+            IOLoop.current().call_later(self.window, self.flush)
+        waiting = []
+        if routespec in self._pending:
+            self.coalesced += 1
+            earlier_operation, _, _, earlier = self._pending.pop(routespec)
+            if earlier_operation == operation:
+                # e.g. an add with a new target: the earlier callers wait for this one
+                waiting = earlier
+            else:
+                # the earlier change is undone without ever being applied
+                for earlier_future in earlier:
+                    earlier_future.set_exception(RouteSuperseded("%s of route %s superseded by a %s"
+                                                                 % (earlier_operation, routespec, operation)))
+        self._pending[routespec] = (operation, target, data, waiting + [future])
+        return future
+
+    @gen.coroutine
+    def flush(self):
+        """ Applies the pending changes. """
+        pending, self._pending = self._pending, OrderedDict()
+        if pending:
+            self.flushes += 1
+            yield [self._apply(routespec, *change) for routespec, change in pending.items()]
+
+    @gen.coroutine
+    def _apply(self, routespec, operation, target, data, futures):
+        with (yield self._semaphore.acquire()):
+            try:
+                yield self.apply(operation, routespec, target, data)
+            except Exception as e:
+                self.failed += 1
+                logger.warning("could not %s route %s: %s" % (operation, routespec, e))
+                for future in futures:
+                    future.set_exception(e)
+                return
+        self.applied += 1
+        for future in futures:
+            future.set_result(None)
+
+    def metrics(self):
+        return {"requested": self.requested, "coalesced": self.coalesced, "applied": self.applied,
+                "failed": self.failed, "flushes": self.flushes, "pending": len(self._pending)}
@@ -0,0 +1,243 @@
+#!/usr/bin/python3 python3
+""" Publishes and inspects versions of the shared datasets that every worker mounts read-only at /datasets.
+
+    `publish --url URL` builds a version on a scratch worker (see golden_home_builder.sh): it creates a volume of
+    --size GB, formats it with the "datasets" label, unpacks the .tar.gz bundle at URL (e.g. a presigned S3 URL) onto
+    it and snapshots it. `publish --snapshot ID` publishes an existing snapshot of such a volume instead, e.g. to roll
+    back to an earlier version. Either way the snapshot is recorded as the next, current DatasetVersion; workers get it
+    when they are launched or next started (see datasets.py). --fast-restore enables fast snapshot restore in the
+    workers' availability zones, so that the first read of each file is not slowed down (charged per zone and hour).
+    The snapshots of the KEEP_VERSIONS latest versions are kept, older ones are deleted.
+
+    `show` lists the versions and how many workers have each. `local-check` runs the build and the read-only mount of a
+    bundle on this machine, on a loop device when run as root with mkfs.xfs installed and on a directory standing in
+    for the volume otherwise, and the version bookkeeping against a scratch tracking database; it needs no cluster.
+
+    Usage: python3 shared_datasets.py publish (--url URL --size GB | --snapshot ID) [--description TEXT]
+                                              [--fast-restore]
+           python3 shared_datasets.py show
+           python3 shared_datasets.py local-check [--bundle FILE.tar.gz] """
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+import boto3
+from botocore.exceptions import ClientError
+
+sys.path.insert(1, '/etc/jupyterhub')
+if sys.argv[1:2] == ["local-check"]:
+    # the check uses a scratch tracking database, never the cluster's
+    os.environ["TRACKING_DB_URL"] = "sqlite:///%s" % os.path.join(tempfile.mkdtemp(), "tracking.sqlite3")
+from datasets import DatasetVolumes, DATASET_LABEL, VERSION_TAG
+from models import DatasetVersion, DatasetVolume
+
+KEEP_VERSIONS = 3
+DATASETS_TAG = "Shared Datasets"  # tags the snapshots, with the cluster name as value
+
+
+def server_params():
+    with open("/etc/jupyterhub/server_config.json", "r") as f:
+        return json.load(f)
+
+
+def build(ec2, url, size):
+    """ Builds a datasets volume from the bundle at url on a scratch worker and snapshots it. Returns the snapshot
+        id. """
+    # golden_home.py reads the cluster's configuration when imported
+    from golden_home import CLUSTER, attach, builder_reports, cleanup, create_volume, launch_builder, progress, wait
+    instance_id, availability_zone = launch_builder(ec2, "dataset", url)
+    volume_id, _ = create_volume(ec2, availability_zone, size)
+    try:
+        attach(ec2, volume_id, instance_id, "/dev/sdf")
+        reports = builder_reports(ec2, instance_id)
+        if reports[-1] != "built":
+            raise RuntimeError("building the datasets volume failed: %s" % reports[-1])
+        ec2.detach_volume(VolumeId=volume_id)
+        wait(ec2, "volume_available", VolumeIds=[volume_id])
+        snapshot_id = ec2.create_snapshot(
+            VolumeId=volume_id, Description="Shared datasets of %s" % CLUSTER,
+            TagSpecifications=[{"ResourceType": "snapshot", "Tags": [
+                {"Key": DATASETS_TAG, "Value": CLUSTER}, {"Key": "Name", "Value": "datasets-%s" % CLUSTER}]}]
+        )["SnapshotId"]
+        progress("snapshotting %s (%s)" % (snapshot_id, ", ".join(reports[:-1])))
+        wait(ec2, "snapshot_completed", SnapshotIds=[snapshot_id])
+    finally:
+        cleanup(ec2, instance_id, [volume_id])
+    return snapshot_id
+
+
+def publish(ec2, url, size, snapshot_id, description, fast_restore):
+    from golden_home import disable_fast_restore, progress, worker_zones
+    previous = DatasetVersion.current()
+    if snapshot_id is None:
+        snapshot_id = build(ec2, url, size)
+    snapshot = ec2.describe_snapshots(SnapshotIds=[snapshot_id])["Snapshots"][0]
+    version = DatasetVersion.publish(snapshot_id, snapshot["VolumeSize"], description or url or "")
+    ec2.create_tags(Resources=[snapshot_id], Tags=[{"Key": VERSION_TAG, "Value": str(version.version)}])
+    if fast_restore:
+        zones = worker_zones()
+        ec2.enable_fast_snapshot_restores(AvailabilityZones=zones, SourceSnapshotIds=[snapshot_id])
+        progress("enabled fast snapshot restore of %s in %s" % (snapshot_id, ", ".join(zones)))
+    if previous is not None and previous.snapshot_id != snapshot_id:
+        disable_fast_restore(ec2, previous.snapshot_id)  # volumes are only restored from the current version
+    versions = list(DatasetVersion.select().order_by(DatasetVersion.version.desc()))
+    kept = {v.snapshot_id for v in versions[:KEEP_VERSIONS]}
+    for old in versions[KEEP_VERSIONS:]:
+        if old.snapshot_id not in kept:
+            try:
+                ec2.delete_snapshot(SnapshotId=old.snapshot_id)
+                progress("deleted the snapshot %s of version %s" % (old.snapshot_id, old.version))
+            except ClientError as e:
+                progress("could not delete the snapshot %s of version %s: %s" % (old.snapshot_id, old.version, e))
+        old.delete_instance()
+    print("published %s as version %s; workers get it when they are next launched or started" % (
+        snapshot_id, version.version))
+
+
+def forget_terminated(ec2):
+    """ Removes the DatasetVolumes of instances that no longer exist. """
+    instance_ids = [record.instance_id for record in DatasetVolume.select()]
+    existing = set()
+    for start in range(0, len(instance_ids), 200):
+        for reservation in ec2.describe_instances(Filters=[
+                {"Name": "instance-id", "Values": instance_ids[start:start + 200]},
+                {"Name": "instance-state-name", "Values": ["pending", "running", "stopping", "stopped"]}
+        ])["Reservations"]:
+            existing.update(instance["InstanceId"] for instance in reservation["Instances"])
+    for instance_id in set(instance_ids) - existing:
+        DatasetVolume.remove(instance_id)
+
+
+def show(ec2):
+    forget_terminated(ec2)
+    workers = {}
+    for record in DatasetVolume.select():
+        workers[record.version] = workers.get(record.version, 0) + 1
+    print("%8s  %-22s %6s %8s  %-16s  %s" % ("version", "snapshot", "GB", "workers", "published", "description"))
+    for version in DatasetVersion.select().order_by(DatasetVersion.version.desc()):
+        print("%8s  %-22s %6s %8s  %-16s  %s" % (version.version, version.snapshot_id, version.size,
+                                                 workers.pop(version.version, 0),
+                                                 version.created_at.strftime("%Y-%m-%d %H:%M"), version.description))
+    if workers:
+        print("%s workers have older, deleted versions" % sum(workers.values()))
+
+
+def local_check(bundle=None):
+    """ Builds a datasets file system from a bundle (a generated one by default) and mounts it read-only as a worker
+        would, then publishes two versions in the scratch tracking database and checks which version a worker gets.
+        Exits with an error message at the first step that fails. """
+    work = tempfile.mkdtemp(prefix="datasets-check-")
+
+    def step(message):
+        print("ok   %s" % message)
+
+    if bundle is None:
+        source = os.path.join(work, "bundle")
+        os.makedirs(os.path.join(source, "week1"))
+        with open(os.path.join(source, "README.txt"), "w") as f:
+            f.write("Course datasets, read-only\n")
+        with open(os.path.join(source, "week1", "grades.csv"), "w") as f:
+            f.write("student,grade\n" + "".join("student%d,%d\n" % (i, 50 + i % 50) for i in range(1000)))
+        bundle = os.path.join(work, "bundle.tar.gz")
+        with tarfile.open(bundle, "w:gz") as tar:
+            tar.add(source, arcname=".")
+    with tarfile.open(bundle) as tar:
+        expected = sorted(os.path.normpath(member.name) for member in tar.getmembers() if member.isfile())
+    step("bundle %s holds %d files" % (bundle, len(expected)))
+
+    mount_point = os.path.join(work, "datasets")
+    os.makedirs(mount_point)
+    loop = os.geteuid() == 0 and shutil.which("mkfs.xfs") and shutil.which("losetup")
+    if loop:
+        # as golden_home_builder.sh does on the scratch worker, then as the worker's fstab line mounts it
+        image = os.path.join(work, "datasets.img")
+        with open(image, "wb") as f:
+            f.truncate(max(512, os.path.getsize(bundle) * 20 // (1024 * 1024)) * 1024 * 1024)
+        subprocess.check_call(["mkfs.xfs", "-q", "-L", DATASET_LABEL, image])
+        label = subprocess.check_output(["blkid", "-o", "value", "-s", "LABEL", image]).decode().strip()
+        if label != DATASET_LABEL:
+            sys.exit("FAIL the file system is labelled %r rather than %r" % (label, DATASET_LABEL))
+        subprocess.check_call(["mount", "-o", "loop", image, mount_point])
+        subprocess.check_call(["tar", "-xzf", bundle, "-C", mount_point])
+        subprocess.check_call(["chmod", "-R", "a+rX,go-w", mount_point])
+        subprocess.check_call(["umount", mount_point])
+        subprocess.check_call(["mount", "-o", "loop,ro,noatime", image, mount_point])
+        step("built an XFS file system labelled %s on a loop device and mounted it read-only" % DATASET_LABEL)
+    else:
+        # a directory stands in for the volume; root ignores the missing write permission
+        with tarfile.open(bundle) as tar:
+            tar.extractall(mount_point)
+        subprocess.check_call(["chmod", "-R", "a+rX,a-w", mount_point])
+        step("unpacked the bundle into a read-only directory standing in for the volume")
+    try:
+        found = sorted(os.path.relpath(os.path.join(root, name), mount_point)
+                       for root, _, names in os.walk(mount_point) for name in names)
+        if found != expected:
+            sys.exit("FAIL the mounted datasets hold %s rather than %s" % (found, expected))
+        for name in found:
+            with open(os.path.join(mount_point, name), "rb") as f:
+                f.read()
+        step("every file of the bundle can be read")
+        if loop or os.geteuid() != 0:
+            try:
+                open(os.path.join(mount_point, "written-by-a-user"), "w").close()
+                sys.exit("FAIL the datasets can be written to")
+            except OSError:
+                step("the datasets cannot be written to")
+    finally:
+        if loop:
+            subprocess.call(["umount", mount_point])
+        subprocess.call(["chmod", "-R", "u+w", work])
+        shutil.rmtree(work, ignore_errors=True)
+
+    volumes = DatasetVolumes("us-east-1")
+    if volumes.launch_mapping() != (None, None):
+        sys.exit("FAIL a worker gets datasets before any version was published")
+    DatasetVersion.publish("snap-00000000000000001", 1, "first")
+    mapping, version = volumes.launch_mapping()
+    if version != 1 or mapping["Ebs"]["SnapshotId"] != "snap-00000000000000001":
+        sys.exit("FAIL a new worker gets %s of version %s rather than version 1" % (mapping, version))
+    DatasetVolume.set_volume("i-00000000000000001", "vol-00000000000000001", 1)
+    if volumes._update("i-00000000000000001") != 1:
+        sys.exit("FAIL a worker with the current version would get a new volume")
+    step("a new worker gets a volume of version 1, and keeps it while version 1 is current")
+    DatasetVersion.publish("snap-00000000000000002", 1, "second")
+    mapping, version = volumes.launch_mapping()
+    record = DatasetVolume.get_volume("i-00000000000000001")
+    if version != 2 or record.version >= DatasetVersion.current().version:
+        sys.exit("FAIL after publishing version 2, new workers get version %s and the stopped worker with version %s "
+                 "is not updated" % (version, record.version))
+    step("after publishing version 2, new workers get it and the worker with version 1 is updated on its next start")
+    print("all checks passed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Publishes and inspects versions of the shared datasets")
+    parser.add_argument("command", choices=["publish", "show", "local-check"])
+    parser.add_argument("--url", help="URL of a .tar.gz bundle of the datasets, to build a new version from")
+    parser.add_argument("--size", type=int, default=0, help="size (GB) of the datasets volume, for --url")
+    parser.add_argument("--snapshot", help="publish this existing snapshot of a datasets volume")
+    parser.add_argument("--description", default="")
+    parser.add_argument("--fast-restore", action="store_true",
+                        help="enable fast snapshot restore in the workers' availability zones")
+    parser.add_argument("--bundle", help="for local-check, a .tar.gz bundle to check instead of a generated one")
+    args = parser.parse_args()
+
+    if args.command == "local-check":
+        local_check(args.bundle)
+        sys.exit(0)
+    ec2 = boto3.client("ec2", region_name=server_params()["REGION"])
+    if args.command == "publish":
+        if bool(args.url) == bool(args.snapshot):
+            sys.exit("publish needs either --url or --snapshot")
+        if args.url and args.size <= 0:
+            sys.exit("--url needs the --size (GB) of the volume to build")
+        publish(ec2, args.url, args.size, args.snapshot, args.description, args.fast_restore)
+    else:
+        show(ec2)
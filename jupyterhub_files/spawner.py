@@ -1,6 +1,11 @@
+import html
 import json
 import logging
+import os
+import shlex
 import socket
+import sys
+import uuid
 import boto3
 from fabric.api import env, sudo as _sudo, run as _run
 from fabric.operations import put as _put
@@ -8,12 +13,33 @@ from fabric.context_managers import settings
 from fabric.exceptions import NetworkError
 from paramiko.ssh_exception import SSHException, ChannelException
 from botocore.exceptions import ClientError, WaiterError
-from datetime import datetime
+from datetime import datetime, timedelta
+from io import StringIO
 from tornado import gen, web
+from tornado.ioloop import IOLoop
 from jupyterhub.spawner import Spawner
+from traitlets import default
 from concurrent.futures import ThreadPoolExecutor
 
-from models import Server
+from models import (DB, Server, UserProfile, SpotUsage, HomeVolume, SpawnClaim, SharedWorker, PackedServer,
+                    IntegrityError)
+from instance_profiles import InstanceProfiles, SCRATCH_DEVICES, ebs_parameters
+from health_check import HealthMonitor, UNHEALTHY
+from home_volumes import HomeVolumes, HomeVolumeError
+from datasets import DatasetVolumes
+from placement import PlacementScheduler, CAPACITY_ERRORS, describe_subnets
+from admission import AdmissionController, LAUNCH, BOOT, NOTEBOOK
+from instance_states import InstanceStateCache
+from stop_pipeline import StopPipeline, StopFailed
+from event_log import EventLog, SPAWN, START, STOP, TERMINATE
+from structured_log import ContextAdapter, Sampler, install as install_logging, summarize
+from packing import SharedWorkerPool, PackingError, instance_capacity
+from poll_scheduler import PollScheduler, NOT_CHECKED
+from capacity import CapacityPlanner, CapacityExhausted
+from tracing import tracer_from_config, spawner_key
+import cluster_metrics
+from worker_agent import (AgentClientPool, WorkerAgentError, agent_token, notebook_env_file, DEFAULT_AGENT_PORT,
+                          NOTEBOOK_UNIT, NOTEBOOK_ENV_FILE, TOKEN_FILE as AGENT_TOKEN_FILE)
 
 def get_local_ip_address():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -25,10 +51,32 @@ def get_local_ip_address():
 with open("/etc/jupyterhub/server_config.json", "r") as f:
     SERVER_PARAMS = json.load(f) # load local server parameters
 
+# With TRACE_DIR set, the spawner's calls to AWS, the workers and the tracking database are written to a trace that
+# tracing.py replays offline.
+tracer = tracer_from_config(SERVER_PARAMS, "hub")
+if tracer is not None:
+    tracer.install_aws()
+    tracer.install_db(DB)
+    tracer.install_agent()
+
 LONG_RETRY_COUNT = 120
 HUB_MANAGER_IP_ADDRESS = get_local_ip_address()
 NOTEBOOK_SERVER_PORT = 4444
 WORKER_USERNAME  = SERVER_PARAMS["WORKER_USERNAME"]
+# Workers launched from an AMI with the worker agent are controlled through it rather than through SSH commands.
+WORKER_AGENT_SECRET = SERVER_PARAMS.get("WORKER_AGENT_SECRET")
+WORKER_AGENT_PORT = SERVER_PARAMS.get("WORKER_AGENT_PORT", DEFAULT_AGENT_PORT)
+# Workers whose AMI has the jupyter-singleuser@ systemd unit run notebooks under it: starting it returns once the
+# notebook is listening, and systemd restarts a notebook that crashed.
+NOTEBOOK_UNIT_ENABLED = SERVER_PARAMS.get("NOTEBOOK_UNIT", False)
+
+# Spot workers: one-time Spot instances that are terminated rather than stopped. The user's home volume outlives
+# them and is attached to a replacement instance on the next start.
+SPOT_ENABLED = SERVER_PARAMS.get("SPOT_ENABLED", False)
+SPOT_MARKET_OPTIONS = {"MarketType": "spot",
+                       "SpotOptions": {"SpotInstanceType": "one-time", "InstanceInterruptionBehavior": "terminate"}}
+with open("/etc/jupyterhub/instance_prices.json", "r") as f:
+    ON_DEMAND_PRICES = json.load(f) # hourly prices used to report Spot savings
 
 
 WORKER_TAGS = [ #These tags are set on every server created by the spawner
@@ -38,6 +86,95 @@ WORKER_TAGS = [ #These tags are set on every server created by the spawner
     {"Key": "Jupyter Cluster", "Value": SERVER_PARAMS["JUPYTER_CLUSTER"]},
 ]
 
+# Worker sizes users can run on, the cluster-wide INSTANCE_TYPE unless instance_profiles.json defines more.
+# Their volumes default to the cluster-wide ROOT_VOLUME and HOME_VOLUME EBS settings (gp3 unless set otherwise).
+instance_profiles = InstanceProfiles(SERVER_PARAMS["INSTANCE_TYPE"], SERVER_PARAMS.get("SPOT_INSTANCE_TYPES"),
+                                     SERVER_PARAMS.get("FALLBACK_INSTANCE_TYPES"),
+                                     default_volumes={"root_volume": SERVER_PARAMS.get("ROOT_VOLUME"),
+                                                      "home_volume": SERVER_PARAMS.get("HOME_VOLUME"),
+                                                      "scratch": SERVER_PARAMS.get("WORKER_SCRATCH", False)})
+
+# New workers go to the subnet (availability zone) and instance type with the fewest recent capacity errors.
+placement = PlacementScheduler(
+    describe_subnets(SERVER_PARAMS["REGION"], SERVER_PARAMS.get("WORKER_SUBNET_IDS") or [SERVER_PARAMS["SUBNET_ID"]]),
+    half_life=SERVER_PARAMS.get("PLACEMENT_ERROR_HALF_LIFE", 900),
+)
+cluster_metrics.register("placement", placement.metrics)
+
+# Bounds the number of spawns in each phase at a time, the others wait in line (first come, first served).
+spawn_limits = SERVER_PARAMS.get("SPAWN_LIMITS", {})
+admission = AdmissionController({LAUNCH: spawn_limits.get(LAUNCH, 20),
+                                 BOOT: spawn_limits.get(BOOT, 50),
+                                 NOTEBOOK: spawn_limits.get(NOTEBOOK, 20)})
+cluster_metrics.register("admission", admission.metrics)
+# Stops are batched and followed until the instance has stopped, using instance states shared across the spawner.
+instance_states = InstanceStateCache(SERVER_PARAMS["REGION"])
+stop_pipeline = StopPipeline(SERVER_PARAMS["REGION"], instance_states)
+cluster_metrics.register("stops", stop_pipeline.metrics)
+
+# Servers are checked on their own, phase-spread schedules; poll() answers with the latest result.
+poll_scheduler = PollScheduler(interval=SERVER_PARAMS.get("POLL_INTERVAL", 10),
+                               min_interval=SERVER_PARAMS.get("POLL_MIN_INTERVAL", 5),
+                               max_interval=SERVER_PARAMS.get("POLL_MAX_INTERVAL", 60),
+                               concurrency=SERVER_PARAMS.get("POLL_CONCURRENCY", 20))
+cluster_metrics.register("polls", poll_scheduler.metrics)
+
+# Launches and starts are checked against the account's vCPU quotas and the subnets' free addresses before EC2 is
+# asked, a spawn that cannot fit waits briefly for capacity and then fails right away.
+capacity_planner = CapacityPlanner(SERVER_PARAMS["REGION"], [subnet["SUBNET_ID"] for subnet in placement.subnets],
+                                   instance_states, interval=SERVER_PARAMS.get("CAPACITY_REFRESH_INTERVAL", 60),
+                                   queue_timeout=SERVER_PARAMS.get("CAPACITY_QUEUE_TIMEOUT", 60),
+                                   vcpu_margin=SERVER_PARAMS.get("CAPACITY_VCPU_MARGIN", 0),
+                                   address_margin=SERVER_PARAMS.get("CAPACITY_ADDRESS_MARGIN", 0))
+cluster_metrics.register("capacity", capacity_planner.metrics)
+
+# spawn, start, stop and terminate events, for cost accounting (see cost_report.py)
+event_log = EventLog()
+
+SPAWN_PROGRESS = {LAUNCH: 10, BOOT: 40, NOTEBOOK: 80}
+SPAWN_PHASE_DESCRIPTIONS = {LAUNCH: "get a server", BOOT: "wait for your server to boot",
+                            NOTEBOOK: "start your notebook"}
+
+# Shown when there is already a spawn pending for a user. Users with several instance profiles to choose from get a
+# choice instead of being redirected automatically.
+OPTIONS_FORM_REDIRECT = """
+%s<center> You will be automatically redirected. Please hold on. Servers can take up to 2 minutes to boot up. </center>
+<center> If you are not redirected within 2 minutes, click <a href="/hub/home">here</a></center>
+
+<script>
+document.getElementById("spawn_form").submit();
+</script>
+"""
+OPTIONS_FORM_PROFILES = """
+%s<center> Choose the size of your server. Servers can take up to 2 minutes to boot up. </center>
+<center><select name="profile">%s</select></center>
+"""
+
+OPTIONS_FORM_QUEUE = """
+<center> Many servers are starting right now. %s. </center>
+"""
+
+def queue_message(user_name):
+    """ Tells a user whose spawn is waiting for admission where they are in line, or returns None. """
+    phase, position = admission.status(user_name)
+    if not position:
+        return None
+    return "You are number %d in line to %s" % (position, SPAWN_PHASE_DESCRIPTIONS[phase])
+
+def options_form(spawner):
+    """ Renders the spawn form for a user, see OPTIONS_FORM_REDIRECT and OPTIONS_FORM_PROFILES. """
+    message = queue_message(spawner.user.name)
+    queue = OPTIONS_FORM_QUEUE % message if message else ""
+    allowed = instance_profiles.allowed_profiles(spawner.user.name)
+    if len(allowed) < 2:
+        return OPTIONS_FORM_REDIRECT % queue
+    current = instance_profiles.resolve(spawner.user.name, stored=UserProfile.get_profile(spawner.user.name))
+    options = "".join('<option value="%s"%s>%s</option>' % (
+        html.escape(profile), " selected" if profile == current else "",
+        html.escape(instance_profiles.profiles[profile].get("description", profile)))
+        for profile in allowed)
+    return OPTIONS_FORM_PROFILES % (queue, options)
+
 #User data script to be executed on every worker created by the spawner
 WORKER_USER_DATA = None
 with open("/etc/jupyterhub/user_data_worker.sh", "r") as f:
@@ -45,9 +182,46 @@ with open("/etc/jupyterhub/user_data_worker.sh", "r") as f:
 
 thread_pool = ThreadPoolExecutor(100)
 
-#Logging settings
+# Concurrent starts for a user share one spawn (user name: Future). Across processes, the spawn is guarded by a
+# SpawnClaim in the tracking database, identified by this process.
+spawns_in_progress = {}
+PROCESS_ID = "%s:%s" % (socket.gethostname(), os.getpid())
+SPAWN_CLAIM_EXPIRY = SERVER_PARAMS.get("SPAWN_CLAIM_EXPIRY", 900)
+
+# Home volumes are created once per user and attached to whichever instance the user runs on.
+home_volumes = None
+if SERVER_PARAMS["USER_HOME_EBS_SIZE"] > 0:
+    # new volumes are created from the cluster's golden snapshot once golden_home.py has built one
+    golden_cluster = SERVER_PARAMS["JUPYTER_CLUSTER"] if SERVER_PARAMS.get("HOME_GOLDEN_SNAPSHOT", True) else None
+    home_volumes = HomeVolumes(SERVER_PARAMS["REGION"], SERVER_PARAMS["USER_HOME_EBS_SIZE"],
+                               volume=instance_profiles.volume(None, "home_volume"), tags=WORKER_TAGS,
+                               golden_cluster=golden_cluster)
+
+# Every worker gets a read-only volume of the current version of the shared datasets, once one was published.
+dataset_volumes = DatasetVolumes(SERVER_PARAMS["REGION"], volume=SERVER_PARAMS.get("DATASET_VOLUME"), tags=WORKER_TAGS)
+
+agent_clients = AgentClientPool(WORKER_AGENT_SECRET, WORKER_AGENT_PORT) if WORKER_AGENT_SECRET else None
+
+# Hung workers are detected in the background, poll() only reads the monitor's verdict.
+health_monitor = HealthMonitor(
+    interval=SERVER_PARAMS.get("HEALTH_CHECK_INTERVAL", 30),
+    probe_timeout=SERVER_PARAMS.get("HEALTH_CHECK_TIMEOUT", 5),
+    failure_threshold=SERVER_PARAMS.get("HEALTH_CHECK_FAILURES", 3),
+    grace_period=SERVER_PARAMS.get("HEALTH_CHECK_GRACE_PERIOD", 180),
+)
+
+# Packed mode (SPAWNER_MODE "packed", the PackedSpawner): users' notebooks share larger workers, see packing.py.
+SPAWNER_MODE = SERVER_PARAMS.get("SPAWNER_MODE", "instance")
+PACKED_USER_MEMORY_MB = SERVER_PARAMS.get("PACKED_USER_MEMORY_MB", 1024)  # unless the user's profile has memory_mb
+PACKED_USER_CPUS = SERVER_PARAMS.get("PACKED_USER_CPUS", 0.5)  # unless the user's profile has cpus
+# packed users get the same uid on every shared worker, as their homes are on a shared file system
+PACKED_UID_BASE = 20000
+shared_workers = None
+
+#Logging settings; the hub's handlers are set up by install_logging() when the first spawner is created.
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO)
+LOG_FORMAT = SERVER_PARAMS.get("LOG_FORMAT", "json")  # or "text"
+LOG_SAMPLE_EVERY = SERVER_PARAMS.get("LOG_SAMPLE_EVERY", 20)  # keep 1 in N of each user's per-poll debug messages
 
 
 #Global Fabric config
@@ -76,6 +250,9 @@ def put(*args, **kwargs):
     ret = yield retry(_put, *args, **kwargs)
     return ret
 
+if tracer is not None:
+    tracer.install_ssh(sys.modules[__name__])
+
 @gen.coroutine
 def retry(function, *args, **kwargs):
     """ Retries a function up to max_retries, waiting `timeout` seconds between tries.
@@ -90,14 +267,118 @@ def retry(function, *args, **kwargs):
             return ret
         except (ClientError, WaiterError, NetworkError, RemoteCmdExecutionError, EOFError, SSHException, ChannelException) as e:
             #EOFError can occur in fabric
-            logger.error("Failure in %s with args %s and kwargs %s" % (function.__name__, args, kwargs))
-            logger.info("retrying %s, (~%s seconds elapsed)" % (function.__name__, attempt * 3))
+            logger.warning("Failure in %s (attempt %s of %s): %s", function.__name__, attempt + 1, max_retries, e)
             yield gen.sleep(timeout)
     else:
-        logger.error("Failure in %s with args %s and kwargs %s" % (function.__name__, args, kwargs))
+        # arguments can be long or secret (e.g. a rendered user-data script), only a redacted summary is logged
+        logger.error("Failure in %s after %s attempts, with args %s and kwargs %s", function.__name__, max_retries,
+                     summarize(args), summarize(kwargs))
         yield gen.sleep(0.1) #this line exists to allow the logger time to print
         return ("RETRY_FAILED")
 
+@gen.coroutine
+def launch_shared_worker(name, instance_type):
+    """ Launches a shared worker for the SharedWorkerPool in the healthiest subnet, gives its agent the token derived
+        from name and waits until the agent is ready. Returns (instance id, private ip address). The token is copied
+        over SSH rather than put in the user data, which any process on the instance could read. """
+    ec2 = boto3.client("ec2", region_name=SERVER_PARAMS["REGION"])
+    resource = boto3.resource("ec2", region_name=SERVER_PARAMS["REGION"])
+    scratch = instance_profiles.scratch(None)
+    user_data_script = SHARED_WORKER_USER_DATA.format(nfs_home=SERVER_PARAMS.get("PACKED_HOME_NFS", ""),
+                                                      scratch="1" if scratch else "")
+    boot_drive = {"DeviceName": "/dev/sda1",
+                  "Ebs": dict(ebs_parameters(instance_profiles.volume(None, "root_volume")),
+                              VolumeSize=SERVER_PARAMS["WORKER_EBS_SIZE"], DeleteOnTermination=True)}
+    block_devices = [boot_drive] + (SCRATCH_DEVICES if scratch else [])
+    dataset_mapping, dataset_version = dataset_volumes.launch_mapping()
+    if dataset_mapping is not None:
+        block_devices.append(dataset_mapping)
+    try:
+        capacity = yield capacity_planner.reserve(name, [instance_type])
+    except CapacityExhausted as e:
+        raise PackingError("no capacity for a %s shared worker: %s" % (instance_type, e))
+    with capacity:
+        for attempt, (subnet, _) in enumerate(placement.candidates([instance_type], "on-demand"), start=1):
+            if not capacity_planner.has_addresses(subnet["SUBNET_ID"]):
+                continue
+            try:
+                reservation = yield thread_pool.submit(
+                    ec2.run_instances, ImageId=SERVER_PARAMS["WORKER_AMI"], MinCount=1, MaxCount=1,
+                    KeyName=SERVER_PARAMS["KEY_NAME"], SecurityGroupIds=SERVER_PARAMS["WORKER_SECURITY_GROUPS"],
+                    BlockDeviceMappings=block_devices, UserData=user_data_script, InstanceType=instance_type,
+                    SubnetId=subnet["SUBNET_ID"])
+            except ClientError as e:
+                logger.warning("Could not launch shared worker %s in %s: %s", name, subnet["SUBNET_ID"], e)
+                placement.record_failure(subnet, instance_type, "on-demand", e.response["Error"]["Code"])
+                continue
+            placement.record_launch(name, subnet, instance_type, "on-demand", attempt)
+            break
+        else:
+            raise PackingError("no capacity for a %s shared worker" % instance_type)
+    instance = resource.Instance(reservation["Instances"][0]["InstanceId"])
+    event_log.record(SPAWN, name, instance.id, instance_type, "on-demand")
+    try:
+        yield retry(instance.wait_until_exists)
+        yield retry(instance.create_tags, Tags=WORKER_TAGS + [{"Key": "Shared Worker", "Value": name}])
+        if (yield retry(instance.wait_until_running)) == "RETRY_FAILED":
+            raise PackingError("shared worker %s never started running" % instance.id)
+        with settings(**FABRIC_DEFAULTS, host_string=instance.private_ip_address):
+            if (yield run("# waiting for ssh to be connectable...", max_retries=LONG_RETRY_COUNT)) == "RETRY_FAILED":
+                raise PackingError("shared worker %s never became reachable over SSH" % instance.id)
+            yield sudo("install -d -o root -g root -m 700 %s" % os.path.dirname(AGENT_TOKEN_FILE))
+            yield put(StringIO(agent_token(WORKER_AGENT_SECRET, name) + "\n"), AGENT_TOKEN_FILE, use_sudo=True,
+                      mode=0o600)
+            yield sudo("chown root:root %s" % AGENT_TOKEN_FILE)
+        if dataset_version is not None:
+            yield dataset_volumes.launched(instance.id, dataset_version)
+        agent = agent_clients.get(name, instance.private_ip_address)
+        for _ in range(LONG_RETRY_COUNT):
+            try:
+                status = yield agent.call("ready")
+                if status["ready"]:
+                    return instance.id, instance.private_ip_address
+            except WorkerAgentError as e:
+                logger.debug("agent of shared worker %s not reachable yet: %s", name, e)
+            yield gen.sleep(1)
+        raise PackingError("the agent of shared worker %s never became ready" % instance.id)
+    except Exception:
+        agent_clients.discard(name)
+        yield retry(instance.terminate)
+        event_log.record(TERMINATE, name, instance.id)
+        raise
+
+@gen.coroutine
+def retire_shared_worker(worker):
+    """ Terminates a shared worker the SharedWorkerPool no longer needs. Homes are on the shared file system, so
+        nothing is kept. """
+    agent_clients.discard(worker.name)
+    resource = boto3.resource("ec2", region_name=SERVER_PARAMS["REGION"])
+    if (yield retry(resource.Instance(worker.instance_id).terminate)) == "RETRY_FAILED":
+        raise PackingError("could not terminate %s" % worker.instance_id)
+    event_log.record(TERMINATE, worker.name, worker.instance_id)
+
+if SPAWNER_MODE == "packed":
+    if agent_clients is None:
+        raise ValueError("SPAWNER_MODE packed needs worker agents, see WORKER_AGENT_SECRET")
+    with open("/etc/jupyterhub/user_data_shared_worker.sh", "r") as f:
+        SHARED_WORKER_USER_DATA = f.read()
+    PACKED_INSTANCE_TYPE = SERVER_PARAMS.get("PACKED_INSTANCE_TYPE", "m5.2xlarge")
+    shared_memory_mb, shared_vcpus = instance_capacity(SERVER_PARAMS["REGION"], PACKED_INSTANCE_TYPE)
+    shared_workers = SharedWorkerPool(
+        launch_shared_worker, retire_shared_worker, PACKED_INSTANCE_TYPE,
+        # what is left for notebooks once the system and the agent are served; CPUs may be overcommitted as most
+        # notebooks of light workloads are idle most of the time
+        memory_mb=shared_memory_mb - SERVER_PARAMS.get("PACKED_RESERVED_MEMORY_MB", 768),
+        cpus=shared_vcpus * SERVER_PARAMS.get("PACKED_CPU_OVERCOMMIT", 2.0),
+        instance_states=instance_states,
+        scale_out_at=SERVER_PARAMS.get("PACKED_SCALE_OUT_AT", 0.8),
+        scale_in_at=SERVER_PARAMS.get("PACKED_SCALE_IN_AT", 0.5),
+        min_workers=SERVER_PARAMS.get("PACKED_MIN_WORKERS", 1),
+        max_workers=SERVER_PARAMS.get("PACKED_MAX_WORKERS", 20),
+        max_users=SERVER_PARAMS.get("PACKED_MAX_USERS_PER_WORKER"),
+    )
+    cluster_metrics.register("packing", shared_workers.metrics)
+
 #########################################################################################################
 #########################################################################################################
 
@@ -118,39 +399,153 @@ class InstanceSpawner(Spawner):
             flush.
         """
 
+    def __init__(self, *args, **kwargs):
+        super(InstanceSpawner, self).__init__(*args, **kwargs)
+        install_logging(self.log, LOG_FORMAT)
+        self.spawn_id = None
+        self.user_log = ContextAdapter(self.log, self.log_context, Sampler(LOG_SAMPLE_EVERY))
+
+    def log_context(self):
+        """ Attached to every record logged through self.user_log. spawn_id is the correlation id of the user's
+            current (or last) spawn. """
+        return {"user": self.user.name, "spawn_id": self.spawn_id}
+
+    @default("options_form")
+    def _options_form_default(self):
+        return options_form
+
+    def options_from_form(self, formdata):
+        return {"profile": formdata.get("profile", [None])[0]}
+
+    def get_profile(self):
+        """ The user's instance profile. A profile picked in the spawn form is remembered for later spawns. """
+        stored = UserProfile.get_profile(self.user.name)
+        profile = instance_profiles.resolve(self.user.name, self.user_options.get("profile"), stored)
+        if profile != stored:
+            UserProfile.set_profile(self.user.name, profile)
+        return profile
+
+    def get_instance_type(self):
+        return instance_profiles.instance_type(self.get_profile())
+
+    async def progress(self):
+        """ Shows the spawn's place in line on the spawn pending page while it waits for admission. """
+        last_message = None
+        while True:
+            phase, position = admission.status(self.user.name)
+            message = queue_message(self.user.name)
+            if message and message != last_message:
+                yield {"progress": SPAWN_PROGRESS[phase], "message": message}
+            last_message = message
+            await gen.sleep(1)
+
     @gen.coroutine
     def start(self):
         """ When user logs in, start their instance.
-            Must return a tuple of the ip and port for the server and Jupyterhub instance. """
-        self.log.debug("function start for user %s" % self.user.name)
+            Must return a tuple of the ip and port for the server and Jupyterhub instance. Concurrent starts for the
+            same user (e.g. a page refresh while a spawn is pending) share a single spawn. """
+        spawn = spawns_in_progress.get(self.user.name)
+        if spawn is not None:
+            self.user_log.info("A spawn is already in progress for user %s, waiting for it", self.user.name)
+        else:
+            self.spawn_id = uuid.uuid4().hex[:12]
+            spawn = spawns_in_progress[self.user.name] = self.claimed_spawn()
+
+            def forget(future, user_name=self.user.name):
+                if spawns_in_progress.get(user_name) is future:
+                    del spawns_in_progress[user_name]
+            spawn.add_done_callback(forget)
+        ret = yield spawn
+        poll_scheduler.track(self.user.name, self.check_server, None, fresh=True)
+        return ret
+
+    @gen.coroutine
+    def claimed_spawn(self):
+        """ Spawns while holding the user's SpawnClaim, so that another process (another hub, or the culler) neither
+            launches a second instance for the user nor stops the one being started. """
+        waited = 0
+        while not SpawnClaim.acquire(self.user.name, PROCESS_ID, expiry=SPAWN_CLAIM_EXPIRY):
+            if waited >= self.start_timeout:
+                raise web.HTTPError(503, "Server for user %s is being started elsewhere. Please try again in a few "
+                                         "minutes" % self.user.name)
+            self.user_log.info("Server for user %s is being started by another process, waiting", self.user.name)
+            yield gen.sleep(2)
+            waited += 2
+        try:
+            ret = yield self.spawn_server()
+            return ret
+        finally:
+            SpawnClaim.release(self.user.name, PROCESS_ID)
+
+    @gen.coroutine
+    def spawn_server(self):
+        """ Starts the user's instance, launching one if they have none, and their notebook on it. """
+        self.user_log.debug("function start for user %s", self.user.name)
         self.user.last_activity = datetime.utcnow()
+        stopping = stop_pipeline.pending(self.user.name)
+        if stopping is not None:
+            # starting an instance that is still being stopped would race with the stop
+            self.user_log.info("Waiting for user %s instance to finish stopping", self.user.name)
+            try:
+                yield gen.with_timeout(timedelta(seconds=stop_pipeline.timeout), stopping)
+            except StopFailed:
+                pass  # logged by the stop pipeline, the instance is handled in whatever state it is in
+            except gen.TimeoutError:
+                self.user_log.warning("The stop of user %s instance is still pending after %s seconds, starting anyway",
+                                      self.user.name, stop_pipeline.timeout)
         try:
             instance = yield self.get_instance() #cannot be a thread pool...
+            server = Server.get_server(self.user.name)
             #comprehensive list of states: pending, running, shutting-down, terminated, stopping, stopped.
+            if instance.state["Name"] == "shutting-down" or (instance.state["Name"] == "terminated"
+                                                            and self.has_home_volume()):
+                # e.g. an interrupted or culled Spot instance, which cannot be started again; the home volume survived,
+                # so give it a new instance.
+                yield retry(instance.wait_until_terminated, max_retries=LONG_RETRY_COUNT)
+                ret = yield self.replace_instance(server)
+                return ret
             if instance.state["Name"] == "running":
                 ec2_run_status = yield self.check_for_hanged_ec2(instance)
                 if ec2_run_status == "SSH_CONNECTION_FAILED":
-                    #yield self.poll()
-                    #yield self.kill_instance(instance)
-                    #yield retry(instance.start, max_retries=(LONG_RETRY_COUNT*2))
-                    #yield retry(instance.wait_until_running, max_retries=(LONG_RETRY_COUNT*2)) #this call can occasionally fail, so we wrap it in a retry.
-                    #return instance.private_ip_address, NOTEBOOK_SERVER_PORT
-                    return None
+                    if not self.has_home_volume():
+                        return None
+                    # the user's files are on their home volume, swap the hung instance for a new one
+                    self.user_log.warning("Instance %s of user %s is hung, replacing it", instance.id, self.user.name)
+                    health_monitor.unregister(self.user.name)
+                    SpotUsage.end(instance.id)
+                    yield retry(instance.terminate)
+                    yield retry(instance.wait_until_terminated, max_retries=LONG_RETRY_COUNT)
+                    ret = yield self.replace_instance(server)
+                    return ret
+                yield self.claim_home_volume(instance)
                 #start_worker_server will handle starting notebook
                 yield self.start_worker_server(instance, new_server=False)
-                self.log.debug("start ip and port: %s , %s" % (instance.private_ip_address, NOTEBOOK_SERVER_PORT))
+                self.user_log.debug("start ip and port: %s , %s", instance.private_ip_address, NOTEBOOK_SERVER_PORT)
                 self.ip = self.user.server.ip = instance.private_ip_address
                 self.port = self.user.server.port = NOTEBOOK_SERVER_PORT
                 return instance.private_ip_address, NOTEBOOK_SERVER_PORT
-            elif instance.state["Name"] in ["stopped", "stopping", "pending", "shutting-down"]:
+            elif instance.state["Name"] in ["stopped", "stopping", "pending"]:
                 #Server needs to be booted, do so.
-                self.log.info("Starting user %s instance " % self.user.name)
-                yield retry(instance.start, max_retries=LONG_RETRY_COUNT)
-                #yield retry(instance.start)
-                # blocking calls should be wrapped in a Future
-                yield retry(instance.wait_until_running) #this call can occasionally fail, so we wrap it in a retry.
+                self.user_log.info("Starting user %s instance ", self.user.name)
+                with (yield admission.enter(LAUNCH, self.user.name)):
+                    if instance.state["Name"] == "pending":
+                        # already booting, e.g. started by fleet_admin.py prewarm: the stopped waiter would fail at
+                        # once, so its home volume is claimed once it runs, as for a running instance
+                        yield retry(instance.wait_until_running)
+                        yield self.claim_home_volume(instance)
+                    else:
+                        yield self.update_datasets(instance)
+                        if home_volumes is not None:
+                            # the volume was detached when the instance stopped, it must be back before it boots
+                            yield retry(instance.wait_until_stopped)
+                            yield self.claim_home_volume(instance)
+                        yield self.start_stopped_instance(instance)
+                        #yield retry(instance.start)
+                        # blocking calls should be wrapped in a Future; this call can occasionally fail, so we wrap it
+                        # in a retry.
+                        yield retry(instance.wait_until_running)
                 yield self.start_worker_server(instance, new_server=False)
-                self.log.debug("%s , %s" % (instance.private_ip_address, NOTEBOOK_SERVER_PORT))
+                self.user_log.debug("%s , %s", instance.private_ip_address, NOTEBOOK_SERVER_PORT)
                 # a longer sleep duration reduces the chance of a 503 or infinite redirect error (which a user can
                 # resolve with a page refresh). 10s seems to be a good inflection point of behavior
                 yield gen.sleep(10)
@@ -165,16 +560,58 @@ class InstanceSpawner(Spawner):
                 # if instance is in pending, shutting-down, or rebooting state
                 raise web.HTTPError(503, "Unknown server state for %s. Please try again in a few minutes" % self.user.name)
         except Server.DoesNotExist:
-            self.log.info("\nserver DNE for user %s\n" % self.user.name)
+            self.user_log.info("server DNE for user %s", self.user.name)
+            ret = yield self.launch_worker()
+            return ret
+        except ClientError as e:
+            # the terminated instance is already gone from EC2
+            server = Server.get_server(self.user.name)
+            if "InvalidInstanceID.NotFound" not in str(e) or not self.has_home_volume():
+                raise
+            ret = yield self.replace_instance(server)
+            return ret
+
+    @gen.coroutine
+    def launch_worker(self):
+        """ Creates a new instance for the user and starts their notebook on it. """
+        with (yield admission.enter(LAUNCH, self.user.name)):
             instance = yield self.create_new_instance()
-            yield self.start_worker_server(instance, new_server=True)
-            # self.notebook_should_be_running = False
-            self.log.debug("%s , %s" % (instance.private_ip_address, NOTEBOOK_SERVER_PORT))
-            # to reduce chance of 503 or infinite redirect
-            yield gen.sleep(10)
-            self.ip = self.user.server.ip = instance.private_ip_address
-            self.port = self.user.server.port = NOTEBOOK_SERVER_PORT
-            return instance.private_ip_address, NOTEBOOK_SERVER_PORT
+        yield self.start_worker_server(instance, new_server=True)
+        # self.notebook_should_be_running = False
+        self.user_log.debug("%s , %s", instance.private_ip_address, NOTEBOOK_SERVER_PORT)
+        # to reduce chance of 503 or infinite redirect
+        yield gen.sleep(10)
+        self.ip = self.user.server.ip = instance.private_ip_address
+        self.port = self.user.server.port = NOTEBOOK_SERVER_PORT
+        return instance.private_ip_address, NOTEBOOK_SERVER_PORT
+
+    @gen.coroutine
+    def replace_instance(self, server):
+        """ Launches a replacement for the user's terminated instance, which gets their home volume attached. """
+        self.user_log.info("Replacing terminated instance %s of user %s", server.server_id, self.user.name)
+        event_log.record(TERMINATE, self.user.name, server.server_id)
+        Server.remove_terminated(server.server_id)
+        ret = yield self.launch_worker()
+        return ret
+
+    def has_home_volume(self):
+        return home_volumes is not None and HomeVolume.get_volume(self.user.name) is not None
+
+    def home_volume_settings(self):
+        return instance_profiles.volume(self.get_profile(), "home_volume")
+
+    @gen.coroutine
+    def claim_home_volume(self, instance):
+        """ Attaches the user's home volume to instance, creating it if the user has none yet. """
+        if home_volumes is None:
+            return
+        try:
+            yield home_volumes.claim(self.user.name, instance.id, self.home_volume_settings())
+        except (HomeVolumeError, ClientError, WaiterError) as e:
+            self.user_log.error("Could not attach the home volume of user %s to %s: %s", self.user.name, instance.id, e)
+            raise web.HTTPError(500, "Couldn't attach the home directory of user '%s'. Please try again in a few "
+                                     "minutes" % self.user.name)
+
 
     def clear_state(self):
         """Clear stored state about this spawner """
@@ -182,48 +619,81 @@ class InstanceSpawner(Spawner):
 
     @gen.coroutine
     def stop(self, now=False):
-        """ When user session stops, stop user instance """
-        self.log.debug("function stop")
-        self.log.info("Stopping user %s instance " % self.user.name)
+        """ When user session stops, stop user instance. The stop is handed to the stop pipeline, which batches it
+            with other stops and follows it until the instance has stopped; the hub is not held up meanwhile. """
+        self.user_log.info("Stopping user %s instance", self.user.name)
+        # a spawn still waiting in line is given up
+        admission.cancel(self.user.name)
+        poll_scheduler.untrack(self.user.name)
         try:
-            instance = yield self.get_instance()
-            retry(instance.stop)
+            server = Server.get_server(self.user.name)
+            health_monitor.unregister(self.user.name)
+            if agent_clients is not None:
+                agent_clients.discard(self.user.name)
+            spot = server.market == "spot"
+            if spot:
+                # One-time Spot instances cannot be stopped. The home volume is kept and reattached on next start.
+                SpotUsage.end(server.server_id)
+            stopped = stop_pipeline.stop(self.user.name, server.server_id, terminate=spot)
+            event_log.record(TERMINATE if spot else STOP, self.user.name, server.server_id)
+            IOLoop.current().spawn_callback(self.finish_stop, server.server_id, stopped)
             # self.notebook_should_be_running = False
         except Server.DoesNotExist:
-            self.log.error("Couldn't stop server for user '%s' as it does not exist" % self.user.name)
+            self.user_log.error("Couldn't stop server for user '%s' as it does not exist", self.user.name)
             # self.notebook_should_be_running = False
         self.clear_state()
 
+    @gen.coroutine
+    def finish_stop(self, instance_id, stopped):
+        """ Waits for a stop to complete, then detaches the user's home volume. Errors are logged by the stop
+            pipeline and home_volumes. """
+        try:
+            yield stopped
+        except StopFailed:
+            return
+        if home_volumes is not None:
+            try:
+                yield home_volumes.release(self.user.name, instance_id)
+            except (HomeVolumeError, ClientError, WaiterError):
+                pass
+
     @gen.coroutine
     def kill_instance(self,instance):
-        self.log.debug(" Kill hanged user %s instance:  %s " % (self.user.name,instance.id))
+        self.user_log.debug(" Kill hanged user %s instance:  %s ", self.user.name,instance.id)
         yield self.stop(now=True)
 
 
     # Check if the machine is hanged
     @gen.coroutine
     def check_for_hanged_ec2(self, instance):
-        timerightnow    = datetime.utcnow().replace(tzinfo=None)
-        ec2launchtime   = instance.launch_time.replace(tzinfo=None)
-        ec2uptimeSecond = (timerightnow - ec2launchtime).seconds
-        #conn_health = None
-        conn_health = ""
-        if ec2uptimeSecond > 180:
-            # wait_until_SSHable return : 1) "some object" if SSH is established;  2) "SSH_CONNECTION_FAILED" otherwise
-            conn_health  = yield self.wait_until_SSHable(instance.private_ip_address,max_retries=5)
-        return(conn_health)
+        """ Returns "SSH_CONNECTION_FAILED" if the background health monitor considers the instance hung, "" otherwise.
+            This only registers the instance with the monitor and reads its latest verdict, it never probes inline. """
+        health_monitor.register(self.user.name, instance.id, instance.private_ip_address, instance.launch_time)
+        if health_monitor.verdict(self.user.name) == UNHEALTHY:
+            return "SSH_CONNECTION_FAILED"
+        return ""
 
 
     @gen.coroutine
     def poll(self):
         """ Polls for whether process is running. If running, return None. If not running,
-            return exit code """
-        self.log.debug("function poll for user %s" % self.user.name)
+            return exit code. Answers with the latest scheduled check_server() result; a server that the poll
+            scheduler does not follow (e.g. after a hub restart) is checked here, and followed if it runs. """
+        result = poll_scheduler.result(self.user.name)
+        if result is NOT_CHECKED:
+            result = yield self.check_server()
+            if result is None:
+                poll_scheduler.track(self.user.name, self.check_server, result)
+        return result
+
+    @gen.coroutine
+    def check_server(self):
+        """ Checks whether the user's instance and notebook run: returns None if so, why not otherwise. """
         try:
             instance = yield self.get_instance()
-            self.log.debug(instance.state)
+            self.user_log.debug("poll: instance of user %s is %s", self.user.name, instance.state["Name"],
+                                sample="poll")
             if instance.state['Name'] == 'running':
-                self.log.debug("poll: server is running for user %s" % self.user.name)
                 # We cannot have this be a long timeout because Jupyterhub uses poll to determine whether a user can log in.
                 # If this has a long timeout, logging in without notebook running takes a long time.
                 # attempts = 30 if self.notebook_should_be_running else 1
@@ -231,45 +701,90 @@ class InstanceSpawner(Spawner):
                 ec2_run_status = yield self.check_for_hanged_ec2(instance)
                 if ec2_run_status == "SSH_CONNECTION_FAILED":
                     #self.log.debug(ec2_run_status)
-                    yield self.kill_instance(instance)
+                    # stopping can take a while, do not hold up the poll for it.
+                    IOLoop.current().spawn_callback(self.kill_instance, instance)
                     return "Instance Hang"
+                interruption = yield self.check_for_spot_interruption(instance)
+                if interruption:
+                    self.user_log.warning("Spot instance of user %s is being interrupted: %s", self.user.name,
+                                          interruption)
+                    return "Spot instance interrupted"
                 else:
-                    notebook_running = yield self.is_notebook_running(instance.private_ip_address, attempts=1)
-                    if notebook_running:
-                        self.log.debug("poll: notebook is running for user %s" % self.user.name)
+                    # a single SSH try: whether the worker can be reached at all is the health monitor's call
+                    notebook_running = yield self.is_notebook_running(instance.private_ip_address, attempts=1,
+                                                                      ssh_retries=1)
+                    if notebook_running is None:
+                        self.user_log.debug("poll: could not check the notebook of user %s", self.user.name)
+                        return None
+                    elif notebook_running:
+                        self.user_log.debug("poll: notebook is running for user %s", self.user.name,
+                                            sample="poll running")
                         return None #its up!
                     else:
-                        self.log.debug("Poll, notebook is not running for user %s" % self.user.name)
+                        self.user_log.debug("Poll, notebook is not running for user %s", self.user.name)
                         return "server up, no instance running for user %s" % self.user.name
             else:
-                self.log.debug("instance waiting for user %s" % self.user.name)
+                self.user_log.debug("instance waiting for user %s", self.user.name)
                 return "instance stopping, stopped, or pending for user %s" % self.user.name
         except Server.DoesNotExist:
-            self.log.error("Couldn't poll server for user '%s' as it does not exist" % self.user.name)
+            self.user_log.error("Couldn't poll server for user '%s' as it does not exist", self.user.name)
             # self.notebook_should_be_running = False
             return "Instance not found/tracked"
+        except ClientError as e:
+            if "InvalidInstanceID.NotFound" not in str(e):
+                raise
+            return "Instance terminated"
+
+    @gen.coroutine
+    def check_for_spot_interruption(self, instance):
+        """ Returns the interruption notice of a Spot worker, as reported by its worker agent, or None. """
+        agent = self.get_agent(instance.private_ip_address)
+        if agent is None or instance.instance_lifecycle != "spot":
+            return None
+        try:
+            status = yield agent.call("interruption", timeout=5)
+        except WorkerAgentError as e:
+            self.user_log.debug("could not check Spot interruption for user %s: %s", self.user.name, e)
+            return None
+        return status["notice"]
 
     ################################################################################################################
     ### helpers ###
 
     @gen.coroutine
-    def is_notebook_running(self, ip_address_string, attempts=1):
+    def is_notebook_running(self, ip_address_string, attempts=1, ssh_retries=10):
         """ Checks if jupyterhub/notebook is running on the target machine, returns True if Yes, False if not.
             If an attempts count N is provided the check will be run N times or until the notebook is running, whichever
-            comes first. """
+            comes first. Without a worker agent the check runs over SSH, tried ssh_retries times; None is returned if
+            SSH fails every time. """
+        agent = self.get_agent(ip_address_string)
+        if agent is not None:
+            try:
+                for i in range(attempts):
+                    status = yield agent.call("notebook_status", port=NOTEBOOK_SERVER_PORT)
+                    if status["running"]:
+                        return True
+                    self.user_log.debug("Notebook for user %s not running...", self.user.name)
+                    yield gen.sleep(1)
+                self.user_log.error("Notebook for user %s is not running.", self.user.name)
+                return False
+            except WorkerAgentError as e:
+                self.user_log.warning("Worker agent for user %s unavailable, checking over SSH: %s", self.user.name, e)
         with settings(**FABRIC_DEFAULTS, host_string=ip_address_string):
             for i in range(attempts):
-                self.log.debug("function check_notebook_running for user %s, attempt %s..." % (self.user.name, i+1))
-                output = yield run("ps -ef | grep jupyterhub-singleuser")
+                self.user_log.debug("function check_notebook_running for user %s, attempt %s...", self.user.name, i+1,
+                                    sample="check notebook")
+                output = yield run("ps -ef | grep jupyterhub-singleuser", max_retries=ssh_retries)
+                if output == "RETRY_FAILED":
+                    return None
                 for line in output.splitlines(): #
                     #if "jupyterhub-singleuser" and NOTEBOOK_SERVER_PORT in line:
                     if "jupyterhub-singleuser" and str(NOTEBOOK_SERVER_PORT)  in line:
-                        self.log.debug("the following notebook is definitely running:")
-                        self.log.debug(line)
+                        self.user_log.debug("the following notebook is definitely running: %s", line)
                         return True
-                self.log.debug("Notebook for user %s not running..." % self.user.name)
+                self.user_log.debug("Notebook for user %s not running...", self.user.name)
                 yield gen.sleep(1)
-            self.log.error("Notebook for user %s is not running." % self.user.name)
+            self.user_log.error("Notebook for user %s is not running.", self.user.name)
             return False
 
 
@@ -277,7 +792,7 @@ class InstanceSpawner(Spawner):
     @gen.coroutine
     def wait_until_SSHable(self, ip_address_string, max_retries=1):
         """ Run a meaningless bash command (a comment) inside a retry statement. """
-        self.log.debug("function wait_until_SSHable for user %s" % self.user.name)
+        self.user_log.debug("function wait_until_SSHable for user %s", self.user.name)
         with settings(**FABRIC_DEFAULTS, host_string=ip_address_string):
             ret = yield run("# waiting for ssh to be connectable for user %s..." % self.user.name, max_retries=max_retries)
         if ret == "RETRY_FAILED":
@@ -285,6 +800,30 @@ class InstanceSpawner(Spawner):
         return (ret)
 
 
+    @gen.coroutine
+    def wait_until_agent_ready(self, ip_address_string, max_retries=1):
+        """ Waits until the worker agent reports that the user data script has finished setting up the worker.
+            Returns False if the cluster has no worker agents or the agent never became ready. """
+        agent = self.get_agent(ip_address_string)
+        if agent is None:
+            return False
+        for attempt in range(max_retries):
+            try:
+                status = yield agent.call("ready")
+                if status["ready"]:
+                    return True
+            except WorkerAgentError as e:
+                self.user_log.debug("worker agent for user %s not reachable yet: %s", self.user.name, e)
+            yield gen.sleep(1)
+        self.user_log.warning("Worker agent for user %s never became ready", self.user.name)
+        return False
+
+    def get_agent(self, ip_address_string):
+        """ Returns the worker agent client for this user's worker, or None if workers do not run an agent. """
+        if agent_clients is None:
+            return None
+        return agent_clients.get(self.user.name, ip_address_string)
+
     @gen.coroutine
     def get_instance(self):
         #""" This returns a boto Instance resource; if boto can't find the instance or if no entry for instance in database,
@@ -293,12 +832,13 @@ class InstanceSpawner(Spawner):
             it raises Server.DoesNotExist error. If the instance in the database but 
             boto can't find the instance, it raise 500 http error """
 
-        self.log.debug("function get_instance for user %s" % self.user.name)
+        self.user_log.debug("function get_instance for user %s", self.user.name, sample="get_instance")
         server = Server.get_server(self.user.name)
         resource = yield retry(boto3.resource, "ec2", region_name=SERVER_PARAMS["REGION"])
         try:
             ret = yield retry(resource.Instance, server.server_id)
-            self.log.debug("return for get_instance for user %s: %s" % (self.user.name, ret))
+            self.user_log.debug("return for get_instance for user %s: %s", self.user.name, ret,
+                                sample="get_instance return")
             # boto3.Instance is lazily loaded. Force with .load()
             yield retry(ret.load)
             if ret.meta.data is None:
@@ -307,9 +847,9 @@ class InstanceSpawner(Spawner):
                 #raise Server.DoesNotExist()
             return ret
         except ClientError as e:
-            self.log.error("get_instance client error: %s" % e)
+            self.user_log.error("get_instance client error: %s", e)
             if "InvalidInstanceID.NotFound" not in str(e):
-                self.log.error("Couldn't find instance for user '%s'" % self.user.name)
+                self.user_log.error("Couldn't find instance for user '%s'", self.user.name)
                 raise web.HTTPError(500, "Couldn't access instance for user '%s'. Please try again in a few minutes" % self.user.name)
                 #Server.remove_server(server.server_id)
                 #raise Server.DoesNotExist()
@@ -319,22 +859,27 @@ class InstanceSpawner(Spawner):
     def start_worker_server(self, instance, new_server=False):
         """ Runs remote commands on worker server to mount user EBS and connect to Jupyterhub. If new_server=True,
             also create filesystem on newly created user EBS"""
-        self.log.debug("function start_worker_server for user %s" % self.user.name)
+        self.user_log.debug("function start_worker_server for user %s", self.user.name)
         # redundant variable set for get_args()
         self.ip = self.user.server.ip = instance.private_ip_address
         self.port = self.user.server.port = NOTEBOOK_SERVER_PORT
         # self.user.server.port = NOTEBOOK_SERVER_PORT
         try:
             # Wait for server to finish booting...
-            wait_result = yield self.wait_until_SSHable(instance.private_ip_address,max_retries=LONG_RETRY_COUNT)
+            with (yield admission.enter(BOOT, self.user.name)):
+                agent_ready = yield self.wait_until_agent_ready(instance.private_ip_address, max_retries=LONG_RETRY_COUNT)
+                if not agent_ready:
+                    wait_result = yield self.wait_until_SSHable(instance.private_ip_address,max_retries=LONG_RETRY_COUNT)
             #start notebook
-            self.log.error("\n\n\n\nabout to check if notebook is running before launching\n\n\n\n")
-            notebook_running = yield self.is_notebook_running(instance.private_ip_address)
-            if not notebook_running:
-                yield self.remote_notebook_start(instance)
+            with (yield admission.enter(NOTEBOOK, self.user.name)):
+                self.user_log.debug("about to check if the notebook of user %s is running before launching",
+                                    self.user.name)
+                notebook_running = yield self.is_notebook_running(instance.private_ip_address)
+                if not notebook_running:
+                    yield self.remote_notebook_start(instance)
         except RemoteCmdExecutionError as e:
             # terminate instance and create a new one
-            self.log.exception(e)
+            self.user_log.exception("Worker of user %s unreachable", self.user.name)
             raise web.HTTPError(500, "Instance unreachable")
 
     def user_env(self, env):
@@ -356,76 +901,335 @@ class InstanceSpawner(Spawner):
     @gen.coroutine
     def remote_notebook_start(self, instance):
         """ Do notebook start command on the remote server."""
-        # Setup environments
         env = self.get_env()
-        lenv=''
-        for key in env:
-            lenv = lenv + key + "=" + env[key] + " "
-        # End setup environment
-        self.log.debug("function remote_server_start %s" % self.user.name)
+        self.user_log.debug("function remote_server_start %s", self.user.name)
         worker_ip_address_string = instance.private_ip_address
-        start_notebook_cmd = self.cmd + self.get_args()
-        start_notebook_cmd = " ".join(start_notebook_cmd)
-        self.log.info("Starting user %s jupyterhub" % self.user.name)
-        with settings(user = self.user.name, key_filename = FABRIC_DEFAULTS["key_filename"],  host_string=worker_ip_address_string):
-             yield sudo("%s %s --user=%s --notebook-dir=/home/%s/ --allow-root > /tmp/jupyter.log 2>&1 &" % (lenv, start_notebook_cmd,self.user.name,self.user.name),  pty=False)
-        self.log.debug("just started the notebook for user %s, waiting." % self.user.name)
+        start_notebook_cmd = self.cmd + self.get_args() + ["--user=%s" % self.user.name,
+                                                          "--notebook-dir=/home/%s/" % self.user.name, "--allow-root"]
+        self.user_log.info("Starting user %s jupyterhub", self.user.name)
+        notebook_started = notebook_ready = False
+        agent = self.get_agent(worker_ip_address_string)
+        if agent is not None:
+            # the agent builds the command line itself and starts the notebook without a shell, it answers once the
+            # notebook is listening
+            try:
+                if NOTEBOOK_UNIT_ENABLED:
+                    result = yield agent.call("notebook_unit_start", timeout=120, user=self.user.name,
+                                              args=self.get_args(), env=env, port=NOTEBOOK_SERVER_PORT,
+                                              ip=worker_ip_address_string)
+                else:
+                    result = yield agent.call("notebook_start", user=self.user.name, args=self.get_args(), env=env,
+                                              port=NOTEBOOK_SERVER_PORT, ip=worker_ip_address_string, wait=30)
+                notebook_started, notebook_ready = True, result["ready"]
+            except WorkerAgentError as e:
+                self.user_log.warning("Worker agent for user %s could not start the notebook, using SSH: %s",
+                                      self.user.name, e)
+        if not notebook_started:
+            with settings(user = self.user.name, key_filename = FABRIC_DEFAULTS["key_filename"],  host_string=worker_ip_address_string):
+                if NOTEBOOK_UNIT_ENABLED:
+                    env_file = notebook_env_file(start_notebook_cmd, env,
+                                                 "%s:%s" % (worker_ip_address_string, NOTEBOOK_SERVER_PORT))
+                    yield put(StringIO(env_file), NOTEBOOK_ENV_FILE % self.user.name, use_sudo=True, mode=0o600)
+                    # returns once the notebook is listening, or fails after the unit's start timeout
+                    started = yield sudo("systemctl start %s" % NOTEBOOK_UNIT % self.user.name, max_retries=2)
+                    notebook_ready = started != "RETRY_FAILED"
+                else:
+                    lenv = " ".join("%s=%s" % (key, shlex.quote(value)) for key, value in env.items())
+                    yield sudo("%s %s > /tmp/jupyter.log 2>&1 &" % (lenv, " ".join(start_notebook_cmd)),  pty=False)
+        self.user_log.debug("just started the notebook for user %s, waiting.", self.user.name)
         try:
             self.user.settings[self.user.name] = instance.public_ip_address
         except:
             self.user.settings[self.user.name] = ""
         # self.notebook_should_be_running = True
-        yield self.is_notebook_running(worker_ip_address_string, attempts=30)
+        if not notebook_ready:
+            yield self.is_notebook_running(worker_ip_address_string, attempts=30)
+
+    @gen.coroutine
+    def update_datasets(self, instance):
+        """ Gives a stopped (or stopping) instance the current version of the shared datasets, see datasets.py. If
+            that fails, the instance starts with the version it has. """
+        if instance.state["Name"] not in ["stopped", "stopping"]:
+            return
+        try:
+            yield dataset_volumes.update(instance.id)
+        except (ClientError, WaiterError) as e:
+            self.user_log.warning("Could not update the datasets of user %s instance %s: %s", self.user.name,
+                                  instance.id, e)
+
+    @gen.coroutine
+    def record_datasets(self, instance, version):
+        try:
+            yield dataset_volumes.launched(instance.id, version)
+        except ClientError as e:
+            self.user_log.warning("Could not record the datasets of user %s instance %s: %s", self.user.name,
+                                  instance.id, e)
 
     @gen.coroutine
     def create_new_instance(self):
-        """ Creates and boots a new server to host the worker instance."""
-        self.log.debug("function create_new_instance %s" % self.user.name)
+        """ Creates and boots a new server to host the worker instance. The user's home volume, if home volumes are
+            enabled, is created (once) and attached separately rather than launched with the instance. """
+        self.user_log.debug("function create_new_instance %s", self.user.name)
         ec2 = boto3.client("ec2", region_name=SERVER_PARAMS["REGION"])
         resource = boto3.resource("ec2", region_name=SERVER_PARAMS["REGION"])
-        BDM = []
+        profile = self.get_profile()
         boot_drive = {'DeviceName': '/dev/sda1',  # this is to be the boot drive
-                      'Ebs': {'VolumeSize': SERVER_PARAMS["WORKER_EBS_SIZE"],  # size in gigabytes
-                              'DeleteOnTermination': True,
-                              'VolumeType': 'gp2',  # This means General Purpose SSD
-                              # 'Iops': 1000 }  # i/o speed for storage, default is 100, more is faster
-                              }
+                      'Ebs': dict(ebs_parameters(instance_profiles.volume(profile, "root_volume")),
+                                  VolumeSize=SERVER_PARAMS["WORKER_EBS_SIZE"],  # size in gigabytes
+                                  DeleteOnTermination=True)
                      }
         BDM = [boot_drive]
-        if SERVER_PARAMS["USER_HOME_EBS_SIZE"] > 0:
-            user_drive = {'DeviceName': '/dev/sdf',  # this is to be the user data drive
-                          'Ebs': {'VolumeSize': SERVER_PARAMS["USER_HOME_EBS_SIZE"],  # size in gigabytes
-                                  'DeleteOnTermination': False,
-                                  'VolumeType': 'gp2',  # General Purpose SSD
-                                  }
-                         }
-            BDM = [boot_drive, user_drive]
+        scratch = instance_profiles.scratch(profile)
+        if scratch:
+            BDM += SCRATCH_DEVICES  # mounted at /mnt by the user data script
+        dataset_mapping, dataset_version = dataset_volumes.launch_mapping()
+        if dataset_mapping is not None:
+            BDM.append(dataset_mapping)  # mounted read-only at /datasets by the user data script
 
         # prepare userdata script to execute on the worker instance
-        user_home_device = "xvdf" if SERVER_PARAMS["USER_HOME_EBS_SIZE"] > 0 else ""
-        user_data_script = WORKER_USER_DATA.format(user=self.user.name, device=user_home_device)
+        user_home_device = "xvdf" if home_volumes is not None else ""
+        worker_agent_token = agent_token(WORKER_AGENT_SECRET, self.user.name) if WORKER_AGENT_SECRET else ""
+        user_data_script = WORKER_USER_DATA.format(user=self.user.name, device=user_home_device,
+                                                   agent_token=worker_agent_token, scratch="1" if scratch else "")
 
         # create new instance
-        reservation = yield retry(
-                ec2.run_instances,
+        reservation, market = yield self.run_worker_instance(
+                ec2,
                 ImageId=SERVER_PARAMS["WORKER_AMI"],
                 MinCount=1,
                 MaxCount=1,
                 KeyName=SERVER_PARAMS["KEY_NAME"],
-                InstanceType=SERVER_PARAMS["INSTANCE_TYPE"],
-                SubnetId=SERVER_PARAMS["SUBNET_ID"],
                 SecurityGroupIds=SERVER_PARAMS["WORKER_SECURITY_GROUPS"],
                 BlockDeviceMappings=BDM,
                 UserData=user_data_script,
         )
         instance_id = reservation["Instances"][0]["InstanceId"]
         instance = yield retry(resource.Instance, instance_id)
-        Server.new_server(instance_id, self.user.name)
+        try:
+            Server.new_server(instance_id, self.user.name, market=market)
+        except IntegrityError:
+            # another instance was recorded for the user meanwhile; do not leak this one
+            self.user_log.error("User %s already has a server, terminating duplicate %s", self.user.name, instance_id)
+            yield retry(instance.terminate)
+            raise web.HTTPError(409, "A server for user %s already exists. Please try again" % self.user.name)
+        event_log.record(SPAWN, self.user.name, instance_id, reservation["Instances"][0]["InstanceType"], market)
         yield retry(instance.wait_until_exists)
         # add server tags; tags cannot be added until server exists
         yield retry(instance.create_tags, Tags=WORKER_TAGS)
         yield retry(instance.create_tags, Tags=[{"Key": "User", "Value": self.user.name}])
         # start server
         # blocking calls should be wrapped in a Future
-        yield retry(instance.wait_until_running)
+        if home_volumes is not None:
+            # a new user's volume is created while the instance boots, the user data script waits for it.
+            availability_zone = reservation["Instances"][0]["Placement"]["AvailabilityZone"]
+            yield [retry(instance.wait_until_running), home_volumes.ensure(self.user.name, availability_zone,
+                                                                             self.home_volume_settings())]
+            yield self.claim_home_volume(instance)
+        else:
+            yield retry(instance.wait_until_running)
+        if dataset_version is not None:
+            yield self.record_datasets(instance, dataset_version)
+        if market == "spot":
+            yield self.record_spot_usage(instance)
         return instance
+
+    @gen.coroutine
+    def run_worker_instance(self, ec2, **launch_args):
+        """ Runs ec2.run_instances for a worker, trying the placement options (subnet and instance type) of the
+            user's profile healthiest first, in the zone of their home volume if they have one. With Spot enabled,
+            the Spot options are tried first and on-demand is the fallback when none has capacity.
+            Returns (reservation, market). """
+        profile = self.get_profile()
+        availability_zone = None
+        home_volume = HomeVolume.get_volume(self.user.name) if home_volumes is not None else None
+        if home_volume is not None and home_volume.availability_zone:
+            availability_zone = home_volume.availability_zone  # volumes can only be attached within their zone
+        markets = [("on-demand", instance_profiles.instance_types(profile), {})]
+        if SPOT_ENABLED:
+            markets.insert(0, ("spot", instance_profiles.spot_instance_types(profile),
+                               {"InstanceMarketOptions": SPOT_MARKET_OPTIONS}))
+        all_instance_types = []
+        for _, instance_types, _ in markets:
+            all_instance_types += [t for t in instance_types if t not in all_instance_types]
+        capacity = yield self.reserve_capacity(all_instance_types, [market for market, _, _ in markets])
+        attempts = 0
+        with capacity:
+            for market, instance_types, market_args in markets:
+                if market not in capacity.markets:
+                    continue  # its vCPU quota is used up
+                for subnet, instance_type in placement.candidates(instance_types, market, availability_zone):
+                    if not capacity_planner.has_addresses(subnet["SUBNET_ID"]):
+                        continue
+                    attempts += 1
+                    try:
+                        reservation = yield thread_pool.submit(ec2.run_instances, InstanceType=instance_type,
+                                                               SubnetId=subnet["SUBNET_ID"], **market_args,
+                                                               **launch_args)
+                    except ClientError as e:
+                        error_code = e.response["Error"]["Code"]
+                        self.user_log.warning("Could not launch %s %s in %s for user %s: %s",
+                                              market, instance_type, subnet["SUBNET_ID"], self.user.name, e)
+                        placement.record_failure(subnet, instance_type, market, error_code)
+                        if market == "spot" and error_code not in CAPACITY_ERRORS:
+                            break
+                        continue
+                    placement.record_launch(self.user.name, subnet, instance_type, market, attempts)
+                    return reservation, market
+        self.user_log.error("Could not place a worker for user %s after %s attempts", self.user.name, attempts)
+        raise web.HTTPError(503, "No capacity is available for your server right now. Please try again in a few minutes")
+
+    @gen.coroutine
+    def reserve_capacity(self, instance_types, markets=("on-demand",), new_instance=True):
+        """ Reserves room for a launch (or, if not new_instance, a start) within the account's vCPU quotas and the
+            subnets' free addresses, see capacity.py. Fails the spawn at once when there is none. """
+        try:
+            capacity = yield capacity_planner.reserve(self.user.name, instance_types, markets, new_instance)
+        except CapacityExhausted as e:
+            self.user_log.error("No capacity for the server of user %s: %s", self.user.name, e)
+            raise web.HTTPError(503, "The cluster has reached its AWS capacity limits. Please try again later")
+        return capacity
+
+    @gen.coroutine
+    def start_stopped_instance(self, instance):
+        """ Starts a stopped instance, resized to the instance types of the user's profile if it has another one.
+            A stopped instance cannot change zones, so when its zone has no capacity for an instance type it is
+            resized to the profile's next type, healthiest first. """
+        subnet = {"SUBNET_ID": instance.subnet_id, "AVAILABILITY_ZONE": instance.placement["AvailabilityZone"]}
+        instance_types = instance_profiles.instance_types(self.get_profile())
+        if instance.instance_type not in instance_types:
+            # e.g. the user's profile changed: its types come first, the instance's own is the last resort
+            instance_types.append(instance.instance_type)
+        candidates = []
+        for _, instance_type in placement.candidates(instance_types, "on-demand", subnet["AVAILABILITY_ZONE"]):
+            if instance_type not in candidates:
+                candidates.append(instance_type)
+        # a stopped instance keeps its address, starting it only takes vCPUs
+        capacity = yield self.reserve_capacity(candidates or instance_types, new_instance=False)
+        with capacity:
+            for attempt, instance_type in enumerate(candidates or instance_types, start=1):
+                if instance_type != instance.instance_type:
+                    yield retry(instance.wait_until_stopped)
+                    yield retry(instance.modify_attribute, InstanceType={"Value": instance_type})
+                    yield retry(instance.reload)
+                try:
+                    yield thread_pool.submit(instance.start)
+                except ClientError as e:
+                    error_code = e.response["Error"]["Code"]
+                    placement.record_failure(subnet, instance_type, "on-demand", error_code)
+                    if error_code not in CAPACITY_ERRORS:
+                        # e.g. the instance is still stopping, as before keep retrying
+                        yield retry(instance.start, max_retries=LONG_RETRY_COUNT)
+                        return
+                    self.user_log.warning("No capacity to start %s of user %s as %s", instance.id, self.user.name,
+                                          instance_type)
+                    continue
+                placement.record_launch(self.user.name, subnet, instance_type, "on-demand", attempt)
+                event_log.record(START, self.user.name, instance.id, instance_type, "on-demand")
+                return
+        raise web.HTTPError(503, "No capacity is available for your server right now. Please try again in a few minutes")
+
+    @gen.coroutine
+    def record_spot_usage(self, instance):
+        """ Records the Spot price at launch next to the on-demand price, for spot_savings_report.py. """
+        ec2 = boto3.client("ec2", region_name=SERVER_PARAMS["REGION"])
+        history = yield retry(ec2.describe_spot_price_history, InstanceTypes=[instance.instance_type],
+                              AvailabilityZone=instance.placement["AvailabilityZone"],
+                              ProductDescriptions=["Linux/UNIX"], StartTime=datetime.utcnow(), MaxResults=1)
+        prices = history.get("SpotPriceHistory", []) if isinstance(history, dict) else []
+        SpotUsage.start(instance.id, self.user.name, instance.instance_type,
+                        float(prices[0]["SpotPrice"]) if prices else None, ON_DEMAND_PRICES.get(instance.instance_type))
+
+
+class PackedSpawner(InstanceSpawner):
+    """ A Spawner that runs users' notebooks on shared workers, several per worker, each on its own port and within
+        cgroup limits of the memory and CPU reserved for the user (see packing.py). Shared workers need the worker
+        agent and the jupyter-singleuser@ unit in the worker AMI. """
+
+    def resources(self):
+        """ The memory (MiB) and CPUs reserved for the user: the memory_mb and cpus of their instance profile, or
+            PACKED_USER_MEMORY_MB and PACKED_USER_CPUS. """
+        profile = instance_profiles.profiles.get(self.get_profile(), {})
+        return int(profile.get("memory_mb", PACKED_USER_MEMORY_MB)), float(profile.get("cpus", PACKED_USER_CPUS))
+
+    @gen.coroutine
+    def spawn_server(self):
+        """ Places the user on a shared worker, launching one if none has room, and starts their notebook there. """
+        self.user.last_activity = datetime.utcnow()
+        memory_mb, cpus = self.resources()
+        try:
+            worker, port = yield shared_workers.place(self.user.name, memory_mb, cpus)
+        except PackingError as e:
+            self.user_log.error("Could not place user %s on a shared worker: %s", self.user.name, e)
+            raise web.HTTPError(503, "No capacity is available for your server right now. Please try again in a few "
+                                     "minutes")
+        # get_args() reads them
+        self.ip = self.user.server.ip = worker.ip_address
+        self.port = self.user.server.port = port
+        agent = agent_clients.get(worker.name, worker.ip_address)
+        try:
+            with (yield admission.enter(NOTEBOOK, self.user.name)):
+                yield agent.call("user_setup", user=self.user.name, uid=PACKED_UID_BASE + self.user.id)
+                yield agent.call("notebook_unit_start", timeout=120, user=self.user.name, args=self.get_args(),
+                                 env=self.get_env(), port=port, ip=worker.ip_address,
+                                 limits={"memory_mb": memory_mb, "cpus": cpus})
+        except WorkerAgentError as e:
+            self.user_log.error("Could not start the notebook of user %s on shared worker %s: %s", self.user.name,
+                                worker.name, e)
+            shared_workers.release(self.user.name)
+            raise web.HTTPError(500, "Couldn't start your server. Please try again in a few minutes")
+        self.user_log.info("Started the notebook of user %s on shared worker %s, port %s", self.user.name,
+                           worker.name, port)
+        return worker.ip_address, port
+
+    @gen.coroutine
+    def stop(self, now=False):
+        """ Stops the user's notebook and gives up their place on the shared worker. The worker itself is retired by
+            the pool once it has been drained. """
+        self.user_log.info("Stopping notebook of user %s", self.user.name)
+        admission.cancel(self.user.name)
+        poll_scheduler.untrack(self.user.name)
+        server = PackedServer.get_server(self.user.name)
+        if server is None:
+            self.user_log.error("Couldn't stop server for user '%s' as it does not exist", self.user.name)
+            self.clear_state()
+            return
+        worker = SharedWorker.get_or_none(SharedWorker.name == server.worker)
+        if worker is not None and worker.ip_address:
+            try:
+                yield agent_clients.get(worker.name, worker.ip_address).call(
+                    "notebook_stop", timeout=30, port=server.port, user=self.user.name)
+            except WorkerAgentError as e:
+                self.user_log.warning("Could not stop the notebook of user %s on shared worker %s: %s",
+                                      self.user.name, worker.name, e)
+        shared_workers.release(self.user.name)
+        self.clear_state()
+
+    @gen.coroutine
+    def check_server(self):
+        """ Returns None while the user's notebook runs on its shared worker. An agent that cannot be reached is not
+            taken to mean that the notebook stopped: a worker that is gone is noticed by the pool. """
+        server = PackedServer.get_server(self.user.name)
+        if server is None:
+            return "Not placed on a shared worker"
+        worker = SharedWorker.get_or_none(SharedWorker.name == server.worker)
+        if worker is None or not worker.ip_address:
+            return "Shared worker gone"
+        try:
+            status = yield agent_clients.get(worker.name, worker.ip_address).call("notebook_status", timeout=10,
+                                                                                  port=server.port)
+        except WorkerAgentError as e:
+            self.user_log.warning("Could not poll the notebook of user %s on shared worker %s: %s", self.user.name,
+                                  worker.name, e)
+            return None
+        if status["running"]:
+            self.user_log.debug("poll: notebook is running for user %s", self.user.name, sample="poll running")
+            return None
+        return "notebook not running for user %s" % self.user.name
+
+
+if tracer is not None:
+    # the hub's calls, which a replay of the trace repeats
+    for spawner_class in (InstanceSpawner, PackedSpawner):
+        for method in ("start", "stop", "poll"):
+            if method in vars(spawner_class):
+                tracer.patch(spawner_class, method, "hub", spawner_key)
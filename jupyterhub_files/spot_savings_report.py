@@ -0,0 +1,46 @@
+#!/usr/bin/python3 python3
+""" Reports what Spot workers cost compared to running the same instance types on-demand.
+
+    Every Spot worker's lifetime and its Spot price at launch are recorded by the spawner (see models.SpotUsage);
+    on-demand prices come from instance_prices.json. Instances that are still running are counted up to now.
+
+    Usage: python3 spot_savings_report.py [--days 30] """
+
+import argparse
+import sys
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+sys.path.insert(1, '/etc/jupyterhub')
+from models import SpotUsage
+
+
+def spot_savings(since):
+    """ Returns {instance type: {"hours", "spot_cost", "on_demand_cost"}} for Spot usage since `since`. """
+    totals = defaultdict(lambda: {"hours": 0.0, "spot_cost": 0.0, "on_demand_cost": 0.0})
+    now = datetime.now()
+    for usage in SpotUsage.select().where((SpotUsage.ended_at.is_null()) | (SpotUsage.ended_at >= since)):
+        if usage.spot_price is None or usage.on_demand_price is None:
+            continue
+        hours = ((usage.ended_at or now) - max(usage.started_at, since)).total_seconds() / 3600
+        totals[usage.instance_type]["hours"] += hours
+        totals[usage.instance_type]["spot_cost"] += hours * usage.spot_price
+        totals[usage.instance_type]["on_demand_cost"] += hours * usage.on_demand_price
+    return totals
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reports the savings achieved with Spot workers")
+    parser.add_argument("--days", type=int, default=30, help="how many days back to report")
+    args = parser.parse_args()
+
+    totals = spot_savings(datetime.now() - timedelta(days=args.days))
+    print("%-14s %10s %12s %14s %10s" % ("instance type", "hours", "spot ($)", "on-demand ($)", "saved"))
+    for instance_type, total in sorted(totals.items()):
+        saved = 1 - total["spot_cost"] / total["on_demand_cost"] if total["on_demand_cost"] else 0
+        print("%-14s %10.1f %12.2f %14.2f %9.0f%%" % (instance_type, total["hours"], total["spot_cost"],
+                                                     total["on_demand_cost"], 100 * saved))
+    spot_cost = sum(total["spot_cost"] for total in totals.values())
+    on_demand_cost = sum(total["on_demand_cost"] for total in totals.values())
+    print("Total: $%.2f on Spot instead of $%.2f on-demand, $%.2f saved" % (spot_cost, on_demand_cost,
+                                                                            on_demand_cost - spot_cost))
@@ -0,0 +1,170 @@
+""" Batched, tracked stopping of worker instances.
+
+    Stopping a worker used to be a fire-and-forget retry(instance.stop): its errors were dropped and nothing knew when
+    the instance had actually stopped. The StopPipeline collects the stop (and, for Spot workers, terminate) requests
+    made within a short window into one StopInstances or TerminateInstances call, then follows every request through
+    the shared InstanceStateCache until its instance has stopped. Each request is a Future that resolves with the final
+    state or fails with StopFailed, so the spawner can make a start wait for a stop still in flight. Failures are
+    logged and kept for the admin metrics. """
+
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+logger = logging.getLogger(__name__)
+
+STOP = "stop"
+TERMINATE = "terminate"
+DONE_STATES = {STOP: ["stopped", "terminated"], TERMINATE: ["terminated"]}
+BATCH_LIMIT = 100  # instances per StopInstances/TerminateInstances call
+
+
+class StopFailed(Exception):
+    pass
+
+
+class StopRequest(object):
+
+    def __init__(self, user_name, instance_id, action):
+        self.user_name = user_name
+        self.instance_id = instance_id
+        self.action = action
+        self.requested_at = time.time()
+        self.future = Future()
+
+
+class StopPipeline(object):
+
+    def __init__(self, region, instance_states, window=1.0, poll_interval=5, timeout=600, recent_failures=50):
+        self.region = region
+        self.instance_states = instance_states
+        self.window = window
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(2)
+        self.queued = []
+        self.in_flight = {}  # instance id: StopRequest
+        self.by_user = {}  # user name: StopRequest
+        self.counts = {"requested": 0, "batches": 0, "done": 0, "failed": 0}
+        self.total_seconds = 0.0
+        self.failures = deque(maxlen=recent_failures)
+        self._tracking = False
+
+    def stop(self, user_name, instance_id, terminate=False):
+        """ Requests that instance_id be stopped (or terminated) and returns a Future of its final state. A request
+            for an instance that is already being stopped shares that request's Future. """
+        request = self.in_flight.get(instance_id)
+        if request is not None:
+            return request.future
+        request = StopRequest(user_name, instance_id, TERMINATE if terminate else STOP)
+        self.counts["requested"] += 1
+        self.in_flight[instance_id] = self.by_user[user_name] = request
+        if not self.queued:
+            IOLoop.current().call_later(self.window, self._flush)
+        self.queued.append(request)
+        return request.future
+
+    def pending(self, user_name):
+        """ Returns the Future of user_name's stop still in flight, or None. """
+        request = self.by_user.get(user_name)
+        return request.future if request is not None else None
+
+    @gen.coroutine
+    def _flush(self):
+        queued, self.queued = self.queued, []
+        try:
+            for action in [STOP, TERMINATE]:
+                requests = [request for request in queued if request.action == action]
+                for i in range(0, len(requests), BATCH_LIMIT):
+                    yield self._send(action, requests[i:i + BATCH_LIMIT])
+        finally:
+            if not self._tracking:
+                IOLoop.current().spawn_callback(self._track)
+
+    @gen.coroutine
+    def _send(self, action, requests):
+        self.counts["batches"] += 1
+        try:
+            yield self.executor.submit(self._call, action, [request.instance_id for request in requests])
+        except ClientError as e:
+            if len(requests) == 1:
+                if "InvalidInstanceID.NotFound" in str(e):
+                    self._finish(requests[0], state="terminated")  # already gone
+                elif "IncorrectInstanceState" not in str(e):  # e.g. already terminated, left to _track() to find out
+                    self._finish(requests[0], error=e)
+                return
+            # one bad instance (e.g. already terminated) fails the whole call; find out which one it was
+            for request in requests:
+                yield self._send(action, [request])
+            return
+        except Exception as e:
+            # e.g. EC2 could not be reached: the requests fail rather than wait for a stop that was never sent
+            for request in requests:
+                self._finish(request, error=e)
+            return
+        self.instance_states.invalidate([request.instance_id for request in requests])
+
+    def _call(self, action, instance_ids):
+        ec2 = boto3.client("ec2", region_name=self.region)
+        if action == TERMINATE:
+            ec2.terminate_instances(InstanceIds=instance_ids)
+        else:
+            ec2.stop_instances(InstanceIds=instance_ids)
+
+    @gen.coroutine
+    def _track(self):
+        """ Follows the requests in flight until their instances have stopped, with one batched lookup per round. """
+        self._tracking = True
+        try:
+            while self.in_flight:
+                yield gen.sleep(self.poll_interval)
+                requests = [request for request in self.in_flight.values() if request not in self.queued]
+                instance_ids = [request.instance_id for request in requests]
+                self.instance_states.invalidate(instance_ids)
+                try:
+                    descriptions = yield self.instance_states.get(instance_ids)
+                except (ClientError, BotoCoreError) as e:
+                    logger.warning("could not check on stopping instances: %s" % e)
+                    continue
+                for request in requests:
+                    state = descriptions[request.instance_id]["State"]["Name"]
+                    if state in DONE_STATES[request.action]:
+                        self._finish(request, state=state)
+                    elif time.time() - request.requested_at > self.timeout:
+                        self._finish(request, error="still %s after %s seconds" % (state, self.timeout))
+        finally:
+            self._tracking = False
+
+    def _finish(self, request, state=None, error=None):
+        if self.in_flight.get(request.instance_id) is request:
+            del self.in_flight[request.instance_id]
+        if self.by_user.get(request.user_name) is request:
+            del self.by_user[request.user_name]
+        if error is None:
+            self.counts["done"] += 1
+            self.total_seconds += time.time() - request.requested_at
+            request.future.set_result(state)
+            return
+        self.counts["failed"] += 1
+        message = "could not %s instance %s of %s: %s" % (request.action, request.instance_id, request.user_name, error)
+        logger.error(message)
+        self.failures.append({"time": time.time(), "user": request.user_name, "instance_id": request.instance_id,
+                              "action": request.action, "error": str(error)})
+        request.future.set_exception(StopFailed(message))
+
+    def metrics(self):
+        metrics = dict(self.counts)
+        metrics.update({
+            "in_flight": len(self.in_flight),
+            "describe_calls": self.instance_states.describe_calls,
+            "average_seconds": round(self.total_seconds / self.counts["done"], 1) if self.counts["done"] else 0.0,
+            "recent_failures": list(self.failures),
+        })
+        return metrics
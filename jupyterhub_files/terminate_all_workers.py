@@ -1,6 +1,6 @@
 import boto3
 import json
-from models import Server
+from models import Server, SharedWorker, PackedServer
 from time import sleep
 
 #######################################################################################
@@ -21,6 +21,8 @@ from time import sleep
 #################################################################################################
 
 # Note: DO NOT USE THIS SCRIPT UNLESS YOU KNOW WHAT YOU ARE DOING
+# For day-to-day fleet operations use fleet_admin.py, e.g. `fleet_admin.py terminate --all --yes` does the same in
+# batches.
 
 #################################################################################################
 
@@ -55,6 +57,10 @@ def check_user_ec2(userid):
 def delete_all_users_ec2s():
     servers = Server.select()
     instance_ids = [server.server_id for server in servers]
+    # shared workers of packed mode (see packing.py), and the places of users on them
+    instance_ids += [worker.instance_id for worker in SharedWorker.select() if worker.instance_id]
+    PackedServer.delete().execute()
+    SharedWorker.delete().execute()
     # if instance_ids is empty (i.e no single ec2 instance yet created for a user), 
     # then the functionec2.instances.filter below will 
     # return all the EC2 instances in your environment and apply
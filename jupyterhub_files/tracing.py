@@ -0,0 +1,806 @@
+#!/usr/bin/python3 python3
+""" Records the hub's (or the culler's) interactions with the outside world, and replays them offline.
+
+    The failures seen at class start (retries running out, redirect loops) depend on the timing of hundreds of
+    concurrent spawns against EC2, the workers and the tracking database, and cannot be reproduced by hand. With
+    TRACE_DIR set in server_config.json, the spawner and the culler write a trace there: one gzipped JSON line per EC2
+    (or other AWS) call, SSH command, worker agent call, hub API request and tracking database query, with when it
+    started, how long it took and what it returned or raised, and one line per call of the spawner's start(), stop()
+    and poll() (or per cull), which are the trace's inputs. Passwords are never involved; user data scripts are left
+    out of the recorded EC2 parameters. Traces grow by roughly a kilobyte per call, so only enable them when needed.
+
+    `python3 tracing.py replay TRACE --speed 10` runs the spawner (or the culler) against a trace without touching
+    AWS, the workers or the tracking database: the inputs are replayed at their recorded times, and every call is
+    answered with the recorded response for the same call (in recorded order when it was made several times, the last
+    response once they run out) after its recorded latency. Sleeps in the code and in boto3 waiters, and the
+    latencies, are divided by --speed; timeouts measured with the clock are not, and neither is the time the code
+    itself takes, so durations replayed at a high speed come out longer. It reports the inputs whose outcome
+    differs from the recording, how long they took compared to the recording, and calls that the trace cannot answer,
+    i.e. code paths the recording never took. Run it on a manager (or a copy of one), with the code to test.
+
+    `python3 tracing.py show TRACE` summarizes a trace: calls, errors and latencies per operation. `python3 tracing.py
+    demo` records a burst of spawns of a stand-in spawner against a simulated EC2 and replays it. """
+
+import base64
+import gzip
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from datetime import date, datetime
+from urllib.parse import urlparse
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+TRACE_VERSION = 1
+INPUT_KINDS = ("hub", "cull")
+# left out of recorded and matched AWS parameters: secrets, or different on every call
+VOLATILE_PARAMETERS = ("UserData", "ClientToken")
+REPLAY_ENV = "JUPYTER_REPLAY"
+
+
+def encode(value):
+    """ value as JSON: datetimes and bytes are tagged, other unknown types become their repr. """
+    if isinstance(value, dict):
+        return {str(key): encode(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        return [encode(item) for item in value]
+    if isinstance(value, (datetime, date)):
+        return {"$dt": value.isoformat()}
+    if isinstance(value, bytes):
+        return {"$b": base64.b64encode(value).decode()}
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return repr(value)
+
+
+def decode(value):
+    if isinstance(value, dict):
+        if "$dt" in value:
+            from dateutil.parser import parse
+            return parse(value["$dt"])
+        if "$b" in value:
+            return base64.b64decode(value["$b"])
+        return {key: decode(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [decode(item) for item in value]
+    return value
+
+
+def describe_error(error):
+    code = getattr(error, "code", None) or getattr(error, "status_code", None)
+    return {"type": type(error).__name__, "message": str(error)[:500], "code": code if isinstance(code, int) else None}
+
+
+def outcome(entry):
+    """ What an input amounted to, to compare recording and replay: "ok" (with a poll's result) or the error. """
+    if "e" in entry:
+        return "%s %s" % (entry["e"]["type"], entry["e"]["code"] or "")
+    return "ok" if entry["op"] != "poll" else "ok %s" % entry.get("r")
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, len(sorted_values) * p // 100)]
+
+
+######################################################################################################################
+######################################################## KEYS ########################################################
+######################################################################################################################
+# A call is matched with its recording by kind, operation and key. Keys leave out what differs between runs (tokens,
+# timestamps, the hub's address), so that the same call matches.
+
+def aws_key(params):
+    return json.dumps(encode({name: value for name, value in params.items() if name not in VOLATILE_PARAMETERS}),
+                      sort_keys=True, separators=(",", ":"))
+
+
+def ssh_key(*args, **kwargs):
+    """ The host of a fabric command; the commands to a host are replayed in order. """
+    from fabric.api import env
+    return env.host_string or ""
+
+
+def agent_key(client, operation, *args, **kwargs):
+    return "%s %s" % (client.host, operation)
+
+
+def http_key(client, request, *args, **kwargs):
+    url = request.url if hasattr(request, "url") else request
+    method = getattr(request, "method", kwargs.get("method", "GET"))
+    return "%s %s" % (method, urlparse(url).path)
+
+
+def spawner_key(spawner, *args, **kwargs):
+    return spawner.user.name
+
+
+def no_key(*args, **kwargs):
+    return ""
+
+
+def encode_ssh(result):
+    return {"out": str(result), "rc": getattr(result, "return_code", None)}
+
+
+class ReplayedOutput(str):
+    """ The output of a replayed fabric command, with the attributes fabric sets on it. """
+    return_code = None
+
+    @property
+    def failed(self):
+        return bool(self.return_code)
+
+    @property
+    def succeeded(self):
+        return not self.failed
+
+
+def decode_ssh(result, *args, **kwargs):
+    if isinstance(result, list):
+        return result  # put()
+    output = ReplayedOutput(result["out"])
+    output.return_code = result["rc"]
+    return output
+
+
+def encode_http(response):
+    return {"code": response.code, "body": (response.body or b"").decode("utf-8", "replace")}
+
+
+def decode_http(result, client, request, *args, **kwargs):
+    from io import BytesIO
+    from tornado.httpclient import HTTPRequest, HTTPResponse
+    if not hasattr(request, "url"):
+        request = HTTPRequest(request, **kwargs)
+    return HTTPResponse(request, result["code"], buffer=BytesIO(result["body"].encode("utf-8")))
+
+
+class RecordedCursor(object):
+    """ A database cursor whose rows were fetched already: what a traced query returns, and a replayed one. """
+
+    def __init__(self, description, rows, rowcount, lastrowid):
+        self.description = description
+        self._rows = deque(tuple(row) for row in rows)
+        self.rowcount = rowcount
+        self.lastrowid = lastrowid
+
+    def fetchone(self):
+        return self._rows.popleft() if self._rows else None
+
+    def fetchall(self):
+        rows, self._rows = list(self._rows), deque()
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        pass
+
+
+######################################################################################################################
+###################################################### RECORDING #####################################################
+######################################################################################################################
+
+class Interceptor(object):
+    """ Hooks into AWS calls (through botocore's events), the database, and coroutine functions or methods.
+        Subclasses record (Tracer) or answer (Replayer) the calls. uninstall() undoes everything. """
+
+    def __init__(self):
+        self._undo = []
+
+    def install_aws(self, session=None):
+        """ Hooks into the AWS clients created from session (boto3's default session) from now on. """
+        import boto3
+        if session is None:
+            if boto3.DEFAULT_SESSION is None:
+                boto3.setup_default_session()
+            session = boto3.DEFAULT_SESSION
+        for event, handler in self._aws_handlers():
+            session.events.register(event, handler)
+            self._undo.append(lambda event=event, handler=handler: session.events.unregister(event, handler))
+
+    def _aws_handlers(self):
+        return [("before-parameter-build", self._before_parameter_build)]
+
+    def _before_parameter_build(self, params, context, event_name, **kwargs):
+        _, service, operation = event_name.split(".")[:3]
+        context["trace"] = {"op": "%s.%s" % (service, operation), "key": aws_key(params), "started": time.time()}
+
+    def install_db(self, database):
+        original = database.execute_sql
+        database.execute_sql = self._execute_sql(original)
+        self._undo.append(lambda: setattr(database, "execute_sql", original))
+
+    def patch(self, owner, name, kind, key, encode_result=encode, decode_result=None):
+        """ Intercepts the coroutine function (or method) owner.name; key(*args, **kwargs) identifies a call. """
+        original = getattr(owner, name)
+        setattr(owner, name, self._wrap(original, kind, name, key, encode_result, decode_result))
+        self._undo.append(lambda: setattr(owner, name, original))
+
+    def install_ssh(self, module):
+        """ The fabric wrappers sudo, run and put of the spawner module. """
+        for name in ("sudo", "run", "put"):
+            self.patch(module, name, "ssh", ssh_key, encode_ssh, decode_ssh)
+
+    def install_agent(self):
+        from worker_agent import WorkerAgentClient
+        self.patch(WorkerAgentClient, "call", "agent", agent_key)
+
+    def install_http(self):
+        from tornado.httpclient import AsyncHTTPClient
+        self.patch(AsyncHTTPClient, "fetch", "http", http_key, encode_http, decode_http)
+
+    def uninstall(self):
+        while self._undo:
+            self._undo.pop()()
+
+
+class TraceWriter(object):
+
+    def __init__(self, path, process, flush_interval=5):
+        self.path = path
+        self.started = time.time()
+        self.flush_interval = flush_interval
+        self._file = gzip.open(path, "wt")
+        self._lock = threading.Lock()
+        self._flushed = self.started
+        self.entries = 0
+        self._write_line({"trace": TRACE_VERSION, "process": process, "started": self.started})
+
+    def _write_line(self, entry):
+        with self._lock:
+            self._file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+            now = time.time()
+            if now - self._flushed > self.flush_interval:
+                self._file.flush()
+                self._flushed = now
+
+    def write(self, kind, op, key, started, seconds, result=None, error=None):
+        entry = {"t": round(started - self.started, 4), "k": kind, "op": op, "key": key, "s": round(seconds, 4)}
+        if error is not None:
+            entry["e"] = error
+        else:
+            entry["r"] = result
+        self.entries += 1
+        self._write_line(entry)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class Tracer(Interceptor):
+    """ Writes every intercepted call to a trace file. """
+
+    def __init__(self, path, process):
+        super(Tracer, self).__init__()
+        self.writer = TraceWriter(path, process)
+
+    def _aws_handlers(self):
+        return super(Tracer, self)._aws_handlers() + [("after-call", self._after_call),
+                                                     ("after-call-error", self._after_call_error)]
+
+    def _after_call(self, http_response, parsed, context, **kwargs):
+        trace = context.get("trace")
+        if trace is not None:
+            response = {name: value for name, value in parsed.items() if name != "ResponseMetadata"}
+            self.writer.write("aws", trace["op"], trace["key"], trace["started"], time.time() - trace["started"],
+                              {"status": http_response.status_code, "parsed": encode(response)})
+
+    def _after_call_error(self, exception, context, **kwargs):
+        trace = context.get("trace")
+        if trace is not None:
+            self.writer.write("aws", trace["op"], trace["key"], trace["started"], time.time() - trace["started"],
+                              error=describe_error(exception))
+
+    def _execute_sql(self, original):
+        def execute_sql(sql, params=None, *args, **kwargs):
+            started = time.time()
+            try:
+                cursor = original(sql, params, *args, **kwargs)
+                rows = cursor.fetchall() if cursor.description else []
+                description = [list(column[:2]) for column in cursor.description or []]
+                result = RecordedCursor(description, rows, cursor.rowcount, cursor.lastrowid)
+            except Exception as e:
+                self.writer.write("db", "execute_sql", sql, started, time.time() - started, error=describe_error(e))
+                raise
+            self.writer.write("db", "execute_sql", sql, started, time.time() - started, {
+                "d": description, "rows": encode(rows), "rc": result.rowcount, "id": result.lastrowid})
+            return result
+        return execute_sql
+
+    def _wrap(self, original, kind, name, key, encode_result, decode_result):
+        writer = self.writer
+
+        @gen.coroutine
+        def traced(*args, **kwargs):
+            call_key = key(*args, **kwargs)  # before yielding, e.g. fabric's host is global
+            started = time.time()
+            try:
+                result = yield original(*args, **kwargs)
+            except Exception as e:
+                writer.write(kind, name, call_key, started, time.time() - started, error=describe_error(e))
+                raise
+            writer.write(kind, name, call_key, started, time.time() - started, encode_result(result))
+            return result
+        traced.__name__ = name
+        return traced
+
+    def uninstall(self):
+        super(Tracer, self).uninstall()
+        self.writer.close()
+
+
+def tracer_from_config(server_params, process):
+    """ A Tracer writing to a new file in TRACE_DIR (server_config.json, or the environment), or None. Never while
+        replaying. """
+    trace_dir = os.environ.get("TRACE_DIR") or server_params.get("TRACE_DIR")
+    if not trace_dir or os.environ.get(REPLAY_ENV):
+        return None
+    os.makedirs(trace_dir, exist_ok=True)
+    path = os.path.join(trace_dir, "%s-%s-%s.jsonl.gz" % (process, time.strftime("%Y%m%d-%H%M%S"), os.getpid()))
+    return Tracer(path, process)
+
+
+######################################################################################################################
+####################################################### REPLAY #######################################################
+######################################################################################################################
+
+class UnrecordedCall(Exception):
+    """ A call that the trace has no response for. """
+
+
+class ReplayedError(Exception):
+    """ A recorded error of a type that cannot be rebuilt. """
+
+
+class Recording(object):
+
+    def __init__(self, path):
+        self.header = None
+        self.inputs = []
+        self._responses = defaultdict(deque)
+        self._lock = threading.Lock()
+        self.unrecorded = Counter()
+        with gzip.open(path, "rt") as f:
+            for line in f:
+                entry = json.loads(line)
+                if self.header is None:
+                    self.header = entry
+                elif entry["k"] in INPUT_KINDS:
+                    self.inputs.append(entry)
+                else:
+                    self._responses[entry["k"], entry["op"], entry["key"]].append(entry)
+
+    def respond(self, kind, op, key):
+        """ The next recorded response to the call, the last one once they ran out, or None. """
+        with self._lock:
+            responses = self._responses.get((kind, op, key))
+            if not responses:
+                self.unrecorded[kind, op] += 1
+                return None
+            return responses.popleft() if len(responses) > 1 else responses[0]
+
+
+class ScaledTime(object):
+    """ Stands in for the time module in botocore's waiters, so that their polling delays are scaled. """
+
+    def __init__(self, speed):
+        self.speed = speed
+
+    def sleep(self, seconds):
+        time.sleep(seconds / self.speed)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class Replayer(Interceptor):
+    """ Answers intercepted calls from a Recording, after their recorded latency divided by speed. """
+
+    def __init__(self, recording, speed=1.0):
+        super(Replayer, self).__init__()
+        self.recording = recording
+        self.speed = float(speed)
+        self.error_types = {}  # type name: exception class taking a message, for recorded errors
+        self._sleep = gen.sleep
+
+    def scale_sleeps(self, *modules):
+        """ Divides gen.sleep (also as imported into modules) and boto3 waiters' delays by speed. """
+        import botocore.waiter
+        original, speed = gen.sleep, self.speed
+
+        def sleep(duration):
+            return original(duration / speed)
+        for module in (gen,) + modules:
+            if getattr(module, "sleep", None) is original:
+                self.patch_attribute(module, "sleep", sleep)
+        self.patch_attribute(botocore.waiter, "time", ScaledTime(speed))
+
+    def patch_attribute(self, owner, name, value):
+        original = getattr(owner, name)
+        setattr(owner, name, value)
+        self._undo.append(lambda: setattr(owner, name, original))
+
+    def _aws_handlers(self):
+        return super(Replayer, self)._aws_handlers() + [("before-call", self._before_call)]
+
+    def _before_call(self, model, context, **kwargs):
+        from botocore.awsrequest import AWSResponse
+        trace = context["trace"]
+        entry = self.recording.respond("aws", trace["op"], trace["key"])
+        if entry is None:
+            raise UnrecordedCall("%s %s" % (trace["op"], trace["key"]))
+        time.sleep(entry["s"] / self.speed)  # in the calling thread, as the request would
+        if "e" in entry:
+            raise self.error(entry["e"])
+        parsed = decode(entry["r"]["parsed"])
+        parsed["ResponseMetadata"] = {"HTTPStatusCode": entry["r"]["status"]}
+        return AWSResponse("https://replay/", entry["r"]["status"], {}, None), parsed
+
+    def error(self, description):
+        error_type = self.error_types.get(description["type"])
+        if description["type"] in ("HTTPError", "HTTPClientError") and description["code"]:
+            from tornado.httpclient import HTTPClientError
+            return HTTPClientError(description["code"], description["message"])
+        if error_type is not None:
+            return error_type(description["message"])
+        return ReplayedError("%s: %s" % (description["type"], description["message"]))
+
+    def _execute_sql(self, original):
+        def execute_sql(sql, params=None, *args, **kwargs):
+            entry = self.recording.respond("db", "execute_sql", sql)
+            if entry is None:
+                return original(sql, params, *args, **kwargs)  # e.g. creating tables, in the scratch database
+            if "e" in entry:
+                raise self.error(entry["e"])
+            result = entry["r"]
+            return RecordedCursor(result["d"], decode(result["rows"]), result["rc"], result["id"])
+        return execute_sql
+
+    def _wrap(self, original, kind, name, key, encode_result, decode_result):
+        recording, replayer = self.recording, self
+
+        @gen.coroutine
+        def replayed(*args, **kwargs):
+            call_key = key(*args, **kwargs)
+            entry = recording.respond(kind, name, call_key)
+            if entry is None:
+                raise UnrecordedCall("%s %s %s" % (kind, name, call_key))
+            yield replayer._sleep(entry["s"] / replayer.speed)
+            if "e" in entry:
+                raise replayer.error(entry["e"])
+            result = decode(entry["r"])
+            return decode_result(result, *args, **kwargs) if decode_result else result
+        replayed.__name__ = name
+        return replayed
+
+    @gen.coroutine
+    def drive(self, drivers, timeout=3600):
+        """ Replays the recording's inputs at their recorded times (divided by speed) with drivers, {(kind, op):
+            coroutine function(key)}. Returns [(input entry, replayed outcome, replayed seconds)]. """
+        inputs = [entry for entry in self.recording.inputs if (entry["k"], entry["op"]) in drivers]
+        if not inputs:
+            return []
+        loop = IOLoop.current()
+        started, first = loop.time(), inputs[0]["t"]
+        results = []
+
+        @gen.coroutine
+        def replay_input(entry):
+            yield self._sleep(max(0.0, started + (entry["t"] - first) / self.speed - loop.time()))
+            call_started = loop.time()
+            replayed = {"op": entry["op"]}
+            try:
+                replayed["r"] = encode((yield drivers[entry["k"], entry["op"]](entry["key"])))
+            except Exception as e:
+                replayed["e"] = describe_error(e)
+            results.append((entry, outcome(replayed), (loop.time() - call_started) * self.speed))
+
+        yield gen.with_timeout(loop.time() + timeout, gen.multi([replay_input(entry) for entry in inputs]))
+        return results
+
+    def report(self, results):
+        mismatches = [(entry, replayed) for entry, replayed, _ in results if outcome(entry) != replayed]
+        durations = defaultdict(lambda: ([], []))
+        for entry, _, seconds in results:
+            durations[entry["op"]][0].append(entry["s"])
+            durations[entry["op"]][1].append(seconds)
+        return {
+            "inputs": len(results),
+            "mismatches": len(mismatches),
+            "mismatched": [{"op": entry["op"], "key": entry["key"], "t": entry["t"], "recorded": outcome(entry),
+                            "replayed": replayed} for entry, replayed in mismatches[:50]],
+            "seconds": {op: {"recorded_p50": round(percentile(sorted(recorded), 50), 2),
+                             "replayed_p50": round(percentile(sorted(replayed), 50), 2),
+                             "recorded_p90": round(percentile(sorted(recorded), 90), 2),
+                             "replayed_p90": round(percentile(sorted(replayed), 90), 2)}
+                        for op, (recorded, replayed) in sorted(durations.items())},
+            "unrecorded_calls": {"%s %s" % key: count for key, count in self.recording.unrecorded.most_common()},
+        }
+
+
+class ReplayUser(object):
+    """ The parts of a hub User that the spawner uses. """
+
+    def __init__(self, name):
+        from types import SimpleNamespace
+        self.name = self.escaped_name = name
+        self.url = self.base_url = "/user/%s/" % name
+        self.server = SimpleNamespace(ip=None, port=None, base_url=self.url)
+        self.last_activity = None
+        self.settings = {}
+        self.state = {}
+
+
+def prepare_replay(path, speed):
+    """ Points the tracking database at a scratch SQLite file and AWS at the recording, before the spawner or culler
+        are imported. Returns the Replayer. """
+    os.environ[REPLAY_ENV] = "1"
+    os.environ["TRACKING_DB_URL"] = "sqlite:///%s" % os.path.join(tempfile.mkdtemp(prefix="replay-"), "tracking.db")
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        os.environ[name] = "replay"  # the requests never leave the process, but boto3 wants credentials
+    replayer = Replayer(Recording(path), speed)
+    replayer.install_aws()
+    from models import DB
+    replayer.install_db(DB)
+    replayer.install_agent()
+    replayer.install_http()
+    return replayer
+
+
+def hub_drivers(replayer):
+    sys.path.insert(1, "/etc/jupyterhub")
+    import spawner as spawner_module
+    from worker_agent import WorkerAgentError
+    from tornado import web
+    replayer.install_ssh(spawner_module)
+    replayer.scale_sleeps()
+    replayer.error_types.update({"RemoteCmdExecutionError": spawner_module.RemoteCmdExecutionError,
+                                 "WorkerAgentError": WorkerAgentError,
+                                 "HTTPError": lambda message: web.HTTPError(500, message)})
+    packed = spawner_module.SERVER_PARAMS.get("SPAWNER_MODE") == "packed"
+    spawner_class = spawner_module.PackedSpawner if packed else spawner_module.InstanceSpawner
+    hub = _hub_stub()
+    spawners = {}
+
+    def get(user_name):
+        if user_name not in spawners:
+            spawners[user_name] = spawner_class(user=ReplayUser(user_name), hub=hub)
+        return spawners[user_name]
+
+    return {("hub", "start"): lambda user_name: get(user_name).start(),
+            ("hub", "stop"): lambda user_name: get(user_name).stop(),
+            ("hub", "poll"): lambda user_name: get(user_name).poll()}
+
+
+def _hub_stub():
+    from types import SimpleNamespace
+    return SimpleNamespace(api_url="http://127.0.0.1:8081/hub/api", base_url="/hub/", url="http://127.0.0.1:8081/hub/",
+                           public_host="", host="")
+
+
+def cull_drivers(replayer, cpu_threshold=5.0):
+    sys.path.insert(1, "/etc/jupyterhub")
+    import cull_idle_servers as culler
+    from activity import ActivityCollector
+    replayer.scale_sleeps(culler)
+    timeout = culler.SERVER_PARAMS["JUPYTER_NOTEBOOK_TIMEOUT"]
+    collector = ActivityCollector(culler.SERVER_PARAMS["REGION"], agent_clients=culler.agent_clients,
+                                  notebook_port=culler.NOTEBOOK_SERVER_PORT, cpu_window=timeout)
+    return {("cull", "cull_idle"): lambda key: culler.cull_idle("http://127.0.0.1:8081/hub/api", "replay", timeout,
+                                                                collector, cpu_threshold)}
+
+
+def replay(path, speed, as_json=False):
+    replayer = prepare_replay(path, speed)
+    process = replayer.recording.header["process"]
+    drivers = cull_drivers(replayer) if process == "culler" else hub_drivers(replayer)
+    results = IOLoop.current().run_sync(lambda: replayer.drive(drivers))
+    report = replayer.report(results)
+    print_report(report, as_json)
+    return report
+
+
+def print_report(report, as_json=False):
+    if as_json:
+        print(json.dumps(report, indent=2))
+        return
+    print("%d inputs replayed, %d with a different outcome" % (report["inputs"], report["mismatches"]))
+    for mismatch in report["mismatched"]:
+        print("  %(t)10.2f %(op)-6s %(key)-20s recorded %(recorded)s, replayed %(replayed)s" % mismatch)
+    print("%-10s %14s %14s %14s %14s" % ("seconds", "recorded p50", "replayed p50", "recorded p90", "replayed p90"))
+    for op, seconds in report["seconds"].items():
+        print("%-10s %14.2f %14.2f %14.2f %14.2f" % (op, seconds["recorded_p50"], seconds["replayed_p50"],
+                                                     seconds["recorded_p90"], seconds["replayed_p90"]))
+    for call, count in report["unrecorded_calls"].items():
+        print("unrecorded: %s (%d times)" % (call, count))
+
+
+def show(path):
+    """ Calls, errors and latencies per operation in a trace. """
+    calls = defaultdict(list)
+    errors = Counter()
+    with gzip.open(path, "rt") as f:
+        header = json.loads(next(f))
+        end = 0
+        for line in f:
+            entry = json.loads(line)
+            calls[entry["k"], entry["op"]].append(entry["s"])
+            end = max(end, entry["t"] + entry["s"])
+            if "e" in entry or (entry["k"] == "aws" and entry["r"]["status"] >= 300):
+                errors[entry["k"], entry["op"]] += 1
+    print("%s trace, started %s, %.0f seconds" % (header["process"], time.ctime(header["started"]), end))
+    print("%-6s %-40s %8s %8s %10s %10s" % ("kind", "operation", "calls", "errors", "p50 s", "p99 s"))
+    for (kind, op), seconds in sorted(calls.items()):
+        seconds.sort()
+        print("%-6s %-40s %8d %8d %10.3f %10.3f" % (kind, op, len(seconds), errors[kind, op],
+                                                    percentile(seconds, 50), percentile(seconds, 99)))
+
+
+######################################################################################################################
+######################################################## DEMO ########################################################
+######################################################################################################################
+
+class SimulatedEC2(object):
+    """ Answers DescribeInstances and RunInstances with latency, throttling some calls, instead of EC2. """
+
+    def __init__(self, latency=0.1, throttle_rate=0.1, boot_seconds=3.0):
+        import random
+        self.random = random.Random(1)
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.boot_seconds = boot_seconds
+        self.instances = {}  # id: (user, launched at)
+
+    def __call__(self, model, params, context, **kwargs):
+        from botocore.awsrequest import AWSResponse
+        time.sleep(self.latency * self.random.uniform(0.5, 2))
+        if self.random.random() < self.throttle_rate:
+            return AWSResponse("https://ec2/", 503, {}, None), {
+                "Error": {"Code": "RequestLimitExceeded", "Message": "Request limit exceeded."}}
+        body = params["body"]
+        if model.name == "RunInstances":
+            instance_id = "i-%08x" % len(self.instances)
+            self.instances[instance_id] = time.time()
+            return AWSResponse("https://ec2/", 200, {}, None), {"Instances": [{"InstanceId": instance_id}]}
+        instance_id = body["InstanceId.1"]
+        running = time.time() - self.instances[instance_id] > self.boot_seconds
+        return AWSResponse("https://ec2/", 200, {}, None), {"Reservations": [{"Instances": [{
+            "InstanceId": instance_id, "State": {"Name": "running" if running else "pending"},
+            "PrivateIpAddress": "10.0.%d.%d" % divmod(int(instance_id[2:], 16) + 10, 250),
+            "LaunchTime": datetime.utcnow()}]}]}
+
+
+class DemoSpawner(object):
+    """ A stand-in for the spawner: launches an instance, waits for it to run, then starts the notebook over SSH. """
+
+    def __init__(self, user_name, database):
+        import boto3
+        self.user_name = user_name
+        self.database = database
+        self.ec2 = boto3.client("ec2", region_name="us-east-1")
+
+    @gen.coroutine
+    def call(self, operation, **kwargs):
+        from botocore.exceptions import ClientError
+        for attempt in range(5):
+            try:
+                response = yield demo_pool.submit(getattr(self.ec2, operation), **kwargs)
+                return response
+            except ClientError:
+                yield gen.sleep(1)
+        raise RuntimeError("RETRY_FAILED: %s" % operation)
+
+    @gen.coroutine
+    def start(self):
+        self.database.execute_sql("INSERT INTO spawns (user) VALUES (?)", (self.user_name,))
+        instance_id = (yield self.call("run_instances", ImageId="ami-demo", MinCount=1, MaxCount=1,
+                                       UserData="secret"))["Instances"][0]["InstanceId"]
+        while True:
+            instance = (yield self.call("describe_instances", InstanceIds=[instance_id]))["Reservations"][0][
+                "Instances"][0]
+            if instance["State"]["Name"] == "running":
+                break
+            yield gen.sleep(1)
+        yield demo_ssh(instance["PrivateIpAddress"], "systemctl start jupyter-singleuser@%s" % self.user_name)
+        return instance["PrivateIpAddress"], 4444
+
+
+demo_pool = None
+
+
+@gen.coroutine
+def demo_ssh(host, command):
+    yield gen.sleep(0.2)
+    return ReplayedOutput("")
+
+
+def demo(users=50, window=5.0, speed=10.0):
+    """ Records a burst of `users` stand-in spawns within window seconds, then replays it at speed. """
+    import random
+    from concurrent.futures import ThreadPoolExecutor
+    from peewee import SqliteDatabase
+    global demo_pool
+    import boto3
+    demo_pool = ThreadPoolExecutor(50)
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "demo")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "demo")
+    boto3.setup_default_session()
+    work_dir = tempfile.mkdtemp(prefix="tracing-demo-")
+    path = os.path.join(work_dir, "demo.jsonl.gz")
+    module = sys.modules[__name__]
+    database = SqliteDatabase(os.path.join(work_dir, "demo.db"), check_same_thread=False)
+    database.execute_sql("CREATE TABLE spawns (user TEXT)")
+    simulated = SimulatedEC2()
+    boto3.DEFAULT_SESSION.events.register("before-call.ec2", simulated)
+
+    tracer = Tracer(path, "demo")
+    tracer.install_aws()
+    tracer.install_db(database)
+    tracer.patch(module, "demo_ssh", "ssh", lambda host, command: host, encode_ssh, decode_ssh)
+    tracer.patch(DemoSpawner, "start", "hub", lambda spawner: spawner.user_name)
+    names = ["student%03d" % i for i in range(users)]
+
+    @gen.coroutine
+    def burst():
+        @gen.coroutine
+        def login(name):
+            yield gen.sleep(random.uniform(0, window))
+            try:
+                yield DemoSpawner(name, database).start()
+            except RuntimeError:
+                pass  # recorded
+        yield [login(name) for name in names]
+
+    started = time.time()
+    IOLoop.current().run_sync(burst)
+    recorded_seconds = time.time() - started
+    tracer.uninstall()
+    boto3.DEFAULT_SESSION.events.unregister("before-call.ec2", simulated)
+    print("recorded %d calls of %d spawns in %.1f s to %s (%d bytes)" % (
+        tracer.writer.entries, users, recorded_seconds, path, os.path.getsize(path)))
+    show(path)
+
+    replayer = Replayer(Recording(path), speed)
+    replayer.install_aws()
+    replayer.install_db(database)
+    replayer.patch(module, "demo_ssh", "ssh", lambda host, command: host, encode_ssh, decode_ssh)
+    replayer.scale_sleeps()
+    started = time.time()
+    results = IOLoop.current().run_sync(lambda: replayer.drive(
+        {("hub", "start"): lambda user_name: DemoSpawner(user_name, database).start()}))
+    print("\nreplayed at %gx in %.1f s" % (speed, time.time() - started))
+    replayer.uninstall()
+    print_report(replayer.report(results))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Replays and summarizes traces of the hub and the culler")
+    commands = parser.add_subparsers(dest="command")
+    replay_parser = commands.add_parser("replay", help="run the spawner or culler against a trace")
+    replay_parser.add_argument("trace")
+    replay_parser.add_argument("--speed", type=float, default=1.0, help="e.g. 10 replays 10 times as fast")
+    replay_parser.add_argument("--json", action="store_true")
+    show_parser = commands.add_parser("show", help="summarize a trace")
+    show_parser.add_argument("trace")
+    demo_parser = commands.add_parser("demo", help="record and replay a simulated burst of spawns")
+    demo_parser.add_argument("--users", type=int, default=50)
+    demo_parser.add_argument("--window", type=float, default=5.0, help="seconds over which the users log in")
+    demo_parser.add_argument("--speed", type=float, default=10.0)
+    args = parser.parse_args()
+    if args.command == "replay":
+        report = replay(args.trace, args.speed, args.json)
+        sys.exit(1 if report["mismatches"] or report["unrecorded_calls"] else 0)
+    elif args.command == "show":
+        show(args.trace)
+    elif args.command == "demo":
+        demo(args.users, args.window, args.speed)
+    else:
+        parser.print_help()
@@ -0,0 +1,54 @@
+#!/bin/bash -ex
+exec 1> >(logger -s -t $(basename $0)) 2>&1 # Redirect stdout/stderr to the syslog
+
+# A shared worker runs the notebooks of several users (see packing.py). The users' accounts and homes are set up by
+# the worker agent as they are placed here, this script only mounts the file system their homes are on.
+mkdir -p /jupyteruser
+if [ -n "{nfs_home}" ]; then
+    # e.g. an EFS file system; nofail so that the worker still boots, and the agent still answers, if it is down
+    echo "{nfs_home} /jupyteruser nfs4 nfsvers=4.1,rsize=1048576,wsize=1048576,hard,timeo=600,retrans=2,_netdev,nofail 0 0" >> /etc/fstab
+    for i in $(seq 1 30); do
+        mount /jupyteruser && break
+        sleep 2
+    done
+    mountpoint -q /jupyteruser
+fi
+
+# Mount the shared datasets read-only, now and at every boot, whenever the worker has a volume of them: the spawner
+# gives a stopped worker a volume of the current version before starting it again (see datasets.py).
+mkdir -p /datasets
+echo "LABEL=datasets /datasets xfs ro,noatime,nofail,x-systemd.device-timeout=10s 0 0" >> /etc/fstab
+mount /datasets || true
+
+# Mount the instance store at /mnt, now and at every later boot, if the worker's profile asks for it.
+if [ -n "{scratch}" ] && [ -f /etc/systemd/system/jupyter-scratch.service ]; then
+    systemctl enable jupyter-scratch
+    systemctl start jupyter-scratch || true
+fi
+
+# Users' notebooks must not reach the instance metadata service (the user data, or the credentials of an instance
+# role): only root may, at this boot and every later one, from before any user account exists.
+cat > /etc/systemd/system/jupyter-block-metadata.service <<'UNIT'
+[Unit]
+Description=Only root may reach the instance metadata service
+Before=jupyter-worker-agent.service
+
+[Service]
+Type=oneshot
+RemainAfterExit=yes
+ExecStart=/bin/sh -c 'iptables -C OUTPUT -d 169.254.169.254 -m owner ! --uid-owner 0 -j REJECT || iptables -I OUTPUT -d 169.254.169.254 -m owner ! --uid-owner 0 -j REJECT'
+
+[Install]
+WantedBy=multi-user.target
+UNIT
+systemctl daemon-reload
+systemctl enable jupyter-block-metadata
+systemctl start jupyter-block-metadata
+
+# Start the worker agent. It only accepts requests signed with this worker's token, which the hub copies to
+# /etc/jupyter_worker_agent/token over SSH (see spawner.launch_shared_worker) rather than through the user data.
+mkdir -p /etc/jupyter_worker_agent
+chmod 700 /etc/jupyter_worker_agent
+systemctl enable jupyter-worker-agent
+systemctl restart jupyter-worker-agent
+touch /etc/jupyter_worker_agent/ready
@@ -11,17 +11,57 @@ mkdir -p /jupyteruser
 
 # Mount EBS home volume if a device is specified
 if [ -n "{device}" ]; then
-    mkfs.xfs /dev/{device}
-    echo "/dev/{device} /jupyteruser xfs defaults 1 1" >> /etc/fstab
+    # The home volume is attached separately from the instance, possibly after boot, wait for it.
+    for i in $(seq 1 300); do
+        [ -b /dev/{device} ] && break
+        sleep 1
+    done
+    # Only format new, blank volumes: an existing home volume already holds the user's files, and a volume created
+    # from the golden snapshot is already formatted and populated.
+    if ! blkid /dev/{device}; then
+        mkfs.xfs /dev/{device}
+    fi
+    # nofail: the volume is detached while the instance is stopped, and attached again before it starts
+    echo "/dev/{device} /jupyteruser xfs defaults,nofail 1 1" >> /etc/fstab
     mount -a
+    # the golden snapshot's filesystem may be smaller than the volume created from it
+    xfs_growfs /jupyteruser || true
 else
     : # No-op. If no device is specified, use the root device and continue with user account setup
 fi
 
+# Mount the shared datasets read-only, now and at every boot, whenever the worker has a volume of them: the spawner
+# gives a stopped worker a volume of the current version before starting it again (see datasets.py).
+mkdir -p /datasets
+echo "LABEL=datasets /datasets xfs ro,noatime,nofail,x-systemd.device-timeout=10s 0 0" >> /etc/fstab
+mount /datasets || true
+
 # Setup the user account and home directory
 useradd -d /home/{user} {user} -s /bin/bash  &>/dev/null
-cp -R /home/ubuntu /jupyteruser/{user}
+if [ ! -d /jupyteruser/{user} ]; then
+    if [ -d /jupyteruser/.skel ]; then
+        # a new volume from the golden snapshot, the skeleton and course materials only need to be moved into place
+        mv /jupyteruser/.skel /jupyteruser/{user}
+    else
+        cp -R /home/ubuntu /jupyteruser/{user}
+    fi
+fi
 ln -s /jupyteruser/{user} /home/{user}
 echo " {user} ALL=(ALL) NOPASSWD:ALL " > /etc/sudoers.d/{user}
 chown -R {user}.{user} /home/{user} /jupyteruser/{user}
 echo "User setup completed for {user}"
+
+# Mount the instance store at /mnt, now and at every later boot, if the worker's profile asks for it.
+if [ -n "{scratch}" ] && [ -f /etc/systemd/system/jupyter-scratch.service ]; then
+    systemctl enable jupyter-scratch
+    systemctl start jupyter-scratch || true
+fi
+
+# Start the worker agent if the AMI has one, it only accepts requests signed with this worker's token.
+mkdir -p /etc/jupyter_worker_agent
+if [ -n "{agent_token}" ] && [ -f /etc/systemd/system/jupyter-worker-agent.service ]; then
+    (umask 077; echo "{agent_token}" > /etc/jupyter_worker_agent/token)
+    systemctl enable jupyter-worker-agent
+    systemctl restart jupyter-worker-agent
+fi
+touch /etc/jupyter_worker_agent/ready
@@ -0,0 +1,596 @@
+#!/usr/bin/python3 python3
+""" A small agent that runs on every worker and answers the hub's questions about it.
+
+    It replaces ad-hoc SSH commands (`ps -ef | grep`, a backgrounded sudo with a concatenated environment) with a
+    handful of operations: readiness, notebook start/stop/status, kernel activity and resource usage. Every operation
+    is available as an authenticated HTTP endpoint (/api/<operation>) and over a single persistent websocket
+    (/api/channel), which is what WorkerAgentClient uses so that the hub keeps one connection per worker instead of
+    doing an SSH handshake per command.
+
+    The agent is installed into the worker AMI by launch.py:make_worker_ami() and enabled by user_data_worker.sh,
+    which also writes its token (on shared workers, whose users have no sudo, the hub copies the token over SSH
+    instead, see user_data_shared_worker.sh). The token for a worker is derived from the cluster's WORKER_AGENT_SECRET
+    and the user name (see agent_token()), so the secret itself never leaves the hub. The hub never sends a command
+    line: the agent builds the single-user server's own, see notebook_command().
+
+    To try it locally, run `python3 worker_agent.py --port=4445 --token=test` and connect a
+    WorkerAgentClient("127.0.0.1", 4445, "test"). """
+
+import hashlib
+import hmac
+import ipaddress
+import itertools
+import json
+import logging
+import os
+import pwd
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import time
+from datetime import timedelta
+
+from tornado import gen, web
+from tornado.concurrent import Future
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.process import Subprocess
+from tornado.websocket import WebSocketHandler, websocket_connect
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_AGENT_PORT = 4445
+TOKEN_FILE = "/etc/jupyter_worker_agent/token"
+# written by user_data_worker.sh once the user's account and home directory are set up
+READY_MARKER = "/etc/jupyter_worker_agent/ready"
+NOTEBOOK_LOG = "/tmp/jupyter.log"
+# the templated systemd unit the notebooks run under (jupyter-singleuser@.service), and its per-user environment file
+NOTEBOOK_UNIT = "jupyter-singleuser@%s.service"
+NOTEBOOK_ENV_FILE = "/etc/jupyter_singleuser/%s.env"
+# runtime drop-in of a user's unit on a shared worker: the account it runs as and its cgroup limits, see packing.py
+NOTEBOOK_UNIT_DROP_IN = "/run/systemd/system/jupyter-singleuser@%s.service.d/50-limits.conf"
+# on shared workers, homes are on a file system shared by all of them, mounted by user_data_shared_worker.sh
+SHARED_HOME_ROOT = "/jupyteruser"
+HOME_SKELETON = "/home/ubuntu"
+VALID_USER_NAME = re.compile(r"^[a-z_][a-z0-9_.-]{0,31}$")
+# The agent builds the single-user server's command line itself, the hub only chooses among these options (from
+# Spawner.get_args()); --ip, --port, --user and --notebook-dir are always the agent's own.
+SINGLEUSER_COMMAND = ["jupyterhub-singleuser"]
+NOTEBOOK_OPTION = re.compile(r"^--(debug|disable-user-config|SingleUserNotebookApp\.default_url=[\w./%?&=-]*)$")
+AGENT_OPTIONS = ("--ip", "--port", "--user", "--notebook-dir", "--allow-root")
+# environment variables that would run code of the caller's choosing in the notebook server (which may run as root)
+UNSAFE_ENV = re.compile(r"^(LD_\w*|PYTHONSTARTUP|PYTHONINSPECT|BASH_ENV|ENV)$")
+NOTEBOOK_PATH = "/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
+INSTANCE_METADATA_URL = "http://169.254.169.254/latest"
+CPU_SAMPLE_INTERVAL = 5
+
+
+def agent_token(secret, user_name):
+    """ The token the agent on user_name's worker accepts. """
+    return hmac.new(secret.encode("utf8"), user_name.encode("utf8"), hashlib.sha256).hexdigest()
+
+
+class WorkerAgentError(Exception): pass
+
+#########################################################################################################
+### worker side ###
+
+
+def read_cpu_times():
+    """ Returns (idle, total) jiffies from /proc/stat. """
+    with open("/proc/stat") as f:
+        fields = [int(value) for value in f.readline().split()[1:]]
+    idle = fields[3] + (fields[4] if len(fields) > 4 else 0)  # idle + iowait
+    return idle, sum(fields)
+
+
+def read_meminfo():
+    meminfo = {}
+    with open("/proc/meminfo") as f:
+        for line in f:
+            key, value = line.split(":", 1)
+            meminfo[key] = int(value.split()[0]) * 1024  # values are in kB
+    return meminfo
+
+
+def find_notebook_pids(port):
+    """ The equivalent of `ps -ef | grep jupyterhub-singleuser` filtered on the notebook port. """
+    pids = []
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open("/proc/%s/cmdline" % pid, "rb") as f:
+                cmdline = f.read().replace(b"\0", b" ").decode("utf8", "replace")
+        except (IOError, OSError):
+            continue  # the process exited while we were looking
+        if "jupyterhub-singleuser" in cmdline and str(port) in cmdline:
+            pids.append(int(pid))
+    return pids
+
+
+def notebook_command(user, ip, port, args=(), as_root=True):
+    """ The single-user server's command line for user on ip:port. Of the hub's args, only the options NOTEBOOK_OPTION
+        allows are kept; the agent's own options are dropped and anything else is refused. """
+    if not VALID_USER_NAME.match(user):
+        raise WorkerAgentError("invalid user name %r" % user)
+    try:
+        ip = str(ipaddress.ip_address(ip))
+    except ValueError:
+        raise WorkerAgentError("invalid address %r" % ip)
+    command = SINGLEUSER_COMMAND + ["--ip=%s" % ip, "--port=%d" % int(port), "--user=%s" % user,
+                                    "--notebook-dir=/home/%s/" % user]
+    for arg in args:
+        if arg.split("=", 1)[0] in AGENT_OPTIONS:
+            continue
+        if not NOTEBOOK_OPTION.match(arg):
+            raise WorkerAgentError("option %r is not allowed" % arg)
+        command.append(arg)
+    if as_root:
+        command.append("--allow-root")
+    return command
+
+
+def notebook_environment(env):
+    """ The hub's environment for a notebook, without the variables that would let it run other code. The hub's
+        PATH means nothing on the worker, the notebook gets NOTEBOOK_PATH. """
+    unsafe = sorted(key for key in env if UNSAFE_ENV.match(key))
+    if unsafe:
+        logger.warning("ignoring the notebook environment variables %s", ", ".join(unsafe))
+    env = {key: str(value) for key, value in env.items() if key not in unsafe}
+    env["PATH"] = NOTEBOOK_PATH
+    return env
+
+
+def notebook_env_file(cmd, env, address):
+    """ The contents of a notebook's EnvironmentFile: its environment, plus NOTEBOOK_CMD and NOTEBOOK_ADDRESS
+        (host:port) for the unit. Values are double quoted, which systemd unquotes; nothing is expanded. """
+    env = dict(env, NOTEBOOK_CMD=" ".join(cmd), NOTEBOOK_ADDRESS=address)
+    env.setdefault("PATH", NOTEBOOK_PATH)
+    lines = ['%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " "))
+             for key, value in sorted(env.items())]
+    return "\n".join(lines) + "\n"
+
+
+def wait_for_port(address, timeout):
+    """ Waits for host:port to accept connections. Returns whether it did within timeout seconds. """
+    host, port = address.rsplit(":", 1)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if is_port_open(int(port), host):
+            return True
+        time.sleep(0.25)
+    return False
+
+
+def is_port_open(port, host="127.0.0.1"):
+    try:
+        socket.create_connection((host, port), timeout=1).close()
+        return True
+    except (socket.timeout, OSError):
+        return False
+
+
+class WorkerAgent(object):
+    """ The operations the agent exposes. Every operation is a coroutine taking keyword arguments and returning
+        something JSON serializable. """
+
+    OPERATIONS = ("ready", "notebook_start", "notebook_unit_start", "notebook_stop", "notebook_status", "activity",
+                  "resources", "interruption", "user_setup", "io_benchmark")
+
+    def __init__(self, token=None, token_file=TOKEN_FILE, ready_marker=READY_MARKER):
+        self._token = token
+        self.token_file = token_file
+        self.ready_marker = ready_marker
+        self.process = None
+        self.notebook_envs = {}  # port: the environment of the notebook started on it
+        self.cpu_percent = None
+        self._last_cpu_times = None
+
+    def authorized(self, authorization_header):
+        """ Checks an `Authorization: token <token>` header. The token file is only written once the user data script
+            runs, so until then every request is refused. """
+        if self._token is None:
+            try:
+                with open(self.token_file) as f:
+                    self._token = f.read().strip() or None
+            except (IOError, OSError):
+                return False
+        if self._token is None:
+            return False
+        return hmac.compare_digest(authorization_header, "token %s" % self._token)
+
+    def sample_cpu(self):
+        """ Updates cpu_percent from the change in /proc/stat since the previous sample. """
+        idle, total = read_cpu_times()
+        if self._last_cpu_times is not None:
+            idle_delta = idle - self._last_cpu_times[0]
+            total_delta = total - self._last_cpu_times[1]
+            if total_delta > 0:
+                self.cpu_percent = round(100.0 * (1 - idle_delta / total_delta), 1)
+        self._last_cpu_times = (idle, total)
+
+    @gen.coroutine
+    def ready(self):
+        ready = os.path.exists(self.ready_marker)
+        return {"ready": ready}
+
+    @gen.coroutine
+    def notebook_status(self, port):
+        pids = find_notebook_pids(port)
+        return {"running": bool(pids), "pids": pids}
+
+    @gen.coroutine
+    def notebook_start(self, user, env, port, ip="127.0.0.1", args=(), wait=30):
+        """ Starts user's single-user server (see notebook_command()) with the given environment, then waits up to
+            `wait` seconds for it to listen on ip:port. No shell is involved, so nothing in env needs quoting. """
+        cmd = notebook_command(user, ip, port, args)
+        status = yield self.notebook_status(port)
+        if status["running"]:
+            return {"started": False, "ready": True, "pids": status["pids"]}
+        env = notebook_environment(env)
+        with open(NOTEBOOK_LOG, "ab") as log:
+            self.process = subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT,
+                                            stdin=subprocess.DEVNULL, start_new_session=True)
+        self.notebook_envs[port] = env
+        logger.info("started notebook process %s", self.process.pid)
+        for _ in range(wait):
+            if self.process.poll() is not None:
+                raise WorkerAgentError("notebook exited with code %s, see %s" % (self.process.returncode, NOTEBOOK_LOG))
+            if is_port_open(port, ip):
+                return {"started": True, "ready": True, "pids": [self.process.pid]}
+            yield gen.sleep(1)
+        return {"started": True, "ready": False, "pids": [self.process.pid]}
+
+    @gen.coroutine
+    def notebook_unit_start(self, user, env, port, ip="127.0.0.1", args=(), limits=None):
+        """ Starts the single-user server as the user's instance of the jupyter-singleuser@ unit, which systemd
+            restarts if it crashes. Returns once the unit has started, i.e. once the server is listening. With limits
+            ({"memory_mb", "cpus"}, on shared workers), the server runs as the user rather than as root, in a cgroup
+            capped at those limits. """
+        cmd = notebook_command(user, ip, port, args, as_root=limits is None)  # also checks the user name
+        status = yield self.notebook_status(port)
+        if status["running"]:
+            return {"started": False, "ready": True, "pids": status["pids"]}
+        env = notebook_environment(env)
+        os.makedirs(os.path.dirname(NOTEBOOK_ENV_FILE), exist_ok=True)
+        with open(os.open(NOTEBOOK_ENV_FILE % user, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+            f.write(notebook_env_file(cmd, env, "%s:%s" % (ip, port)))
+        if limits is not None:
+            yield self.limit_unit(user, int(limits["memory_mb"]), float(limits["cpus"]))
+        process = Subprocess(["systemctl", "start", NOTEBOOK_UNIT % user], stdin=subprocess.DEVNULL)
+        code = yield process.wait_for_exit(raise_error=False)
+        if code != 0:
+            raise WorkerAgentError("could not start %s, see journalctl -u %s" % (NOTEBOOK_UNIT % user,
+                                                                                 NOTEBOOK_UNIT % user))
+        self.notebook_envs[port] = env
+        status = yield self.notebook_status(port)
+        return {"started": True, "ready": True, "pids": status["pids"]}
+
+    @gen.coroutine
+    def limit_unit(self, user, memory_mb, cpus):
+        """ Writes the drop-in that runs the user's unit as the user, with at most memory_mb of memory (beyond which
+            the kernel reclaims, then kills, within the cgroup only) and cpus CPUs. """
+        if not VALID_USER_NAME.match(user):
+            raise WorkerAgentError("invalid user name %r" % user)
+        drop_in = NOTEBOOK_UNIT_DROP_IN % user
+        os.makedirs(os.path.dirname(drop_in), exist_ok=True)
+        with open(drop_in, "w") as f:
+            f.write("[Service]\nUser=%s\nMemoryAccounting=yes\nMemoryMax=%dM\nCPUAccounting=yes\nCPUQuota=%d%%\n"
+                    % (user, memory_mb, round(100 * cpus)))
+        process = Subprocess(["systemctl", "daemon-reload"], stdin=subprocess.DEVNULL)
+        yield process.wait_for_exit(raise_error=False)
+
+    @gen.coroutine
+    def user_setup(self, user, uid):
+        """ Creates user's account on a shared worker, with the same uid on every worker since their home is on the
+            shared file system, and their home from the skeleton the first time. Unlike on a worker of their own,
+            the user gets no sudo rights. """
+        if not VALID_USER_NAME.match(user):
+            raise WorkerAgentError("invalid user name %r" % user)
+        try:
+            pwd.getpwnam(user)
+        except KeyError:
+            for command in (["groupadd", "-g", str(uid), user],
+                            ["useradd", "-u", str(uid), "-g", str(uid), "-d", "/home/%s" % user, "-s", "/bin/bash",
+                             user]):
+                code = yield Subprocess(command, stdin=subprocess.DEVNULL).wait_for_exit(raise_error=False)
+                if code != 0:
+                    raise WorkerAgentError("%s failed with code %s" % (command[0], code))
+        home = os.path.join(SHARED_HOME_ROOT, user)
+        if not os.path.isdir(home):
+            shutil.copytree(HOME_SKELETON, home, symlinks=True)
+            code = yield Subprocess(["chown", "-R", "%s:%s" % (uid, uid), home],
+                                    stdin=subprocess.DEVNULL).wait_for_exit(raise_error=False)
+            if code != 0:
+                raise WorkerAgentError("could not give %s its home %s" % (user, home))
+        if not os.path.lexists("/home/%s" % user):
+            os.symlink(home, "/home/%s" % user)
+        return {"home": home}
+
+    @gen.coroutine
+    def notebook_stop(self, port, wait=10, user=None):
+        if user is not None:
+            if not VALID_USER_NAME.match(user):
+                raise WorkerAgentError("invalid user name %r" % user)
+            # a notebook killed under its unit would be restarted
+            process = Subprocess(["systemctl", "stop", NOTEBOOK_UNIT % user], stdin=subprocess.DEVNULL)
+            yield process.wait_for_exit(raise_error=False)
+        pids = find_notebook_pids(port)
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for _ in range(wait):
+            if not find_notebook_pids(port):
+                break
+            yield gen.sleep(1)
+        else:
+            for pid in find_notebook_pids(port):
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+        return {"stopped": pids}
+
+    @gen.coroutine
+    def activity(self, port, ip="127.0.0.1"):
+        """ Kernel execution state and last activity, read from the single-user server's /api/kernels with the API
+            token the server was started with. Kernels are None when they cannot be read (e.g. the agent restarted
+            since it started the notebook). """
+        notebook_env = self.notebook_envs.get(port, {})
+        token = notebook_env.get("JUPYTERHUB_API_TOKEN")
+        prefix = notebook_env.get("JUPYTERHUB_SERVICE_PREFIX", "/")
+        if not token or not is_port_open(port, ip):
+            return {"kernels": None, "last_activity": None}
+        request = HTTPRequest("http://%s:%s%sapi/kernels" % (ip, port, prefix),
+                              headers={"Authorization": "token %s" % token}, request_timeout=5)
+        try:
+            response = yield AsyncHTTPClient().fetch(request)
+        except Exception as e:
+            logger.warning("could not read kernels: %s", e)
+            return {"kernels": None, "last_activity": None}
+        kernels = [{"id": kernel["id"],
+                    "execution_state": kernel.get("execution_state"),
+                    "last_activity": kernel.get("last_activity"),
+                    "connections": kernel.get("connections")}
+                   for kernel in json.loads(response.body.decode("utf8", "replace"))]
+        # ISO 8601 timestamps in UTC compare correctly as strings
+        last_activity = max([k["last_activity"] for k in kernels if k["last_activity"]], default=None)
+        return {"kernels": kernels, "last_activity": last_activity}
+
+    @gen.coroutine
+    def resources(self):
+        meminfo = read_meminfo()
+        disks = {}
+        for path in ("/", "/jupyteruser", "/mnt"):
+            if os.path.isdir(path):
+                stat = os.statvfs(path)
+                disks[path] = {"total": stat.f_blocks * stat.f_frsize, "free": stat.f_bavail * stat.f_frsize}
+        return {
+            "cpu_percent": self.cpu_percent,
+            "load_average": os.getloadavg(),
+            "memory_total": meminfo.get("MemTotal"),
+            "memory_available": meminfo.get("MemAvailable", meminfo.get("MemFree")),
+            "disks": disks,
+        }
+
+    @gen.coroutine
+    def interruption(self):
+        """ The pending Spot interruption notice from the instance metadata service ({"action", "time"}), or None. """
+        client = AsyncHTTPClient()
+        try:
+            token = yield client.fetch(HTTPRequest(INSTANCE_METADATA_URL + "/api/token", method="PUT", body="",
+                                                   headers={"X-aws-ec2-metadata-token-ttl-seconds": "60"},
+                                                   request_timeout=2))
+            response = yield client.fetch(HTTPRequest(INSTANCE_METADATA_URL + "/meta-data/spot/instance-action",
+                                                      headers={"X-aws-ec2-metadata-token": token.body.decode()},
+                                                      request_timeout=2), raise_error=False)
+        except Exception as e:
+            raise WorkerAgentError("instance metadata unavailable: %s" % e)
+        if response.code != 200:
+            return {"notice": None}  # 404 until the instance is marked for interruption
+        return {"notice": json.loads(response.body.decode("utf8"))}
+
+    @gen.coroutine
+    def io_benchmark(self, paths=None, size_mb=1024, seconds=10, jobs=8):
+        """ Runs io_benchmark.py, installed next to the agent, on paths (by default /, and /jupyteruser and /mnt if
+            they are mounted) one after the other. """
+        import io_benchmark
+        results = []
+        for path in paths or io_benchmark.default_paths():
+            try:
+                result = yield IOLoop.current().run_in_executor(None, io_benchmark.run, path, size_mb, seconds, jobs)
+            except (OSError, ValueError) as e:
+                result = {"path": path, "error": str(e)}
+            results.append(result)
+        return {"results": results}
+
+    @gen.coroutine
+    def dispatch(self, operation, args):
+        if operation not in self.OPERATIONS:
+            raise WorkerAgentError("unknown operation %s" % operation)
+        result = yield getattr(self, operation)(**args)
+        return result
+
+
+class AgentHandlerMixin(object):
+
+    def initialize(self, agent):
+        self.agent = agent
+
+    def prepare(self):
+        if not self.agent.authorized(self.request.headers.get("Authorization", "")):
+            raise web.HTTPError(403)
+
+
+class OperationHandler(AgentHandlerMixin, web.RequestHandler):
+    """ One operation per request, for debugging with curl. Arguments are a JSON body. """
+
+    @gen.coroutine
+    def post(self, operation):
+        args = json.loads(self.request.body.decode("utf8")) if self.request.body else {}
+        try:
+            result = yield self.agent.dispatch(operation, args)
+        except (WorkerAgentError, TypeError) as e:
+            raise web.HTTPError(400, str(e))
+        self.finish(json.dumps(result))
+
+    get = post
+
+
+class ChannelHandler(AgentHandlerMixin, WebSocketHandler):
+    """ The persistent channel. Messages are {"id", "op", "args"}; replies are {"id", "ok", "result" or "error"}.
+        Operations run concurrently and reply as they finish, so a slow notebook start does not hold up the status
+        and activity checks behind it. """
+
+    def on_message(self, message):
+        # not a coroutine: tornado waits for a coroutine on_message before it reads the next message
+        IOLoop.current().spawn_callback(self._handle, json.loads(message))
+
+    @gen.coroutine
+    def _handle(self, request):
+        try:
+            result = yield self.agent.dispatch(request["op"], request.get("args", {}))
+            response = {"id": request["id"], "ok": True, "result": result}
+        except (WorkerAgentError, TypeError) as e:
+            response = {"id": request["id"], "ok": False, "error": "%s: %s" % (type(e).__name__, e)}
+        except Exception as e:
+            logger.exception("operation %s failed", request.get("op"))
+            response = {"id": request["id"], "ok": False, "error": "%s: %s" % (type(e).__name__, e)}
+        try:
+            self.write_message(json.dumps(response))
+        except Exception:
+            pass  # the hub went away, it will reconnect and ask again
+
+
+def make_app(agent):
+    return web.Application([
+        (r"/api/channel", ChannelHandler, {"agent": agent}),
+        (r"/api/(\w+)", OperationHandler, {"agent": agent}),
+    ])
+
+#########################################################################################################
+### hub side ###
+
+
+class WorkerAgentClient(object):
+    """ Keeps one websocket to a worker's agent and multiplexes requests over it. The connection is (re)opened
+        lazily, so a client can be created before the worker has booted. """
+
+    def __init__(self, host, port, token, connect_timeout=5, request_timeout=60):
+        self.host = host
+        self.url = "ws://%s:%s/api/channel" % (host, port)
+        self.token = token
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self._connection = None
+        self._connecting = None
+        self._pending = {}
+        self._ids = itertools.count()
+
+    @gen.coroutine
+    def _connect(self):
+        if self._connection is not None:
+            return self._connection
+        if self._connecting is None:
+            request = HTTPRequest(self.url, headers={"Authorization": "token %s" % self.token},
+                                  connect_timeout=self.connect_timeout, request_timeout=self.connect_timeout)
+            self._connecting = websocket_connect(request, on_message_callback=self._on_message)
+        try:
+            connection = yield self._connecting
+        except Exception as e:
+            raise WorkerAgentError("could not connect to %s: %s" % (self.url, e))
+        finally:
+            self._connecting = None
+        self._connection = connection
+        return connection
+
+    def _on_message(self, message):
+        if message is None:
+            # connection closed, fail everything that was waiting on it
+            self._connection = None
+            pending, self._pending = self._pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(WorkerAgentError("connection to %s closed" % self.url))
+            return
+        response = json.loads(message)
+        future = self._pending.pop(response["id"], None)
+        if future is not None and not future.done():
+            future.set_result(response)
+
+    @gen.coroutine
+    def call(self, operation, timeout=None, **args):
+        """ Runs an operation on the agent and returns its result. Raises WorkerAgentError on failure. """
+        connection = yield self._connect()
+        request_id = next(self._ids)
+        future = Future()
+        self._pending[request_id] = future
+        try:
+            connection.write_message(json.dumps({"id": request_id, "op": operation, "args": args}))
+            response = yield gen.with_timeout(timedelta(seconds=timeout or self.request_timeout), future)
+        except gen.TimeoutError:
+            raise WorkerAgentError("%s on %s timed out" % (operation, self.url))
+        except WorkerAgentError:
+            raise
+        except Exception as e:
+            self.close()
+            raise WorkerAgentError("%s on %s failed: %s" % (operation, self.url, e))
+        finally:
+            self._pending.pop(request_id, None)
+        if not response["ok"]:
+            raise WorkerAgentError(response["error"])
+        return response["result"]
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class AgentClientPool(object):
+    """ One WorkerAgentClient per user, reused across calls for as long as the user's worker keeps its address. """
+
+    def __init__(self, secret, port=DEFAULT_AGENT_PORT):
+        self.secret = secret
+        self.port = port
+        self.clients = {}
+
+    def get(self, user_name, ip_address):
+        client = self.clients.get(user_name)
+        if client is None or client.host != ip_address:
+            if client is not None:
+                client.close()
+            client = WorkerAgentClient(ip_address, self.port, agent_token(self.secret, user_name))
+            self.clients[user_name] = client
+        return client
+
+    def discard(self, user_name):
+        client = self.clients.pop(user_name, None)
+        if client is not None:
+            client.close()
+
+
+if __name__ == "__main__":
+    from tornado.options import define, options, parse_command_line
+    define("port", default=DEFAULT_AGENT_PORT, help="The port the agent listens on")
+    define("token", default=None, help="Token to accept instead of reading %s" % TOKEN_FILE)
+    define("wait_for", default=None, help="Only wait for host:port to accept connections, e.g. in a unit's "
+                                          "ExecStartPost, and exit with 1 if it does not within --wait_timeout")
+    define("wait_timeout", default=85, help="Seconds to wait for --wait_for")
+    parse_command_line()
+    if options.wait_for:
+        raise SystemExit(0 if wait_for_port(options.wait_for, options.wait_timeout) else 1)
+
+    agent = WorkerAgent(token=options.token)
+    make_app(agent).listen(options.port)
+    agent.sample_cpu()
+    PeriodicCallback(agent.sample_cpu, 1e3 * CPU_SAMPLE_INTERVAL).start()
+    try:
+        IOLoop.current().start()
+    except KeyboardInterrupt:
+        pass
@@ -11,10 +11,12 @@ not being Python 3 compatible
 """
 import json
 import argparse
+import binascii
 import boto3
 import json
 import logging
 import os
+import re
 import sys
 from time import sleep
 from botocore.exceptions import ClientError, WaiterError
@@ -61,7 +63,8 @@ def launch_manager(config):
 
     # Launch the manager
     logger.info("Launching manager instance")
-    instance = launch_server(config, ec2, [manager_security_group.id, manager_security_group2.id])
+    instance = launch_server(config, ec2, [manager_security_group.id, manager_security_group2.id],
+                             volume_type=config.manager_ebs_type)
 
     # Add server tags
     availability_zone = public_subnet.availability_zone
@@ -87,6 +90,7 @@ def launch_manager(config):
 
     # These parameters will be used by the manager to launch a worker
     worker_server_name = "JUPYTER_HUB_%s_%s_WORKER" % (availability_zone.split("-")[-1], config.cluster_name)
+    worker_subnet_ids = [subnet_id for subnet_id in config.private_subnet_id.split(",") if subnet_id]
 
     server_params = {
         "REGION": config.region,
@@ -101,12 +105,46 @@ def launch_manager(config):
         "JUPYTER_CLUSTER": config.cluster_name,
         "INSTANCE_TYPE": config.worker_instance_type,
         "WORKER_EBS_SIZE": config.worker_ebs_size,
-        "SUBNET_ID": config.private_subnet_id,
+        "SUBNET_ID": worker_subnet_ids[0],
+        # workers are placed in whichever of these subnets (availability zones) has capacity, see placement.py
+        "WORKER_SUBNET_IDS": worker_subnet_ids,
         "JUPYTER_NOTEBOOK_TIMEOUT": int(config.jupyter_notebook_timeout),
         "JUPYTER_MANAGER_IP": instance.public_ip_address,
         "USER_HOME_EBS_SIZE": config.user_home_ebs_size,
         "MANAGER_IP_ADDRESS": str(instance.private_ip_address),
     }
+    # EBS settings of the workers' root and home volumes, instance profiles can override them (0 means the baseline)
+    server_params["ROOT_VOLUME"] = {"type": config.worker_ebs_type, "iops": int(config.worker_ebs_iops),
+                                    "throughput": int(config.worker_ebs_throughput)}
+    server_params["HOME_VOLUME"] = {"type": config.user_home_ebs_type, "iops": int(config.user_home_ebs_iops),
+                                    "throughput": int(config.user_home_ebs_throughput)}
+    # mount the instance store of instance types that have one at /mnt, see jupyterhub_files/mount_scratch.sh
+    server_params["WORKER_SCRATCH"] = config.worker_scratch == "true"
+    if config.worker_fallback_instance_types:
+        server_params["FALLBACK_INSTANCE_TYPES"] = [t for t in config.worker_fallback_instance_types.split(",") if t]
+    if config.worker_spot == "true":
+        # workers run as one-time Spot instances, trying these types in order before falling back to on-demand
+        server_params["SPOT_ENABLED"] = True
+        server_params["SPOT_INSTANCE_TYPES"] = [t for t in config.worker_spot_instance_types.split(",") if t]
+    if config.worker_notebook_unit == "true":
+        # the worker AMI has the jupyter-singleuser@ unit, see jupyterhub_files/jupyter-singleuser@.service
+        server_params["NOTEBOOK_UNIT"] = True
+    # a database shared with other managers of this cluster, see jupyterhub_files/models.py and leader.py
+    if config.tracking_db_url:
+        server_params["TRACKING_DB_URL"] = config.tracking_db_url
+    if config.hub_db_url:
+        server_params["HUB_DB_URL"] = config.hub_db_url
+    if config.spawner_mode == "packed":
+        # users share larger workers, with their homes on an NFS (e.g. EFS) export, see jupyterhub_files/packing.py
+        server_params["SPAWNER_MODE"] = "packed"
+        server_params["PACKED_INSTANCE_TYPE"] = config.packed_instance_type
+        server_params["PACKED_HOME_NFS"] = config.packed_home_nfs
+    # instances that grading.py launches to autograde submissions in parallel
+    server_params["GRADER_INSTANCE_TYPE"] = config.grader_instance_type or config.worker_instance_type
+    if config.worker_agent == "true":
+        # per-worker agent tokens are derived from this secret, see jupyterhub_files/worker_agent.py
+        server_params["WORKER_AGENT_SECRET"] = binascii.b2a_hex(os.urandom(16)).decode()
+        server_params["WORKER_AGENT_PORT"] = 4445
 
     # Setup the common files and settings between manager and worker.
     setup_manager(server_params, config, instance.private_ip_address)
@@ -168,7 +206,8 @@ def setup_manager(server_params,config, manager_ip_address):
 
 def make_worker_ami(config, ec2, security_group_list):
     """ Sets up worker components, runs before jupyterhub setup, after common setup. """
-    instance = launch_server(config, ec2, security_group_list, size=int(config.worker_ebs_size))
+    instance = launch_server(config, ec2, security_group_list, size=int(config.worker_ebs_size),
+                             volume_type=config.worker_ebs_type)
     instance.wait_until_exists()
     instance.wait_until_running()
 
@@ -201,6 +240,25 @@ def make_worker_ami(config, ec2, security_group_list):
     # register Python 3 and 2 kernel
     sudo("python3 -m ipykernel install")
     sudo("python2 -m ipykernel install")
+
+    # Install the worker agent; user_data_worker.sh writes its token and enables it on each worker.
+    put("jupyterhub_files/worker_agent.py", remote_path="/var/tmp/")
+    put("jupyterhub_files/jupyter-worker-agent.service", remote_path="/var/tmp/")
+    sudo("mkdir -p /opt/jupyter_worker_agent")
+    sudo("cp /var/tmp/worker_agent.py /opt/jupyter_worker_agent/worker_agent.py")
+    sudo("cp /var/tmp/jupyter-worker-agent.service /etc/systemd/system/jupyter-worker-agent.service")
+    # Install the unit the spawner runs each notebook under; it writes the unit's environment file per user.
+    put("jupyterhub_files/jupyter-singleuser@.service", remote_path="/var/tmp/")
+    sudo("cp /var/tmp/jupyter-singleuser@.service /etc/systemd/system/jupyter-singleuser@.service")
+    sudo("mkdir -p -m 700 /etc/jupyter_singleuser")
+    # The disk benchmark, run through the agent or by hand, and the unit that mounts the instance store at /mnt.
+    put("jupyterhub_files/io_benchmark.py", remote_path="/var/tmp/")
+    put("jupyterhub_files/mount_scratch.sh", remote_path="/var/tmp/")
+    put("jupyterhub_files/jupyter-scratch.service", remote_path="/var/tmp/")
+    sudo("cp /var/tmp/io_benchmark.py /var/tmp/mount_scratch.sh /opt/jupyter_worker_agent/")
+    sudo("cp /var/tmp/jupyter-scratch.service /etc/systemd/system/jupyter-scratch.service")
+    # shared workers mount the users' homes over NFS, mount_scratch.sh stripes several instance store disks
+    sudo("apt-get -qq -y install -q nfs-common mdadm")
     sudo("chmod 755 /mnt")
     sudo("chown ubuntu /mnt")
 
@@ -297,14 +355,13 @@ def create_server_security_groups():
     return worker_security_group, manager_security_group, manager_security_group2
 
 
-def launch_server(config, ec2, security_groups_list, size=8):
+def launch_server(config, ec2, security_groups_list, size=8, volume_type="gp3"):
     # if we need more storage, these are parameters for BlockDeviceMappings. AWS default for EBS-backed instances is 8GB.
     # Specifying a smaller volume size requires a custom AMI of that particular size, or AWS will throw an error.
     boot_drive = {'DeviceName': '/dev/sda1',  # this is to be the boot drive
                   'Ebs': {'VolumeSize': size,  # size in gigabytes
                           'DeleteOnTermination': True,
-                          'VolumeType': 'gp2',  # This means General Purpose SSD
-                          # 'Iops': 1000 }  # i/o speed for storage, default is 100, more is faster
+                          'VolumeType': volume_type,  # gp3 gives 3000 IOPS and 125 MiB/s at any size, without credits
                           }
                   }
     reservation = retry(
@@ -368,6 +425,85 @@ def validate_config():
                 exit()
 
 
+def check_capacity():
+    """ Checks that the account's vCPU quota and the worker subnets' free IP addresses can hold CLASS_SIZE workers
+        of WORKER_INSTANCE_TYPE running at once (plus the manager), so that a class does not find out at its first
+        lecture. The hub checks again before each launch, see jupyterhub_files/capacity.py. """
+    class_size = int(config.class_size)
+    if class_size <= 0:
+        return
+    if config.spawner_mode == "packed":
+        print("Not checking the capacity for %d users, packed workers are shared" % class_size)
+        return
+    ec2 = ec2_connection(config.region)
+    instance_types = {config.worker_instance_type, config.manager_instance_type}
+    vcpus = {description["InstanceType"]: description["VCpuInfo"]["DefaultVCpus"]
+             for description in ec2.describe_instance_types(InstanceTypes=list(instance_types))["InstanceTypes"]}
+    worker_class = vcpu_quota_class(config.worker_instance_type)
+    needed = class_size * vcpus[config.worker_instance_type]
+    if vcpu_quota_class(config.manager_instance_type) == worker_class:
+        needed += vcpus[config.manager_instance_type]
+    problems = []
+    try:
+        limit = vcpu_quota(config.region, worker_class)
+    except ClientError as e:
+        limit = None
+        logger.warning("Could not read the EC2 vCPU quota, not checking it: %s", e)
+    if limit is not None:
+        in_use = 0
+        for page in ec2.get_paginator("describe_instances").paginate(
+                Filters=[{"Name": "instance-state-name", "Values": ["pending", "running"]}]):
+            for reservation in page["Reservations"]:
+                for instance in reservation["Instances"]:
+                    if (vcpu_quota_class(instance["InstanceType"]) == worker_class
+                            and instance.get("InstanceLifecycle") != "spot"):
+                        in_use += instance["CpuOptions"]["CoreCount"] * instance["CpuOptions"]["ThreadsPerCore"]
+        if in_use + needed > limit:
+            problems.append("%d %s workers need %d vCPUs, but the account's on-demand %s vCPU quota is %d and %d "
+                            "are in use. Request a quota increase or choose a smaller instance type"
+                            % (class_size, config.worker_instance_type, needed, worker_class, limit, in_use))
+    subnet_ids = [subnet_id for subnet_id in config.private_subnet_id.split(",") if subnet_id]
+    free_addresses = sum(subnet["AvailableIpAddressCount"]
+                         for subnet in ec2.describe_subnets(SubnetIds=subnet_ids)["Subnets"])
+    if free_addresses < class_size:
+        problems.append("the worker subnets %s have %d free IP addresses for %d workers. Add (or enlarge) subnets"
+                        % (", ".join(subnet_ids), free_addresses, class_size))
+    if problems:
+        print("The cluster cannot hold a class of %d users:\n  %s\n"
+              '(You can override this check with "--class_size 0")' % (class_size, "\n  ".join(problems)))
+        exit()
+    logger.info("capacity checked: %d workers need %d vCPUs and %d IP addresses", class_size, needed, class_size)
+
+
+# on-demand vCPU quota codes (Service Quotas) of the EC2 instance family classes, the other families are "Standard"
+VCPU_QUOTA_CODES = {"Standard": "L-1216C47A", "G": "L-DB2E81BA", "P": "L-417A185B", "X": "L-7295265B",
+                    "F": "L-74FC7D96", "Inf": "L-1945791B"}
+FAMILY_QUOTA_CLASSES = {"g": "G", "vt": "G", "p": "P", "x": "X", "f": "F", "inf": "Inf"}
+
+
+def vcpu_quota_class(instance_type):
+    family = re.match(r"[a-z]+", instance_type).group(0)
+    return FAMILY_QUOTA_CLASSES.get(family, "Standard")
+
+
+def vcpu_quota(region, quota_class):
+    """ The account's on-demand vCPU limit for quota_class, or None if it is not known. """
+    if quota_class not in VCPU_QUOTA_CODES:
+        return None
+    if AWS_ACCESS_KEY_ID:
+        quotas = boto3.client("service-quotas", region_name=region, aws_access_key_id=AWS_ACCESS_KEY_ID,
+                              aws_secret_access_key=AWS_SECRET_KEY)
+    else:
+        quotas = boto3.client("service-quotas", region_name=region)
+    try:
+        return quotas.get_service_quota(ServiceCode="ec2", QuotaCode=VCPU_QUOTA_CODES[quota_class])["Quota"]["Value"]
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "NoSuchResourceException":
+            raise
+        return quotas.get_aws_default_service_quota(
+            ServiceCode="ec2", QuotaCode=VCPU_QUOTA_CODES[quota_class])["Quota"]["Value"]
+
+
 def retry(function, *args, **kwargs):
     """ Retries a function up to max_retries, waiting `timeout` seconds between tries.
         This function is designed to retry both boto3 and fabric calls.  In the
@@ -393,11 +529,13 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Launches a JupyterHub cluster")
     parser.add_argument("cluster_name", help="the name of the cluster, used for tagging aws resources")
     parser.add_argument("base_ami", help="the AWS base AMI id used for user servers")
-    parser.add_argument("private_subnet_id", help="the AWS id of the private subnet for user servers")
+    parser.add_argument("private_subnet_id", help="the AWS id of the private subnet for user servers, or a "
+                        "comma-separated list of private subnets in different availability zones")
     parser.add_argument("public_subnet_id", help="the AWS id of the public subnet for manager server(s)")
     for item, default in CONFIG_DEFAULTS.items():
         flag = "--%s" % item.lower()
         parser.add_argument(flag, help="defaults to %s" % default, default=default)
     config = parser.parse_args()
     validate_config()
+    check_capacity()
     launch_manager(config)
@@ -0,0 +1,9 @@
+""" The hub's modules are deployed flat into /etc/jupyterhub, so tests import them from jupyterhub_files directly. The
+    tracking database is a scratch SQLite file, see models.tracking_database_url(). """
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "jupyterhub_files"))
+os.environ.setdefault("TRACKING_DB_URL", "sqlite:///%s" % os.path.join(tempfile.mkdtemp(), "tracking.sqlite3"))
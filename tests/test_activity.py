@@ -0,0 +1,95 @@
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+
+import activity
+from activity import ActivityCollector, IdlePolicy
+
+NOW = datetime(2024, 3, 1, 12, 0, 0)
+HOUR = 3600
+
+
+def kernels(state, last_activity):
+    return {"kernels": [{"id": "k", "execution_state": state, "last_activity": last_activity.isoformat() + "Z"}],
+            "last_activity": last_activity.isoformat() + "Z"}
+
+
+def test_idle_kernels_do_not_cull_a_user_active_in_the_hub():
+    policy = IdlePolicy(HOUR)
+    should_cull, _ = policy.should_cull(NOW - timedelta(minutes=5),
+                                        {"kernels": kernels("idle", NOW - timedelta(hours=3))}, now=NOW)
+    assert not should_cull
+
+
+def test_culls_once_kernels_and_hub_activity_are_both_old():
+    policy = IdlePolicy(HOUR)
+    should_cull, reason = policy.should_cull(NOW - timedelta(hours=2),
+                                             {"kernels": kernels("idle", NOW - timedelta(hours=3))}, now=NOW)
+    assert should_cull
+    assert "kernels idle" in reason
+
+
+def test_recent_kernel_activity_or_a_busy_kernel_keeps_a_server():
+    policy = IdlePolicy(HOUR)
+    old = NOW - timedelta(hours=2)
+    assert not policy.should_cull(old, {"kernels": kernels("idle", NOW - timedelta(minutes=1))}, now=NOW)[0]
+    assert not policy.should_cull(old, {"kernels": kernels("busy", old)}, now=NOW)[0]
+
+
+def test_sustained_cpu_keeps_a_server():
+    policy = IdlePolicy(HOUR, cpu_threshold=5.0)
+    old = NOW - timedelta(hours=2)
+    assert not policy.should_cull(old, {"cpu": 40.0}, now=NOW)[0]
+    assert policy.should_cull(old, {"cpu": 1.0}, now=NOW)[0]
+    assert policy.should_cull(old, {"cpu": None}, now=NOW)[0]
+
+
+class FakeCloudWatch(object):
+
+    def __init__(self, datapoints):
+        self.datapoints = datapoints  # [(minutes ago, average)]
+
+    def get_metric_data(self, MetricDataQueries, EndTime, **kwargs):
+        timestamps = [(EndTime - timedelta(minutes=ago)).replace(tzinfo=timezone.utc) for ago, _ in self.datapoints]
+        return {"MetricDataResults": [{"Id": query["Id"], "Timestamps": timestamps,
+                                       "Values": [value for _, value in self.datapoints]}
+                                      for query in MetricDataQueries]}
+
+
+def cpu_of(monkeypatch, datapoints):
+    monkeypatch.setattr(activity.boto3, "client", lambda *args, **kwargs: FakeCloudWatch(datapoints))
+    collector = ActivityCollector("us-east-1", cpu_window=HOUR, cpu_recent=900, cpu_period=300)
+    return collector._get_metric_data(["i-1"])["i-1"]
+
+
+def test_one_busy_period_an_hour_ago_is_not_sustained_cpu(monkeypatch):
+    sustained, peak = cpu_of(monkeypatch, [(50, 90.0), (10, 1.0), (5, 1.0), (0, 2.0)])
+    assert sustained == 1.0
+    assert peak == 90.0
+
+
+def test_cpu_is_sustained_when_every_recent_period_is_busy(monkeypatch):
+    sustained, _ = cpu_of(monkeypatch, [(30, 1.0), (10, 30.0), (5, 25.0), (0, 60.0)])
+    assert sustained == 25.0
+
+
+def test_no_recent_datapoints_means_unknown_cpu(monkeypatch):
+    sustained, peak = cpu_of(monkeypatch, [(45, 80.0)])
+    assert sustained is None
+    assert peak == 80.0
+
+
+def test_slow_metric_queries_are_collected(monkeypatch):
+    class SlowCloudWatch(FakeCloudWatch):
+        def get_metric_data(self, **kwargs):
+            time.sleep(0.05)  # the IOLoop is waiting by the time the query returns
+            return FakeCloudWatch.get_metric_data(self, **kwargs)
+
+    monkeypatch.setattr(activity.boto3, "client", lambda *args, **kwargs: SlowCloudWatch([(0, 50.0)]))
+    collector = ActivityCollector("us-east-1")
+
+    async def collect():
+        return await asyncio.wait_for(collector.get_cpu_utilization({"ann": {"instance_id": "i-1"}}), timeout=5)
+    started = time.time()
+    assert asyncio.run(collect())["i-1"] == (50.0, 50.0)
+    assert time.time() - started < 2  # not only once something else woke the IOLoop
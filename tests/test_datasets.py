@@ -0,0 +1,90 @@
+import pytest
+
+from datasets import DatasetVolumes, DATASET_DEVICE
+from models import DatasetVersion, DatasetVolume
+
+
+@pytest.fixture(autouse=True)
+def no_versions():
+    DatasetVersion.delete().execute()
+    DatasetVolume.delete().execute()
+
+
+class FakeWaiter(object):
+
+    def wait(self, **kwargs):
+        pass
+
+
+class FakeEC2(object):
+    """ An instance with the dataset volume vol-old attached. """
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        def call(**kwargs):
+            self.calls.append(name)
+            return {"VolumeId": "vol-new"} if name == "create_volume" else {}
+        return call
+
+    def get_waiter(self, name):
+        return FakeWaiter()
+
+    def describe_instances(self, InstanceIds):
+        self.calls.append("describe_instances")
+        return {"Reservations": [{"Instances": [{
+            "InstanceId": InstanceIds[0], "Placement": {"AvailabilityZone": "us-east-1a"},
+            "BlockDeviceMappings": [{"DeviceName": DATASET_DEVICE, "Ebs": {"VolumeId": "vol-old"}}]}]}]}
+
+
+def volumes_with(ec2):
+    volumes = DatasetVolumes("us-east-1")
+    volumes._client = lambda: ec2
+    return volumes
+
+
+def test_the_latest_publish_is_the_current_version():
+    assert DatasetVolumes("us-east-1").launch_mapping() == (None, None)
+    DatasetVersion.publish("snap-1")
+    DatasetVersion.publish("snap-2")
+    DatasetVersion.publish("snap-1")  # publishing an older snapshot again
+    mapping, version = DatasetVolumes("us-east-1").launch_mapping()
+    assert version == 3
+    assert mapping["DeviceName"] == DATASET_DEVICE
+    assert mapping["Ebs"]["SnapshotId"] == "snap-1"
+    assert mapping["Ebs"]["DeleteOnTermination"]
+
+
+def test_a_worker_with_the_current_version_is_left_alone():
+    DatasetVersion.publish("snap-1")
+    DatasetVolume.set_volume("i-1", "vol-old", 1)
+    ec2 = FakeEC2()
+    assert volumes_with(ec2)._update("i-1") == 1
+    assert ec2.calls == []
+
+
+def test_a_worker_with_an_older_version_gets_a_new_volume():
+    DatasetVersion.publish("snap-1")
+    DatasetVersion.publish("snap-2")
+    DatasetVolume.set_volume("i-1", "vol-old", 1)
+    ec2 = FakeEC2()
+    assert volumes_with(ec2)._update("i-1") == 2
+    assert ["create_volume", "detach_volume", "delete_volume", "attach_volume"] == [
+        call for call in ec2.calls if call.endswith("_volume")]
+    record = DatasetVolume.get_volume("i-1")
+    assert (record.volume_id, record.version) == ("vol-new", 2)
+
+
+def test_a_failed_attach_deletes_the_new_volume():
+    DatasetVersion.publish("snap-1")
+    ec2 = FakeEC2()
+
+    def attach_volume(**kwargs):
+        raise IOError("attach failed")
+
+    ec2.attach_volume = attach_volume
+    with pytest.raises(IOError):
+        volumes_with(ec2)._update("i-1")
+    assert ec2.calls.count("delete_volume") == 2  # the old volume, then the new one
+    assert DatasetVolume.get_volume("i-1") is None
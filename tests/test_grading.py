@@ -0,0 +1,97 @@
+import sys
+import threading
+from collections import deque
+
+from grading import GradingScheduler, Job, run_job
+
+
+class ScriptedBackend(object):
+    """ Graders whose results are decided by fail(grader, job, attempt); records where each job ran. """
+
+    def __init__(self, graders, fail=lambda grader, job, attempt: None):
+        self.graders = graders
+        self.fail = fail
+        self.runs = []
+        self.lock = threading.Lock()
+
+    def slots(self):
+        return [(grader, 0) for grader in self.graders]
+
+    def run(self, slot, job, timeout):
+        with self.lock:
+            self.runs.append((job.student, slot[0]))
+        failure = self.fail(slot[0], job, job.attempts)
+        if isinstance(failure, Exception):
+            raise failure
+        if failure:
+            return {"status": failure, "log": "it broke"}
+        return {"status": "graded", "scores": []}
+
+
+def schedule(backend, students, attempts=3, on_result=None):
+    jobs = [Job("ps1", student) for student in students]
+    scheduler = GradingScheduler(backend, timeout=10, attempts=attempts, on_result=on_result,
+                                 report=lambda message: None)
+    return jobs, scheduler.run(jobs)
+
+
+def test_every_job_is_graded_and_merged():
+    merged = []
+    backend = ScriptedBackend(["g1", "g2"])
+    jobs, summary = schedule(backend, ["s%02d" % i for i in range(20)], on_result=lambda job, result: merged.append(
+        job.student))
+    assert summary["graded"] == 20 and summary["failed"] == [] and summary["retries"] == 0
+    assert sorted(merged) == [job.student for job in jobs]
+
+
+def test_a_failed_job_is_retried_on_another_grader():
+    backend = ScriptedBackend(["g1", "g2"], fail=lambda grader, job, attempt: "failed" if grader == "g1" else None)
+    jobs, summary = schedule(backend, ["ann"])
+    assert summary["graded"] == 1 and summary["retries"] == 1
+    assert backend.runs == [("ann", "g1"), ("ann", "g2")]
+    assert jobs[0].avoid == {"g1"}
+
+
+def test_a_job_that_keeps_failing_is_given_up_after_its_attempts():
+    backend = ScriptedBackend(["g1", "g2"], fail=lambda grader, job, attempt: (
+        RuntimeError("ssh down") if job.student == "bob" else None))
+    jobs, summary = schedule(backend, ["ann", "bob"], attempts=2)
+    assert summary["graded"] == 1
+    assert summary["failed"] == ["bob"]
+    bob = [job for job in jobs if job.student == "bob"][0]
+    assert bob.attempts == 2
+    assert bob.result["status"] == "error" and "ssh down" in bob.result["log"]
+
+
+def test_a_job_whose_merge_fails_is_not_counted_as_graded():
+    def on_result(job, result):
+        if job.student == "bob":
+            raise IOError("gradebook locked")
+
+    backend = ScriptedBackend(["g1"])
+    jobs, summary = schedule(backend, ["ann", "bob"], on_result=on_result)
+    assert summary["graded"] == 1
+    assert summary["failed"] == ["bob"]
+    assert "gradebook locked" in jobs[1].result["log"]
+    assert len(backend.runs) == 2  # a failed merge is not retried
+
+
+def test_a_slot_takes_a_job_that_did_not_fail_on_its_grader():
+    scheduler = GradingScheduler(ScriptedBackend(["g1"]))
+    failed_here, fresh = Job("ps1", "ann"), Job("ps1", "bob")
+    failed_here.avoid.add("g1")
+    queue = deque([failed_here, fresh])
+    assert scheduler._take(queue, ("g1", 0)) is fresh
+    assert scheduler._take(queue, ("g1", 0)) is failed_here  # rather than leaving the slot idle
+
+
+def test_run_job_reports_failures_and_kills_jobs_past_the_timeout(tmp_path):
+    def scores(job_dir, assignment, student):
+        return [{"notebook": "ps1", "cell": "q1", "auto_score": 1.0, "max_score": 1.0}]
+
+    graded = run_job(str(tmp_path), "ps1", "ann", 10, [sys.executable, "-c", "print('ok')"], scores)
+    assert graded["status"] == "graded" and graded["scores"][0]["auto_score"] == 1.0
+    failed = run_job(str(tmp_path), "ps1", "ann", 10, [sys.executable, "-c", "raise SystemExit('no')"], scores)
+    assert failed["status"] == "failed" and "no" in failed["log"]
+    hung = run_job(str(tmp_path), "ps1", "ann", 0.5, [sys.executable, "-c", "import time; time.sleep(30)"], scores)
+    assert hung["status"] == "timeout" and hung["seconds"] < 10
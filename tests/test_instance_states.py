@@ -0,0 +1,53 @@
+import asyncio
+import time
+
+from botocore.exceptions import EndpointConnectionError
+
+from instance_states import InstanceStateCache
+
+
+def test_lookups_fail_when_describe_cannot_reach_ec2():
+    cache = InstanceStateCache("us-east-1", window=0.01)
+
+    def unreachable(instance_ids):
+        raise EndpointConnectionError(endpoint_url="https://ec2.us-east-1.amazonaws.com")
+    cache._describe = unreachable
+
+    async def lookup():
+        return await asyncio.wait_for(asyncio.gather(cache.get(["i-1"]), cache.get(["i-2"]), return_exceptions=True),
+                                      timeout=5)
+    results = asyncio.run(lookup())
+    assert all(isinstance(result, EndpointConnectionError) for result in results)
+
+
+def test_lookups_are_batched_and_cached():
+    cache = InstanceStateCache("us-east-1", window=0.01)
+    calls = []
+
+    def describe(instance_ids):
+        calls.append(sorted(instance_ids))
+        return [{"InstanceId": "i-1", "State": {"Name": "running"}}]
+    cache._describe = describe
+
+    async def lookup():
+        first = await asyncio.gather(cache.get(["i-1"]), cache.get(["i-2"]))
+        second = await cache.get(["i-1"])
+        return first, second
+    first, second = asyncio.run(lookup())
+    assert calls == [["i-1", "i-2"]]
+    assert first[0]["i-1"]["State"]["Name"] == "running"
+    assert first[1]["i-2"]["State"]["Name"] == "terminated"
+    assert second["i-1"]["State"]["Name"] == "running"
+
+
+def test_a_slow_describe_wakes_the_waiting_lookups():
+    cache = InstanceStateCache("us-east-1", window=0.01)
+
+    def describe(instance_ids):
+        time.sleep(0.05)  # done on the executor's thread after the IOLoop went back to waiting
+        return [{"InstanceId": "i-1", "State": {"Name": "running"}}]
+    cache._describe = describe
+
+    async def lookup():
+        return await asyncio.wait_for(cache.state("i-1"), timeout=5)
+    assert asyncio.run(lookup()) == "running"
@@ -0,0 +1,46 @@
+import datetime
+
+from leader import LeaderElection
+from models import Lease
+
+
+def expire(name):
+    Lease.update(expires_at=datetime.datetime.now() - datetime.timedelta(seconds=1)).where(Lease.name == name).execute()
+
+
+def test_only_one_process_leads_until_its_lease_expires():
+    events = []
+    first = LeaderElection("culler-expiry", ttl=60, holder="first", on_deposed=lambda: events.append("first deposed"))
+    second = LeaderElection("culler-expiry", ttl=60, holder="second",
+                            on_elected=lambda: events.append("second elected"))
+    assert first.renew()
+    assert not second.renew()
+    assert first.renew()  # renewing keeps the lease
+
+    expire("culler-expiry")
+    assert second.renew()
+    assert not first.renew()
+    assert Lease.holder_of("culler-expiry") == "second"
+    assert events == ["second elected", "first deposed"]
+
+
+def test_stopping_hands_the_lease_over():
+    first = LeaderElection("culler-stop", holder="first")
+    second = LeaderElection("culler-stop", holder="second")
+    assert first.renew()
+    first.stop()
+    assert Lease.holder_of("culler-stop") is None
+    assert second.renew()
+
+
+def test_a_leader_that_cannot_reach_the_database_steps_down(monkeypatch):
+    deposed = []
+    election = LeaderElection("culler-db-down", holder="first", on_deposed=lambda: deposed.append(True))
+    assert election.renew()
+
+    def unreachable(*args):
+        raise IOError("database unreachable")
+
+    monkeypatch.setattr(Lease, "acquire", unreachable)
+    assert not election.renew()
+    assert deposed == [True]
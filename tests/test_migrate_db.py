@@ -0,0 +1,47 @@
+from migrate_db import copy_table
+from models import MODELS, Server, Lease, open_database
+
+
+def open_sqlite(tmp_path, name):
+    return open_database("sqlite:///%s" % (tmp_path / name))
+
+
+def test_every_table_is_copied(tmp_path):
+    source, target = open_sqlite(tmp_path, "source.sqlite3"), open_sqlite(tmp_path, "target.sqlite3")
+    with source.bind_ctx(MODELS):
+        for model in MODELS:
+            model.create_table(True)
+        for i in range(1200):  # more than one batch
+            Server.new_server("i-%04d" % i, "user%04d" % i)
+
+    copied = {model: copy_table(model, source, target) for model in MODELS}
+
+    assert copied[Server] == 1200
+    assert copied[Lease] == 0
+    with target.bind_ctx([Server]):
+        assert Server.select().count() == 1200
+        assert Server.get_server("user0042").server_id == "i-0042"
+
+
+def test_tables_with_rows_are_only_replaced_when_asked(tmp_path):
+    source, target = open_sqlite(tmp_path, "source.sqlite3"), open_sqlite(tmp_path, "target.sqlite3")
+    with source.bind_ctx([Server]):
+        Server.create_table(True)
+        Server.new_server("i-new", "alice")
+    with target.bind_ctx([Server]):
+        Server.create_table(True)
+        Server.new_server("i-old", "alice")
+
+    assert copy_table(Server, source, target) is None
+    with target.bind_ctx([Server]):
+        assert Server.get_server("alice").server_id == "i-old"
+
+    assert copy_table(Server, source, target, replace=True) == 1
+    with target.bind_ctx([Server]):
+        assert Server.get_server("alice").server_id == "i-new"
+
+
+def test_tables_missing_from_the_source_are_created_empty(tmp_path):
+    source, target = open_sqlite(tmp_path, "source.sqlite3"), open_sqlite(tmp_path, "target.sqlite3")
+    assert copy_table(Lease, source, target) == 0
+    assert target.table_exists(Lease._meta.table_name)
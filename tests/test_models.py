@@ -0,0 +1,15 @@
+from models import Server, SpotUsage, HomeVolume, DatasetVolume
+
+
+def test_remove_terminated_cleans_up_after_the_instance():
+    Server.new_server("i-gone", "alice", market="spot")
+    SpotUsage.start("i-gone", "alice", "t3.medium", 0.01, 0.04)
+    HomeVolume.new_volume("alice", "vol-home", "us-east-1a", instance_id="i-gone")
+    DatasetVolume.set_volume("i-gone", "vol-data", 1)
+
+    Server.remove_terminated("i-gone")
+
+    assert Server.get_or_none(Server.server_id == "i-gone") is None
+    assert SpotUsage.get(SpotUsage.instance_id == "i-gone").ended_at is not None
+    assert HomeVolume.get_volume("alice").instance_id is None
+    assert DatasetVolume.get_volume("i-gone") is None
@@ -0,0 +1,165 @@
+import asyncio
+import json
+
+import pytest
+from tornado import gen
+
+from instance_profiles import InstanceProfiles
+from roster import AuthCache, Roster, UserlistFile
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def attached_roster(entries):
+    roster = Roster(lambda: None)
+    roster.apply(entries)
+    whitelist, admin, admin_changes = {"added-in-the-hub"}, set(), []
+    roster.attach(whitelist, admin, admin_changes.append)
+    return roster, whitelist, admin, admin_changes
+
+
+def test_a_sync_applies_only_the_difference():
+    roster, whitelist, admin, admin_changes = attached_roster({"ann": False, "bob": True, "cat": False})
+    added, removed, changed = roster.apply({"ann": True, "cat": False, "dan": False})
+    assert (added, removed, changed) == ({"dan"}, {"bob"}, {"ann"})
+    assert whitelist == {"added-in-the-hub", "ann", "cat", "dan"}
+    assert admin == {"ann"}
+    assert admin_changes == [{"ann": True, "bob": False, "dan": False}]
+
+
+def test_an_unchanged_roster_changes_nothing():
+    roster, whitelist, admin, admin_changes = attached_roster({"ann": False, "bob": True})
+    assert roster.apply({"ann": False, "bob": True}) == (set(), set(), set())
+    assert admin_changes == []
+
+
+def test_a_source_returning_nobody_is_ignored():
+    results = iter([{"ann": True}, {}])
+    roster = Roster(lambda: next(results))
+    roster.load()
+
+    async def test():
+        await roster.sync()
+
+    asyncio.run(test())
+    assert roster.entries == {"ann": True}
+    assert roster.admin == {"ann"}
+    assert roster.metrics()["failures"] == 1
+
+
+def test_the_userlist_file_is_only_read_when_it_changes(tmp_path):
+    path = tmp_path / "userlist"
+    path.write_text("ann admin\nbob\n\n")
+    changes = []
+    source = UserlistFile(str(path), on_change=changes.append)
+    assert source() == {"ann": True, "bob": False}
+    assert source() is None
+    path.write_text("ann admin\nbob group=instructors\ncat\n")
+    assert source() == {"ann": True, "bob": False, "cat": False}
+    assert len(changes) == 2
+    assert changes[-1]["bob"] == {"admin": False, "group": "instructors"}
+
+
+def test_profile_groups_follow_the_userlist(tmp_path):
+    path = tmp_path / "userlist"
+    path.write_text("ann\n")
+    profiles_file = tmp_path / "instance_profiles.json"
+    profiles_file.write_text(json.dumps({"default": "small", "profiles": {"small": {"instance_type": "t3.small"},
+                                                                          "large": {"instance_type": "t3.xlarge"}},
+                                         "groups": {"instructors": ["large", "small"]}}))
+    profiles = InstanceProfiles("t3.small", profiles_file=str(profiles_file), userlist_file=str(path))
+    source = UserlistFile(str(path), on_change=profiles.set_users)
+    source()
+    assert profiles.allowed_profiles("ann") == ["small"]
+    path.write_text("ann group=instructors\n")
+    source()
+    assert profiles.allowed_profiles("ann") == ["large", "small"]
+
+
+class Directory(object):
+
+    def __init__(self):
+        self.lookups = 0
+
+    @gen.coroutine
+    def authenticate(self, handler, data):
+        self.lookups += 1
+        yield gen.sleep(0.01)
+        return {"name": data["username"]} if data["password"] == "right" else None
+
+
+def login(cache, directory, password):
+    return cache.authenticate(directory.authenticate, None, {"username": "ann", "password": password})
+
+
+def test_logins_are_cached_until_the_ttl_expires():
+    directory, clock = Directory(), Clock()
+    cache = AuthCache(ttl=300)
+    cache.cache.clock = clock
+
+    async def test():
+        assert (await login(cache, directory, "right")) == {"name": "ann"}
+        clock.now = 299
+        assert (await login(cache, directory, "right")) == {"name": "ann"}
+        assert directory.lookups == 1
+        clock.now = 301
+        await login(cache, directory, "right")
+        assert directory.lookups == 2
+
+    asyncio.run(test())
+
+
+def test_failed_logins_are_cached_for_a_shorter_time():
+    directory, clock = Directory(), Clock()
+    cache = AuthCache(ttl=300)
+    cache.cache.clock = clock
+
+    async def test():
+        assert (await login(cache, directory, "wrong")) is None
+        clock.now = 29
+        assert (await login(cache, directory, "wrong")) is None
+        assert directory.lookups == 1
+        clock.now = 31
+        assert (await login(cache, directory, "wrong")) is None
+        assert directory.lookups == 2
+        # a failure does not hide the right password
+        assert (await login(cache, directory, "right")) == {"name": "ann"}
+
+    asyncio.run(test())
+
+
+def test_concurrent_logins_share_a_lookup_and_get_their_own_result():
+    directory = Directory()
+    cache = AuthCache()
+
+    async def test():
+        results = await asyncio.gather(*[login(cache, directory, "right") for _ in range(5)])
+        results[0]["admin"] = True
+        assert results[1] == {"name": "ann"}
+        assert cache.metrics()["shared"] == 4
+
+    asyncio.run(test())
+    assert directory.lookups == 1
+
+
+def test_logins_without_a_password_are_not_cached():
+    calls = []
+    cache = AuthCache()
+
+    def authenticate(handler, data):
+        calls.append(data)
+        return "ann"
+
+    async def test():
+        for _ in range(2):
+            assert (await cache.authenticate(authenticate, None, {"username": "ann"})) == "ann"
+
+    asyncio.run(test())
+    assert len(calls) == 2
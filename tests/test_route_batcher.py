@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+from tornado import gen
+
+from route_batcher import RouteBatcher, RouteSuperseded, ADD, DELETE
+
+
+def batcher_applying_to(applied, **kwargs):
+    @gen.coroutine
+    def apply(operation, routespec, target, data):
+        applied.append((operation, routespec, target))
+    return RouteBatcher(apply, window=0.01, **kwargs)
+
+
+def test_changes_in_a_window_are_applied_together():
+    applied = []
+
+    async def test():
+        batcher = batcher_applying_to(applied)
+        await asyncio.gather(batcher.add("/user/a", "http://a"), batcher.add("/user/b", "http://b"),
+                             batcher.delete("/user/c"))
+        assert batcher.metrics()["flushes"] == 1
+
+    asyncio.run(test())
+    assert sorted(applied) == [(ADD, "/user/a", "http://a"), (ADD, "/user/b", "http://b"), (DELETE, "/user/c", None)]
+
+
+def test_repeated_adds_wait_for_the_last_one():
+    applied = []
+
+    async def test():
+        batcher = batcher_applying_to(applied)
+        await asyncio.gather(batcher.add("/user/a", "http://old"), batcher.add("/user/a", "http://new"))
+
+    asyncio.run(test())
+    assert applied == [(ADD, "/user/a", "http://new")]
+
+
+def test_an_add_undone_by_a_delete_fails():
+    applied = []
+
+    async def test():
+        batcher = batcher_applying_to(applied)
+        added = batcher.add("/user/a", "http://a")
+        deleted = batcher.delete("/user/a")
+        await deleted
+        with pytest.raises(RouteSuperseded):
+            await added
+
+    asyncio.run(test())
+    assert applied == [(DELETE, "/user/a", None)]
+
+
+def test_a_failed_change_fails_its_callers():
+    @gen.coroutine
+    def apply(operation, routespec, target, data):
+        raise IOError("proxy down")
+
+    async def test():
+        batcher = RouteBatcher(apply, window=0.01)
+        with pytest.raises(IOError):
+            await batcher.add("/user/a", "http://a")
+        assert batcher.metrics()["failed"] == 1
+
+    asyncio.run(test())
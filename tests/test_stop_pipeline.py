@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+from botocore.exceptions import EndpointConnectionError
+
+from instance_states import InstanceStateCache
+from stop_pipeline import StopFailed, StopPipeline
+
+
+def pipeline_with(call, describe):
+    instance_states = InstanceStateCache("us-east-1", window=0.01)
+    instance_states._describe = describe
+    pipeline = StopPipeline("us-east-1", instance_states, window=0.01, poll_interval=0.01)
+    pipeline._call = call
+    return pipeline
+
+
+def test_a_stop_that_cannot_reach_ec2_fails_and_can_be_requested_again():
+    calls = []
+
+    def call(action, instance_ids):
+        calls.append(instance_ids)
+        if len(calls) == 1:
+            raise EndpointConnectionError(endpoint_url="https://ec2.us-east-1.amazonaws.com")
+
+    def describe(instance_ids):
+        return [{"InstanceId": instance_id, "State": {"Name": "stopped"}} for instance_id in instance_ids]
+
+    pipeline = pipeline_with(call, describe)
+
+    async def test():
+        with pytest.raises(StopFailed):
+            await asyncio.wait_for(asyncio.gather(pipeline.stop("ann", "i-1"), pipeline.stop("bob", "i-2")), 5)
+        assert pipeline.in_flight == {} and pipeline.pending("ann") is None
+        return await asyncio.wait_for(pipeline.stop("ann", "i-1"), 5)
+
+    assert asyncio.run(test()) == "stopped"
+    assert calls == [["i-1", "i-2"], ["i-1"]]
+    assert pipeline.metrics()["failed"] == 2
+
+
+def test_stops_are_batched_and_followed_until_stopped():
+    calls, states = [], {"i-1": "stopping", "i-2": "stopping"}
+
+    def call(action, instance_ids):
+        calls.append((action, sorted(instance_ids)))
+
+    def describe(instance_ids):
+        descriptions = [{"InstanceId": instance_id, "State": {"Name": states[instance_id]}}
+                        for instance_id in instance_ids]
+        states.update({instance_id: "stopped" for instance_id in states})
+        return descriptions
+
+    pipeline = pipeline_with(call, describe)
+
+    async def test():
+        return await asyncio.wait_for(asyncio.gather(pipeline.stop("ann", "i-1"), pipeline.stop("bob", "i-2")), 5)
+
+    assert asyncio.run(test()) == ["stopped", "stopped"]
+    assert calls == [("stop", ["i-1", "i-2"])]
@@ -0,0 +1,155 @@
+import asyncio
+import json
+
+import pytest
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+
+import worker_agent
+from worker_agent import WorkerAgent, WorkerAgentClient, WorkerAgentError, make_app
+
+
+class SlowAgent(WorkerAgent):
+    OPERATIONS = WorkerAgent.OPERATIONS + ("slow",)
+
+    @gen.coroutine
+    def slow(self, seconds):
+        yield gen.sleep(seconds)
+        return "slow"
+
+
+def serve(agent, test):
+    """ Runs test(port) against agent, serving on a free local port. """
+    async def main():
+        socket, port = bind_unused_port()
+        server = HTTPServer(make_app(agent))
+        server.add_sockets([socket])
+        try:
+            return await test(port)
+        finally:
+            server.stop()
+    return asyncio.run(main())
+
+
+def with_agent(test, tmp_path):
+    """ Runs test(port) against a ready agent that accepts the token "test". """
+    marker = tmp_path / "ready"
+    marker.write_text("")
+    return serve(SlowAgent(token="test", ready_marker=str(marker)), test)
+
+
+def test_channel_round_trip(tmp_path):
+    async def test(port):
+        client = WorkerAgentClient("127.0.0.1", port, "test")
+        try:
+            # a port no process's command line mentions, unlike e.g. 1
+            return await client.call("ready"), await client.call("notebook_status", port=65531)
+        finally:
+            client.close()
+    ready, status = with_agent(test, tmp_path=tmp_path)
+    assert ready == {"ready": True}
+    assert status == {"running": False, "pids": []}
+
+
+def test_channel_reports_failed_operations(tmp_path):
+    async def test(port):
+        client = WorkerAgentClient("127.0.0.1", port, "test")
+        try:
+            with pytest.raises(WorkerAgentError, match="unknown operation"):
+                await client.call("rm_rf")
+            with pytest.raises(WorkerAgentError, match="TypeError"):
+                await client.call("slow", minutes=1)
+            return await client.call("ready")  # the channel is still usable
+        finally:
+            client.close()
+    assert with_agent(test, tmp_path=tmp_path) == {"ready": True}
+
+
+def test_wrong_token_is_rejected(tmp_path):
+    async def test(port):
+        client = WorkerAgentClient("127.0.0.1", port, "not the token")
+        with pytest.raises(WorkerAgentError, match="could not connect"):
+            await client.call("ready")
+        with pytest.raises(HTTPClientError) as error:
+            await AsyncHTTPClient().fetch("http://127.0.0.1:%s/api/ready" % port, method="POST", body="{}",
+                                          headers={"Authorization": "token not the token"})
+        return error.value.code
+    assert with_agent(test, tmp_path=tmp_path) == 403
+
+
+def test_agent_without_token_refuses_everything(tmp_path):
+    async def test(port):
+        response = await AsyncHTTPClient().fetch("http://127.0.0.1:%s/api/ready" % port, method="POST", body="{}",
+                                                 headers={"Authorization": "token "}, raise_error=False)
+        return response.code
+    agent = WorkerAgent(token_file=str(tmp_path / "missing-token"), ready_marker=str(tmp_path / "ready"))
+    assert serve(agent, test) == 403
+
+
+def test_channel_runs_operations_concurrently(tmp_path):
+    async def test(port):
+        client = WorkerAgentClient("127.0.0.1", port, "test")
+        finished = []
+
+        async def call(operation, **args):
+            result = await client.call(operation, **args)
+            finished.append(operation)
+            return result
+        try:
+            slow = asyncio.ensure_future(call("slow", seconds=1.0))
+            await asyncio.sleep(0.1)  # the slow operation is sent, and running, first
+            ready = await asyncio.wait_for(call("ready"), timeout=0.5)
+            await slow
+        finally:
+            client.close()
+        return finished, ready
+    finished, ready = with_agent(test, tmp_path=tmp_path)
+    assert finished == ["ready", "slow"]
+    assert ready == {"ready": True}
+
+
+def test_http_endpoint_runs_operations(tmp_path):
+    async def test(port):
+        response = await AsyncHTTPClient().fetch("http://127.0.0.1:%s/api/ready" % port, method="POST", body="{}",
+                                                 headers={"Authorization": "token test"})
+        return json.loads(response.body)
+    assert with_agent(test, tmp_path=tmp_path) == {"ready": True}
+
+
+def test_the_notebook_command_is_built_by_the_agent():
+    command = worker_agent.notebook_command("ann", "10.0.0.5", 8888, [
+        "--debug", "--port=22", "--ip=0.0.0.0", "--SingleUserNotebookApp.default_url=/lab"])
+    assert command == ["jupyterhub-singleuser", "--ip=10.0.0.5", "--port=8888", "--user=ann",
+                       "--notebook-dir=/home/ann/", "--debug", "--SingleUserNotebookApp.default_url=/lab",
+                       "--allow-root"]
+    assert "--allow-root" not in worker_agent.notebook_command("ann", "127.0.0.1", 8888, as_root=False)
+
+
+@pytest.mark.parametrize("user, ip, args", [
+    ("../root", "127.0.0.1", []),
+    ("ann", "127.0.0.1; reboot", []),
+    ("ann", "127.0.0.1", ["--NotebookApp.terminado_settings={'shell_command': ['sh']}"]),
+    ("ann", "127.0.0.1", ["--debug; reboot"]),
+])
+def test_unsafe_notebook_commands_are_refused(user, ip, args):
+    with pytest.raises(WorkerAgentError):
+        worker_agent.notebook_command(user, ip, 8888, args)
+
+
+def test_the_notebook_environment_cannot_run_other_code():
+    env = worker_agent.notebook_environment({"JUPYTERHUB_API_TOKEN": "t", "LD_PRELOAD": "/tmp/x.so",
+                                             "PYTHONSTARTUP": "/tmp/x.py", "PATH": "/tmp/bin", "PORT": 8888})
+    assert env == {"JUPYTERHUB_API_TOKEN": "t", "PORT": "8888", "PATH": worker_agent.NOTEBOOK_PATH}
+
+
+def test_an_invalid_user_writes_no_environment_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(worker_agent, "NOTEBOOK_ENV_FILE", str(tmp_path / "%s.env"))
+
+    async def test():
+        with pytest.raises(WorkerAgentError):
+            await WorkerAgent(None).notebook_unit_start("../../etc/cron.d/x", {}, 8888)
+
+    asyncio.run(test())
+    assert list(tmp_path.iterdir()) == []